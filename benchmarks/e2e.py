@@ -0,0 +1,252 @@
+"""プロキシのエンドツーエンドのベンチマーク
+
+偽のllama.cppサーバーとプロキシを起動し、エンドポイント・ストリーミングの有無・並行数の
+組み合わせごとに負荷をかけて、結果をJSONに書き出す。同じ負荷を偽のサーバーへ直接送った
+結果との差を、プロキシによるレイテンシの増加分とする。
+
+    python -m benchmarks.e2e --output results.json
+    python -m benchmarks.e2e --output current.json --compare baseline.json --threshold 0.1
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+from dataclasses import asdict
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from benchmarks.fake_llamacpp import FakeServerSettings
+from benchmarks.load import Scenario, run_scenario, summarize
+
+API_KEY = "benchmark"
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHAT_TEMPLATE = os.path.join(ROOT, "mixtral-template-wo-bos.jinja")
+
+# 比較する指標と、値が大きいほど悪いか
+COMPARED_METRICS = {
+    "throughput_rps": False,
+    "added_latency_ms.p50": True,
+    "added_latency_ms.p99": True,
+    "ttft_overhead_ms.p50": True,
+    "cpu_ms_per_request": True,
+}
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_until_ready(url: str, process: subprocess.Popen, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Process exited with {process.returncode} before {url} became ready")
+        try:
+            if httpx.get(url, timeout=1.0).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"Timed out waiting for {url}")
+
+
+def start_fake_server(settings: FakeServerSettings, port: int) -> subprocess.Popen:
+    process = subprocess.Popen(
+        [
+            sys.executable, "-m", "benchmarks.fake_llamacpp",
+            "--port", str(port),
+            "--tokens-per-second", str(settings.tokens_per_second),
+            "--ttft", str(settings.ttft),
+            "--slots", str(settings.slots),
+            "--n-ctx", str(settings.n_ctx),
+            "--error-rate", str(settings.error_rate),
+            "--default-tokens", str(settings.default_tokens),
+        ],
+        cwd=ROOT,
+    )
+    _wait_until_ready(f"http://127.0.0.1:{port}/health", process)
+    return process
+
+
+def start_proxy(upstream: str, port: int, proxy_args: List[str]) -> subprocess.Popen:
+    env = {**os.environ, "LLAMACPP_PROXY_UNLIMITED_API_KEY": API_KEY}
+    process = subprocess.Popen(
+        [
+            sys.executable, "-c", "from llamacpp_proxy.main import main; main()",
+            "--host", "127.0.0.1",
+            "--port", str(port),
+            "--llamacpp-server", upstream,
+            "--chat-template-jinja", CHAT_TEMPLATE,
+            *proxy_args,
+        ],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    _wait_until_ready(f"http://127.0.0.1:{port}/metrics", process)
+    return process
+
+
+def _stop(process: Optional[subprocess.Popen]) -> None:
+    if process is None or process.poll() is not None:
+        return
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+async def run_benchmarks(
+    scenarios: List[Scenario],
+    fake_url: str,
+    proxy_url: str,
+    proxy_pid: int,
+    warmup: int,
+) -> List[Dict[str, Any]]:
+    results = []
+    for scenario in scenarios:
+        if warmup:
+            await run_scenario(
+                proxy_url, Scenario(scenario.endpoint, scenario.stream, scenario.concurrency, warmup), API_KEY
+            )
+        direct = await run_scenario(fake_url, scenario, direct=True)
+        proxy = await run_scenario(proxy_url, scenario, API_KEY, pid=proxy_pid)
+        summary = summarize(scenario, proxy, direct)
+        print(_format_summary(summary), flush=True)
+        results.append(summary)
+    return results
+
+
+def _format_summary(summary: Dict[str, Any]) -> str:
+    added = summary.get("added_latency_ms", {})
+    text = (
+        f"{summary['name']:<28} {summary['throughput_rps']:>8} req/s  "
+        f"added p50={added.get('p50')}ms p99={added.get('p99')}ms  "
+        f"cpu={summary['cpu_ms_per_request']}ms/req  rss={summary['max_rss_mb']}MB  errors={summary['errors']}"
+    )
+    if summary["stream"]:
+        text += f"  ttft overhead p50={summary['ttft_overhead_ms']['p50']}ms"
+    return text
+
+
+def _metric(summary: Dict[str, Any], path: str) -> Optional[float]:
+    value: Any = summary
+    for key in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value if isinstance(value, (int, float)) else None
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], threshold: Optional[float]) -> List[str]:
+    """同じ名前のシナリオの指標を比較して表示し、threshold（割合）を超えて悪化した指標を返す"""
+    regressions = []
+    baseline_scenarios = {summary["name"]: summary for summary in baseline["scenarios"]}
+    for summary in current["scenarios"]:
+        previous = baseline_scenarios.get(summary["name"])
+        if previous is None:
+            continue
+        for path, higher_is_worse in COMPARED_METRICS.items():
+            old, new = _metric(previous, path), _metric(summary, path)
+            if old is None or new is None:
+                continue
+            change = (new - old) / abs(old) if old else 0.0
+            worse = change > 0 if higher_is_worse else change < 0
+            marker = ""
+            if threshold is not None and worse and abs(change) > threshold:
+                marker = "  REGRESSION"
+                regressions.append(f"{summary['name']} {path}")
+            print(f"{summary['name']:<28} {path:<24} {old:>10} -> {new:>10} ({change:+.1%}){marker}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of llamacpp-proxy against a fake llama.cpp server")
+    parser.add_argument("--output", default="benchmark-results.json", help="JSON file to write the results to")
+    parser.add_argument("--endpoints", default="completions,chat", help="Comma separated: completions,chat")
+    parser.add_argument("--modes", default="block,stream", help="Comma separated: block,stream")
+    parser.add_argument("--concurrency", default="1,8,32", help="Comma separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario")
+    parser.add_argument("--warmup", type=int, default=20, help="Warm-up requests per scenario (not measured)")
+    parser.add_argument("--max-tokens", type=int, default=32)
+    parser.add_argument("--tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--ttft", type=float, default=0.02)
+    parser.add_argument("--slots", type=int, default=64, help="Keep above the concurrency to measure the proxy only")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--proxy-arg", action="append", default=[], help="Extra argument for the proxy (repeatable)")
+    parser.add_argument("--compare", help="Baseline JSON to compare against")
+    parser.add_argument("--threshold", type=float, help="Exit with 1 if a metric regresses by more than this fraction")
+    args = parser.parse_args()
+
+    fake_settings = FakeServerSettings(
+        tokens_per_second=args.tokens_per_second,
+        ttft=args.ttft,
+        slots=args.slots,
+        error_rate=args.error_rate,
+        default_tokens=args.max_tokens,
+    )
+    scenarios = [
+        Scenario(endpoint, mode == "stream", int(concurrency), args.requests, args.max_tokens)
+        for endpoint in args.endpoints.split(",")
+        for mode in args.modes.split(",")
+        for concurrency in args.concurrency.split(",")
+    ]
+
+    fake_port, proxy_port = _free_port(), _free_port()
+    fake = proxy = None
+    try:
+        fake = start_fake_server(fake_settings, fake_port)
+        proxy = start_proxy(f"http://127.0.0.1:{fake_port}", proxy_port, args.proxy_arg)
+        results = asyncio.run(
+            run_benchmarks(
+                scenarios,
+                f"http://127.0.0.1:{fake_port}",
+                f"http://127.0.0.1:{proxy_port}",
+                proxy.pid,
+                args.warmup,
+            )
+        )
+    finally:
+        _stop(proxy)
+        _stop(fake)
+
+    commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": commit,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "fake_server": asdict(fake_settings),
+            "proxy_args": args.proxy_arg,
+            "requests": args.requests,
+            "warmup": args.warmup,
+        },
+        "scenarios": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report, args.threshold)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
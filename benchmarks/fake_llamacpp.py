@@ -0,0 +1,145 @@
+"""ベンチマーク用の偽のllama.cppサーバー
+
+/completions（ストリーミング・非ストリーミング）、/v1/embeddings、/props、/tokenize、/healthを実装し、
+最初のトークンまでの時間・生成速度・スロット数・エラーの発生率を設定できる。
+
+    python -m benchmarks.fake_llamacpp --port 18080 --tokens-per-second 100 --ttft 0.05 --slots 4
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+@dataclass
+class FakeServerSettings:
+    tokens_per_second: float = 100.0  # 生成速度
+    ttft: float = 0.05  # プロンプト処理にかかる時間（秒）
+    slots: int = 4  # 同時に生成できるリクエスト数。超えた分はスロットが空くまで待つ
+    n_ctx: int = 4096
+    error_rate: float = 0.0  # 500を返す割合
+    default_tokens: int = 32  # n_predictが指定されていない場合に生成するトークン数
+    token: str = "tok "  # 1トークンとして返す文字列
+    embedding_dim: int = 8  # 返す埋め込みの次元数
+
+
+def create_app(settings: FakeServerSettings) -> FastAPI:
+    app = FastAPI()
+    slots = asyncio.Semaphore(settings.slots)
+
+    def tokens_to_generate(body: Dict[str, Any]) -> int:
+        n_predict = body.get("n_predict")
+        if n_predict is None or n_predict < 0:
+            return settings.default_tokens
+        return n_predict
+
+    def final_event(body: Dict[str, Any], n: int, prompt_ms: float, predicted_ms: float) -> Dict[str, Any]:
+        return {
+            "content": "",
+            "stop": True,
+            "stop_type": "limit",
+            "tokens_predicted": n,
+            "tokens_evaluated": len(str(body.get("prompt", "")).split()),
+            "timings": {"prompt_ms": prompt_ms, "predicted_ms": predicted_ms, "predicted_n": n},
+        }
+
+    @app.get("/health")
+    async def health():
+        return {"status": "ok"}
+
+    @app.get("/props")
+    async def props():
+        return {"total_slots": settings.slots, "default_generation_settings": {"n_ctx": settings.n_ctx}}
+
+    @app.post("/tokenize")
+    async def tokenize(request: Request):
+        body = await request.json()
+        return {"tokens": list(range(len(str(body.get("content", "")).split())))}
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        inputs = body.get("input", [])
+        inputs = inputs if isinstance(inputs, list) else [inputs]
+        async with slots:
+            await asyncio.sleep(settings.ttft)
+        # 入力ごとに決まった値を返す
+        data = [
+            {
+                "object": "embedding",
+                "index": i,
+                "embedding": [random.Random(f"{value}-{d}").uniform(-1, 1) for d in range(settings.embedding_dim)],
+            }
+            for i, value in enumerate(inputs)
+        ]
+        tokens = sum(len(value) if isinstance(value, list) else len(str(value).split()) for value in inputs)
+        return {"object": "list", "data": data, "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+
+    @app.post("/completions")
+    async def completions(request: Request):
+        body = await request.json()
+        if settings.error_rate and random.random() < settings.error_rate:
+            return JSONResponse({"error": {"code": 500, "message": "injected error"}}, status_code=500)
+        n = tokens_to_generate(body)
+
+        if not body.get("stream"):
+            async with slots:
+                started = time.perf_counter()
+                await asyncio.sleep(settings.ttft)
+                prompt_ms = (time.perf_counter() - started) * 1000
+                await asyncio.sleep(n / settings.tokens_per_second)
+                predicted_ms = (time.perf_counter() - started) * 1000 - prompt_ms
+            return {**final_event(body, n, prompt_ms, predicted_ms), "content": settings.token * n}
+
+        async def events() -> AsyncIterator[bytes]:
+            async with slots:
+                started = time.perf_counter()
+                await asyncio.sleep(settings.ttft)
+                first = time.perf_counter()
+                # 遅れが積み重ならないよう、開始時刻からの予定時刻に合わせて送る
+                for i in range(n):
+                    delay = first + (i + 1) / settings.tokens_per_second - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    yield b"data: " + json.dumps({"content": settings.token, "stop": False}).encode() + b"\n\n"
+                prompt_ms = (first - started) * 1000
+                predicted_ms = (time.perf_counter() - first) * 1000
+            yield b"data: " + json.dumps(final_event(body, n, prompt_ms, predicted_ms)).encode() + b"\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake llama.cpp server for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--tokens-per-second", type=float, default=100.0)
+    parser.add_argument("--ttft", type=float, default=0.05, help="Prompt processing time in seconds")
+    parser.add_argument("--slots", type=int, default=4)
+    parser.add_argument("--n-ctx", type=int, default=4096)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of completions that return 500")
+    parser.add_argument("--default-tokens", type=int, default=32)
+    args = parser.parse_args()
+
+    settings = FakeServerSettings(
+        tokens_per_second=args.tokens_per_second,
+        ttft=args.ttft,
+        slots=args.slots,
+        n_ctx=args.n_ctx,
+        error_rate=args.error_rate,
+        default_tokens=args.default_tokens,
+    )
+    uvicorn.run(create_app(settings), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""ベンチマークの負荷生成と集計"""
+import asyncio
+import json
+import math
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+CHAT_PATH = "/v1/chat/completions"
+COMPLETIONS_PATH = "/v1/completions"
+DIRECT_PATH = "/completions"  # 偽のllama.cppサーバーへ直接送る場合
+
+
+@dataclass
+class Scenario:
+    endpoint: str  # "completions" / "chat"
+    stream: bool
+    concurrency: int
+    requests: int
+    max_tokens: int = 32
+
+    @property
+    def name(self) -> str:
+        return f"{self.endpoint}-{'stream' if self.stream else 'block'}-c{self.concurrency}"
+
+
+@dataclass
+class Sample:
+    status: int
+    latency: float  # 秒。ストリーミングは最後のチャンクまで
+    ttft: Optional[float] = None  # ストリーミングの最初のトークンまでの秒数
+    error: str = ""
+
+
+@dataclass
+class RunResult:
+    samples: List[Sample]
+    wall_time: float
+    cpu_seconds: Optional[float] = None  # 計測したプロセスのCPU時間
+    max_rss_bytes: Optional[int] = None
+
+
+def build_request(scenario: Scenario, index: int, direct: bool) -> Tuple[str, Dict[str, Any]]:
+    """シナリオのindex番目のリクエストの(パス, JSON)を返す
+
+    プロンプトごとに内容を変え、プロキシのキャッシュや同一リクエストの共有が効かないようにする。
+    """
+    prompt = f"Benchmark request {index}: write a short story about the number {index}."
+    if direct:
+        return DIRECT_PATH, {"prompt": prompt, "n_predict": scenario.max_tokens, "stream": scenario.stream}
+    if scenario.endpoint == "chat":
+        return CHAT_PATH, {
+            "model": "bench",
+            "messages": [{"role": "user", "content": prompt}],
+            "max_tokens": scenario.max_tokens,
+            "stream": scenario.stream,
+        }
+    return COMPLETIONS_PATH, {
+        "model": "bench",
+        "prompt": prompt,
+        "max_tokens": scenario.max_tokens,
+        "stream": scenario.stream,
+    }
+
+
+def _has_token(data: bytes) -> bool:
+    """SSEのdataが生成されたテキストを含むか（OpenAI形式とllama.cpp形式の両方）"""
+    if data == b"[DONE]":
+        return False
+    event = json.loads(data)
+    if "choices" in event:
+        for choice in event["choices"]:
+            if choice.get("text") or (choice.get("delta") or {}).get("content"):
+                return True
+        return False
+    return bool(event.get("content"))
+
+
+async def _send(client: httpx.AsyncClient, path: str, body: Dict[str, Any], stream: bool) -> Sample:
+    started = time.perf_counter()
+    try:
+        if not stream:
+            response = await client.post(path, json=body)
+            return Sample(status=response.status_code, latency=time.perf_counter() - started)
+        ttft = None
+        async with client.stream("POST", path, json=body) as response:
+            async for line in response.aiter_lines():
+                if ttft is None and line.startswith("data: ") and _has_token(line[6:].encode()):
+                    ttft = time.perf_counter() - started
+            return Sample(status=response.status_code, latency=time.perf_counter() - started, ttft=ttft)
+    except httpx.HTTPError as e:
+        return Sample(status=0, latency=time.perf_counter() - started, error=type(e).__name__)
+
+
+async def run_scenario(
+    base_url: str,
+    scenario: Scenario,
+    api_key: str = "",
+    direct: bool = False,
+    pid: Optional[int] = None,
+) -> RunResult:
+    """scenario.concurrency個の並行クライアントでscenario.requests件のリクエストを送る
+
+    pidを指定した場合は、そのプロセス（と子プロセス）のCPU時間と最大RSSを計測する。
+    """
+    headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+    limits = httpx.Limits(max_connections=scenario.concurrency, max_keepalive_connections=scenario.concurrency)
+    samples: List[Sample] = []
+    next_index = 0
+
+    async with httpx.AsyncClient(base_url=base_url, headers=headers, limits=limits, timeout=300.0) as client:
+
+        async def worker():
+            nonlocal next_index
+            while next_index < scenario.requests:
+                index = next_index
+                next_index += 1
+                path, body = build_request(scenario, index, direct)
+                samples.append(await _send(client, path, body, scenario.stream))
+
+        cpu_before = process_cpu_seconds(pid) if pid else None
+        max_rss = [process_rss_bytes(pid) if pid else None]
+        sampler = asyncio.create_task(_sample_rss(pid, max_rss)) if pid else None
+        started = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(scenario.concurrency)])
+        wall_time = time.perf_counter() - started
+        if sampler is not None:
+            sampler.cancel()
+        cpu_after = process_cpu_seconds(pid) if pid else None
+
+    cpu = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+    return RunResult(samples=samples, wall_time=wall_time, cpu_seconds=cpu, max_rss_bytes=max_rss[0])
+
+
+async def _sample_rss(pid: int, max_rss: List[Optional[int]], interval: float = 0.1) -> None:
+    while True:
+        rss = process_rss_bytes(pid)
+        if rss is not None and (max_rss[0] is None or rss > max_rss[0]):
+            max_rss[0] = rss
+        await asyncio.sleep(interval)
+
+
+def _process_tree(pid: int) -> List[int]:
+    """pidとその子孫のプロセスID（uvicornのワーカーを含めるため）"""
+    pids = []
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        pids.append(current)
+        try:
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except OSError:
+            continue
+    return pids
+
+
+def process_cpu_seconds(pid: int) -> Optional[float]:
+    """プロセス（ワーカーを含む）のユーザー+システムCPU時間"""
+    total = 0.0
+    ticks = os.sysconf("SC_CLK_TCK")
+    try:
+        for current in _process_tree(pid):
+            with open(f"/proc/{current}/stat") as f:
+                # commに空白が含まれる場合があるため、")"の後ろから数える
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += (int(fields[11]) + int(fields[12])) / ticks
+    except (OSError, IndexError, ValueError):
+        return None
+    return total
+
+
+def process_rss_bytes(pid: int) -> Optional[int]:
+    """プロセス（ワーカーを含む）の常駐メモリの合計"""
+    total = 0
+    try:
+        for current in _process_tree(pid):
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        return None
+    return total
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    """p50/p95/p99（ミリ秒）。最近傍法で求める"""
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    ordered = sorted(values)
+
+    def at(q: float) -> float:
+        index = max(0, math.ceil(q * len(ordered)) - 1)
+        return round(ordered[index] * 1000, 3)
+
+    return {"p50": at(0.50), "p95": at(0.95), "p99": at(0.99)}
+
+
+def _difference(a: Dict[str, Optional[float]], b: Dict[str, Optional[float]]) -> Dict[str, Optional[float]]:
+    return {
+        key: round(a[key] - b[key], 3) if a[key] is not None and b[key] is not None else None
+        for key in a
+    }
+
+
+def summarize(scenario: Scenario, proxy: RunResult, direct: Optional[RunResult] = None) -> Dict[str, Any]:
+    """シナリオの結果をJSONに書き出す形に集計する
+
+    directを指定した場合は、同じ負荷を偽のサーバーへ直接送った結果との差をプロキシによる増加分とする。
+    """
+    ok = [sample for sample in proxy.samples if sample.status == 200]
+    latency = percentiles([sample.latency for sample in ok])
+    summary: Dict[str, Any] = {
+        "name": scenario.name,
+        "endpoint": scenario.endpoint,
+        "stream": scenario.stream,
+        "concurrency": scenario.concurrency,
+        "requests": len(proxy.samples),
+        "errors": len(proxy.samples) - len(ok),
+        "throughput_rps": round(len(ok) / proxy.wall_time, 3) if proxy.wall_time else None,
+        "latency_ms": latency,
+        "cpu_ms_per_request": (
+            round(proxy.cpu_seconds * 1000 / len(proxy.samples), 3)
+            if proxy.cpu_seconds is not None and proxy.samples else None
+        ),
+        "max_rss_mb": round(proxy.max_rss_bytes / 2**20, 1) if proxy.max_rss_bytes is not None else None,
+    }
+    if scenario.stream:
+        summary["ttft_ms"] = percentiles([sample.ttft for sample in ok if sample.ttft is not None])
+    if direct is not None:
+        direct_ok = [sample for sample in direct.samples if sample.status == 200]
+        direct_latency = percentiles([sample.latency for sample in direct_ok])
+        summary["direct_latency_ms"] = direct_latency
+        summary["added_latency_ms"] = _difference(latency, direct_latency)
+        if scenario.stream:
+            direct_ttft = percentiles([sample.ttft for sample in direct_ok if sample.ttft is not None])
+            summary["direct_ttft_ms"] = direct_ttft
+            summary["ttft_overhead_ms"] = _difference(summary["ttft_ms"], direct_ttft)
+    return summary
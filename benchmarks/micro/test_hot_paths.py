@@ -0,0 +1,155 @@
+"""リクエストごとに実行される関数のマイクロベンチマーク
+
+エンドツーエンドの計測ではノイズに埋もれる小さな性能の悪化を検出するため、
+pytest-benchmarkで計測し、保存したベースラインと比較する（README参照）。
+"""
+import json
+import os
+import time
+
+import pytest
+from fastapi import Response
+
+from llamacpp_proxy.api.completion import process_logprobs
+from llamacpp_proxy.config.rate_limit import RateLimitSettings
+from llamacpp_proxy.config.settings import Settings
+from llamacpp_proxy.middleware.auth import get_api_key
+from llamacpp_proxy.middleware.rate_limit import RateLimiter
+from llamacpp_proxy.models.chat import ChatCompletionResponse, CompletionChoice, Message
+from llamacpp_proxy.models.completion import CompletionResponse, CompletionResponseChoice
+from llamacpp_proxy.services.json_codec import json_response
+from llamacpp_proxy.services.key_store import ApiKey, KeyStore
+from llamacpp_proxy.services.streaming import get_finish_reason
+from llamacpp_proxy.services.template import TemplateService
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+USAGE = {"prompt_tokens": 100, "completion_tokens": 200, "total_tokens": 300}
+
+
+def run_coroutine(coroutine):
+    """awaitしないコルーチンをイベントループなしで実行する"""
+    try:
+        coroutine.send(None)
+    except StopIteration as e:
+        return e.value
+    raise RuntimeError("coroutine awaited")
+
+
+def test_process_logprobs(benchmark):
+    top_n = 20
+    probs = [
+        {
+            "token": f"token{i}",
+            "logprob": -0.1 * (i % 10),
+            "top_logprobs": [{"token": f"alt{j}", "logprob": -0.5 * j} for j in range(top_n)],
+        }
+        for i in range(1000)
+    ]
+    logprobs = benchmark(process_logprobs, probs, top_n)
+    assert len(logprobs.tokens) == 1000
+
+
+@pytest.mark.parametrize("choice", [
+    {"stop_type": "eos"},
+    {"stop_type": "limit"},
+    {"truncated": True, "stop_type": "word"},
+], ids=["eos", "limit", "truncated"])
+def test_get_finish_reason(benchmark, choice):
+    assert benchmark(get_finish_reason, choice) is not None
+
+
+def test_template_render_long_history(benchmark):
+    with open(os.path.join(ROOT, "mixtral-template-wo-bos.jinja")) as f:
+        template = f.read()
+    service = TemplateService(Settings(llamacpp_server_url="http://localhost:8080", chat_template=template))
+    messages = [
+        Message(role="user" if i % 2 == 0 else "assistant", content=f"Message number {i}. " * 20)
+        for i in range(200)
+    ]
+    prompt = benchmark(service.render, messages)
+    assert "Message number 199" in prompt
+
+
+def test_rate_limit_check_large_store(benchmark):
+    settings = RateLimitSettings(limited_api_key="limited", window=60, max_requests=10**9, max_tokens_per_minute=10**9)
+    rate_limiter = RateLimiter(settings, clock=time.monotonic)
+    for i in range(9999):
+        rate_limiter.requests.acquire(f"key{i}", settings.max_requests, settings.window)
+        rate_limiter.tokens.charge(f"key{i}", settings.max_tokens_per_minute, 60.0, 10)
+    headers = benchmark(rate_limiter.check, ApiKey(id="limited", key_hash="0" * 64))
+    assert "X-RateLimit-Remaining" in headers
+
+
+def test_get_api_key(benchmark, tmp_path):
+    key_file = tmp_path / "keys.json"
+    key_file.write_text(json.dumps({"keys": [{"id": f"team{i}", "key": f"key{i}"} for i in range(10000)]}))
+    key_store = KeyStore(RateLimitSettings(unlimited_api_key="unlimited", key_file=str(key_file)))
+    api_key = benchmark(lambda: run_coroutine(get_api_key("Bearer key5000", key_store)))
+    assert api_key.id == "team5000"
+
+
+def test_completion_response_construction(benchmark):
+    def build():
+        return CompletionResponse(
+            id="cmpl-benchmark",
+            created=0,
+            model="model",
+            choices=[
+                CompletionResponseChoice(text="generated text " * 50, index=i, logprobs=None, finish_reason="stop")
+                for i in range(8)
+            ],
+            usage=USAGE,
+        )
+
+    assert len(benchmark(build).choices) == 8
+
+
+def test_chat_completion_response_construction(benchmark):
+    def build():
+        return ChatCompletionResponse(
+            id="chatcmpl-benchmark",
+            created=0,
+            model="model",
+            choices=[
+                CompletionChoice(
+                    index=i,
+                    message=Message(role="assistant", content="generated text " * 50),
+                    finish_reason="stop",
+                )
+                for i in range(8)
+            ],
+            usage=USAGE,
+        )
+
+    assert len(benchmark(build).choices) == 8
+
+
+def test_completion_response_logprobs_json(benchmark):
+    """検証を省いたモデルの生成からJSONへのシリアライズまで（エンドポイントと同じ経路）"""
+    top_n = 5
+    probs = [
+        {
+            "token": f"token{i}",
+            "logprob": -0.1 * (i % 10),
+            "top_logprobs": [{"token": f"alt{j}", "logprob": -0.5 * j} for j in range(top_n)],
+        }
+        for i in range(1000)
+    ]
+
+    def build():
+        return json_response(
+            CompletionResponse.model_construct(
+                id="cmpl-benchmark",
+                created=0,
+                model="model",
+                choices=[
+                    CompletionResponseChoice.model_construct(
+                        text="generated text " * 50, index=0, logprobs=process_logprobs(probs, top_n), finish_reason="stop"
+                    )
+                ],
+                usage=USAGE,
+            ),
+            Response(),
+        )
+
+    assert benchmark(build).status_code == 200
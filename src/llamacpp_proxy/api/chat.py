@@ -1,32 +1,77 @@
 import logging
 import time
 import uuid
-from fastapi import Depends, HTTPException
-from fastapi.responses import StreamingResponse
+from functools import partial
+from fastapi import Depends, HTTPException, Request, Response
 
 from llamacpp_proxy.models.chat import ChatCompletionRequest, ChatCompletionResponse, CompletionChoice, Message
+from llamacpp_proxy.config.routing import routing_settings
+from llamacpp_proxy.config.streaming import streaming_settings
+from llamacpp_proxy.services.admission import MAX_QUEUE_WAIT_HEADER, parse_max_queue_wait
+from llamacpp_proxy.services.grammar import GrammarCache, get_grammar_cache
+from llamacpp_proxy.services.disconnect import ClientDisconnected, cancel_on_disconnect
+from llamacpp_proxy.services.batch import expand_requests, gather_bounded, open_streams
 from llamacpp_proxy.services.llamacpp import LlamaCppClient
+from llamacpp_proxy.services.metrics import StreamTimer, metrics
+from llamacpp_proxy.services.json_codec import json_response
+from llamacpp_proxy.services.tracing import current_timing, phase
+from llamacpp_proxy.services.request_log import upstream_request_fields
+from llamacpp_proxy.services.response_cache import (
+    CACHE_HIT,
+    CACHE_STATUS_HEADER,
+    ResponseCache,
+    get_response_cache,
+    merge_cache_statuses,
+)
+from llamacpp_proxy.services.streaming import (
+    ChunkEncoder,
+    buffered_stream,
+    get_finish_reason,
+    openai_stream,
+    streaming_response,
+    translate_stream,
+)
 from llamacpp_proxy.services.template import TemplateService
+from llamacpp_proxy.services.affinity import chat_affinity_key
+from llamacpp_proxy.services.tokenizer import TokenCounter, get_token_counter, usage_from_choices
+from llamacpp_proxy.services.key_store import ApiKey
 from llamacpp_proxy.middleware.auth import get_api_key
+from llamacpp_proxy.middleware.rate_limit import RateLimiter, get_rate_limiter
 
 logger = logging.getLogger(__name__)
 
+# メトリクスのラベルに使うエンドポイント名
+ENDPOINT = "/v1/chat/completions"
+
+# 会話を識別するためのヘッダー。同じ会話は同じバックエンドのスロットへ送られる
+CONVERSATION_ID_HEADER = "X-Conversation-Id"
+
 async def chat_completions(
     request: ChatCompletionRequest,
-    api_key: str = Depends(get_api_key),
+    http_request: Request,
+    response: Response,
+    api_key: ApiKey = Depends(get_api_key),
     llamacpp_client: LlamaCppClient = Depends(),
+    response_cache: ResponseCache = Depends(get_response_cache),
+    rate_limiter: RateLimiter = Depends(get_rate_limiter),
+    token_counter: TokenCounter = Depends(get_token_counter),
+    grammar_cache: GrammarCache = Depends(get_grammar_cache),
     template_service: TemplateService = Depends(),
 ) -> ChatCompletionResponse:
     """チャット補完APIエンドポイント"""
     logger.info(f"Received request for model: {request.model}")
 
+    started = time.perf_counter()
     try:
+        # コンテキスト長の確認（設定によっては古いメッセージを削除する）
+        with phase("tokenize"):
+            messages = await token_counter.fit_messages(request.messages, request.max_tokens)
+
         # テンプレートのレンダリング
-        prompt = template_service.render(request.messages)
+        prompt = await template_service.render_async(messages)
 
         # llama.cppサーバーへのリクエスト
         llamacpp_request = {
-            "prompt": prompt,
             "temperature": request.temperature,
             "top_p": request.top_p,
             "n_predict": request.max_tokens,
@@ -34,48 +79,117 @@ async def chat_completions(
             "stream": request.stream,
         }
 
-        if request.llamacpp_proxy_grammar is not None:
-            llamacpp_request["grammar"] = request.llamacpp_proxy_grammar
+        if request.seed is not None:
+            llamacpp_request["seed"] = request.seed
+
+        # grammar・登録したgrammarのID・response_formatのいずれか（不正なら上流へ送らずに400）
+        grammar = await grammar_cache.resolve(
+            request.llamacpp_proxy_grammar, request.llamacpp_proxy_grammar_id, request.response_format
+        )
+        if grammar is not None:
+            llamacpp_request["grammar"] = grammar
+
+        # nの数だけリクエストを生成し、並行に処理する
+        llamacpp_requests = expand_requests(
+            llamacpp_request, [prompt], request.n or 1, routing_settings.max_batch_choices
+        )
+
+        # プロンプトとgrammarはフォーマッターが伏せ字にする（--log-capture-promptsで全文を記録する）
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Upstream request", extra={"fields": upstream_request_fields(llamacpp_requests)})
 
-        logger.info(f"{llamacpp_request=}")
+        affinity_key = chat_affinity_key(messages, http_request.headers.get(CONVERSATION_ID_HEADER))
+        priority = api_key.priority
+        max_queue_wait = parse_max_queue_wait(http_request.headers.get(MAX_QUEUE_WAIT_HEADER))
 
         if request.stream:
             # ストリーミングレスポンスの処理
-            response = await llamacpp_client.create_streaming_completion(llamacpp_request)
-            return StreamingResponse(response, media_type="text/event-stream")
+            # クライアントが待ちきれずに切断した場合は、待ち行列から外して上流への接続を閉じる
+            streams = await cancel_on_disconnect(
+                http_request,
+                open_streams(
+                    [
+                        partial(llamacpp_client.create_streaming_completion, r, affinity_key, priority, max_queue_wait)
+                        for r in llamacpp_requests
+                    ],
+                    routing_settings.batch_concurrency,
+                ),
+                ENDPOINT,
+            )
+            encoder = ChunkEncoder.for_chat(f"chatcmpl-{uuid.uuid4()}", int(time.time()), request.model)
+
+            timing = current_timing()
+
+            def charge(event):
+                tokens = event.get("tokens_predicted", 0)
+                rate_limiter.charge_tokens(api_key, tokens)
+                metrics.generated_tokens.inc(ENDPOINT, amount=tokens)
+                if timing is not None:
+                    timing.record_llamacpp(event)
+
+            stream = openai_stream([
+                translate_stream(s, encoder, i, charge, StreamTimer(ENDPOINT, started))
+                for i, s in enumerate(streams)
+            ])
+            return streaming_response(buffered_stream(stream, streaming_settings, ENDPOINT), response)
 
         # 非ストリーミングレスポンスの処理
-        llamacpp_response = await llamacpp_client.create_completion(llamacpp_request)
-        if not isinstance(llamacpp_response, list):
-            llamacpp_response = [llamacpp_response]
+        cache_control = http_request.headers.get("Cache-Control")
+        results = await cancel_on_disconnect(
+            http_request,
+            gather_bounded(
+                [
+                    partial(
+                        response_cache.fetch,
+                        r,
+                        partial(llamacpp_client.create_completion, r, affinity_key, priority, max_queue_wait),
+                        cache_control,
+                    )
+                    for r in llamacpp_requests
+                ],
+                routing_settings.batch_concurrency,
+            ),
+            ENDPOINT,
+        )
+        cache_status = merge_cache_statuses([status for _, status in results])
+        if cache_status is not None:
+            response.headers[CACHE_STATUS_HEADER] = cache_status
+        llamacpp_response = [choice for result, _ in results for choice in result]
+        generated_tokens = sum(
+            choice.get("tokens_predicted", 0)
+            for result, status in results
+            if status != CACHE_HIT
+            for choice in result
+        )
+        rate_limiter.charge_tokens(api_key, generated_tokens)
+        metrics.generated_tokens.inc(ENDPOINT, amount=generated_tokens)
 
         # レスポンスの内容をログに記録
-        logger.debug(f"Response: {llamacpp_response}")
-
-        # トークン使用量の計算（実装が必要）
-        prompt_tokens = 0  # TODO: implement token counting
-        completion_tokens = 0  # TODO: implement token counting
-        total_tokens = prompt_tokens + completion_tokens
-
-        return ChatCompletionResponse(
-            id=f"chatcmpl-{uuid.uuid4()}",
-            created=int(time.time()),
-            model=request.model,
-            choices=[
-                CompletionChoice(
-                    index=i,
-                    message=Message(role="assistant", content=choice["content"]),
-                    finish_reason="stop",  # TODO: implement proper finish reason
-                )
-                for i, choice in enumerate(llamacpp_response)
-            ],
-            usage={
-                "prompt_tokens": prompt_tokens,
-                "completion_tokens": completion_tokens,
-                "total_tokens": total_tokens,
-            },
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Upstream response", extra={"fields": {"choices": llamacpp_response}})
+
+        # プロキシ自身が組み立てる値なので検証せずにモデルを生成する
+        return json_response(
+            ChatCompletionResponse.model_construct(
+                id=f"chatcmpl-{uuid.uuid4()}",
+                created=int(time.time()),
+                model=request.model,
+                choices=[
+                    CompletionChoice.model_construct(
+                        index=i,
+                        message=Message.model_construct(role="assistant", content=choice["content"]),
+                        finish_reason=get_finish_reason(choice),
+                    )
+                    for i, choice in enumerate(llamacpp_response)
+                ],
+                usage=usage_from_choices(llamacpp_response, request.n or 1),
+            ),
+            response,
         )
 
     except Exception as e:
-        logger.error(f"Error in chat completion: {str(e)}")
+        if not isinstance(e, ClientDisconnected):
+            logger.error(f"Error in chat completion: {str(e)}")
+        if isinstance(e, HTTPException):
+            raise e
         raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
@@ -1,10 +1,11 @@
+import asyncio
 import logging
 import time
 import uuid
 import math
+from functools import partial
 from typing import Any, Union, List, Dict, Optional
-from fastapi import Depends, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import Depends, HTTPException, Request, Response
 
 from llamacpp_proxy.models.completion import (
     CompletionRequest,
@@ -12,11 +13,43 @@ from llamacpp_proxy.models.completion import (
     CompletionResponseChoice,
     LogProbs
 )
+from llamacpp_proxy.config.routing import routing_settings
+from llamacpp_proxy.config.streaming import streaming_settings
+from llamacpp_proxy.services.affinity import prompt_affinity_key
+from llamacpp_proxy.services.admission import MAX_QUEUE_WAIT_HEADER, parse_max_queue_wait
+from llamacpp_proxy.services.grammar import GrammarCache, get_grammar_cache
+from llamacpp_proxy.services.disconnect import ClientDisconnected, cancel_on_disconnect
+from llamacpp_proxy.services.batch import expand_requests, gather_bounded, open_streams
 from llamacpp_proxy.services.llamacpp import LlamaCppClient
+from llamacpp_proxy.services.metrics import StreamTimer, metrics
+from llamacpp_proxy.services.json_codec import json_response
+from llamacpp_proxy.services.tracing import current_timing, phase
+from llamacpp_proxy.services.request_log import upstream_request_fields
+from llamacpp_proxy.services.response_cache import (
+    CACHE_HIT,
+    CACHE_STATUS_HEADER,
+    ResponseCache,
+    get_response_cache,
+    merge_cache_statuses,
+)
+from llamacpp_proxy.services.streaming import (
+    ChunkEncoder,
+    buffered_stream,
+    get_finish_reason,
+    openai_stream,
+    streaming_response,
+    translate_stream,
+)
+from llamacpp_proxy.services.tokenizer import TokenCounter, get_token_counter, usage_from_choices
+from llamacpp_proxy.services.key_store import ApiKey
 from llamacpp_proxy.middleware.auth import get_api_key
+from llamacpp_proxy.middleware.rate_limit import RateLimiter, get_rate_limiter
 
 logger = logging.getLogger(__name__)
 
+# メトリクスのラベルに使うエンドポイント名
+ENDPOINT = "/v1/completions"
+
 def process_logprobs(probs: List[Dict[str, Any]], top_n: int) -> LogProbs:
     """トークンの確率情報を処理してLogProbsオブジェクトを生成"""
     tokens = []
@@ -39,51 +72,31 @@ def process_logprobs(probs: List[Dict[str, Any]], top_n: int) -> LogProbs:
         text_offset.append(current_offset)
         current_offset += len(logprob_info["token"])
     
-    return LogProbs(
+    return LogProbs.model_construct(
         tokens=tokens,
         token_logprobs=token_logprobs,
         top_logprobs=top_logprobs,
         text_offset=text_offset
     )
 
-def get_finish_reason(choice: dict) -> Optional[str]:
-    """
-    llama.cppのstop_typeとtruncatedフラグからOpenAI APIのfinish_reasonを決定する
-    
-    finish_reason:
-    - "stop": APIリクエストで指定されたstop sequenceに到達
-    - "length": max_tokensに到達
-    - "content_filter": コンテンツフィルターによる停止（llama.cppでは未サポート）
-    - null: 生成が進行中（ストリーミング時のみ）
-    """
-    if choice.get("truncated", False):
-        return "length"
-        
-    stop_type = choice.get("stop_type")
-    if stop_type == "word":
-        return "stop"  # stop wordによる停止
-    elif stop_type == "eos":
-        return "stop"  # EOSトークンによる停止
-    elif stop_type == "limit":
-        return "length"  # n_predict（max_tokens）制限による停止
-    else:
-        return "stop"  # デフォルト値（通常は発生しない）
-
 async def completions(
     request: CompletionRequest,
-    api_key: str = Depends(get_api_key),
+    http_request: Request,
+    response: Response,
+    api_key: ApiKey = Depends(get_api_key),
     llamacpp_client: LlamaCppClient = Depends(),
+    response_cache: ResponseCache = Depends(get_response_cache),
+    rate_limiter: RateLimiter = Depends(get_rate_limiter),
+    token_counter: TokenCounter = Depends(get_token_counter),
+    grammar_cache: GrammarCache = Depends(get_grammar_cache),
 ) -> CompletionResponse:
     """テキスト補完APIエンドポイント"""
     logger.info(f"Received completion request for model: {request.model}")
 
+    started = time.perf_counter()
     try:
-        # プロンプトが文字列のリストの場合は最初の要素のみを使用
-        prompt = request.prompt[0] if isinstance(request.prompt, list) else request.prompt
-
         # llama.cppサーバーへのリクエストを準備
         llamacpp_request = {
-            "prompt": prompt,
             "temperature": request.temperature,
             "top_p": request.top_p,
             "n_predict": request.max_tokens,
@@ -97,28 +110,101 @@ async def completions(
         if request.logprobs is not None:
             llamacpp_request["n_probs"] = request.logprobs
         
-        if request.llamacpp_proxy_grammar is not None:
-            llamacpp_request["grammar"] = request.llamacpp_proxy_grammar
+        if request.seed is not None:
+            llamacpp_request["seed"] = request.seed
+
+        # grammar・登録したgrammarのID・response_formatのいずれか（不正なら上流へ送らずに400）
+        grammar = await grammar_cache.resolve(
+            request.llamacpp_proxy_grammar, request.llamacpp_proxy_grammar_id, request.response_format
+        )
+        if grammar is not None:
+            llamacpp_request["grammar"] = grammar
+
+        # プロンプトのリストとnの組み合わせごとにリクエストを生成し、並行に処理する
+        prompts = request.prompt if isinstance(request.prompt, list) else [request.prompt]
+        with phase("tokenize"):
+            await asyncio.gather(*[token_counter.check_prompt(prompt, request.max_tokens) for prompt in set(prompts)])
+        llamacpp_requests = expand_requests(
+            llamacpp_request, prompts, request.n or 1, routing_settings.max_batch_choices
+        )
 
-        logger.info(f"{llamacpp_request=}")
+        # プロンプトとgrammarはフォーマッターが伏せ字にする（--log-capture-promptsで全文を記録する）
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Upstream request", extra={"fields": upstream_request_fields(llamacpp_requests)})
+
+        affinity_keys = [
+            prompt_affinity_key(r["prompt"], routing_settings.affinity_prefix_chars)
+            for r in llamacpp_requests
+        ]
+
+        priority = api_key.priority
+        max_queue_wait = parse_max_queue_wait(http_request.headers.get(MAX_QUEUE_WAIT_HEADER))
 
         if request.stream:
             # ストリーミングレスポンスの処理
-            response = await llamacpp_client.create_streaming_completion(llamacpp_request)
-            return StreamingResponse(response, media_type="text/event-stream")
+            # クライアントが待ちきれずに切断した場合は、待ち行列から外して上流への接続を閉じる
+            streams = await cancel_on_disconnect(
+                http_request,
+                open_streams(
+                    [
+                        partial(llamacpp_client.create_streaming_completion, r, affinity_key, priority, max_queue_wait)
+                        for r, affinity_key in zip(llamacpp_requests, affinity_keys)
+                    ],
+                    routing_settings.batch_concurrency,
+                ),
+                ENDPOINT,
+            )
+            encoder = ChunkEncoder.for_completion(f"cmpl-{uuid.uuid4()}", int(time.time()), request.model)
+
+            timing = current_timing()
+
+            def charge(event):
+                tokens = event.get("tokens_predicted", 0)
+                rate_limiter.charge_tokens(api_key, tokens)
+                metrics.generated_tokens.inc(ENDPOINT, amount=tokens)
+                if timing is not None:
+                    timing.record_llamacpp(event)
+
+            stream = openai_stream([
+                translate_stream(s, encoder, i, charge, StreamTimer(ENDPOINT, started))
+                for i, s in enumerate(streams)
+            ])
+            return streaming_response(buffered_stream(stream, streaming_settings, ENDPOINT), response)
 
         # 非ストリーミングレスポンスの処理
-        llamacpp_response = await llamacpp_client.create_completion(llamacpp_request)
-        if not isinstance(llamacpp_response, list):
-            llamacpp_response = [llamacpp_response]
+        cache_control = http_request.headers.get("Cache-Control")
+        results = await cancel_on_disconnect(
+            http_request,
+            gather_bounded(
+                [
+                    partial(
+                        response_cache.fetch,
+                        r,
+                        partial(llamacpp_client.create_completion, r, affinity_key, priority, max_queue_wait),
+                        cache_control,
+                    )
+                    for r, affinity_key in zip(llamacpp_requests, affinity_keys)
+                ],
+                routing_settings.batch_concurrency,
+            ),
+            ENDPOINT,
+        )
+        cache_status = merge_cache_statuses([status for _, status in results])
+        if cache_status is not None:
+            response.headers[CACHE_STATUS_HEADER] = cache_status
+        llamacpp_response = [choice for result, _ in results for choice in result]
+        generated_tokens = sum(
+            choice.get("tokens_predicted", 0)
+            for result, status in results
+            if status != CACHE_HIT
+            for choice in result
+        )
+        rate_limiter.charge_tokens(api_key, generated_tokens)
+        metrics.generated_tokens.inc(ENDPOINT, amount=generated_tokens)
 
         # レスポンスの内容をログに記録
-        logger.debug(f"Response: {llamacpp_response}")
-
-        # トークン使用量の計算（実装が必要）
-        prompt_tokens = 0  # TODO: implement token counting
-        completion_tokens = 0  # TODO: implement token counting
-        total_tokens = prompt_tokens + completion_tokens
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Upstream response", extra={"fields": {"choices": llamacpp_response}})
 
         choices = []
         for i, choice in enumerate(llamacpp_response):
@@ -138,8 +224,9 @@ async def completions(
                         }
                     )
 
+            # プロキシ自身が組み立てる値なので検証せずにモデルを生成する
             choices.append(
-                CompletionResponseChoice(
+                CompletionResponseChoice.model_construct(
                     text=choice["content"],
                     index=i,
                     logprobs=logprobs,
@@ -147,20 +234,20 @@ async def completions(
                 )
             )
 
-        return CompletionResponse(
-            id=f"cmpl-{uuid.uuid4()}",
-            created=int(time.time()),
-            model=request.model,
-            choices=choices,
-            usage={
-                "prompt_tokens": prompt_tokens,
-                "completion_tokens": completion_tokens,
-                "total_tokens": total_tokens,
-            },
+        return json_response(
+            CompletionResponse.model_construct(
+                id=f"cmpl-{uuid.uuid4()}",
+                created=int(time.time()),
+                model=request.model,
+                choices=choices,
+                usage=usage_from_choices(llamacpp_response, request.n or 1),
+            ),
+            response,
         )
 
     except Exception as e:
-        logger.error(f"Error in text completion: {str(e)}")
+        if not isinstance(e, ClientDisconnected):
+            logger.error(f"Error in text completion: {str(e)}")
         if isinstance(e, HTTPException):
             raise e
         raise HTTPException(
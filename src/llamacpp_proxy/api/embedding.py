@@ -0,0 +1,80 @@
+import logging
+from fastapi import Depends, HTTPException, Request, Response
+
+from llamacpp_proxy.config.embedding import embedding_settings
+from llamacpp_proxy.models.embedding import Embedding, EmbeddingRequest, EmbeddingResponse
+from llamacpp_proxy.services.admission import MAX_QUEUE_WAIT_HEADER, parse_max_queue_wait
+from llamacpp_proxy.services.disconnect import ClientDisconnected, cancel_on_disconnect
+from llamacpp_proxy.services.embedding import (
+    EmbeddingBatcher,
+    encode_embedding,
+    get_embedding_batcher,
+    normalize_inputs,
+)
+from llamacpp_proxy.services.json_codec import json_response
+from llamacpp_proxy.services.key_store import ApiKey
+from llamacpp_proxy.middleware.auth import get_api_key
+
+logger = logging.getLogger(__name__)
+
+# メトリクスのラベルに使うエンドポイント名
+ENDPOINT = "/v1/embeddings"
+
+
+def invalid_input_error(message: str) -> HTTPException:
+    return HTTPException(
+        status_code=400,
+        detail={
+            "error": {
+                "message": message,
+                "type": "invalid_request_error",
+                "param": "input",
+                "code": "invalid_value",
+            }
+        },
+    )
+
+
+async def embeddings(
+    request: EmbeddingRequest,
+    http_request: Request,
+    response: Response,
+    api_key: ApiKey = Depends(get_api_key),
+    batcher: EmbeddingBatcher = Depends(get_embedding_batcher),
+) -> EmbeddingResponse:
+    """埋め込みAPIエンドポイント
+
+    入力は他のリクエストの入力とまとめて上流へ送られ、同じ入力の埋め込みはキャッシュから返す。
+    """
+    inputs = normalize_inputs(request.input)
+    if not inputs or any(not value for value in inputs):
+        raise invalid_input_error("input must not be empty")
+    if len(inputs) > embedding_settings.max_inputs:
+        raise invalid_input_error(f"Too many inputs. Maximum {embedding_settings.max_inputs} inputs per request.")
+
+    max_queue_wait = parse_max_queue_wait(http_request.headers.get(MAX_QUEUE_WAIT_HEADER))
+    try:
+        results = await cancel_on_disconnect(
+            http_request, batcher.embed(inputs, api_key.priority, max_queue_wait), ENDPOINT
+        )
+    except Exception as e:
+        if not isinstance(e, ClientDisconnected):
+            logger.error(f"Error in embeddings: {str(e)}")
+        if isinstance(e, HTTPException):
+            raise e
+        raise HTTPException(status_code=500, detail=str(e))
+
+    prompt_tokens = sum(tokens for _, tokens in results)
+    return json_response(
+        EmbeddingResponse.model_construct(
+            data=[
+                Embedding.model_construct(
+                    embedding=encode_embedding(embedding, request.encoding_format), index=i
+                )
+                for i, (embedding, _) in enumerate(results)
+            ],
+            model=request.model,
+            usage={"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+        ),
+        response,
+    )
@@ -0,0 +1,43 @@
+from fastapi import Depends, Response
+
+from llamacpp_proxy.models.grammar import GrammarObject, GrammarRegistration
+from llamacpp_proxy.services.grammar import GrammarCache, GrammarError, get_grammar_cache, grammar_error
+from llamacpp_proxy.services.json_codec import json_response
+
+async def register_grammar(
+    registration: GrammarRegistration,
+    response: Response,
+    grammar_cache: GrammarCache = Depends(get_grammar_cache),
+) -> GrammarObject:
+    """grammarを登録し、llamacpp_proxy_grammar_idで指定するIDを返す
+
+    JSONスキーマを渡した場合は変換したgrammarを登録する。同じ内容なら同じIDになる。
+    """
+    if (registration.grammar is None) == (registration.json_schema is None):
+        raise grammar_error("Exactly one of grammar and json_schema must be specified", "grammar", "invalid_value")
+    if registration.grammar is not None:
+        param, code, grammar = "grammar", "invalid_grammar", registration.grammar
+    else:
+        param, code = "json_schema", "invalid_json_schema"
+    try:
+        if registration.json_schema is not None:
+            grammar = await grammar_cache.from_schema(registration.json_schema)
+        grammar_id = await grammar_cache.register(grammar)
+    except GrammarError as e:
+        raise grammar_error(f"Invalid {param}: {e}", param, code)
+    return json_response(
+        GrammarObject.model_construct(id=grammar_id, bytes=len(grammar.encode()), grammar=grammar), response
+    )
+
+async def retrieve_grammar(
+    grammar_id: str,
+    response: Response,
+    grammar_cache: GrammarCache = Depends(get_grammar_cache),
+) -> GrammarObject:
+    """登録されたgrammarを返す"""
+    grammar = await grammar_cache.lookup(grammar_id)
+    if grammar is None:
+        raise grammar_error(f"Grammar {grammar_id} not found", "grammar_id", "grammar_not_found", status_code=404)
+    return json_response(
+        GrammarObject.model_construct(id=grammar_id, bytes=len(grammar.encode()), grammar=grammar), response
+    )
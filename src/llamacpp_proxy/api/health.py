@@ -0,0 +1,20 @@
+from fastapi import Depends
+from fastapi.responses import JSONResponse
+
+from llamacpp_proxy.services.balancer import LoadBalancer, get_load_balancer
+
+async def liveness() -> JSONResponse:
+    """プロセスが応答できるかを返す（バックエンドの状態には依存しない）"""
+    return JSONResponse({"status": "ok"})
+
+async def readiness(load_balancer: LoadBalancer = Depends(get_load_balancer)) -> JSONResponse:
+    """リクエストを割り当てられるバックエンドがあるかを返す。ない場合は503"""
+    backends = [
+        {"url": backend.url, "state": backend.state, "healthy": backend.healthy}
+        for backend in load_balancer.backends
+    ]
+    ready = any(backend["healthy"] for backend in backends)
+    return JSONResponse(
+        {"status": "ready" if ready else "unavailable", "backends": backends},
+        status_code=200 if ready else 503,
+    )
@@ -0,0 +1,7 @@
+from fastapi import Response
+
+from llamacpp_proxy.services.metrics import metrics
+
+async def prometheus_metrics() -> Response:
+    """Prometheus形式のメトリクスを返す"""
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -1,20 +1,71 @@
 from fastapi import APIRouter, Depends
 from llamacpp_proxy.api.chat import chat_completions
 from llamacpp_proxy.api.completion import completions
-from llamacpp_proxy.middleware.auth import get_api_key
+from llamacpp_proxy.api.embedding import embeddings
+from llamacpp_proxy.api.grammar import register_grammar, retrieve_grammar
+from llamacpp_proxy.api.health import liveness, readiness
+from llamacpp_proxy.api.metrics import prometheus_metrics
+from llamacpp_proxy.middleware.auth import check_model_access, get_api_key
+from llamacpp_proxy.middleware.rate_limit import check_rate_limit
+from llamacpp_proxy.services.json_codec import FastJSONRoute
 
-router = APIRouter(prefix="/v1")
+router = APIRouter(prefix="/v1", route_class=FastJSONRoute)
 
 router.add_api_route(
     "/chat/completions",
     chat_completions,
     methods=["POST"],
-    dependencies=[Depends(get_api_key)]
+    dependencies=[Depends(check_model_access), Depends(check_rate_limit)]
 )
 
 router.add_api_route(
     "/completions",
     completions,
     methods=["POST"],
+    dependencies=[Depends(check_model_access), Depends(check_rate_limit)]
+)
+
+router.add_api_route(
+    "/embeddings",
+    embeddings,
+    methods=["POST"],
+    dependencies=[Depends(check_model_access), Depends(check_rate_limit)]
+)
+
+router.add_api_route(
+    "/grammars",
+    register_grammar,
+    methods=["POST"],
     dependencies=[Depends(get_api_key)]
-)
\ No newline at end of file
+)
+
+router.add_api_route(
+    "/grammars/{grammar_id}",
+    retrieve_grammar,
+    methods=["GET"],
+    dependencies=[Depends(get_api_key)]
+)
+
+# 運用向けのエンドポイント（/v1の外に置く）
+ops_router = APIRouter()
+
+ops_router.add_api_route(
+    "/metrics",
+    prometheus_metrics,
+    methods=["GET"],
+    include_in_schema=False,
+)
+
+ops_router.add_api_route(
+    "/healthz",
+    liveness,
+    methods=["GET"],
+    include_in_schema=False,
+)
+
+ops_router.add_api_route(
+    "/readyz",
+    readiness,
+    methods=["GET"],
+    include_in_schema=False,
+)
@@ -1,4 +1,42 @@
 from llamacpp_proxy.config.settings import Settings, settings
 from llamacpp_proxy.config.rate_limit import RateLimitSettings, rate_limit_settings
+from llamacpp_proxy.config.upstream import UpstreamSettings, upstream_settings
+from llamacpp_proxy.config.routing import RoutingSettings, routing_settings
+from llamacpp_proxy.config.cache import CacheSettings, cache_settings
+from llamacpp_proxy.config.server import ServerSettings, server_settings
+from llamacpp_proxy.config.tokenizer import TokenizerSettings, tokenizer_settings
+from llamacpp_proxy.config.tracing import TracingSettings, tracing_settings
+from llamacpp_proxy.config.log import LogSettings, log_settings
+from llamacpp_proxy.config.streaming import StreamingSettings, streaming_settings
+from llamacpp_proxy.config.health import HealthSettings, health_settings
+from llamacpp_proxy.config.grammar import GrammarSettings, grammar_settings
+from llamacpp_proxy.config.embedding import EmbeddingSettings, embedding_settings
 
-__all__ = ['Settings', 'settings', 'RateLimitSettings', 'rate_limit_settings']
\ No newline at end of file
+__all__ = [
+    'Settings',
+    'settings',
+    'RateLimitSettings',
+    'rate_limit_settings',
+    'UpstreamSettings',
+    'upstream_settings',
+    'RoutingSettings',
+    'routing_settings',
+    'CacheSettings',
+    'cache_settings',
+    'ServerSettings',
+    'server_settings',
+    'TokenizerSettings',
+    'tokenizer_settings',
+    'TracingSettings',
+    'tracing_settings',
+    'LogSettings',
+    'log_settings',
+    'StreamingSettings',
+    'streaming_settings',
+    'HealthSettings',
+    'health_settings',
+    'GrammarSettings',
+    'grammar_settings',
+    'EmbeddingSettings',
+    'embedding_settings',
+]
@@ -0,0 +1,24 @@
+from dataclasses import dataclass
+
+@dataclass
+class CacheSettings:
+    enabled: bool = False  # 決定的なリクエスト(temperature=0またはseed指定)のレスポンスをキャッシュする
+    ttl: float = 3600.0  # キャッシュの有効期間（秒）
+    max_entries: int = 10000  # メモリキャッシュの最大件数
+    max_bytes: int = 64 * 1024 * 1024  # メモリキャッシュの最大サイズ
+    disk_path: str = ""  # 設定すると再起動後も残るSQLiteのキャッシュを併用する
+    disk_max_bytes: int = 1024 * 1024 * 1024  # ディスクキャッシュの最大サイズ
+
+    def validate(self):
+        """設定の検証を行う"""
+        if self.ttl <= 0:
+            raise ValueError("ttl must be positive")
+        if self.max_entries < 1:
+            raise ValueError("max_entries must be at least 1")
+        if self.max_bytes < 1:
+            raise ValueError("max_bytes must be at least 1")
+        if self.disk_max_bytes < 1:
+            raise ValueError("disk_max_bytes must be at least 1")
+
+
+cache_settings = CacheSettings()
@@ -0,0 +1,25 @@
+from dataclasses import dataclass
+
+@dataclass
+class EmbeddingSettings:
+    batch_window: float = 0.005  # 同時に届いた入力を1つの上流のリクエストにまとめるために待つ時間（秒）。0で待たない
+    max_batch_size: int = 32  # 上流の1リクエストにまとめる入力の最大数。集まった時点で待たずに送る
+    max_inputs: int = 2048  # 1リクエストのinputの最大数
+    cache_size: int = 10000  # 埋め込みをキャッシュする入力の最大数。0で無効
+    cache_max_bytes: int = 256 * 1024 * 1024  # キャッシュの最大サイズ
+
+    def validate(self):
+        """設定の検証を行う"""
+        if self.batch_window < 0:
+            raise ValueError("batch_window must not be negative")
+        if self.max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        if self.max_inputs < 1:
+            raise ValueError("max_inputs must be at least 1")
+        if self.cache_size < 0:
+            raise ValueError("cache_size must not be negative")
+        if self.cache_max_bytes < 1:
+            raise ValueError("cache_max_bytes must be at least 1")
+
+
+embedding_settings = EmbeddingSettings()
@@ -0,0 +1,53 @@
+import json
+from dataclasses import asdict, fields
+from typing import Any, Dict
+
+from llamacpp_proxy.config.settings import BackendConfig, settings
+from llamacpp_proxy.config.rate_limit import rate_limit_settings
+from llamacpp_proxy.config.upstream import upstream_settings
+from llamacpp_proxy.config.routing import routing_settings
+from llamacpp_proxy.config.cache import cache_settings
+from llamacpp_proxy.config.server import server_settings
+from llamacpp_proxy.config.tokenizer import tokenizer_settings
+from llamacpp_proxy.config.tracing import tracing_settings
+from llamacpp_proxy.config.log import log_settings
+from llamacpp_proxy.config.streaming import streaming_settings
+from llamacpp_proxy.config.health import health_settings
+from llamacpp_proxy.config.grammar import grammar_settings
+from llamacpp_proxy.config.embedding import embedding_settings
+
+# ワーカープロセスへ設定を引き渡す環境変数
+SETTINGS_ENV = "LLAMACPP_PROXY_SETTINGS"
+
+_SECTIONS = {
+    "settings": settings,
+    "rate_limit": rate_limit_settings,
+    "upstream": upstream_settings,
+    "routing": routing_settings,
+    "cache": cache_settings,
+    "server": server_settings,
+    "tokenizer": tokenizer_settings,
+    "tracing": tracing_settings,
+    "log": log_settings,
+    "streaming": streaming_settings,
+    "health": health_settings,
+    "grammar": grammar_settings,
+    "embedding": embedding_settings,
+}
+
+def dump_settings() -> str:
+    """全ての設定をJSONにシリアライズする"""
+    return json.dumps({name: asdict(section) for name, section in _SECTIONS.items()})
+
+def load_settings(serialized: str) -> None:
+    """dump_settingsの出力から設定を復元する
+
+    各モジュールが設定オブジェクトを直接参照しているため、オブジェクトは置き換えずに値を上書きする。
+    """
+    data: Dict[str, Dict[str, Any]] = json.loads(serialized)
+    for name, section in _SECTIONS.items():
+        values = data.get(name, {})
+        for field in fields(section):
+            if field.name in values:
+                setattr(section, field.name, values[field.name])
+    settings.backends = [BackendConfig(**backend) for backend in settings.backends]
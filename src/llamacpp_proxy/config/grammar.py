@@ -0,0 +1,26 @@
+from dataclasses import dataclass
+
+@dataclass
+class GrammarSettings:
+    cache_size: int = 1000  # 検証済みのgrammarと、JSONスキーマから変換したgrammarをキャッシュする件数
+    max_registered: int = 10000  # /v1/grammarsで登録できるgrammarの件数（古いものから削除する）
+    max_bytes: int = 1024 * 1024  # 1つのgrammar（変換後を含む）の最大サイズ
+    cache_max_bytes: int = 64 * 1024 * 1024  # 検証・変換済みのgrammarのキャッシュの合計サイズ
+    max_registered_bytes: int = 64 * 1024 * 1024  # 登録したgrammarの合計サイズ（古いものから削除する）
+    offload_threshold: int = 64 * 1024  # このサイズ以上のgrammarはスレッドプールで検証・変換する。0以下で無効
+
+    def validate(self):
+        """設定の検証を行う"""
+        if self.cache_size < 1:
+            raise ValueError("cache_size must be at least 1")
+        if self.max_registered < 1:
+            raise ValueError("max_registered must be at least 1")
+        if self.max_bytes < 1:
+            raise ValueError("max_bytes must be at least 1")
+        if self.cache_max_bytes < 1:
+            raise ValueError("cache_max_bytes must be at least 1")
+        if self.max_registered_bytes < 1:
+            raise ValueError("max_registered_bytes must be at least 1")
+
+
+grammar_settings = GrammarSettings()
@@ -0,0 +1,22 @@
+from dataclasses import dataclass
+
+@dataclass
+class HealthSettings:
+    interval: float = 5.0  # 各バックエンドの/healthと/slotsを確認する間隔（秒）。0で無効
+    timeout: float = 2.0  # 確認のタイムアウト（秒）
+    failure_threshold: int = 2  # 連続してこの回数失敗したバックエンドを割り当ての対象から外す
+    max_backoff: float = 30.0  # 外したバックエンドを再確認する間隔の上限（秒）。間隔はintervalから倍々に延ばす
+
+    def validate(self):
+        """設定の検証を行う"""
+        if self.interval < 0:
+            raise ValueError("interval must not be negative")
+        if self.timeout <= 0:
+            raise ValueError("timeout must be positive")
+        if self.failure_threshold < 1:
+            raise ValueError("failure_threshold must be at least 1")
+        if self.max_backoff < self.interval:
+            raise ValueError("max_backoff must not be less than interval")
+
+
+health_settings = HealthSettings()
@@ -0,0 +1,33 @@
+from dataclasses import dataclass, field
+from typing import List
+
+# 常に伏せる項目（APIキーなど）
+SECRET_FIELDS = ["api_key", "authorization"]
+# プロンプトの記録を有効にしない限り伏せる項目
+PROMPT_FIELDS = ["prompt", "prompts", "messages", "grammar", "content"]
+
+@dataclass
+class LogSettings:
+    level: str = "INFO"
+    format: str = "text"  # text / json
+    sample_rate: float = 1.0  # リクエスト単位のINFO以下のログを出力する割合（WARNING以上は常に出力する）
+    max_field_chars: int = 256  # ログの項目の値をこの文字数で切り詰める
+    redact_fields: List[str] = field(default_factory=lambda: SECRET_FIELDS + PROMPT_FIELDS)
+    capture_prompts: bool = False  # デバッグ用。プロンプトなどの全文を切り詰めずに記録する
+    queue_size: int = 10000  # 出力待ちのログの上限。超えた分は破棄する
+
+    def validate(self):
+        """設定の検証を行う"""
+        if self.level.upper() not in ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"):
+            raise ValueError("level must be one of DEBUG, INFO, WARNING, ERROR, CRITICAL")
+        if self.format not in ("text", "json"):
+            raise ValueError("format must be text or json")
+        if not 0 <= self.sample_rate <= 1:
+            raise ValueError("sample_rate must be between 0 and 1")
+        if self.max_field_chars < 16:
+            raise ValueError("max_field_chars must be at least 16")
+        if self.queue_size < 1:
+            raise ValueError("queue_size must be at least 1")
+
+
+log_settings = LogSettings()
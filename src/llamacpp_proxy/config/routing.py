@@ -0,0 +1,40 @@
+from dataclasses import dataclass
+
+@dataclass
+class RoutingSettings:
+    prefix_affinity: bool = True  # 同じ会話・プレフィックスを同じバックエンドとスロットへ送る
+    affinity_prefix_chars: int = 2048  # /v1/completionsでハッシュするプロンプト先頭の文字数
+    affinity_table_size: int = 10000  # 記憶するプレフィックスの最大数
+    singleflight: bool = True  # 同時に届いた同一の決定的リクエストで上流の生成を共有する
+    batch_concurrency: int = 4  # 1リクエスト内のプロンプト×nを上流へ同時に送る最大数
+    max_batch_choices: int = 64  # 1リクエストで生成できるchoiceの最大数（プロンプト数×n）
+    admission_control: bool = False  # バックエンドへの同時リクエスト数を制限し、超えた分を待ち行列で待たせる
+    max_in_flight_per_backend: int = 0  # バックエンドごとの同時リクエスト数の上限（0はスロット数）
+    queue_size: int = 100  # 待ち行列の最大長。超えた場合は503を返す
+    max_queue_wait: float = 30.0  # 待ち行列で待つ最大秒数。超えた場合は503を返す
+    max_retries: int = 1  # 最初のトークンより前の接続エラーや5xxを別のバックエンドで再試行する回数
+    hedge_percentile: float = 0.0  # 最初のトークンまでの時間がこのパーセンタイルを超えたら別のバックエンドにも送る（0は無効）
+
+    def validate(self):
+        """設定の検証を行う"""
+        if self.affinity_prefix_chars < 1:
+            raise ValueError("affinity_prefix_chars must be at least 1")
+        if self.affinity_table_size < 1:
+            raise ValueError("affinity_table_size must be at least 1")
+        if self.batch_concurrency < 1:
+            raise ValueError("batch_concurrency must be at least 1")
+        if self.max_batch_choices < 1:
+            raise ValueError("max_batch_choices must be at least 1")
+        if self.max_in_flight_per_backend < 0:
+            raise ValueError("max_in_flight_per_backend must not be negative")
+        if self.queue_size < 0:
+            raise ValueError("queue_size must not be negative")
+        if self.max_queue_wait < 0:
+            raise ValueError("max_queue_wait must not be negative")
+        if self.max_retries < 0:
+            raise ValueError("max_retries must not be negative")
+        if not 0 <= self.hedge_percentile < 100:
+            raise ValueError("hedge_percentile must be at least 0 and less than 100")
+
+
+routing_settings = RoutingSettings()
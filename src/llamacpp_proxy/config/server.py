@@ -0,0 +1,19 @@
+from dataclasses import dataclass
+
+@dataclass
+class ServerSettings:
+    workers: int = 1  # ワーカープロセス数
+    shared_state_path: str = ""  # ワーカー間で共有する状態のSQLiteファイル。空の場合は共有しない
+    state_sync_interval: float = 0.1  # バックエンドの処理中リクエスト数をワーカー間で同期する間隔（秒）
+
+    def validate(self):
+        """設定の検証を行う"""
+        if self.workers < 1:
+            raise ValueError("workers must be at least 1")
+        if self.workers > 1 and not self.shared_state_path:
+            raise ValueError("shared_state_path must be set when running multiple workers")
+        if self.state_sync_interval <= 0:
+            raise ValueError("state_sync_interval must be positive")
+
+
+server_settings = ServerSettings()
@@ -1,21 +1,41 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
+import json
 import logging
-from typing import Optional
+from typing import List, Optional
 
 logger = logging.getLogger(__name__)
 
+@dataclass
+class BackendConfig:
+    url: str
+    slots: Optional[int] = None  # Noneの場合はllama.cppの/propsから取得する
+
 @dataclass
 class Settings:
     llamacpp_server_url: str = ""
+    backends: List[BackendConfig] = field(default_factory=list)
     chat_template: str = ""
+    chat_template_path: str = ""  # 設定するとファイルの変更を検知して再読み込みする
+    template_reload_interval: float = 2.0  # テンプレートファイルの変更確認間隔（秒）。0以下で無効
+    template_bytecode_cache_dir: str = ""  # Jinjaのバイトコードキャッシュの保存先
+    template_offload_threshold: int = 64  # このメッセージ数以上はスレッドプールでレンダリングする。0以下で無効
 
     def validate(self):
         """設定の検証を行う"""
-        if not self.llamacpp_server_url:
+        if not self.llamacpp_server_url and not self.backends:
             raise ValueError("llamacpp_server_url must be set")
         if not self.chat_template:
             raise ValueError("chat_template must be set")
+        for backend in self.backends:
+            if backend.slots is not None and backend.slots < 1:
+                raise ValueError(f"slots of backend {backend.url} must be at least 1")
+
+    def backend_configs(self) -> List[BackendConfig]:
+        """プロキシ先のバックエンド一覧を返す"""
+        if self.backends:
+            return self.backends
+        return [BackendConfig(url=self.llamacpp_server_url)]
 
     @classmethod
     def load_chat_template(cls, chat_template_path: Optional[str] = None) -> str:
@@ -28,4 +48,22 @@ class Settings:
                 raise ValueError(f"Failed to load chat template: {str(e)}")
         return ""
 
-settings = Settings()
\ No newline at end of file
+    @classmethod
+    def load_backends(cls, backends_config_path: str) -> List[BackendConfig]:
+        """バックエンド設定ファイル(JSON)を読み込む
+
+        形式: {"backends": ["http://host:8080", {"url": "http://host:8081", "slots": 4}]}
+        """
+        try:
+            data = json.loads(Path(backends_config_path).read_text())
+            entries = data["backends"] if isinstance(data, dict) else data
+            return [
+                BackendConfig(url=entry) if isinstance(entry, str)
+                else BackendConfig(url=entry["url"], slots=entry.get("slots"))
+                for entry in entries
+            ]
+        except Exception as e:
+            logger.error(f"Failed to load backends config: {str(e)}")
+            raise ValueError(f"Failed to load backends config: {str(e)}")
+
+settings = Settings()
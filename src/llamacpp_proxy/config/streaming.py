@@ -0,0 +1,25 @@
+from dataclasses import dataclass
+
+# クライアントへの送信が追いつかない場合の扱い
+SLOW_CONSUMER_POLICIES = ("abort", "block")
+
+@dataclass
+class StreamingSettings:
+    flush_interval: float = 0.0  # 最初のトークンからこの秒数だけ待ってまとめて送る。0は待たずに送る（溜まっている分はまとめる）
+    heartbeat_interval: float = 15.0  # この秒数送信がない場合にSSEのコメントを送る。0で無効
+    max_buffer_bytes: int = 1024 * 1024  # クライアントへ送っていないチャンクの上限（ストリームごと）
+    slow_consumer_policy: str = "abort"  # 上限を超えた場合、abortは上流を閉じて打ち切り、blockは上流の読み込みを止めて待つ
+
+    def validate(self):
+        """設定の検証を行う"""
+        if self.flush_interval < 0:
+            raise ValueError("flush_interval must not be negative")
+        if self.heartbeat_interval < 0:
+            raise ValueError("heartbeat_interval must not be negative")
+        if self.max_buffer_bytes < 1:
+            raise ValueError("max_buffer_bytes must be at least 1")
+        if self.slow_consumer_policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError("slow_consumer_policy must be abort or block")
+
+
+streaming_settings = StreamingSettings()
@@ -0,0 +1,13 @@
+import pytest
+from llamacpp_proxy.config.cache import CacheSettings
+
+def test_validate_default_settings():
+    CacheSettings().validate()  # should not raise
+
+def test_validate_invalid_ttl():
+    with pytest.raises(ValueError, match="ttl must be positive"):
+        CacheSettings(ttl=0).validate()
+
+def test_validate_invalid_max_bytes():
+    with pytest.raises(ValueError, match="max_bytes must be at least 1"):
+        CacheSettings(max_bytes=0).validate()
@@ -0,0 +1,19 @@
+import pytest
+from llamacpp_proxy.config.embedding import EmbeddingSettings
+
+def test_validate_default_settings():
+    EmbeddingSettings().validate()  # should not raise
+
+def test_validate_disabled_cache():
+    EmbeddingSettings(batch_window=0, cache_size=0).validate()  # should not raise
+
+@pytest.mark.parametrize("kwargs, message", [
+    ({"batch_window": -0.1}, "batch_window must not be negative"),
+    ({"max_batch_size": 0}, "max_batch_size must be at least 1"),
+    ({"max_inputs": 0}, "max_inputs must be at least 1"),
+    ({"cache_size": -1}, "cache_size must not be negative"),
+    ({"cache_max_bytes": 0}, "cache_max_bytes must be at least 1"),
+])
+def test_validate_invalid_settings(kwargs, message):
+    with pytest.raises(ValueError, match=message):
+        EmbeddingSettings(**kwargs).validate()
@@ -0,0 +1,19 @@
+from llamacpp_proxy.config.environment import dump_settings, load_settings
+from llamacpp_proxy.config.settings import BackendConfig, settings
+from llamacpp_proxy.config.routing import routing_settings
+
+def test_round_trip():
+    original_backends, original_queue_size = settings.backends, routing_settings.queue_size
+    try:
+        settings.backends = [BackendConfig(url="http://a:8080", slots=2)]
+        routing_settings.queue_size = 7
+        serialized = dump_settings()
+
+        settings.backends = []
+        routing_settings.queue_size = 100
+        load_settings(serialized)
+
+        assert settings.backends == [BackendConfig(url="http://a:8080", slots=2)]
+        assert routing_settings.queue_size == 7
+    finally:
+        settings.backends, routing_settings.queue_size = original_backends, original_queue_size
@@ -0,0 +1,16 @@
+import pytest
+from llamacpp_proxy.config.grammar import GrammarSettings
+
+def test_validate_default_settings():
+    GrammarSettings().validate()  # should not raise
+
+@pytest.mark.parametrize("kwargs, message", [
+    ({"cache_size": 0}, "cache_size must be at least 1"),
+    ({"max_registered": 0}, "max_registered must be at least 1"),
+    ({"max_bytes": 0}, "max_bytes must be at least 1"),
+    ({"cache_max_bytes": 0}, "cache_max_bytes must be at least 1"),
+    ({"max_registered_bytes": 0}, "max_registered_bytes must be at least 1"),
+])
+def test_validate_invalid_settings(kwargs, message):
+    with pytest.raises(ValueError, match=message):
+        GrammarSettings(**kwargs).validate()
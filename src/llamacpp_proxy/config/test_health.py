@@ -0,0 +1,18 @@
+import pytest
+from llamacpp_proxy.config.health import HealthSettings
+
+def test_validate_default_settings():
+    HealthSettings().validate()  # should not raise
+
+def test_validate_disabled():
+    HealthSettings(interval=0).validate()  # should not raise
+
+@pytest.mark.parametrize("kwargs, message", [
+    ({"interval": -1}, "interval must not be negative"),
+    ({"timeout": 0}, "timeout must be positive"),
+    ({"failure_threshold": 0}, "failure_threshold must be at least 1"),
+    ({"interval": 10, "max_backoff": 5}, "max_backoff must not be less than interval"),
+])
+def test_validate_invalid_settings(kwargs, message):
+    with pytest.raises(ValueError, match=message):
+        HealthSettings(**kwargs).validate()
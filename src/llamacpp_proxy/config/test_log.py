@@ -0,0 +1,22 @@
+import pytest
+from llamacpp_proxy.config.log import LogSettings
+
+def test_validate_default_settings():
+    LogSettings().validate()  # should not raise
+
+def test_default_settings_redact_prompts_and_keys():
+    settings = LogSettings()
+    for name in ("api_key", "authorization", "prompt", "messages", "grammar"):
+        assert name in settings.redact_fields
+    assert not settings.capture_prompts
+
+@pytest.mark.parametrize("kwargs, message", [
+    ({"level": "TRACE"}, "level must be one of"),
+    ({"format": "xml"}, "format must be text or json"),
+    ({"sample_rate": 1.5}, "sample_rate must be between 0 and 1"),
+    ({"max_field_chars": 0}, "max_field_chars must be at least 16"),
+    ({"queue_size": 0}, "queue_size must be at least 1"),
+])
+def test_validate_invalid_settings(kwargs, message):
+    with pytest.raises(ValueError, match=message):
+        LogSettings(**kwargs).validate()
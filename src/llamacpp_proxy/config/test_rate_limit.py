@@ -28,4 +28,19 @@ def test_validate_both_api_keys():
         unlimited_api_key="unlimited_key",
         limited_api_key="limited_key"
     )
-    settings.validate()  # should not raise
\ No newline at end of file
+    settings.validate()  # should not raise
+
+def test_validate_invalid_max_requests():
+    settings = RateLimitSettings(limited_api_key="limited_key", max_requests=0)
+    with pytest.raises(ValueError, match="max_requests must be at least 1"):
+        settings.validate()
+
+def test_validate_key_file_only(tmp_path):
+    path = tmp_path / "keys.json"
+    path.write_text('{"keys": []}')
+    RateLimitSettings(unlimited_api_key="", limited_api_key="", key_file=str(path)).validate()  # should not raise
+
+def test_validate_missing_key_file(tmp_path):
+    settings = RateLimitSettings(unlimited_api_key="", limited_api_key="", key_file=str(tmp_path / "missing.json"))
+    with pytest.raises(ValueError, match="key_file does not exist"):
+        settings.validate()
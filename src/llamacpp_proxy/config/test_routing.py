@@ -0,0 +1,29 @@
+import pytest
+from llamacpp_proxy.config.routing import RoutingSettings
+
+def test_validate_default_settings():
+    RoutingSettings().validate()  # should not raise
+
+def test_validate_invalid_prefix_chars():
+    with pytest.raises(ValueError, match="affinity_prefix_chars must be at least 1"):
+        RoutingSettings(affinity_prefix_chars=0).validate()
+
+def test_validate_invalid_table_size():
+    with pytest.raises(ValueError, match="affinity_table_size must be at least 1"):
+        RoutingSettings(affinity_table_size=0).validate()
+
+def test_validate_invalid_batch_concurrency():
+    with pytest.raises(ValueError, match="batch_concurrency must be at least 1"):
+        RoutingSettings(batch_concurrency=0).validate()
+
+def test_validate_invalid_max_queue_wait():
+    with pytest.raises(ValueError, match="max_queue_wait must not be negative"):
+        RoutingSettings(max_queue_wait=-1).validate()
+
+def test_validate_invalid_max_retries():
+    with pytest.raises(ValueError, match="max_retries must not be negative"):
+        RoutingSettings(max_retries=-1).validate()
+
+def test_validate_invalid_hedge_percentile():
+    with pytest.raises(ValueError, match="hedge_percentile must be at least 0 and less than 100"):
+        RoutingSettings(hedge_percentile=100).validate()
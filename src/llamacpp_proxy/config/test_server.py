@@ -0,0 +1,14 @@
+import pytest
+from llamacpp_proxy.config.server import ServerSettings
+
+def test_validate_default_settings():
+    ServerSettings().validate()  # should not raise
+
+def test_validate_invalid_workers():
+    with pytest.raises(ValueError, match="workers must be at least 1"):
+        ServerSettings(workers=0).validate()
+
+def test_validate_workers_require_shared_state():
+    with pytest.raises(ValueError, match="shared_state_path must be set"):
+        ServerSettings(workers=2).validate()
+    ServerSettings(workers=2, shared_state_path="/tmp/state.sqlite").validate()
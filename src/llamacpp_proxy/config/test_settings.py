@@ -1,6 +1,6 @@
 import pytest
 from pathlib import Path
-from llamacpp_proxy.config.settings import Settings
+from llamacpp_proxy.config.settings import BackendConfig, Settings
 
 def test_validate_empty_settings():
     settings = Settings()
@@ -29,4 +29,39 @@ def test_load_chat_template_from_file(tmp_path):
 
 def test_load_chat_template_file_not_found():
     with pytest.raises(ValueError, match="Failed to load chat template"):
-        Settings.load_chat_template("nonexistent_file.jinja")
\ No newline at end of file
+        Settings.load_chat_template("nonexistent_file.jinja")
+
+def test_validate_backends_without_server_url():
+    settings = Settings(
+        backends=[BackendConfig(url="http://localhost:8080")],
+        chat_template="test template"
+    )
+    settings.validate()  # should not raise
+
+def test_validate_invalid_backend_slots():
+    settings = Settings(
+        backends=[BackendConfig(url="http://localhost:8080", slots=0)],
+        chat_template="test template"
+    )
+    with pytest.raises(ValueError, match="slots of backend"):
+        settings.validate()
+
+def test_backend_configs_fallback_to_server_url():
+    settings = Settings(llamacpp_server_url="http://localhost:8080")
+    assert settings.backend_configs() == [BackendConfig(url="http://localhost:8080")]
+
+def test_load_backends(tmp_path):
+    config_file = tmp_path / "backends.json"
+    config_file.write_text('{"backends": ["http://a:8080", {"url": "http://b:8080", "slots": 4}]}')
+
+    result = Settings.load_backends(str(config_file))
+    assert result == [
+        BackendConfig(url="http://a:8080"),
+        BackendConfig(url="http://b:8080", slots=4),
+    ]
+
+def test_load_backends_invalid_file(tmp_path):
+    config_file = tmp_path / "backends.json"
+    config_file.write_text("not json")
+    with pytest.raises(ValueError, match="Failed to load backends config"):
+        Settings.load_backends(str(config_file))
@@ -0,0 +1,15 @@
+import pytest
+from llamacpp_proxy.config.streaming import StreamingSettings
+
+def test_validate_default_settings():
+    StreamingSettings().validate()  # should not raise
+
+@pytest.mark.parametrize("kwargs, message", [
+    ({"flush_interval": -0.1}, "flush_interval must not be negative"),
+    ({"heartbeat_interval": -1}, "heartbeat_interval must not be negative"),
+    ({"max_buffer_bytes": 0}, "max_buffer_bytes must be at least 1"),
+    ({"slow_consumer_policy": "drop"}, "slow_consumer_policy must be abort or block"),
+])
+def test_validate_invalid_settings(kwargs, message):
+    with pytest.raises(ValueError, match=message):
+        StreamingSettings(**kwargs).validate()
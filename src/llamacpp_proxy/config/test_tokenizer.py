@@ -0,0 +1,13 @@
+import pytest
+from llamacpp_proxy.config.tokenizer import TokenizerSettings
+
+def test_validate_default_settings():
+    TokenizerSettings().validate()  # should not raise
+
+def test_validate_invalid_cache_size():
+    with pytest.raises(ValueError, match="cache_size must be at least 1"):
+        TokenizerSettings(cache_size=0).validate()
+
+def test_validate_invalid_max_concurrency():
+    with pytest.raises(ValueError, match="max_concurrency must be at least 1"):
+        TokenizerSettings(max_concurrency=0).validate()
@@ -0,0 +1,18 @@
+import pytest
+from llamacpp_proxy.config.tracing import TracingSettings, _find_spec
+
+def test_validate_default_settings():
+    TracingSettings().validate()  # should not raise
+
+def test_validate_unknown_exporter():
+    with pytest.raises(ValueError, match="otel_exporter must be one of"):
+        TracingSettings(otel_exporter="jaeger").validate()
+
+def test_validate_file_exporter_requires_path():
+    with pytest.raises(ValueError, match="otel_file_path must be set"):
+        TracingSettings(otel_exporter="file").validate()
+
+@pytest.mark.skipif(_find_spec("opentelemetry.sdk") is not None, reason="opentelemetry-sdk is installed")
+def test_validate_exporter_requires_sdk():
+    with pytest.raises(ValueError, match="requires the 'opentelemetry.sdk' package"):
+        TracingSettings(otel_exporter="console").validate()
@@ -0,0 +1,15 @@
+import pytest
+from llamacpp_proxy.config.upstream import UpstreamSettings
+
+def test_validate_default_settings():
+    UpstreamSettings().validate()  # should not raise
+
+def test_validate_keepalive_exceeds_max_connections():
+    settings = UpstreamSettings(max_connections=4, max_keepalive_connections=8)
+    with pytest.raises(ValueError, match="max_keepalive_connections must not exceed max_connections"):
+        settings.validate()
+
+def test_validate_non_positive_timeout():
+    settings = UpstreamSettings(read_timeout=0)
+    with pytest.raises(ValueError, match="read_timeout must be positive"):
+        settings.validate()
@@ -0,0 +1,21 @@
+from dataclasses import dataclass
+
+@dataclass
+class TokenizerSettings:
+    context_check: bool = True  # 送信前にプロンプトがバックエンドのn_ctxに収まるか確認する
+    cache_size: int = 10000  # トークン数をキャッシュするテキストの最大数
+    message_overhead: int = 4  # チャットテンプレートが1メッセージごとに追加するトークン数の見積もり
+    trim_chat_history: bool = False  # n_ctxに収まらないチャットは古いメッセージから削除する
+    max_concurrency: int = 4  # 1リクエストのメッセージを並行にトークナイズする最大数
+
+    def validate(self):
+        """設定の検証を行う"""
+        if self.cache_size < 1:
+            raise ValueError("cache_size must be at least 1")
+        if self.message_overhead < 0:
+            raise ValueError("message_overhead must not be negative")
+        if self.max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+
+
+tokenizer_settings = TokenizerSettings()
@@ -0,0 +1,43 @@
+import importlib.util
+from dataclasses import dataclass
+
+# OpenTelemetryのエクスポーターと必要なパッケージ
+OTEL_EXPORTERS = {
+    "otlp": "opentelemetry.exporter.otlp.proto.http.trace_exporter",
+    "console": "opentelemetry.sdk",
+    "file": "opentelemetry.sdk",
+}
+
+@dataclass
+class TracingSettings:
+    server_timing: bool = True  # レスポンスにServer-Timingヘッダーを付ける
+    otel_exporter: str = ""  # OpenTelemetryのスパンの出力先（otlp / console / file）。空の場合は出力しない
+    otel_endpoint: str = "http://localhost:4318/v1/traces"  # otlpの送信先（OTLP/HTTP）
+    otel_file_path: str = ""  # fileの出力先
+    service_name: str = "llamacpp-proxy"
+
+    def validate(self):
+        """設定の検証を行う"""
+        if not self.otel_exporter:
+            return
+        if self.otel_exporter not in OTEL_EXPORTERS:
+            raise ValueError(f"otel_exporter must be one of {', '.join(OTEL_EXPORTERS)}")
+        if self.otel_exporter == "file" and not self.otel_file_path:
+            raise ValueError("otel_file_path must be set when otel_exporter is file")
+        for module in ("opentelemetry.sdk", OTEL_EXPORTERS[self.otel_exporter]):
+            if _find_spec(module) is None:
+                raise ValueError(
+                    f"otel_exporter={self.otel_exporter} requires the '{module}' package "
+                    "(pip install 'llamacpp_proxy[otel]')"
+                )
+
+
+def _find_spec(module: str):
+    """親パッケージがない場合も例外にせずNoneを返す"""
+    try:
+        return importlib.util.find_spec(module)
+    except ModuleNotFoundError:
+        return None
+
+
+tracing_settings = TracingSettings()
@@ -0,0 +1,30 @@
+import importlib.util
+from dataclasses import dataclass
+
+@dataclass
+class UpstreamSettings:
+    max_connections: int = 100  # 上流への最大同時接続数
+    max_keepalive_connections: int = 20  # プールに保持するkeep-alive接続数
+    keepalive_expiry: float = 30.0  # アイドル接続を保持する秒数
+    connect_timeout: float = 10.0
+    read_timeout: float = 300.0  # 生成待ちを含むため長めに設定
+    write_timeout: float = 30.0
+    pool_timeout: float = 30.0  # プールから接続を取得するまでの待ち時間
+    http2: bool = False
+
+    def validate(self):
+        """設定の検証を行う"""
+        if self.max_connections < 1:
+            raise ValueError("max_connections must be at least 1")
+        if self.max_keepalive_connections < 0:
+            raise ValueError("max_keepalive_connections must not be negative")
+        if self.max_keepalive_connections > self.max_connections:
+            raise ValueError("max_keepalive_connections must not exceed max_connections")
+        for name in ("keepalive_expiry", "connect_timeout", "read_timeout", "write_timeout", "pool_timeout"):
+            if getattr(self, name) <= 0:
+                raise ValueError(f"{name} must be positive")
+        if self.http2 and importlib.util.find_spec("h2") is None:
+            raise ValueError("http2 requires the 'h2' package (pip install 'httpx[http2]')")
+
+
+upstream_settings = UpstreamSettings()
@@ -1,29 +1,141 @@
 import argparse
+import asyncio
+import hashlib
 import os
 import logging
+import tempfile
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 import uvicorn
 from fastapi import FastAPI
 
-from llamacpp_proxy.config.settings import settings
+from llamacpp_proxy.config.settings import BackendConfig, settings
 from llamacpp_proxy.config.rate_limit import rate_limit_settings
-from llamacpp_proxy.api.router import router
+from llamacpp_proxy.config.upstream import upstream_settings
+from llamacpp_proxy.config.routing import routing_settings
+from llamacpp_proxy.config.cache import cache_settings
+from llamacpp_proxy.config.server import server_settings
+from llamacpp_proxy.config.tokenizer import tokenizer_settings
+from llamacpp_proxy.config.tracing import tracing_settings
+from llamacpp_proxy.config.log import log_settings
+from llamacpp_proxy.config.streaming import SLOW_CONSUMER_POLICIES, streaming_settings
+from llamacpp_proxy.config.health import health_settings
+from llamacpp_proxy.config.grammar import grammar_settings
+from llamacpp_proxy.config.embedding import embedding_settings
+from llamacpp_proxy.config.environment import SETTINGS_ENV, dump_settings, load_settings
+from llamacpp_proxy.api.router import ops_router, router
+from llamacpp_proxy.middleware.metrics import MetricsMiddleware
+from llamacpp_proxy.middleware.request_log import RequestLogMiddleware
+from llamacpp_proxy.middleware.timing import TimingMiddleware
+from llamacpp_proxy.middleware.rate_limit import RateLimiter
+from llamacpp_proxy.services.balancer import LoadBalancer
+from llamacpp_proxy.services.failover import FailoverPolicy
+from llamacpp_proxy.services.health import HealthMonitor
+from llamacpp_proxy.services.grammar import GrammarCache
+from llamacpp_proxy.services.embedding import EmbeddingBatcher
+from llamacpp_proxy.services.http_client import create_http_client
+from llamacpp_proxy.services.key_store import KeyStore, watch_key_store
+from llamacpp_proxy.services.metrics import metrics
+from llamacpp_proxy.services.request_log import configure_logging
+from llamacpp_proxy.services.response_cache import ResponseCache
+from llamacpp_proxy.services.shared_state import SharedState, remove_database, sync_backend_load
+from llamacpp_proxy.services.singleflight import SingleFlight
+from llamacpp_proxy.services.template import template_cache
+from llamacpp_proxy.services.tokenizer import TokenCounter
+from llamacpp_proxy.services.tracing import configure_tracing, shutdown_tracing
 
 # Load environment variables
 load_dotenv()
 
-# ロギングの設定
+# ロギングの設定（main()やワーカーではconfigure_loggingでキュー経由の出力に置き換える）
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# FastAPIアプリケーションの作成
-app = FastAPI(
-    title="llama.cpp Proxy",
-    description="OpenAI API compatible reverse proxy for llama.cpp server",
-)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """アプリケーション全体で共有するリソースの生成と破棄"""
+    configure_tracing(tracing_settings)
+    shared_state = SharedState(server_settings.shared_state_path) if server_settings.shared_state_path else None
+    app.state.shared_state = shared_state
+    app.state.http_client = create_http_client(upstream_settings)
+    # スロットの使用状況はワーカーごとのため、複数ワーカーではid_slotを指定せずllama.cppに選ばせる
+    app.state.load_balancer = LoadBalancer.from_settings(
+        settings, routing_settings, pin_slots=server_settings.workers == 1
+    )
+    await app.state.load_balancer.refresh_props(app.state.http_client)
+    health_monitor = None
+    if health_settings.interval > 0:
+        # 読み込み中のバックエンドへ最初のリクエストを送らないよう、起動時に一度確認する
+        health_monitor = HealthMonitor(app.state.load_balancer, app.state.http_client, health_settings)
+        await health_monitor.probe_all(force=True)
+    for backend in app.state.load_balancer.backends:
+        logger.info(f"Backend {backend.url}: {backend.slots} slots, n_ctx={backend.n_ctx or 'unknown'}")
+    app.state.response_cache = ResponseCache(cache_settings)
+    app.state.key_store = KeyStore(rate_limit_settings)
+    logger.info(f"Loaded {len(app.state.key_store)} API keys")
+    app.state.rate_limiter = RateLimiter(rate_limit_settings, shared_state=shared_state)
+    app.state.singleflight = SingleFlight() if routing_settings.singleflight else None
+    app.state.failover = FailoverPolicy(routing_settings.max_retries, routing_settings.hedge_percentile)
+    app.state.grammar_cache = GrammarCache(grammar_settings, shared_state)
+    app.state.embedding_batcher = EmbeddingBatcher(
+        app.state.http_client, app.state.load_balancer, embedding_settings, app.state.failover
+    )
+    app.state.token_counter = TokenCounter(app.state.http_client, app.state.load_balancer, tokenizer_settings)
+    metrics.bind(app.state)
+    load_sync = None
+    if shared_state is not None:
+        load_sync = asyncio.create_task(
+            sync_backend_load(app.state.load_balancer, shared_state, server_settings.state_sync_interval)
+        )
+    health_watch = asyncio.create_task(health_monitor.run()) if health_monitor is not None else None
+    key_watch = None
+    if rate_limit_settings.key_file and rate_limit_settings.key_reload_interval > 0:
+        key_watch = asyncio.create_task(watch_key_store(app.state.key_store, rate_limit_settings.key_reload_interval))
+    try:
+        yield
+    finally:
+        if load_sync is not None:
+            load_sync.cancel()
+        if key_watch is not None:
+            key_watch.cancel()
+        if health_watch is not None:
+            health_watch.cancel()
+        app.state.response_cache.close()
+        await app.state.embedding_batcher.close()
+        await app.state.http_client.aclose()
+        if shared_state is not None:
+            shared_state.close()
+        shutdown_tracing()
+
+
+def create_app() -> FastAPI:
+    """FastAPIアプリケーションを生成する
 
-# ルーターの登録
-app.include_router(router)
+    ワーカープロセスでは、親プロセスが環境変数に書き出した設定を読み込んでから生成する。
+    """
+    serialized = os.environ.get(SETTINGS_ENV)
+    if serialized:
+        load_settings(serialized)
+        configure_logging(log_settings)
+        template_cache.configure(settings.template_bytecode_cache_dir)
+
+    app = FastAPI(
+        title="llama.cpp Proxy",
+        description="OpenAI API compatible reverse proxy for llama.cpp server",
+        lifespan=lifespan,
+    )
+
+    # ルーターの登録
+    app.include_router(router)
+    app.include_router(ops_router)
+    app.add_middleware(TimingMiddleware)
+    app.add_middleware(MetricsMiddleware)
+    app.add_middleware(RequestLogMiddleware)
+    return app
+
+
+# FastAPIアプリケーションの作成
+app = create_app()
 
 
 def validate_settings():
@@ -31,6 +143,17 @@ def validate_settings():
     try:
         settings.validate()
         rate_limit_settings.validate()
+        upstream_settings.validate()
+        routing_settings.validate()
+        cache_settings.validate()
+        server_settings.validate()
+        tokenizer_settings.validate()
+        tracing_settings.validate()
+        log_settings.validate()
+        streaming_settings.validate()
+        health_settings.validate()
+        grammar_settings.validate()
+        embedding_settings.validate()
     except ValueError as e:
         logger.error(f"Configuration error: {str(e)}")
         raise
@@ -52,16 +175,325 @@ def main():
         default=8000,
         help="Port to bind to (default: 8000)"
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes (default: 1)",
+    )
+    parser.add_argument(
+        "--shared-state-path",
+        type=str,
+        help="SQLite file for state shared between workers such as rate limits (default: a temporary file when --workers > 1)",
+    )
     parser.add_argument(
         "--llamacpp-server",
-        default="http://localhost:8080",
-        help="URL of the llama.cpp server (default: http://localhost:8080)",
+        action="append",
+        help="URL of a llama.cpp server, repeat to add backends (default: http://localhost:8080)",
+    )
+    parser.add_argument(
+        "--backends-config",
+        type=str,
+        help="Path to a JSON file listing llama.cpp backends and optional slot counts",
+    )
+    parser.add_argument(
+        "--no-prefix-affinity",
+        action="store_true",
+        help="Disable routing requests with the same prompt prefix to the same backend slot",
+    )
+    parser.add_argument(
+        "--affinity-prefix-chars",
+        type=int,
+        default=2048,
+        help="Number of leading prompt characters hashed for /v1/completions affinity (default: 2048)",
+    )
+    parser.add_argument(
+        "--affinity-table-size",
+        type=int,
+        default=10000,
+        help="Maximum number of remembered prompt prefixes (default: 10000)",
+    )
+    parser.add_argument(
+        "--no-singleflight",
+        action="store_true",
+        help="Disable sharing one upstream generation between identical concurrent deterministic requests",
+    )
+    parser.add_argument(
+        "--batch-concurrency",
+        type=int,
+        default=4,
+        help="Maximum number of upstream requests run concurrently for one prompt list / n>1 request (default: 4)",
+    )
+    parser.add_argument(
+        "--max-batch-choices",
+        type=int,
+        default=64,
+        help="Maximum number of choices (prompts x n) per request (default: 64)",
+    )
+    parser.add_argument(
+        "--admission-control",
+        action="store_true",
+        help="Limit concurrent upstream requests per backend and queue the rest by API key priority",
+    )
+    parser.add_argument(
+        "--max-in-flight-per-backend",
+        type=int,
+        default=0,
+        help="Maximum concurrent upstream requests per backend with admission control, 0 uses the slot count (default: 0)",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=100,
+        help="Maximum number of requests waiting for admission before returning 503 (default: 100)",
+    )
+    parser.add_argument(
+        "--max-queue-wait",
+        type=float,
+        default=30.0,
+        help="Maximum seconds a request waits for admission before returning 503 (default: 30.0)",
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=1,
+        help="Times to retry on another backend after a connection error or 5xx before the first token (default: 1)",
+    )
+    parser.add_argument(
+        "--hedge-percentile",
+        type=float,
+        default=0.0,
+        help="Send a streaming request to a second backend when the first token takes longer than "
+        "this percentile, 0 to disable (default: 0)",
+    )
+    parser.add_argument(
+        "--health-check-interval",
+        type=float,
+        default=5.0,
+        help="Seconds between /health and /slots checks of each backend, 0 to disable (default: 5.0)",
+    )
+    parser.add_argument(
+        "--health-check-timeout",
+        type=float,
+        default=2.0,
+        help="Timeout in seconds for a backend health check (default: 2.0)",
+    )
+    parser.add_argument(
+        "--health-failure-threshold",
+        type=int,
+        default=2,
+        help="Consecutive failed checks before a backend is taken out of rotation (default: 2)",
+    )
+    parser.add_argument(
+        "--health-max-backoff",
+        type=float,
+        default=30.0,
+        help="Maximum seconds between checks of a backend out of rotation (default: 30.0)",
+    )
+    parser.add_argument(
+        "--grammar-cache-size",
+        type=int,
+        default=1000,
+        help="Validated grammars and converted JSON schemas to keep in memory (default: 1000)",
+    )
+    parser.add_argument(
+        "--max-registered-grammars",
+        type=int,
+        default=10000,
+        help="Grammars registered with /v1/grammars to keep, oldest first out (default: 10000)",
+    )
+    parser.add_argument(
+        "--max-grammar-bytes",
+        type=int,
+        default=1024 * 1024,
+        help="Maximum size of a grammar, including one converted from a JSON schema (default: 1048576)",
+    )
+    parser.add_argument(
+        "--grammar-cache-max-bytes",
+        type=int,
+        default=64 * 1024 * 1024,
+        help="Total size of validated grammars and converted JSON schemas to keep in memory (default: 67108864)",
+    )
+    parser.add_argument(
+        "--max-registered-grammar-bytes",
+        type=int,
+        default=64 * 1024 * 1024,
+        help="Total size of grammars registered with /v1/grammars to keep, oldest first out (default: 67108864)",
+    )
+    parser.add_argument(
+        "--grammar-offload-threshold",
+        type=int,
+        default=64 * 1024,
+        help="Validate grammars and convert JSON schemas of at least this many bytes in a thread pool, 0 to disable (default: 65536)",
+    )
+    parser.add_argument(
+        "--embedding-batch-window",
+        type=float,
+        default=0.005,
+        help="Seconds to wait for concurrent embedding inputs to send as one upstream batch, 0 to disable (default: 0.005)",
+    )
+    parser.add_argument(
+        "--embedding-max-batch-size",
+        type=int,
+        default=32,
+        help="Maximum inputs per upstream embedding request (default: 32)",
+    )
+    parser.add_argument(
+        "--embedding-max-inputs",
+        type=int,
+        default=2048,
+        help="Maximum inputs per /v1/embeddings request (default: 2048)",
+    )
+    parser.add_argument(
+        "--embedding-cache-size",
+        type=int,
+        default=10000,
+        help="Embeddings to keep in memory, 0 to disable (default: 10000)",
+    )
+    parser.add_argument(
+        "--embedding-cache-max-bytes",
+        type=int,
+        default=256 * 1024 * 1024,
+        help="Maximum size of the embedding cache in bytes (default: 268435456)",
     )
     parser.add_argument(
         "--chat-template-jinja",
         type=str,
         help="Path to chat template file"
     )
+    parser.add_argument(
+        "--template-reload-interval",
+        type=float,
+        default=2.0,
+        help="Seconds between checks of the chat template file for changes, 0 disables hot reload (default: 2.0)",
+    )
+    parser.add_argument(
+        "--template-bytecode-cache-dir",
+        type=str,
+        help="Directory for the Jinja bytecode cache of the chat template",
+    )
+    parser.add_argument(
+        "--template-offload-threshold",
+        type=int,
+        default=64,
+        help="Render chats with at least this many messages in a worker thread, 0 disables (default: 64)",
+    )
+    parser.add_argument(
+        "--no-context-check",
+        action="store_true",
+        help="Do not reject prompts longer than the backend context window before sending them",
+    )
+    parser.add_argument(
+        "--trim-chat-history",
+        action="store_true",
+        help="Drop the oldest chat messages (except system messages) to fit the context window",
+    )
+    parser.add_argument(
+        "--token-cache-size",
+        type=int,
+        default=10000,
+        help="Maximum number of texts whose token counts are cached (default: 10000)",
+    )
+    parser.add_argument(
+        "--message-token-overhead",
+        type=int,
+        default=4,
+        help="Estimated tokens added by the chat template per message (default: 4)",
+    )
+    parser.add_argument(
+        "--tokenize-concurrency",
+        type=int,
+        default=4,
+        help="Maximum concurrent /tokenize requests when counting the messages of one chat request (default: 4)",
+    )
+    parser.add_argument(
+        "--no-server-timing",
+        action="store_true",
+        help="Do not add the Server-Timing header to responses",
+    )
+    parser.add_argument(
+        "--otel-exporter",
+        choices=["otlp", "console", "file"],
+        help="Export OpenTelemetry spans (requires the otel extra)",
+    )
+    parser.add_argument(
+        "--otel-endpoint",
+        default="http://localhost:4318/v1/traces",
+        help="OTLP/HTTP endpoint for --otel-exporter otlp (default: http://localhost:4318/v1/traces)",
+    )
+    parser.add_argument(
+        "--otel-file-path",
+        help="Output file for --otel-exporter file",
+    )
+    parser.add_argument(
+        "--otel-service-name",
+        default="llamacpp-proxy",
+        help="service.name of the exported spans (default: llamacpp-proxy)",
+    )
+    parser.add_argument(
+        "--stream-flush-interval",
+        type=float,
+        default=0.0,
+        help="Seconds to wait after a token to coalesce following tokens into one write, 0 to send immediately (default: 0.0)",
+    )
+    parser.add_argument(
+        "--stream-heartbeat-interval",
+        type=float,
+        default=15.0,
+        help="Send an SSE comment when a stream is idle for this many seconds, 0 to disable (default: 15.0)",
+    )
+    parser.add_argument(
+        "--stream-max-buffer-bytes",
+        type=int,
+        default=1024 * 1024,
+        help="Maximum bytes buffered per stream for a slow client (default: 1048576)",
+    )
+    parser.add_argument(
+        "--slow-consumer-policy",
+        choices=SLOW_CONSUMER_POLICIES,
+        default="abort",
+        help="abort the upstream request or block reading it when the buffer is full (default: abort)",
+    )
+    parser.add_argument(
+        "--log-level",
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        help="Log level (default: INFO)",
+    )
+    parser.add_argument(
+        "--log-format",
+        default="text",
+        choices=["text", "json"],
+        help="Log output format (default: text)",
+    )
+    parser.add_argument(
+        "--log-sample-rate",
+        type=float,
+        default=1.0,
+        help="Fraction of requests whose INFO/DEBUG logs are written, warnings and errors are always written (default: 1.0)",
+    )
+    parser.add_argument(
+        "--log-max-field-chars",
+        type=int,
+        default=256,
+        help="Truncate logged field values to this many characters (default: 256)",
+    )
+    parser.add_argument(
+        "--log-capture-prompts",
+        action="store_true",
+        help="Debug only: log full prompts, messages and grammars instead of redacting them",
+    )
+    parser.add_argument(
+        "--api-key-file",
+        type=str,
+        help="JSON or SQLite (.sqlite/.sqlite3/.db) file of hashed API keys with per-key tier, limits, priority and models",
+    )
+    parser.add_argument(
+        "--api-key-reload-interval",
+        type=float,
+        default=5.0,
+        help="Seconds between checks of --api-key-file for changes, 0 disables hot reload (default: 5.0)",
+    )
     parser.add_argument(
         "--rate-limit-window",
         type=int,
@@ -74,38 +506,256 @@ def main():
         default=10,
         help="Maximum number of requests allowed within the time window (default: 10)",
     )
+    parser.add_argument(
+        "--rate-limit-max-tokens-per-minute",
+        type=int,
+        default=0,
+        help="Maximum number of generated tokens per minute for the limited API key, 0 disables (default: 0)",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Cache responses of deterministic requests (temperature=0 or a fixed seed)",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=3600.0,
+        help="Lifetime of cached responses in seconds (default: 3600)",
+    )
+    parser.add_argument(
+        "--cache-max-entries",
+        type=int,
+        default=10000,
+        help="Maximum number of responses kept in the in-memory cache (default: 10000)",
+    )
+    parser.add_argument(
+        "--cache-max-bytes",
+        type=int,
+        default=64 * 1024 * 1024,
+        help="Maximum total size of the in-memory cache in bytes (default: 64 MiB)",
+    )
+    parser.add_argument(
+        "--cache-disk-path",
+        type=str,
+        help="Path to an SQLite file used as a persistent second-level cache",
+    )
+    parser.add_argument(
+        "--cache-disk-max-bytes",
+        type=int,
+        default=1024 * 1024 * 1024,
+        help="Maximum total size of the disk cache in bytes (default: 1 GiB)",
+    )
+    parser.add_argument(
+        "--upstream-max-connections",
+        type=int,
+        default=100,
+        help="Maximum number of connections to the llama.cpp server (default: 100)",
+    )
+    parser.add_argument(
+        "--upstream-max-keepalive-connections",
+        type=int,
+        default=20,
+        help="Maximum number of idle keep-alive connections kept in the pool (default: 20)",
+    )
+    parser.add_argument(
+        "--upstream-keepalive-expiry",
+        type=float,
+        default=30.0,
+        help="Seconds to keep an idle upstream connection alive (default: 30.0)",
+    )
+    parser.add_argument(
+        "--upstream-connect-timeout",
+        type=float,
+        default=10.0,
+        help="Timeout in seconds for connecting to the llama.cpp server (default: 10.0)",
+    )
+    parser.add_argument(
+        "--upstream-read-timeout",
+        type=float,
+        default=300.0,
+        help="Timeout in seconds for reading from the llama.cpp server (default: 300.0)",
+    )
+    parser.add_argument(
+        "--upstream-write-timeout",
+        type=float,
+        default=30.0,
+        help="Timeout in seconds for writing to the llama.cpp server (default: 30.0)",
+    )
+    parser.add_argument(
+        "--upstream-pool-timeout",
+        type=float,
+        default=30.0,
+        help="Timeout in seconds for acquiring a pooled connection (default: 30.0)",
+    )
+    parser.add_argument(
+        "--upstream-http2",
+        action="store_true",
+        help="Use HTTP/2 for upstream connections (requires httpx[http2])",
+    )
 
     args = parser.parse_args()
 
     # グローバル設定を更新
-    settings.llamacpp_server_url = args.llamacpp_server
+    backends = [BackendConfig(url=url) for url in args.llamacpp_server or []]
+    if args.backends_config:
+        backends += settings.load_backends(args.backends_config)
+    if not backends:
+        backends = [BackendConfig(url="http://localhost:8080")]
+    settings.backends = backends
+    settings.llamacpp_server_url = backends[0].url
+    routing_settings.prefix_affinity = not args.no_prefix_affinity
+    routing_settings.affinity_prefix_chars = args.affinity_prefix_chars
+    routing_settings.affinity_table_size = args.affinity_table_size
+    routing_settings.singleflight = not args.no_singleflight
+    routing_settings.batch_concurrency = args.batch_concurrency
+    routing_settings.max_batch_choices = args.max_batch_choices
+    routing_settings.admission_control = args.admission_control
+    routing_settings.max_in_flight_per_backend = args.max_in_flight_per_backend
+    routing_settings.queue_size = args.queue_size
+    routing_settings.max_queue_wait = args.max_queue_wait
+    routing_settings.max_retries = args.max_retries
+    routing_settings.hedge_percentile = args.hedge_percentile
+    health_settings.interval = args.health_check_interval
+    health_settings.timeout = args.health_check_timeout
+    health_settings.failure_threshold = args.health_failure_threshold
+    health_settings.max_backoff = args.health_max_backoff
+    grammar_settings.cache_size = args.grammar_cache_size
+    grammar_settings.max_registered = args.max_registered_grammars
+    grammar_settings.max_bytes = args.max_grammar_bytes
+    grammar_settings.cache_max_bytes = args.grammar_cache_max_bytes
+    grammar_settings.max_registered_bytes = args.max_registered_grammar_bytes
+    grammar_settings.offload_threshold = args.grammar_offload_threshold
+    embedding_settings.batch_window = args.embedding_batch_window
+    embedding_settings.max_batch_size = args.embedding_max_batch_size
+    embedding_settings.max_inputs = args.embedding_max_inputs
+    embedding_settings.cache_size = args.embedding_cache_size
+    embedding_settings.cache_max_bytes = args.embedding_cache_max_bytes
     settings.chat_template = settings.load_chat_template(args.chat_template_jinja)
+    settings.chat_template_path = args.chat_template_jinja or ""
+    settings.template_reload_interval = args.template_reload_interval
+    settings.template_bytecode_cache_dir = args.template_bytecode_cache_dir or ""
+    settings.template_offload_threshold = args.template_offload_threshold
+    template_cache.configure(settings.template_bytecode_cache_dir)
+    tokenizer_settings.context_check = not args.no_context_check
+    tokenizer_settings.trim_chat_history = args.trim_chat_history
+    tokenizer_settings.cache_size = args.token_cache_size
+    tokenizer_settings.message_overhead = args.message_token_overhead
+    tokenizer_settings.max_concurrency = args.tokenize_concurrency
+    tracing_settings.server_timing = not args.no_server_timing
+    tracing_settings.otel_exporter = args.otel_exporter or ""
+    tracing_settings.otel_endpoint = args.otel_endpoint
+    tracing_settings.otel_file_path = args.otel_file_path or ""
+    tracing_settings.service_name = args.otel_service_name
+    streaming_settings.flush_interval = args.stream_flush_interval
+    streaming_settings.heartbeat_interval = args.stream_heartbeat_interval
+    streaming_settings.max_buffer_bytes = args.stream_max_buffer_bytes
+    streaming_settings.slow_consumer_policy = args.slow_consumer_policy
+    log_settings.level = args.log_level
+    log_settings.format = args.log_format
+    log_settings.sample_rate = args.log_sample_rate
+    log_settings.max_field_chars = args.log_max_field_chars
+    log_settings.capture_prompts = args.log_capture_prompts
     rate_limit_settings.unlimited_api_key = os.getenv("LLAMACPP_PROXY_UNLIMITED_API_KEY")
     rate_limit_settings.limited_api_key = os.getenv("LLAMACPP_PROXY_LIMITED_API_KEY")
+    rate_limit_settings.key_file = args.api_key_file or ""
+    rate_limit_settings.key_reload_interval = args.api_key_reload_interval
     rate_limit_settings.window = args.rate_limit_window
     rate_limit_settings.max_requests = args.rate_limit_max_requests
+    rate_limit_settings.max_tokens_per_minute = args.rate_limit_max_tokens_per_minute
+    cache_settings.enabled = args.cache
+    cache_settings.ttl = args.cache_ttl
+    cache_settings.max_entries = args.cache_max_entries
+    cache_settings.max_bytes = args.cache_max_bytes
+    cache_settings.disk_path = args.cache_disk_path or ""
+    cache_settings.disk_max_bytes = args.cache_disk_max_bytes
+    upstream_settings.max_connections = args.upstream_max_connections
+    upstream_settings.max_keepalive_connections = args.upstream_max_keepalive_connections
+    upstream_settings.keepalive_expiry = args.upstream_keepalive_expiry
+    upstream_settings.connect_timeout = args.upstream_connect_timeout
+    upstream_settings.read_timeout = args.upstream_read_timeout
+    upstream_settings.write_timeout = args.upstream_write_timeout
+    upstream_settings.pool_timeout = args.upstream_pool_timeout
+    upstream_settings.http2 = args.upstream_http2
+    server_settings.workers = args.workers
+    server_settings.shared_state_path = args.shared_state_path or ""
+    temporary_paths = []  # 終了時に削除する一時ファイル
+    if server_settings.workers > 1:
+        if not server_settings.shared_state_path:
+            server_settings.shared_state_path = os.path.join(
+                tempfile.gettempdir(), f"llamacpp-proxy-{os.getpid()}.sqlite"
+            )
+            temporary_paths.append(server_settings.shared_state_path)
+        if cache_settings.enabled and not cache_settings.disk_path:
+            # メモリ上のキャッシュはワーカーごとになるため、ワーカー間で共有するSQLiteを二次キャッシュに使う
+            # （書き込みの多い共有の状態とはロックを分けるため、別のファイルにする）
+            cache_settings.disk_path = os.path.join(
+                tempfile.gettempdir(), f"llamacpp-proxy-{os.getpid()}-cache.sqlite"
+            )
+            temporary_paths.append(cache_settings.disk_path)
 
     # 設定を検証
     validate_settings()
+    configure_logging(log_settings)
 
     # 設定情報のログ出力
     logger.info(f"Starting server on {args.host}:{args.port}")
-    logger.info(f"Proxying requests to {settings.llamacpp_server_url}")
+    logger.info(f"Proxying requests to {', '.join(backend.url for backend in settings.backends)}")
+    logger.info(
+        f"Upstream pool: max_connections={upstream_settings.max_connections}, "
+        f"max_keepalive_connections={upstream_settings.max_keepalive_connections}, "
+        f"http2={upstream_settings.http2}"
+    )
     logger.info(f"Using chat_template from: {args.chat_template_jinja}")
-    logger.info(f"Template content:\n```\n{settings.chat_template}\n```")
+    logger.info(
+        f"Template: {len(settings.chat_template)} chars, "
+        f"sha256={hashlib.sha256(settings.chat_template.encode()).hexdigest()[:16]}"
+    )
+    if log_settings.capture_prompts:
+        logger.warning("Logging full prompts (--log-capture-prompts), do not use in production")
     logger.info(
         f"Rate limit configured: {rate_limit_settings.max_requests} requests per {rate_limit_settings.window} seconds"
     )
 
+    if routing_settings.admission_control:
+        logger.info(
+            f"Admission control enabled: queue_size={routing_settings.queue_size}, "
+            f"max_queue_wait={routing_settings.max_queue_wait}s"
+        )
+
+    if cache_settings.enabled:
+        logger.info(f"Response cache enabled: ttl={cache_settings.ttl}s, disk={cache_settings.disk_path or 'disabled'}")
+
     if rate_limit_settings.unlimited_api_key:
         logger.info("Unlimited API key is configured")
     if rate_limit_settings.limited_api_key:
         logger.info("Rate-limited API key is configured")
-    if not rate_limit_settings.unlimited_api_key and not rate_limit_settings.limited_api_key:
+    if rate_limit_settings.key_file:
+        logger.info(f"Loading API keys from {rate_limit_settings.key_file}")
+    if not rate_limit_settings.unlimited_api_key and not rate_limit_settings.limited_api_key and not rate_limit_settings.key_file:
         logger.warning("No API keys are configured")
 
     # サーバーの起動
-    uvicorn.run(app, host=args.host, port=args.port)
+    if server_settings.workers > 1:
+        logger.info(f"Starting {server_settings.workers} workers, shared state: {server_settings.shared_state_path}")
+        os.environ[SETTINGS_ENV] = dump_settings()
+        try:
+            uvicorn.run(
+                "llamacpp_proxy.main:create_app",
+                factory=True,
+                host=args.host,
+                port=args.port,
+                workers=server_settings.workers,
+                log_config=None,
+                access_log=False,
+            )
+        finally:
+            # 全ワーカーの終了後に削除する
+            for path in temporary_paths:
+                remove_database(path)
+    else:
+        # ログはconfigure_loggingの設定で出力し、アクセスログはRequestLogMiddlewareが出力する
+        uvicorn.run(app, host=args.host, port=args.port, log_config=None, access_log=False)
 
 
 if __name__ == "__main__":
@@ -1,4 +1,4 @@
 from llamacpp_proxy.middleware.auth import get_api_key
-from llamacpp_proxy.middleware.rate_limit import check_rate_limit
+from llamacpp_proxy.middleware.rate_limit import RateLimiter, check_rate_limit
 
-__all__ = ['get_api_key', 'check_rate_limit']
\ No newline at end of file
+__all__ = ['get_api_key', 'check_rate_limit', 'RateLimiter']
@@ -1,8 +1,9 @@
 import logging
-from fastapi import HTTPException, Depends
+from fastapi import HTTPException, Depends, Request
 from fastapi.security import APIKeyHeader
-from starlette.status import HTTP_401_UNAUTHORIZED
-from llamacpp_proxy.config.rate_limit import RateLimitSettings, rate_limit_settings
+from starlette.status import HTTP_401_UNAUTHORIZED, HTTP_403_FORBIDDEN
+from llamacpp_proxy.services.key_store import ApiKey, KeyStore, get_key_store
+from llamacpp_proxy.services.tracing import phase
 
 logger = logging.getLogger(__name__)
 
@@ -12,9 +13,13 @@ api_key_header = APIKeyHeader(name=API_KEY_NAME, auto_error=False)
 
 async def get_api_key(
     api_key: str = Depends(api_key_header),
-    rate_limit_settings: RateLimitSettings = Depends(lambda: rate_limit_settings),
-) -> str:
-    """APIキーを検証する"""
+    key_store: KeyStore = Depends(get_key_store),
+) -> ApiKey:
+    """APIキーを検証し、キーストアのエントリを返す"""
+    with phase("auth"):
+        return _verify_api_key(api_key, key_store)
+
+def _verify_api_key(api_key: str, key_store: KeyStore) -> ApiKey:
     if not api_key:
         logger.warning("No API key provided")
         raise HTTPException(
@@ -26,12 +31,41 @@ async def get_api_key(
     if api_key.startswith("Bearer "):
         api_key = api_key[7:]
 
-    # APIキーの検証
-    if api_key not in [rate_limit_settings.unlimited_api_key, rate_limit_settings.limited_api_key]:
-        logger.warning(f"Invalid API key provided: {api_key}")
+    # APIキーの検証（キーそのものはログに残さない）
+    key = key_store.lookup(api_key)
+    if key is None:
+        logger.warning("Invalid API key provided")
         raise HTTPException(
             status_code=HTTP_401_UNAUTHORIZED,
             detail="Invalid API key"
         )
 
-    return api_key
\ No newline at end of file
+    return key
+
+async def check_model_access(request: Request, api_key: ApiKey = Depends(get_api_key)) -> None:
+    """APIキーに使用できるモデルが設定されている場合、それ以外のモデルへのリクエストを拒否する
+
+    拒否したリクエストをレート制限に数えないよう、check_rate_limitより前に実行する。
+    ボディは依存関係の解決前にデコード済みのため、request.json()はその結果を返す。
+    """
+    if api_key.models is None:
+        return
+    body = await request.json()
+    model = body.get("model") if isinstance(body, dict) else None
+    if isinstance(model, str):
+        ensure_model_allowed(api_key, model)
+
+def ensure_model_allowed(key: ApiKey, model: str) -> None:
+    if key.allows_model(model):
+        return
+    logger.warning(f"API key {key.id} is not allowed to use model {model}")
+    raise HTTPException(
+        status_code=HTTP_403_FORBIDDEN,
+        detail={
+            "error": {
+                "message": f"This API key does not have access to the model '{model}'.",
+                "type": "invalid_request_error",
+                "code": "model_not_allowed",
+            }
+        },
+    )
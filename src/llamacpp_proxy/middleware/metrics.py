@@ -0,0 +1,40 @@
+import time
+from typing import Collection
+
+from llamacpp_proxy.services.metrics import metrics
+
+# メトリクスを記録するエンドポイント（ラベルの種類を固定するため列挙する）
+INSTRUMENTED_PATHS = ("/v1/chat/completions", "/v1/completions", "/v1/embeddings")
+
+
+class MetricsMiddleware:
+    """エンドポイント・APIキーの種別・ステータスごとのリクエスト数とレイテンシを記録するASGIミドルウェア
+
+    ストリーミングの場合は最後のチャンクを送り終えるまでをレイテンシとする。
+    """
+
+    def __init__(self, app, paths: Collection[str] = INSTRUMENTED_PATHS):
+        self.app = app
+        self.paths = frozenset(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            path = scope["path"]
+            tier = scope.get("state", {}).get("key_tier", "none")
+            metrics.requests.inc(path, tier, str(status))
+            metrics.request_duration.observe(time.perf_counter() - started, path)
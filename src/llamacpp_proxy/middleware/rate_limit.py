@@ -1,45 +1,262 @@
+import asyncio
 import logging
-from datetime import datetime, timedelta
-from fastapi import HTTPException, Depends
+import math
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional, Tuple, TypeVar
+from fastapi import HTTPException, Depends, Request, Response
+from starlette.concurrency import run_in_threadpool
 from starlette.status import HTTP_429_TOO_MANY_REQUESTS
-from collections import defaultdict
 
 from llamacpp_proxy.config.rate_limit import RateLimitSettings, rate_limit_settings
+from llamacpp_proxy.middleware.auth import get_api_key
+from llamacpp_proxy.services.key_store import ApiKey
+from llamacpp_proxy.services.shared_state import SharedState
+from llamacpp_proxy.services.tracing import phase
 
 logger = logging.getLogger(__name__)
 
-# レート制限のための辞書
-rate_limit_store = defaultdict(list)
+TOKENS_WINDOW = 60.0  # トークン数の制限の時間窓（秒）
+PRUNE_THRESHOLD = 10000  # キーの数がこれを超えたら期限切れの状態を掃除する（以降は前回の掃除後の2倍を超えたら）
 
-async def check_rate_limit(
-    api_key: str,
-    settings: RateLimitSettings = Depends(lambda: rate_limit_settings),
-) -> None:
-    """レート制限をチェックする"""
-    if api_key == settings.unlimited_api_key:
-        return  # 無制限APIキー
-
-    if api_key != settings.limited_api_key:
-        return  # 不正なAPIキーは認証時に弾かれるのでここではチェックしない
-
-    current_time = datetime.now()
-    request_times = rate_limit_store[api_key]
-
-    # 古いリクエスト履歴の削除
-    request_times = [
-        t
-        for t in request_times
-        if current_time - t < timedelta(seconds=settings.window)
-    ]
-    rate_limit_store[api_key] = request_times
-
-    if len(request_times) >= settings.max_requests:
-        logger.warning(f"Rate limit exceeded for API key: {api_key}")
-        raise HTTPException(
-            status_code=HTTP_429_TOO_MANY_REQUESTS,
-            detail=f"Rate limit exceeded. Maximum {settings.max_requests} requests per {settings.window} seconds.",
+T = TypeVar("T")
+
+
+@dataclass
+class LimitStatus:
+    limit: int
+    remaining: int
+    reset: float  # 制限が完全に回復するまでの秒数
+    retry_after: float = 0.0  # 拒否された場合、次に許可されるまでの秒数
+
+
+class GCRA:
+    """Generic Cell Rate Algorithmによるレート制限
+
+    キーごとに「理論上の到着時刻」(TAT)を1つ保持するだけで、
+    リクエスト数に関係なく判定はO(1)、メモリはキーあたり定数で済む。
+    コストを指定すると、1回で複数単位（生成トークン数など）を消費できる。
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self.clock = clock
+        self._tat: Dict[str, float] = {}
+        self._prune_at = PRUNE_THRESHOLD
+
+    def _update(self, key: str, now: float, decide: Callable[[float], Tuple[Optional[float], T]]) -> T:
+        """キーのTATを読み、decideが新しいTATを返した場合は保存する"""
+        new_tat, result = decide(self._tat.get(key, now))
+        if new_tat is not None:
+            if len(self._tat) >= self._prune_at and key not in self._tat:
+                self._prune(now)
+            self._tat[key] = new_tat
+        return result
+
+    def _prune(self, now: float) -> None:
+        """期限切れの状態を掃除する
+
+        期限内のキーが多く残った場合に新しいキーのたびに掃除しないよう、
+        次の掃除は残ったキーの数の2倍に達するまで行わない（掃除の費用はキーの追加ごとに定数に均される）。
+        """
+        self._tat = {k: tat for k, tat in self._tat.items() if tat > now}
+        self._prune_at = max(PRUNE_THRESHOLD, 2 * len(self._tat))
+
+    @staticmethod
+    def _status(tat: float, now: float, limit: int, period: float) -> LimitStatus:
+        interval = period / limit
+        backlog = max(tat - now, 0.0)
+        remaining = int((period - backlog) / interval + 1e-9)
+        return LimitStatus(limit=limit, remaining=max(remaining, 0), reset=backlog)
+
+    def peek(self, key: str, limit: int, period: float) -> LimitStatus:
+        """消費せずに現在の状態を返す"""
+        now = self.clock()
+        return self._update(key, now, lambda tat: (None, self._status(tat, now, limit, period)))
+
+    def acquire(self, key: str, limit: int, period: float, cost: int = 1) -> LimitStatus:
+        """periodあたりlimit単位を上限としてcost単位を消費する。超える場合は消費せずに拒否する"""
+        now = self.clock()
+
+        def decide(tat: float) -> Tuple[Optional[float], LimitStatus]:
+            tat = max(tat, now)
+            new_tat = tat + period / limit * cost
+            if new_tat - now > period + 1e-9:
+                status = self._status(tat, now, limit, period)
+                status.retry_after = new_tat - period - now
+                return None, status
+            return new_tat, self._status(new_tat, now, limit, period)
+
+        return self._update(key, now, decide)
+
+    def charge(self, key: str, limit: int, period: float, cost: int) -> None:
+        """上限に関係なくcost単位を消費する（実行後に判明したコストの計上用）"""
+        if cost <= 0:
+            return
+        now = self.clock()
+        self._update(key, now, lambda tat: (max(tat, now) + period / limit * cost, None))
+
+    def clear(self) -> None:
+        self._tat.clear()
+        self._prune_at = PRUNE_THRESHOLD
+
+
+class SharedGCRA(GCRA):
+    """TATをワーカー間で共有するSQLiteに保存するGCRA
+
+    判定はSQLiteのロックを待つため、イベントループからはスレッドで呼び出す。
+    """
+
+    def __init__(self, state: SharedState, namespace: str):
+        super().__init__(state.clock)
+        self.state = state
+        self.namespace = namespace
+
+    def _update(self, key: str, now: float, decide: Callable[[float], Tuple[Optional[float], T]]) -> T:
+        with self.state.transaction() as connection:
+            row = connection.execute(
+                "SELECT tat FROM rate_limits WHERE key = ?", (f"{self.namespace}:{key}",)
+            ).fetchone()
+            new_tat, result = decide(row[0] if row is not None else now)
+            if new_tat is not None:
+                connection.execute(
+                    "INSERT OR REPLACE INTO rate_limits (key, tat) VALUES (?, ?)",
+                    (f"{self.namespace}:{key}", new_tat),
+                )
+        return result
+
+    def clear(self) -> None:
+        with self.state.transaction() as connection:
+            connection.execute("DELETE FROM rate_limits WHERE key LIKE ?", (f"{self.namespace}:%",))
+
+
+class RateLimiter:
+    """APIキーごとのリクエスト数と生成トークン数の制限
+
+    リクエスト数はリクエストの受付時に判定する。生成トークン数は事前にわからないため、
+    受付時には残りがあるかだけを判定し、生成後に実際のトークン数を計上する。
+    制限はキーのidごとに数え、キーに制限値がなければ設定の値を使う。
+    ワーカー間で共有する場合（sharedがTrue）、判定はスレッドで行い、計上は完了を待たずにスレッドで行う。
+    """
+
+    def __init__(
+        self,
+        settings: RateLimitSettings,
+        clock: Callable[[], float] = time.monotonic,
+        shared_state: Optional[SharedState] = None,
+    ):
+        self.settings = settings
+        self.shared = shared_state is not None
+        if shared_state is not None:
+            # 複数ワーカーで動かす場合は、カウンターをワーカー間で共有する
+            self.requests: GCRA = SharedGCRA(shared_state, "requests")
+            self.tokens: GCRA = SharedGCRA(shared_state, "tokens")
+        else:
+            self.requests = GCRA(clock)
+            self.tokens = GCRA(clock)
+
+    def is_limited(self, key: ApiKey) -> bool:
+        # 不正なAPIキーは認証時に弾かれるのでここではチェックしない
+        return key.limited
+
+    def limits(self, key: ApiKey) -> Tuple[int, int, int]:
+        """キーの(最大リクエスト数, 時間窓, 1分あたりの最大トークン数)"""
+        settings = self.settings
+        return (
+            key.max_requests if key.max_requests is not None else settings.max_requests,
+            key.window if key.window is not None else settings.window,
+            key.max_tokens_per_minute if key.max_tokens_per_minute is not None else settings.max_tokens_per_minute,
         )
 
-    # 新しいリクエスト時間の追加
-    request_times.append(current_time)
-    logger.debug(f"Request added to rate limit store for API key: {api_key}. Current count: {len(request_times)}")
\ No newline at end of file
+    def check(self, key: ApiKey) -> Dict[str, str]:
+        """リクエストを受け付けられるか判定し、レスポンスに付けるヘッダーを返す
+
+        制限を超えている場合は429を送出する。
+        """
+        if not self.is_limited(key):
+            return {}
+
+        max_requests, window, max_tokens_per_minute = self.limits(key)
+        headers = {}
+        retry_after = 0.0
+        tokens = None
+        if max_tokens_per_minute:
+            tokens = self.tokens.peek(key.id, max_tokens_per_minute, TOKENS_WINDOW)
+            if tokens.remaining < 1:
+                retry_after = tokens.reset - TOKENS_WINDOW + TOKENS_WINDOW / max_tokens_per_minute
+            headers.update(_headers(tokens, "-Tokens"))
+
+        if retry_after <= 0:
+            requests = self.requests.acquire(key.id, max_requests, window)
+            retry_after = requests.retry_after
+            message = f"Rate limit exceeded. Maximum {max_requests} requests per {window} seconds."
+        else:
+            requests = self.requests.peek(key.id, max_requests, window)
+            message = f"Rate limit exceeded. Maximum {max_tokens_per_minute} tokens per minute."
+        headers.update(_headers(requests))
+
+        if retry_after > 0:
+            headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+            logger.warning(f"Rate limit exceeded for API key {key.id}")
+            raise HTTPException(
+                status_code=HTTP_429_TOO_MANY_REQUESTS,
+                detail=message,
+                headers=headers,
+            )
+        return headers
+
+    def charge_tokens(self, key: ApiKey, tokens: int) -> None:
+        """生成されたトークン数を計上する"""
+        if not self.is_limited(key):
+            return
+        max_tokens_per_minute = self.limits(key)[2]
+        if not max_tokens_per_minute:
+            return
+        if self.shared:
+            asyncio.get_running_loop().run_in_executor(
+                None, self._charge_shared, key.id, max_tokens_per_minute, tokens
+            )
+        else:
+            self.tokens.charge(key.id, max_tokens_per_minute, TOKENS_WINDOW, tokens)
+
+    def _charge_shared(self, key_id: str, max_tokens_per_minute: int, tokens: int) -> None:
+        try:
+            self.tokens.charge(key_id, max_tokens_per_minute, TOKENS_WINDOW, tokens)
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to charge {tokens} tokens to API key {key_id}: {str(e)}")
+
+
+def _headers(status: LimitStatus, suffix: str = "") -> Dict[str, str]:
+    return {
+        f"X-RateLimit-Limit{suffix}": str(status.limit),
+        f"X-RateLimit-Remaining{suffix}": str(status.remaining),
+        f"X-RateLimit-Reset{suffix}": str(math.ceil(status.reset)),
+    }
+
+
+def get_rate_limiter(request: Request) -> RateLimiter:
+    """lifespanで生成されたレートリミッターを返す"""
+    return request.app.state.rate_limiter
+
+
+async def check_rate_limit(
+    request: Request,
+    response: Response,
+    api_key: ApiKey = Depends(get_api_key),
+    rate_limiter: RateLimiter = Depends(get_rate_limiter),
+) -> None:
+    """レート制限をチェックし、X-RateLimit-*ヘッダーを設定する"""
+    # メトリクスとアクセスログで参照する
+    request.state.key_tier = api_key.tier
+    request.state.key_id = api_key.id
+    with phase("rate_limit"):
+        if not rate_limiter.shared:
+            response.headers.update(rate_limiter.check(api_key))
+            return
+        try:
+            headers = await run_in_threadpool(rate_limiter.check, api_key)
+        except sqlite3.Error as e:
+            # 共有の状態が使えない場合は、制限をかけずに通す
+            logger.warning(f"Failed to check rate limit for API key {api_key.id}: {str(e)}")
+            return
+        response.headers.update(headers)
@@ -0,0 +1,61 @@
+import logging
+import time
+
+from llamacpp_proxy.config.log import LogSettings, log_settings
+from llamacpp_proxy.services.request_log import bind_request, request_id_from_header, unbind_request
+
+logger = logging.getLogger("llamacpp_proxy.access")
+
+REQUEST_ID_HEADER = b"x-request-id"
+
+
+class RequestLogMiddleware:
+    """リクエストIDを割り当て、リクエストごとに1行のアクセスログを出力するASGIミドルウェア
+
+    クライアントのX-Request-Idを引き継ぎ（ない場合は生成し）、レスポンスのヘッダーに付ける。
+    リクエストの処理中に出力されたログにも同じIDが付く。INFO以下のログはsample_rateの
+    割合のリクエストでのみ出力する。
+    """
+
+    def __init__(self, app, settings: LogSettings = log_settings):
+        self.app = app
+        self.settings = settings
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        incoming = None
+        for key, value in scope["headers"]:
+            if key == REQUEST_ID_HEADER:
+                incoming = value.decode("latin-1")
+                break
+        request_id = request_id_from_header(incoming)
+        tokens = bind_request(request_id, self.settings.sample_rate)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_request_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = [*message.get("headers", []), (REQUEST_ID_HEADER, request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            if logger.isEnabledFor(logging.INFO):
+                client = scope.get("client")
+                key_id = scope.get("state", {}).get("key_id")
+                logger.info(
+                    f"{scope['method']} {scope['path']} {status}",
+                    extra={"fields": {
+                        "status": status,
+                        "duration_ms": round((time.perf_counter() - started) * 1000, 3),
+                        "client": client[0] if client else None,
+                        "key_id": key_id,
+                    }},
+                )
+            unbind_request(tokens)
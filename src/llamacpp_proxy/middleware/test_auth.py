@@ -1,42 +1,55 @@
 import pytest
 from fastapi import HTTPException
-from llamacpp_proxy.middleware.auth import get_api_key
+from llamacpp_proxy.middleware.auth import ensure_model_allowed, get_api_key
 from llamacpp_proxy.config.rate_limit import RateLimitSettings
+from llamacpp_proxy.services.key_store import ApiKey, KeyStore
 
 @pytest.fixture
-def rate_limit_settings():
-    return RateLimitSettings(
+def key_store():
+    return KeyStore(RateLimitSettings(
         unlimited_api_key="test-unlimited",
         limited_api_key="test-limited"
-    )
+    ))
 
 @pytest.mark.asyncio
-async def test_get_api_key_no_key():
+async def test_get_api_key_no_key(key_store):
     with pytest.raises(HTTPException) as exc_info:
-        await get_api_key(None)
+        await get_api_key(None, key_store)
     
     assert exc_info.value.status_code == 401
     assert "API key required" in str(exc_info.value.detail)
 
 @pytest.mark.asyncio
-async def test_get_api_key_invalid(rate_limit_settings):  # フィクスチャを引数として受け取る
+async def test_get_api_key_invalid(key_store, caplog):  # フィクスチャを引数として受け取る
     with pytest.raises(HTTPException) as exc_info:
-        await get_api_key("invalid-key", rate_limit_settings)
+        await get_api_key("invalid-key", key_store)
     
     assert exc_info.value.status_code == 401
     assert "Invalid API key" in str(exc_info.value.detail)
+    # 拒否したキーをログに残さない
+    assert "invalid-key" not in caplog.text
 
 @pytest.mark.asyncio
-async def test_get_api_key_unlimited(rate_limit_settings):
-    result = await get_api_key("test-unlimited", rate_limit_settings)
-    assert result == "test-unlimited"
+async def test_get_api_key_unlimited(key_store):
+    result = await get_api_key("test-unlimited", key_store)
+    assert result.id == "unlimited"
+    assert not result.limited
 
 @pytest.mark.asyncio
-async def test_get_api_key_limited(rate_limit_settings):
-    result = await get_api_key("test-limited", rate_limit_settings)
-    assert result == "test-limited"
+async def test_get_api_key_limited(key_store):
+    result = await get_api_key("test-limited", key_store)
+    assert result.id == "limited"
+    assert result.limited
 
 @pytest.mark.asyncio
-async def test_get_api_key_with_bearer(rate_limit_settings):
-    result = await get_api_key("Bearer test-unlimited", rate_limit_settings)
-    assert result == "test-unlimited"
\ No newline at end of file
+async def test_get_api_key_with_bearer(key_store):
+    result = await get_api_key("Bearer test-unlimited", key_store)
+    assert result.id == "unlimited"
+
+def test_ensure_model_allowed():
+    key = ApiKey(id="team-a", key_hash="0" * 64, models=frozenset({"llama"}))
+    ensure_model_allowed(key, "llama")
+    with pytest.raises(HTTPException) as exc_info:
+        ensure_model_allowed(key, "mixtral")
+    assert exc_info.value.status_code == 403
+    assert exc_info.value.detail["error"]["code"] == "model_not_allowed"
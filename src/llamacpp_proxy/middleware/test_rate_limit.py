@@ -1,8 +1,19 @@
 import pytest
-from datetime import datetime, timedelta
 from fastapi import HTTPException
-from llamacpp_proxy.middleware.rate_limit import check_rate_limit, rate_limit_store
+from llamacpp_proxy.middleware import rate_limit
+from llamacpp_proxy.middleware.rate_limit import GCRA, RateLimiter
 from llamacpp_proxy.config.rate_limit import RateLimitSettings
+from llamacpp_proxy.services.key_store import ApiKey
+
+UNLIMITED = ApiKey(id="unlimited", key_hash="0" * 64, tier="unlimited")
+LIMITED = ApiKey(id="limited", key_hash="1" * 64)
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
 
 @pytest.fixture
 def settings():
@@ -13,48 +24,121 @@ def settings():
         limited_api_key="test-limited"
     )
 
-@pytest.fixture(autouse=True)
-def clear_rate_limit_store():
-    rate_limit_store.clear()
-    yield
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+@pytest.fixture
+def limiter(settings, clock):
+    return RateLimiter(settings, clock)
 
-@pytest.mark.asyncio
-async def test_unlimited_api_key(settings):
+def test_unlimited_api_key(limiter):
     # 無制限APIキーは何度でもリクエスト可能
     for _ in range(10):
-        await check_rate_limit("test-unlimited", settings)
+        assert limiter.check(UNLIMITED) == {}
 
-@pytest.mark.asyncio
-async def test_limited_api_key_within_limit(settings):
+def test_limited_api_key_within_limit(limiter):
     # 制限内のリクエストは許可される
-    await check_rate_limit("test-limited", settings)
-    await check_rate_limit("test-limited", settings)
+    assert limiter.check(LIMITED)["X-RateLimit-Remaining"] == "1"
+    headers = limiter.check(LIMITED)
+    assert headers["X-RateLimit-Limit"] == "2"
+    assert headers["X-RateLimit-Remaining"] == "0"
+    assert headers["X-RateLimit-Reset"] == "60"
 
-@pytest.mark.asyncio
-async def test_limited_api_key_exceeds_limit(settings):
+def test_limited_api_key_exceeds_limit(limiter):
     # 制限を超えるとエラー
-    await check_rate_limit("test-limited", settings)
-    await check_rate_limit("test-limited", settings)
-    
+    limiter.check(LIMITED)
+    limiter.check(LIMITED)
+
     with pytest.raises(HTTPException) as exc_info:
-        await check_rate_limit("test-limited", settings)
-    
+        limiter.check(LIMITED)
+
     assert exc_info.value.status_code == 429
     assert "Rate limit exceeded" in str(exc_info.value.detail)
+    assert exc_info.value.headers["Retry-After"] == "30"
+    assert exc_info.value.headers["X-RateLimit-Remaining"] == "0"
+
+def test_rate_limit_recovers_over_time(limiter, clock):
+    limiter.check(LIMITED)
+    limiter.check(LIMITED)
+
+    # 時間窓/最大リクエスト数ごとに1リクエスト分回復する
+    clock.now += 30
+    limiter.check(LIMITED)
+    with pytest.raises(HTTPException):
+        limiter.check(LIMITED)
+
+def test_rejected_request_is_not_counted(limiter, clock):
+    limiter.check(LIMITED)
+    limiter.check(LIMITED)
+    for _ in range(5):
+        with pytest.raises(HTTPException):
+            limiter.check(LIMITED)
+
+    clock.now += 30
+    limiter.check(LIMITED)
+
+def test_per_key_limits(limiter):
+    # キーの制限値が設定の値より優先される
+    key = ApiKey(id="team-a", key_hash="2" * 64, max_requests=5, window=10)
+    headers = limiter.check(key)
+    assert headers["X-RateLimit-Limit"] == "5"
+    assert headers["X-RateLimit-Reset"] == "2"
+
+def test_keys_with_same_id_share_limits(limiter):
+    other = ApiKey(id="limited", key_hash="3" * 64)
+    limiter.check(LIMITED)
+    limiter.check(other)
+    with pytest.raises(HTTPException):
+        limiter.check(LIMITED)
+
+def test_token_limit(settings, clock):
+    settings.max_requests = 100
+    settings.max_tokens_per_minute = 60
+    limiter = RateLimiter(settings, clock)
+
+    headers = limiter.check(LIMITED)
+    assert headers["X-RateLimit-Remaining-Tokens"] == "60"
+
+    # 生成後に計上したトークン数で次のリクエストが制限される
+    limiter.charge_tokens(LIMITED, 100)
+    with pytest.raises(HTTPException) as exc_info:
+        limiter.check(LIMITED)
+    assert exc_info.value.status_code == 429
+    assert "tokens per minute" in str(exc_info.value.detail)
+    assert exc_info.value.headers["Retry-After"] == "41"
+
+    clock.now += 41
+    assert limiter.check(LIMITED)["X-RateLimit-Remaining-Tokens"] == "1"
+
+def test_unlimited_key_is_not_charged(settings, clock):
+    settings.max_tokens_per_minute = 10
+    limiter = RateLimiter(settings, clock)
+    limiter.charge_tokens(UNLIMITED, 1000)
+    assert limiter.tokens.peek("unlimited", 10, 60).remaining == 10
+
+def test_gcra_constant_state_per_key(clock):
+    gcra = GCRA(clock)
+    for _ in range(1000):
+        gcra.acquire("key", 1000, 1.0)
+        clock.now += 0.001
+    assert len(gcra._tat) == 1
+
+def test_gcra_prune_is_amortised(clock, monkeypatch):
+    monkeypatch.setattr(rate_limit, "PRUNE_THRESHOLD", 4)
+    gcra = GCRA(clock)
+    prunes = []
+    prune = gcra._prune
+    gcra._prune = lambda now: (prunes.append(len(gcra._tat)), prune(now))
+
+    # 期限内のキーしかない間は、キーが2倍になるたびにしか掃除しない
+    for i in range(64):
+        gcra.acquire(f"key-{i}", 1, 60.0)
+    assert prunes == [4, 8, 16, 32]
+    assert len(gcra._tat) == 64
 
-@pytest.mark.asyncio
-async def test_rate_limit_window_reset(settings):
-    # 1回目のリクエスト
-    await check_rate_limit("test-limited", settings)
-    
-    # 古いリクエストを作成（ウィンドウ外）
-    old_time = datetime.now() - timedelta(seconds=settings.window + 1)
-    rate_limit_store["test-limited"].append(old_time)
-    
-    # 2回目のリクエスト（古いリクエストは無視される）
-    await check_rate_limit("test-limited", settings)
-
-@pytest.mark.asyncio
-async def test_invalid_api_key(settings):
-    # 不正なAPIキーはレート制限チェックをスキップ（認証で弾かれる）
-    await check_rate_limit("invalid-key", settings)
\ No newline at end of file
+    # 期限切れのキーは、次の掃除で消える
+    clock.now += 61.0
+    gcra.acquire("new", 1, 60.0)
+    assert prunes[-1] == 64
+    assert list(gcra._tat) == ["new"]
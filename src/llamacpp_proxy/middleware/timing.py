@@ -0,0 +1,44 @@
+from typing import Collection
+
+from llamacpp_proxy.config.tracing import TracingSettings, tracing_settings
+from llamacpp_proxy.middleware.metrics import INSTRUMENTED_PATHS
+from llamacpp_proxy.services.tracing import end_request, start_request
+
+
+class TimingMiddleware:
+    """リクエストの処理時間をフェーズごとに計測するASGIミドルウェア
+
+    各フェーズはservices.tracing.phaseで記録され、レスポンスの送信開始時点までの結果を
+    Server-Timingヘッダーとして返す。OpenTelemetryが有効な場合はリクエストのスパンも出力する。
+    """
+
+    def __init__(self, app, settings: TracingSettings = tracing_settings, paths: Collection[str] = INSTRUMENTED_PATHS):
+        self.app = app
+        self.settings = settings
+        self.paths = frozenset(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        headers = {key.decode("latin-1"): value.decode("latin-1") for key, value in scope["headers"]}
+        timing, token = start_request(f"{scope['method']} {scope['path']}", headers)
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if self.settings.server_timing:
+                    message["headers"] = [
+                        *message.get("headers", []),
+                        (b"server-timing", timing.server_timing().encode("latin-1")),
+                    ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            end_request(token)
+            timing.finish(status)
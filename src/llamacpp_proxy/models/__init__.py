@@ -9,6 +9,17 @@ from llamacpp_proxy.models.completion import (
     CompletionResponseChoice,
     CompletionResponse,
 )
+from llamacpp_proxy.models.embedding import (
+    EmbeddingRequest,
+    Embedding,
+    EmbeddingResponse,
+)
+from llamacpp_proxy.models.grammar import (
+    JsonSchemaFormat,
+    ResponseFormat,
+    GrammarRegistration,
+    GrammarObject,
+)
 
 __all__ = [
     'Message',
@@ -18,4 +29,11 @@ __all__ = [
     'CompletionRequest',
     'CompletionResponseChoice',
     'CompletionResponse',
+    'EmbeddingRequest',
+    'Embedding',
+    'EmbeddingResponse',
+    'JsonSchemaFormat',
+    'ResponseFormat',
+    'GrammarRegistration',
+    'GrammarObject',
 ]
\ No newline at end of file
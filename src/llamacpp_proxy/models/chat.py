@@ -1,6 +1,8 @@
 from typing import Dict, List, Optional, Union
 from pydantic import BaseModel
 
+from llamacpp_proxy.models.grammar import ResponseFormat
+
 class Message(BaseModel):
     role: str
     content: str
@@ -17,10 +19,13 @@ class ChatCompletionRequest(BaseModel):
     max_tokens: Optional[int] = None
     presence_penalty: Optional[float] = 0.0
     frequency_penalty: Optional[float] = 0.0
+    seed: Optional[int] = None
     user: Optional[str] = None
+    response_format: Optional[ResponseFormat] = None
 
     # extra_body
     llamacpp_proxy_grammar: Optional[str] = None
+    llamacpp_proxy_grammar_id: Optional[str] = None  # /v1/grammarsで登録したgrammarのID
 
 class CompletionChoice(BaseModel):
     index: int
@@ -2,6 +2,8 @@ from typing import Any, Dict, List, Optional, Union
 from pydantic import BaseModel, Field, validator
 from fastapi import HTTPException
 
+from llamacpp_proxy.models.grammar import ResponseFormat
+
 class CompletionRequest(BaseModel):
     model: str
     prompt: Union[str, List[str]]
@@ -14,15 +16,18 @@ class CompletionRequest(BaseModel):
     stop: Optional[Union[str, List[str]]] = None
     presence_penalty: Optional[float] = 0.0
     frequency_penalty: Optional[float] = 0.0
+    seed: Optional[int] = None
     # これらのパラメータは現在サポートしていない
     echo: Optional[bool] = Field(False, info="Not supported")
     suffix: Optional[str] = Field(None, info="Not supported")
     best_of: Optional[int] = Field(1, info="Not supported")
     logit_bias: Optional[Dict[str, float]] = Field(None, info="Not supported")
     user: Optional[str] = None
+    response_format: Optional[ResponseFormat] = None
 
     # extra parameter for llamacpp
     llamacpp_proxy_grammar: Optional[str] = None
+    llamacpp_proxy_grammar_id: Optional[str] = None  # /v1/grammarsで登録したgrammarのID
 
     """
     @validator('n')
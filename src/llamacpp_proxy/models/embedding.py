@@ -0,0 +1,20 @@
+from typing import Dict, List, Literal, Optional, Union
+from pydantic import BaseModel
+
+class EmbeddingRequest(BaseModel):
+    model: str
+    # 文字列・文字列のリスト・トークンIDのリスト・トークンIDのリストのリスト
+    input: Union[str, List[str], List[int], List[List[int]]]
+    encoding_format: Optional[Literal["float", "base64"]] = "float"
+    user: Optional[str] = None
+
+class Embedding(BaseModel):
+    object: str = "embedding"
+    embedding: Union[List[float], str]
+    index: int
+
+class EmbeddingResponse(BaseModel):
+    object: str = "list"
+    data: List[Embedding]
+    model: str
+    usage: Dict[str, int]
@@ -0,0 +1,30 @@
+from typing import Any, Dict, Literal, Optional
+from pydantic import BaseModel, ConfigDict, Field
+
+class JsonSchemaFormat(BaseModel):
+    model_config = ConfigDict(populate_by_name=True)
+
+    name: Optional[str] = None
+    description: Optional[str] = None
+    # BaseModel.schemaと衝突するためエイリアスで受け取る
+    schema_: Dict[str, Any] = Field(default_factory=dict, alias="schema")
+    strict: Optional[bool] = None
+
+class ResponseFormat(BaseModel):
+    model_config = ConfigDict(populate_by_name=True)
+
+    type: Literal["text", "json_object", "json_schema"] = "text"
+    json_schema: Optional[JsonSchemaFormat] = None
+    # llama.cppの拡張: {"type": "json_object", "schema": {...}}
+    schema_: Optional[Dict[str, Any]] = Field(None, alias="schema")
+
+class GrammarRegistration(BaseModel):
+    """/v1/grammarsへの登録リクエスト（grammarかjson_schemaのどちらか）"""
+    grammar: Optional[str] = None
+    json_schema: Optional[Dict[str, Any]] = None
+
+class GrammarObject(BaseModel):
+    id: str
+    object: str = "grammar"
+    bytes: int
+    grammar: Optional[str] = None
@@ -48,4 +48,17 @@ def test_message_name_optional():
     assert message.name is None
     
     message_with_name = Message(role="user", content="test message", name="test-name")
-    assert message_with_name.name == "test-name"
\ No newline at end of file
+    assert message_with_name.name == "test-name"
+
+def test_response_format_json_schema():
+    request = ChatCompletionRequest.model_validate({
+        "model": "test-model",
+        "messages": [{"role": "user", "content": "Hello"}],
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {"name": "answer", "schema": {"type": "object"}, "strict": True},
+        },
+    })
+    assert request.response_format.type == "json_schema"
+    assert request.response_format.json_schema.schema_ == {"type": "object"}
+    assert request.llamacpp_proxy_grammar_id is None
@@ -1,4 +1,5 @@
 from llamacpp_proxy.services.llama import LlamaClient
+from llamacpp_proxy.services.llamacpp import LlamaCppClient
 from llamacpp_proxy.services.template import TemplateService
 
-__all__ = ['LlamaClient', 'TemplateService']
\ No newline at end of file
+__all__ = ['LlamaClient', 'LlamaCppClient', 'TemplateService']
@@ -0,0 +1,150 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import time
+from typing import Dict, List, Optional
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+# 待ち行列の優先度（小さいほど先に処理される）
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+
+# リクエストごとに最大待ち時間（秒）を指定するヘッダー
+MAX_QUEUE_WAIT_HEADER = "X-Max-Queue-Wait"
+
+def parse_max_queue_wait(value: Optional[str]) -> Optional[float]:
+    """X-Max-Queue-Waitヘッダーの値を秒数に変換する（不正な値は無視する）"""
+    if value is None:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        return None
+    if math.isnan(seconds) or seconds < 0:
+        return None
+    return seconds
+
+
+class AdmissionController:
+    """上流へ同時に送るリクエスト数を制限し、超えた分を優先度付きの待ち行列で待たせる
+
+    空きが出ると、待ち行列の先頭のリクエストへ処理中の枠をそのまま引き渡す。
+    待ち行列が満杯の場合と、待ち時間が上限を超えた場合は503を返す。
+    """
+
+    def __init__(self, queue_size: int, max_wait: float):
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.admitted = 0  # 処理中の枠を持っているリクエスト数
+        self._waiters: List[list] = []  # [priority, seq, future] のヒープ
+        self._queued = 0
+        self._seq = itertools.count()
+        self.rejected = 0  # 待ち行列が満杯で拒否した数
+        self.timed_out = 0  # 待ち時間の上限を超えた数
+        self.queued_total = 0  # 待ち行列に入った数
+        self.wait_seconds_total = 0.0
+        self.avg_wait = 0.0  # 待ち時間の指数移動平均
+        self.avg_service = 1.0  # 処理時間の指数移動平均（Retry-Afterの見積もりに使う）
+
+    def queue_depth(self) -> int:
+        return self._queued
+
+    def retry_after(self, capacity: int) -> int:
+        """現在の待ち行列が捌けるまでの見積もり秒数"""
+        estimate = self.avg_service * (self._queued + 1) / max(capacity, 1)
+        return max(1, math.ceil(estimate))
+
+    def _overloaded(self, message: str, capacity: int) -> HTTPException:
+        return HTTPException(
+            status_code=503,
+            detail={
+                "error": {
+                    "message": message,
+                    "type": "server_error",
+                    "code": "server_overloaded",
+                }
+            },
+            headers={"Retry-After": str(self.retry_after(capacity))},
+        )
+
+    async def admit(self, capacity: int, priority: int = PRIORITY_NORMAL, max_wait: Optional[float] = None) -> None:
+        """処理中の枠を確保する。空きがなければ優先度順に待つ"""
+        if self.admitted < capacity and not self._queued:
+            self.admitted += 1
+            return
+        if self._queued >= self.queue_size:
+            self.rejected += 1
+            raise self._overloaded("Server is busy, the request queue is full", capacity)
+
+        wait = self.wait_limit(max_wait)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, [priority, next(self._seq), future])
+        self._queued += 1
+        self.queued_total += 1
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(future, wait)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                return self._record_wait(started)  # タイムアウトと同時に枠を引き渡された
+            self._queued -= 1
+            raise self.timeout(wait, capacity)
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()  # 引き渡された枠を次の待ち手へ回す
+            else:
+                self._queued -= 1
+            raise
+        self._record_wait(started)
+
+    def wait_limit(self, max_wait: Optional[float] = None) -> float:
+        """リクエストが待ち行列で待てる最大の秒数"""
+        return self.max_wait if max_wait is None else min(max_wait, self.max_wait)
+
+    def timeout(self, wait: float, capacity: int) -> HTTPException:
+        """待ち時間の上限を超えたリクエストを拒否する503を返す"""
+        self.timed_out += 1
+        return self._overloaded(f"Request waited in queue for more than {wait:g} seconds", capacity)
+
+    def _record_wait(self, started: float) -> None:
+        waited = time.monotonic() - started
+        self.wait_seconds_total += waited
+        self.avg_wait = 0.9 * self.avg_wait + 0.1 * waited
+
+    def release(self, service_time: Optional[float] = None) -> None:
+        """処理中の枠を返す。待っているリクエストがあればその枠を引き渡す"""
+        if service_time is not None:
+            self.avg_service = 0.9 * self.avg_service + 0.1 * service_time
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue  # タイムアウトまたはキャンセル済み
+            self._queued -= 1
+            future.set_result(None)
+            return
+        self.admitted -= 1
+
+    def wake(self, capacity: int) -> None:
+        """上限が増えた場合に、空いた分だけ待っているリクエストを通す"""
+        while self.admitted < capacity and self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self._queued -= 1
+            self.admitted += 1
+            future.set_result(None)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "admitted": self.admitted,
+            "queue_depth": self._queued,
+            "queued_total": self.queued_total,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "wait_seconds_total": self.wait_seconds_total,
+            "avg_wait_seconds": self.avg_wait,
+        }
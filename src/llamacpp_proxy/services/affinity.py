@@ -0,0 +1,76 @@
+import hashlib
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from llamacpp_proxy.models.chat import Message
+
+def chat_affinity_key(messages: List[Message], conversation_id: Optional[str] = None) -> str:
+    """チャットのアフィニティキーを生成
+
+    会話IDがあればそれを使い、なければ最初のユーザーメッセージまで
+    （システムプロンプトを含む）の内容をハッシュする。この部分は同じ会話の
+    後続ターンでも変わらず、レンダリング後のプロンプトの先頭になる。
+    """
+    digest = hashlib.sha256()
+    if conversation_id:
+        digest.update(b"conversation\0")
+        digest.update(conversation_id.encode())
+        return digest.hexdigest()
+
+    for message in messages:
+        digest.update(message.role.encode())
+        digest.update(b"\0")
+        digest.update(message.content.encode())
+        digest.update(b"\0")
+        if message.role == "user":
+            break
+    return digest.hexdigest()
+
+def prompt_affinity_key(prompt: str, prefix_chars: int) -> str:
+    """プロンプトの先頭部分からアフィニティキーを生成"""
+    return hashlib.sha256(prompt[:prefix_chars].encode()).hexdigest()
+
+
+class AffinityTable:
+    """アフィニティキーから(バックエンドURL, スロットID)への対応を保持するLRU表
+
+    スロットを固定しない場合、スロットIDはNoneになる。
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Tuple[str, Optional[int]]]" = OrderedDict()
+        self.hits = 0  # 前回と同じスロットへ送れた
+        self.misses = 0  # 初めてのキー
+        self.fallbacks = 0  # 前回のスロットが使用中などで別のスロットへ送った
+
+    def get(self, key: str) -> Optional[Tuple[str, Optional[int]]]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def peek(self, key: str) -> Optional[str]:
+        """LRUの順序を変えずに、キーの割り当て先のバックエンドURLを返す"""
+        entry = self._entries.get(key)
+        return entry[0] if entry is not None else None
+
+    def put(self, key: str, backend_url: str, slot_id: Optional[int]) -> None:
+        self._entries[key] = (backend_url, slot_id)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, float]:
+        """プレフィックスのヒット率などの統計を返す"""
+        lookups = self.hits + self.misses + self.fallbacks
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "fallbacks": self.fallbacks,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
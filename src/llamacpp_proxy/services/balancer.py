@@ -0,0 +1,319 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Collection, Dict, List, Optional, Set
+import httpx
+from fastapi import HTTPException, Request
+
+from llamacpp_proxy.config.routing import RoutingSettings
+from llamacpp_proxy.config.settings import Settings
+from llamacpp_proxy.services.admission import PRIORITY_NORMAL, AdmissionController
+from llamacpp_proxy.services.affinity import AffinityTable
+from llamacpp_proxy.services.tracing import phase
+
+logger = logging.getLogger(__name__)
+
+# ヘルスチェックで判定したバックエンドの状態
+BACKEND_UNKNOWN = "unknown"  # まだ確認していない
+BACKEND_READY = "ready"
+BACKEND_BUSY = "busy"  # 全スロットが処理中（割り当ての対象には残す）
+BACKEND_LOADING = "loading"  # モデルの読み込み中
+BACKEND_DOWN = "down"  # 接続できない、またはエラーを返す
+
+@dataclass(eq=False)
+class Backend:
+    url: str
+    slots: int = 1  # llama.cppの並列スロット数
+    slots_configured: bool = False  # Trueの場合は/propsの値で上書きしない
+    max_in_flight: Optional[int] = None  # アドミッション制御での同時処理数の上限（Noneはスロット数）
+    n_ctx: int = 0  # スロットあたりのコンテキスト長（0は不明）
+    in_flight: int = 0
+    remote_in_flight: int = 0  # 他のワーカープロセスからの処理中リクエスト数
+    queued: int = 0  # アドミッション制御で待っている、アフィニティの割り当て先がこのバックエンドのリクエスト数
+    busy_slots: Set[int] = field(default_factory=set)  # このプロキシが使用中のスロットID
+    slot_last_used: Dict[int, float] = field(default_factory=dict)
+    state: str = BACKEND_UNKNOWN
+    healthy: bool = True  # Falseの間は回路遮断器が開いており、割り当ての対象から外す
+
+    def load(self) -> float:
+        """このバックエンドにもう1件割り当てた場合のスロットあたりの負荷"""
+        return (self.in_flight + self.remote_in_flight + 1) / self.slots
+
+    def has_free_slot(self) -> bool:
+        return self.in_flight + self.remote_in_flight < self.slots
+
+    def limit(self) -> int:
+        return self.max_in_flight or self.slots
+
+    def under_limit(self) -> bool:
+        """アドミッション制御での同時処理数の上限に空きがあるか"""
+        return self.in_flight + self.remote_in_flight < self.limit()
+
+    def free_slot(self) -> Optional[int]:
+        """最も長く使われていない空きスロットを返す"""
+        free = [slot_id for slot_id in range(self.slots) if slot_id not in self.busy_slots]
+        if not free:
+            return None
+        return min(free, key=lambda slot_id: self.slot_last_used.get(slot_id, 0.0))
+
+
+@dataclass
+class Lease:
+    backend: Backend
+    slot_id: Optional[int] = None  # Noneの場合はllama.cppにスロットを選ばせる
+
+
+class LoadBalancer:
+    """処理中リクエスト数が最も少ないバックエンドへ振り分ける
+
+    処理中リクエスト数はバックエンドのスロット数で重み付けする。
+    アフィニティキーが指定された場合は、KVキャッシュを再利用できるよう
+    前回と同じバックエンドのスロットへ送る。pin_slotsがFalseの場合はバックエンドだけを固定し、
+    スロットはllama.cppに選ばせる（使用中のスロットを知らない他のワーカーと同じスロットを指定しないため）。
+    アドミッション制御が有効な場合は、全バックエンドの上限の合計を超えた分を待たせる。
+    枠を得ても、除外したバックエンドの分の枠だった場合など全バックエンドが上限に達している場合は、
+    上限を超えて割り当てずに空きが出るまで待たせる。
+    """
+
+    def __init__(
+        self,
+        backends: List[Backend],
+        affinity: Optional[AffinityTable] = None,
+        admission: Optional[AdmissionController] = None,
+        pin_slots: bool = True,
+    ):
+        self.backends = backends
+        self.affinity = affinity
+        self.admission = admission
+        self.pin_slots = pin_slots
+        self._rotation = 0  # 負荷が同じ場合に順番に振り分けるためのカウンタ
+        self._room = asyncio.Event()  # 処理中の数や上限が変わるたびにsetして差し替える
+
+    @classmethod
+    def from_settings(
+        cls, settings: Settings, routing_settings: Optional[RoutingSettings] = None, pin_slots: bool = True
+    ) -> "LoadBalancer":
+        affinity = None
+        admission = None
+        max_in_flight = None
+        if routing_settings is not None:
+            if routing_settings.prefix_affinity:
+                affinity = AffinityTable(routing_settings.affinity_table_size)
+            if routing_settings.admission_control:
+                admission = AdmissionController(routing_settings.queue_size, routing_settings.max_queue_wait)
+                max_in_flight = routing_settings.max_in_flight_per_backend or None
+        return cls(
+            [
+                Backend(
+                    url=config.url.rstrip("/"),
+                    slots=config.slots or 1,
+                    slots_configured=config.slots is not None,
+                    max_in_flight=max_in_flight,
+                )
+                for config in settings.backend_configs()
+            ],
+            affinity,
+            admission,
+            pin_slots,
+        )
+
+    def capacity(self) -> int:
+        """アドミッション制御で同時に処理できるリクエスト数（他のワーカーの処理中の分を除く）"""
+        return max(
+            sum(backend.limit() - backend.remote_in_flight for backend in self.backends if backend.healthy), 0
+        )
+
+    def context_size(self) -> int:
+        """全バックエンドで収まるコンテキスト長（不明な場合は0）"""
+        sizes = [backend.n_ctx for backend in self.backends if backend.n_ctx > 0]
+        return min(sizes) if sizes else 0
+
+    def set_remote_load(self, remote_in_flight: Dict[str, int]) -> None:
+        """他のワーカーの処理中リクエスト数を反映する"""
+        for backend in self.backends:
+            backend.remote_in_flight = remote_in_flight.get(backend.url, 0)
+        self.wake()
+
+    def wake(self) -> None:
+        """処理中の数や上限が変わったことを、待ち行列と上限の空きを待っているリクエストへ知らせる"""
+        if self.admission is not None:
+            self.admission.wake(self.capacity())
+        self._notify_room()
+
+    def _notify_room(self) -> None:
+        room, self._room = self._room, asyncio.Event()
+        room.set()
+
+    def _candidates(self, exclude: Collection[Backend]) -> List[Backend]:
+        candidates = [backend for backend in self.backends if backend.healthy and backend not in exclude]
+        if not candidates:
+            raise HTTPException(status_code=503, detail="No llama.cpp backend available")
+        return candidates
+
+    def choose(self, exclude: Collection[Backend] = ()) -> Backend:
+        """割り当て先のバックエンドを選択する
+
+        アドミッション制御が有効な場合は上限に空きのあるバックエンドを優先する。
+        上限を超えないことはacquireで保証する（トークン化など枠を使わない処理は上限を超えて送ってよい）。
+        """
+        candidates = self._candidates(exclude)
+        if self.admission is not None:
+            candidates = [b for b in candidates if b.under_limit()] or candidates
+
+        start = self._rotation % len(candidates)
+        self._rotation += 1
+        rotated = candidates[start:] + candidates[:start]
+        return min(rotated, key=Backend.load)
+
+    def has_idle_backend(self, exclude: Collection[Backend] = ()) -> bool:
+        """除外したもの以外に空きスロットのあるバックエンドがあり、待たずに割り当てられるか"""
+        if self.admission is not None and (
+            self.admission.queue_depth() or self.admission.admitted >= self.capacity()
+        ):
+            return False
+        return any(
+            backend.healthy and backend.has_free_slot() for backend in self.backends if backend not in exclude
+        )
+
+    def lease(self, affinity_key: Optional[str] = None, exclude: Collection[Backend] = ()) -> Optional[Lease]:
+        """バックエンドとスロットを選択する
+
+        アドミッション制御が有効で、除外したもの以外の全バックエンドが上限に達している場合はNoneを返す。
+        """
+        if self.admission is not None and not any(b.under_limit() for b in self._candidates(exclude)):
+            return None
+        if affinity_key is None or self.affinity is None:
+            return Lease(self.choose(exclude))
+
+        entry = self.affinity.get(affinity_key)
+        if entry is not None:
+            url, slot_id = entry
+            backend = next((b for b in self.backends if b.url == url), None)
+            if (
+                backend is not None
+                and backend.healthy
+                and backend not in exclude
+                and backend.has_free_slot()
+                and (self.admission is None or backend.under_limit())
+                and (slot_id is None or (slot_id < backend.slots and slot_id not in backend.busy_slots))
+            ):
+                self.affinity.hits += 1
+                return Lease(backend, slot_id)
+            self.affinity.fallbacks += 1
+        else:
+            self.affinity.misses += 1
+
+        backend = self.choose(exclude)
+        if not self.pin_slots:
+            self.affinity.put(affinity_key, backend.url, None)
+            return Lease(backend)
+        slot_id = backend.free_slot() if backend.has_free_slot() else None
+        if slot_id is not None:
+            self.affinity.put(affinity_key, backend.url, slot_id)
+        return Lease(backend, slot_id)
+
+    @asynccontextmanager
+    async def acquire(
+        self,
+        affinity_key: Optional[str] = None,
+        exclude: Collection[Backend] = (),
+        priority: int = PRIORITY_NORMAL,
+        max_queue_wait: Optional[float] = None,
+    ) -> AsyncIterator[Lease]:
+        """バックエンドを選択し、処理が終わるまで処理中として数える
+
+        アドミッション制御が有効な場合は、空きが出るまで優先度順に待ってから選択する。
+        待っている間は、アフィニティの割り当て先のバックエンドの待ち数（Backend.queued）に数える。
+        """
+        target = self._affinity_target(affinity_key)
+        if target is not None:
+            target.queued += 1
+        try:
+            if self.admission is not None:
+                with phase("queue"):
+                    await self.admission.admit(self.capacity(), priority, max_queue_wait)
+            started = time.monotonic()
+            try:
+                lease = self.lease(affinity_key, exclude)
+                while lease is None:
+                    with phase("queue"):
+                        await self._wait_for_room(started, max_queue_wait)
+                    lease = self.lease(affinity_key, exclude)
+            except BaseException:
+                if self.admission is not None:
+                    self.admission.release()
+                raise
+        finally:
+            if target is not None:
+                target.queued -= 1
+        backend = lease.backend
+        backend.in_flight += 1
+        if lease.slot_id is not None:
+            backend.busy_slots.add(lease.slot_id)
+        try:
+            yield lease
+        finally:
+            backend.in_flight -= 1
+            if lease.slot_id is not None:
+                backend.busy_slots.discard(lease.slot_id)
+                backend.slot_last_used[lease.slot_id] = time.monotonic()
+            if self.admission is not None:
+                self.admission.release(time.monotonic() - started)
+                self._notify_room()
+
+    def _affinity_target(self, affinity_key: Optional[str]) -> Optional[Backend]:
+        """アドミッション制御で待つ場合に、アフィニティで割り当てられる見込みのバックエンド"""
+        if self.admission is None or self.affinity is None or affinity_key is None:
+            return None
+        url = self.affinity.peek(affinity_key)
+        return next((b for b in self.backends if b.url == url), None) if url is not None else None
+
+    async def _wait_for_room(self, started: float, max_queue_wait: Optional[float]) -> None:
+        """枠を持ったまま、いずれかのバックエンドの上限に空きが出るまで待つ"""
+        wait = self.admission.wait_limit(max_queue_wait)
+        remaining = wait - (time.monotonic() - started)
+        try:
+            await asyncio.wait_for(self._room.wait(), max(remaining, 0))
+        except asyncio.TimeoutError:
+            raise self.admission.timeout(wait, self.capacity())
+
+    async def refresh_props(self, http_client: httpx.AsyncClient) -> None:
+        """各バックエンドの/propsからスロット数とコンテキスト長を取得する"""
+        for backend in self.backends:
+            try:
+                response = await http_client.get(f"{backend.url}/props")
+                response.raise_for_status()
+                props = response.json()
+            except (httpx.HTTPError, ValueError) as e:
+                logger.warning(f"Failed to fetch props from {backend.url}: {str(e)}")
+                continue
+            total_slots = props.get("total_slots")
+            if not backend.slots_configured and isinstance(total_slots, int) and total_slots > 0:
+                backend.slots = total_slots
+            # default_generation_settingsのn_ctxはスロットあたりのコンテキスト長
+            n_ctx = (props.get("default_generation_settings") or {}).get("n_ctx", props.get("n_ctx"))
+            if isinstance(n_ctx, int) and n_ctx > 0:
+                backend.n_ctx = n_ctx
+        self.wake()
+
+    def stats(self) -> List[dict]:
+        """バックエンドごとの負荷状況を返す"""
+        return [
+            {
+                "url": backend.url,
+                "slots": backend.slots,
+                "in_flight": backend.in_flight,
+                "max_in_flight": backend.limit(),
+                "queued": backend.queued,
+                "state": backend.state,
+                "healthy": backend.healthy,
+            }
+            for backend in self.backends
+        ]
+
+
+def get_load_balancer(request: Request) -> LoadBalancer:
+    """lifespanで生成されたロードバランサーを返す"""
+    return request.app.state.load_balancer
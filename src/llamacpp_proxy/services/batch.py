@@ -0,0 +1,118 @@
+import asyncio
+from functools import partial
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, TypeVar
+from fastapi import HTTPException
+
+T = TypeVar("T")
+
+async def gather_bounded(factories: List[Callable[[], Awaitable[T]]], limit: int) -> List[T]:
+    """同時実行数を制限して並行に実行し、結果を入力と同じ順序で返す
+
+    いずれかが失敗した場合は残りをキャンセルして例外を送出する。
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(factory: Callable[[], Awaitable[T]]) -> T:
+        async with semaphore:
+            return await factory()
+
+    tasks = [asyncio.ensure_future(run(factory)) for factory in factories]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+async def open_streams(factories: List[Callable[[], Awaitable[AsyncIterator[T]]]], limit: int) -> List[AsyncIterator[T]]:
+    """ストリームを並行に開始し、入力と同じ順序で返す
+
+    いずれかの開始に失敗した場合は、開始済みのストリームを閉じて例外を送出する。
+    """
+    opened: List[Optional[AsyncIterator[T]]] = [None] * len(factories)
+
+    async def run(index: int, factory: Callable[[], Awaitable[AsyncIterator[T]]]) -> None:
+        opened[index] = await factory()
+
+    try:
+        await gather_bounded([partial(run, i, factory) for i, factory in enumerate(factories)], limit)
+    except BaseException:
+        for stream in opened:
+            if stream is not None:
+                await stream.aclose()
+        raise
+    return opened
+
+async def merge_streams(streams: List[AsyncIterator[T]], limit: int) -> AsyncIterator[T]:
+    """複数のストリームを同時実行数を制限して並行に読み、届いた順に1本にまとめる"""
+    queue: "asyncio.Queue" = asyncio.Queue()
+    semaphore = asyncio.Semaphore(limit)
+
+    async def pump(stream: AsyncIterator[T]) -> None:
+        try:
+            async with semaphore:
+                async for item in stream:
+                    await queue.put((True, item))
+            await queue.put((False, None))
+        except Exception as e:
+            await queue.put((False, e))
+        finally:
+            await stream.aclose()
+
+    tasks = [asyncio.ensure_future(pump(stream)) for stream in streams]
+    remaining = len(tasks)
+    try:
+        while remaining:
+            is_item, value = await queue.get()
+            if is_item:
+                yield value
+                continue
+            if value is not None:
+                raise value
+            remaining -= 1
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+def expand_requests(
+    llamacpp_request: Dict[str, Any], prompts: List[str], n: int, max_choices: int
+) -> List[Dict[str, Any]]:
+    """プロンプトとnの組み合わせごとにllama.cppへのリクエストを生成
+
+    返すリストの順序がそのままレスポンスのchoicesのindexになる。
+    seedが指定されている場合は、同じプロンプトのchoiceが同じ結果にならないようずらす。
+    """
+    if not prompts or n < 1:
+        raise HTTPException(
+            status_code=400,
+            detail={
+                "error": {
+                    "message": "prompt must not be empty and n must be at least 1",
+                    "type": "invalid_request_error",
+                    "code": "invalid_value",
+                }
+            },
+        )
+    if len(prompts) * n > max_choices:
+        raise HTTPException(
+            status_code=400,
+            detail={
+                "error": {
+                    "message": f"Too many choices requested. Maximum {max_choices} prompts x n per request.",
+                    "type": "invalid_request_error",
+                    "code": "invalid_value",
+                }
+            },
+        )
+
+    seed = llamacpp_request.get("seed")
+    requests = []
+    for prompt in prompts:
+        for i in range(n):
+            expanded = {**llamacpp_request, "prompt": prompt}
+            if seed is not None and seed >= 0:
+                expanded["seed"] = seed + i
+            requests.append(expanded)
+    return requests
@@ -0,0 +1,59 @@
+import asyncio
+import logging
+from typing import Awaitable, TypeVar
+
+from fastapi import HTTPException, Request
+
+from llamacpp_proxy.services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# クライアントが応答を待たずに切断したことを表すステータス（nginxの慣例）
+CLIENT_CLOSED_REQUEST = 499
+
+
+class ClientDisconnected(HTTPException):
+    """応答を返す前にクライアントが切断した
+
+    クライアントには届かないが、メトリクスとアクセスログには499として記録される。
+    """
+
+    def __init__(self):
+        super().__init__(status_code=CLIENT_CLOSED_REQUEST, detail="Client closed request")
+
+
+async def _wait_for_disconnect(request: Request) -> None:
+    # ボディは読み終えているため、次に届くメッセージはhttp.disconnectだけ
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def cancel_on_disconnect(request: Request, awaitable: Awaitable[T], endpoint: str) -> T:
+    """awaitableの完了を待つ間にクライアントが切断した場合は、awaitableをキャンセルしてClientDisconnectedを送出する
+
+    待ち行列での待機や非ストリーミングの生成をキャンセルすると上流への接続が閉じられ、
+    llama.cppはその生成を中止してスロットを解放する。
+    """
+    work = asyncio.ensure_future(awaitable)
+    watcher = asyncio.ensure_future(_wait_for_disconnect(request))
+    try:
+        await asyncio.wait((work, watcher), return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        work.cancel()
+        watcher.cancel()
+        raise
+
+    if work.done():
+        watcher.cancel()
+        return work.result()
+
+    # 後片付け（バックエンドの割り当てや接続の解放）が終わるまで待つ
+    work.cancel()
+    await asyncio.gather(work, return_exceptions=True)
+    metrics.aborted_generations.inc(endpoint, "waiting")
+    logger.info("Client disconnected before the response, aborted the upstream request")
+    raise ClientDisconnected()
@@ -0,0 +1,291 @@
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import sys
+import time
+from array import array
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
+
+import httpx
+from fastapi import HTTPException, Request
+
+from llamacpp_proxy.config.embedding import EmbeddingSettings
+from llamacpp_proxy.services.admission import PRIORITY_NORMAL
+from llamacpp_proxy.services.balancer import Backend, LoadBalancer
+from llamacpp_proxy.services.failover import FailoverPolicy, record_failover, should_fail_over
+from llamacpp_proxy.services.metrics import metrics
+from llamacpp_proxy.services.tracing import phase
+
+logger = logging.getLogger(__name__)
+
+# 埋め込みを計算する入力（テキスト、またはトークンIDのリスト）
+EmbeddingInput = Union[str, List[int]]
+# 埋め込み（float32の配列）と、その入力のトークン数
+EmbeddingResult = Tuple[array, int]
+
+# 上流へ送る前の入力（キャッシュのキー、入力、優先度、待ち行列で待つ最大秒数、結果を受け取るFuture）
+_PendingInput = Tuple[bytes, EmbeddingInput, int, Optional[float], asyncio.Future]
+
+# キャッシュの1件あたりの管理用のサイズ（キーやOrderedDictのノードなど）の見積もり
+ENTRY_OVERHEAD = 200
+
+
+def normalize_inputs(value: Union[str, List[str], List[int], List[List[int]]]) -> List[EmbeddingInput]:
+    """リクエストのinputを入力のリストにする（トークンIDのリスト1つは1つの入力）"""
+    if isinstance(value, str):
+        return [value]
+    if value and isinstance(value[0], int):
+        return [value]
+    return list(value)
+
+
+def encode_embedding(embedding: array, encoding_format: Optional[str]) -> Union[List[float], str]:
+    """encoding_formatがbase64の場合はOpenAIと同じくリトルエンディアンのfloat32をBase64にする"""
+    if encoding_format != "base64":
+        return embedding.tolist()
+    if sys.byteorder == "big":
+        embedding = array("f", embedding)
+        embedding.byteswap()
+    return base64.b64encode(embedding.tobytes()).decode()
+
+
+def _cache_key(value: EmbeddingInput) -> bytes:
+    if isinstance(value, str):
+        return b"t" + hashlib.blake2b(value.encode(), digest_size=16).digest()
+    return b"i" + hashlib.blake2b(json.dumps(value).encode(), digest_size=16).digest()
+
+
+def _apportion_tokens(total: int, inputs: List[EmbeddingInput]) -> List[int]:
+    """上流が返すバッチ全体のトークン数を、入力の長さに比例して各入力に割り振る
+
+    llama.cppは入力ごとのトークン数を返さないため、トークンIDの入力はIDの数、テキストはバイト数で按分する。
+    """
+    weights = [len(value) if isinstance(value, list) else len(value.encode()) for value in inputs]
+    weight_sum = sum(weights) or 1
+    shares = [total * weight // weight_sum for weight in weights]
+    # 端数は余りの大きい順に1ずつ足して合計を合わせる
+    order = sorted(range(len(inputs)), key=lambda i: total * weights[i] % weight_sum, reverse=True)
+    for i in order[:total - sum(shares)]:
+        shares[i] += 1
+    return shares
+
+
+def upstream_error(error: Exception) -> HTTPException:
+    if isinstance(error, httpx.HTTPStatusError) and error.response.status_code == 400:
+        return HTTPException(
+            status_code=400,
+            detail={
+                "error": {
+                    "message": f"llama.cpp server rejected the input: {error.response.text}",
+                    "type": "invalid_request_error",
+                    "param": "input",
+                    "code": "invalid_input",
+                }
+            },
+        )
+    return HTTPException(status_code=502, detail=f"Error communicating with llama.cpp server: {str(error)}")
+
+
+class EmbeddingBatcher:
+    """同時に届いた埋め込みのリクエストを上流のバッチにまとめ、結果をキャッシュする
+
+    キャッシュにない入力は待ち行列に入れ、batch_windowの間に集まった分（最大max_batch_size件）を
+    1回の/v1/embeddingsのリクエストで送り、結果を呼び出し元ごとに分けて返す。
+    計算中の入力と同じ入力が届いた場合は、その結果を共有する。
+    入力の1つが上流に拒否されてバッチ全体が失敗した場合は、1件ずつ送り直して他の呼び出し元に影響させない。
+    """
+
+    def __init__(
+        self,
+        http_client: httpx.AsyncClient,
+        load_balancer: LoadBalancer,
+        settings: EmbeddingSettings,
+        failover: Optional[FailoverPolicy] = None,
+    ):
+        self.http_client = http_client
+        self.load_balancer = load_balancer
+        self.settings = settings
+        self.failover = failover
+        self._cache: "OrderedDict[bytes, EmbeddingResult]" = OrderedDict()
+        self._cache_bytes = 0
+        self._pending: List[_PendingInput] = []
+        self._inflight: Dict[bytes, asyncio.Future] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self.hits = 0
+        self.misses = 0
+
+    async def embed(
+        self,
+        inputs: List[EmbeddingInput],
+        priority: int = PRIORITY_NORMAL,
+        max_queue_wait: Optional[float] = None,
+    ) -> List[EmbeddingResult]:
+        """入力ごとの埋め込みとトークン数を返す
+
+        バッチは含まれる入力のうち最も高い優先度と、最も短い待ち時間の上限で待ち行列に入る。
+        """
+        results: List[Optional[EmbeddingResult]] = [None] * len(inputs)
+        waiting: List[Tuple[int, asyncio.Future]] = []
+        for i, value in enumerate(inputs):
+            key = _cache_key(value)
+            cached = self._cache_get(key)
+            if cached is not None:
+                results[i] = cached
+                continue
+            future = self._inflight.get(key)
+            if future is None:
+                future = self._inflight[key] = asyncio.get_running_loop().create_future()
+                self._pending.append((key, value, priority, max_queue_wait, future))
+            waiting.append((i, future))
+
+        if self._pending:
+            self._schedule()
+        if waiting:
+            # 他の呼び出し元と共有しているため、キャンセルされても計算は止めない
+            values = await asyncio.gather(*[asyncio.shield(future) for _, future in waiting])
+            for (i, _), value in zip(waiting, values):
+                results[i] = value
+        return results
+
+    def _cache_get(self, key: bytes) -> Optional[EmbeddingResult]:
+        cached = self._cache.get(key)
+        if cached is None:
+            self.misses += 1
+            return None
+        self._cache.move_to_end(key)
+        self.hits += 1
+        return cached
+
+    def _cache_put(self, key: bytes, value: EmbeddingResult) -> None:
+        size = len(value[0]) * value[0].itemsize + ENTRY_OVERHEAD
+        if not self.settings.cache_size or size > self.settings.cache_max_bytes or key in self._cache:
+            return
+        self._cache[key] = value
+        self._cache_bytes += size
+        while len(self._cache) > self.settings.cache_size or self._cache_bytes > self.settings.cache_max_bytes:
+            _, (evicted, _) = self._cache.popitem(last=False)
+            self._cache_bytes -= len(evicted) * evicted.itemsize + ENTRY_OVERHEAD
+
+    def _schedule(self) -> None:
+        """max_batch_size件集まった分はすぐに送り、残りはbatch_window後に送る"""
+        while len(self._pending) >= self.settings.max_batch_size:
+            self._start_batch()
+        if not self._pending or self._timer is not None:
+            return
+        if self.settings.batch_window <= 0:
+            self._start_batch()
+        else:
+            self._timer = asyncio.get_running_loop().call_later(self.settings.batch_window, self._flush)
+
+    def _flush(self) -> None:
+        self._timer = None
+        while self._pending:
+            self._start_batch()
+
+    def _start_batch(self) -> None:
+        batch = self._pending[:self.settings.max_batch_size]
+        self._pending = self._pending[self.settings.max_batch_size:]
+        if not self._pending and self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        task = asyncio.create_task(self._run_batch(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, batch: List[_PendingInput]) -> None:
+        try:
+            try:
+                waits = [wait for _, _, _, wait, _ in batch if wait is not None]
+                values = await self._post(
+                    [value for _, value, _, _, _ in batch],
+                    min(p for _, _, p, _, _ in batch),
+                    min(waits) if waits else None,
+                )
+            except HTTPException as e:
+                if e.status_code == 400 and len(batch) > 1:
+                    await asyncio.gather(*[self._run_batch([entry]) for entry in batch])
+                    return
+                for key, _, _, _, future in batch:
+                    self._inflight.pop(key, None)
+                    if not future.done():
+                        future.set_exception(e)
+                        # 呼び出し元が全て切断していても警告を出さないよう、取得済みにしておく
+                        future.exception()
+                return
+            for (key, _, _, _, future), value in zip(batch, values):
+                self._cache_put(key, value)
+                self._inflight.pop(key, None)
+                if not future.done():
+                    future.set_result(value)
+        finally:
+            # 終了時にキャンセルされた場合など、結果を返せなかった入力の待ちを解く
+            for key, _, _, _, future in batch:
+                if not future.done():
+                    self._inflight.pop(key, None)
+                    future.cancel()
+
+    async def _post(
+        self, inputs: List[EmbeddingInput], priority: int, max_queue_wait: Optional[float]
+    ) -> List[EmbeddingResult]:
+        metrics.embedding_batch_size.observe(len(inputs))
+        # 接続エラーや5xxの場合は、失敗したバックエンドを除いて再試行する
+        failed: List[Backend] = []
+        while True:
+            try:
+                return await self._post_batch(inputs, priority, max_queue_wait, failed)
+            except httpx.HTTPError as e:
+                if should_fail_over(self.failover, e, failed, self.load_balancer.backends):
+                    record_failover(failed[-1], e)
+                    continue
+                logger.error(f"Error communicating with llama.cpp server: {str(e)}")
+                raise upstream_error(e)
+            except (ValueError, KeyError, TypeError) as e:
+                logger.error(f"Invalid embedding response from llama.cpp server: {str(e)}")
+                raise upstream_error(e)
+
+    async def _post_batch(
+        self, inputs: List[EmbeddingInput], priority: int, max_queue_wait: Optional[float], failed: List[Backend]
+    ) -> List[EmbeddingResult]:
+        """failedを除いたバックエンドへ送る。通信エラーの場合はバックエンドをfailedに加える"""
+        async with self.load_balancer.acquire(
+            exclude=failed, priority=priority, max_queue_wait=max_queue_wait
+        ) as lease:
+            started = time.perf_counter()
+            try:
+                with phase("upstream"):
+                    response = await self.http_client.post(
+                        f"{lease.backend.url}/v1/embeddings", json={"input": inputs}
+                    )
+                metrics.upstream_duration.observe(time.perf_counter() - started, lease.backend.url)
+                response.raise_for_status()
+            except httpx.HTTPError:
+                failed.append(lease.backend)
+                raise
+        body: Dict[str, Any] = response.json()
+        data = sorted(body["data"], key=lambda item: item["index"])
+        if len(data) != len(inputs):
+            raise ValueError(f"expected {len(inputs)} embeddings, got {len(data)}")
+        tokens = _apportion_tokens((body.get("usage") or {}).get("prompt_tokens", 0), inputs)
+        # OpenAIと同じくfloat32で保持し、キャッシュのメモリを半分にする
+        return [(array("f", item["embedding"]), count) for item, count in zip(data, tokens)]
+
+    async def close(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        for _, _, _, _, future in self._pending:
+            future.cancel()
+        self._pending = []
+        self._inflight.clear()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+def get_embedding_batcher(request: Request) -> EmbeddingBatcher:
+    """lifespanで生成された埋め込みのバッチ処理を返す"""
+    return request.app.state.embedding_batcher
@@ -0,0 +1,86 @@
+import logging
+import math
+from collections import deque
+from typing import Deque, Iterable, List, Optional
+
+import httpx
+from fastapi import Request
+
+from llamacpp_proxy.services.balancer import Backend
+from llamacpp_proxy.services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# ヘッジの閾値を計算するのに必要な最初のトークンまでの時間の件数
+HEDGE_MIN_SAMPLES = 20
+# 閾値を計算し直す間隔（記録した件数）
+HEDGE_RECOMPUTE_INTERVAL = 32
+
+
+def is_retryable(error: httpx.HTTPError) -> bool:
+    """別のバックエンドで再試行すれば成功しうるエラーか（接続エラー・タイムアウト・5xx）
+
+    4xxはリクエスト自体の問題なので再試行しない。
+    """
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+def should_fail_over(
+    policy: Optional["FailoverPolicy"], error: httpx.HTTPError, failed: List[Backend], backends: Iterable[Backend]
+) -> bool:
+    """失敗したリクエストを、failedに含まれない別のバックエンドで再試行するか（policyがNoneなら再試行しない）"""
+    return (
+        policy is not None
+        and len(failed) <= policy.max_retries
+        and is_retryable(error)
+        and any(backend not in failed for backend in backends)
+    )
+
+
+def record_failover(backend: Backend, error: httpx.HTTPError) -> None:
+    metrics.failovers.inc(backend.url)
+    logger.warning(f"llama.cpp server {backend.url} failed, retrying on another backend: {str(error)}")
+
+
+class FailoverPolicy:
+    """上流のエラー時の再試行と、最初のトークンが遅い場合のヘッジの方針
+
+    最初のトークンまでの時間は直近window件を保持し、そのhedge_percentileパーセンタイルを
+    ヘッジの閾値とする。hedge_percentileが0の場合はヘッジしない。
+    """
+
+    def __init__(self, max_retries: int, hedge_percentile: float = 0.0, window: int = 1000):
+        self.max_retries = max_retries
+        self.hedge_percentile = hedge_percentile
+        self._samples: Deque[float] = deque(maxlen=window)
+        self._threshold: Optional[float] = None
+        self._stale = 0
+
+    @property
+    def guards_first_token(self) -> bool:
+        """ストリーミングで最初のトークンが届くまで上流を見張る必要があるか"""
+        return self.max_retries > 0 or self.hedge_percentile > 0
+
+    def observe_first_token(self, seconds: float) -> None:
+        if not self.hedge_percentile:
+            return
+        self._samples.append(seconds)
+        self._stale += 1
+
+    def hedge_delay(self) -> Optional[float]:
+        """ヘッジを送るまでの秒数（無効な場合や記録が少ない場合はNone）"""
+        if not self.hedge_percentile or len(self._samples) < HEDGE_MIN_SAMPLES:
+            return None
+        if self._threshold is None or self._stale >= HEDGE_RECOMPUTE_INTERVAL:
+            ordered = sorted(self._samples)
+            index = min(len(ordered) - 1, math.ceil(len(ordered) * self.hedge_percentile / 100) - 1)
+            self._threshold = ordered[max(index, 0)]
+            self._stale = 0
+        return self._threshold
+
+
+def get_failover_policy(request: Request) -> FailoverPolicy:
+    """lifespanで生成されたフェイルオーバーの方針を返す"""
+    return request.app.state.failover
@@ -0,0 +1,668 @@
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import string
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, Request
+from starlette.concurrency import run_in_threadpool
+
+from llamacpp_proxy.config.grammar import GrammarSettings
+from llamacpp_proxy.models.grammar import ResponseFormat
+
+logger = logging.getLogger(__name__)
+
+# 登録したgrammarのIDの接頭辞（続けて内容のSHA-256の先頭32桁）
+GRAMMAR_ID_PREFIX = "grammar-"
+
+# llama.cppのgrammarパーサーに合わせた制限
+MAX_NESTING = 64  # 括弧の入れ子の深さ
+MAX_REPETITIONS = 2000  # {m,n}の回数
+
+_WORD_CHARS = frozenset(string.ascii_letters + string.digits + "-")
+_HEX_DIGITS = frozenset(string.hexdigits)
+_HEX_ESCAPES = {"x": 2, "u": 4, "U": 8}
+_CHAR_ESCAPES = frozenset('tnr\\"[]')
+_LITERAL_RUN = re.compile(r'[^"\\]+')
+_DIGITS = re.compile(r"[0-9]+")
+_TOKEN = re.compile(r"<(\[[0-9]+\]|[^<>\[\r\n][^<>\r\n]*)>")  # <think>、<[1234]>
+
+
+class GrammarError(ValueError):
+    """grammarの構文エラーや、grammarに変換できないJSONスキーマ"""
+
+
+class _GbnfParser:
+    """llama.cppのgrammar（GBNF）の構文を検証する再帰下降パーサー
+
+    llama.cppのgrammar-parserと同じく、入れ子の外では改行がルールの終わりになる。
+    トークンの指定（<think>、<[1234]>、否定の!<...>）はトークンが語彙にあるかは検証せず、バックエンドに任せる。
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        self.pos = 0
+        self.defined: Dict[str, int] = {}
+        self.referenced: Dict[str, int] = {}
+
+    def error(self, message: str, pos: Optional[int] = None) -> GrammarError:
+        pos = self.pos if pos is None else pos
+        line = self.text.count("\n", 0, pos) + 1
+        column = pos - self.text.rfind("\n", 0, pos)
+        return GrammarError(f"{message} at line {line}, column {column}")
+
+    def peek(self, offset: int = 0) -> str:
+        return self.text[self.pos + offset:self.pos + offset + 1]
+
+    def skip_space(self, newline_ok: bool) -> None:
+        text = self.text
+        while self.pos < len(text):
+            c = text[self.pos]
+            if c == "#":
+                while self.pos < len(text) and text[self.pos] not in "\r\n":
+                    self.pos += 1
+            elif c in " \t" or (newline_ok and c in "\r\n"):
+                self.pos += 1
+            else:
+                break
+
+    def parse(self) -> None:
+        self.skip_space(True)
+        while self.pos < len(self.text):
+            self.parse_rule()
+            self.skip_space(True)
+        if "root" not in self.defined:
+            raise GrammarError("grammar does not define root")
+        for name, pos in self.referenced.items():
+            if name not in self.defined:
+                raise self.error(f"undefined rule {name!r}", pos)
+
+    def parse_name(self) -> str:
+        start = self.pos
+        while self.peek() and self.peek() in _WORD_CHARS:
+            self.pos += 1
+        if self.pos == start:
+            raise self.error("expecting name")
+        return self.text[start:self.pos]
+
+    def parse_rule(self) -> None:
+        start = self.pos
+        name = self.parse_name()
+        self.defined.setdefault(name, start)
+        self.skip_space(False)
+        if not self.text.startswith("::=", self.pos):
+            raise self.error("expecting ::=")
+        self.pos += 3
+        self.skip_space(True)
+        self.parse_alternates(0)
+        if self.peek() not in ("", "\r", "\n"):
+            raise self.error("expecting newline or end")
+
+    def parse_alternates(self, depth: int) -> None:
+        self.parse_sequence(depth)
+        while self.peek() == "|":
+            self.pos += 1
+            self.skip_space(True)
+            self.parse_sequence(depth)
+
+    def parse_sequence(self, depth: int) -> None:
+        nested = depth > 0
+        has_item = False  # 直前に*+?{m,n}を適用できる要素があるか
+        while True:
+            c = self.peek()
+            start = self.pos
+            if c == '"':
+                self.parse_literal()
+            elif c == "[":
+                self.parse_class()
+            elif c and c in _WORD_CHARS:
+                self.referenced.setdefault(self.parse_name(), start)
+            elif c in ("<", "!"):
+                self.parse_token()
+            elif c == "(":
+                if depth >= MAX_NESTING:
+                    raise self.error("grammar is nested too deeply")
+                self.pos += 1
+                self.skip_space(True)
+                self.parse_alternates(depth + 1)
+                if self.peek() != ")":
+                    raise self.error("expecting )")
+                self.pos += 1
+            elif c == ".":
+                self.pos += 1
+            elif c in ("*", "+", "?") and c:
+                if not has_item:
+                    raise self.error(f"expecting preceding item to {c}")
+                self.pos += 1
+            elif c == "{":
+                if not has_item:
+                    raise self.error("expecting preceding item to {")
+                self.parse_repetition(nested)
+                continue
+            else:
+                return
+            has_item = True
+            self.skip_space(nested)
+
+    def parse_int(self) -> int:
+        match = _DIGITS.match(self.text, self.pos)
+        if match is None:
+            raise self.error("expecting an int")
+        self.pos = match.end()
+        return int(match.group())
+
+    def parse_repetition(self, nested: bool) -> None:
+        start = self.pos
+        self.pos += 1
+        self.skip_space(nested)
+        min_times = self.parse_int()
+        self.skip_space(nested)
+        max_times: Optional[int] = min_times
+        if self.peek() == ",":
+            self.pos += 1
+            self.skip_space(nested)
+            max_times = self.parse_int() if self.peek().isdigit() else None
+            self.skip_space(nested)
+        if self.peek() != "}":
+            raise self.error("expecting }")
+        self.pos += 1
+        self.skip_space(nested)
+        if max(min_times, max_times or 0) > MAX_REPETITIONS:
+            raise self.error(f"number of repetitions exceeds {MAX_REPETITIONS}", start)
+        if max_times is not None and max_times < min_times:
+            raise self.error("maximum repetitions is less than minimum", start)
+
+    def parse_char(self) -> None:
+        c = self.peek()
+        if not c:
+            raise self.error("unexpected end of input")
+        if c != "\\":
+            self.pos += 1
+            return
+        escape = self.peek(1)
+        if escape in _HEX_ESCAPES:
+            digits = self.text[self.pos + 2:self.pos + 2 + _HEX_ESCAPES[escape]]
+            if len(digits) != _HEX_ESCAPES[escape] or not all(d in _HEX_DIGITS for d in digits):
+                raise self.error("expecting hex digits")
+            self.pos += 2 + len(digits)
+        elif escape and escape in _CHAR_ESCAPES:
+            self.pos += 2
+        else:
+            raise self.error("unknown escape")
+
+    def parse_literal(self) -> None:
+        self.pos += 1
+        while self.peek() != '"':
+            match = _LITERAL_RUN.match(self.text, self.pos)
+            if match is not None:
+                self.pos = match.end()
+            else:
+                self.parse_char()
+        self.pos += 1
+
+    def parse_token(self) -> None:
+        if self.peek() == "!":
+            self.pos += 1
+        match = _TOKEN.match(self.text, self.pos)
+        if match is None:
+            raise self.error("expecting token such as <think> or <[1234]>")
+        self.pos = match.end()
+
+    def parse_class(self) -> None:
+        self.pos += 1
+        if self.peek() == "^":
+            self.pos += 1
+        while self.peek() != "]":
+            self.parse_char()
+            if self.peek() == "-" and self.peek(1) not in ("]", ""):
+                self.pos += 1
+                self.parse_char()
+        self.pos += 1
+
+
+def validate_gbnf(grammar: str) -> None:
+    """grammarの構文と、参照しているルールが全て定義されていることを検証する（不正ならGrammarError）"""
+    _GbnfParser(grammar).parse()
+
+
+# JSONスキーマから変換したgrammarの共通のルール（llama.cppのjson_schema_to_grammarに合わせる）
+SPACE_RULE = '| " " | "\\n" [ \\t]{0,20}'
+PRIMITIVE_RULES: Dict[str, Tuple[str, Tuple[str, ...]]] = {
+    "boolean": ('("true" | "false") space', ()),
+    "decimal-part": ("[0-9]{1,16}", ()),
+    "integral-part": ("[0] | [1-9] [0-9]{0,15}", ()),
+    "number": (
+        '("-"? integral-part) ("." decimal-part)? ([eE] [-+]? integral-part)? space',
+        ("integral-part", "decimal-part"),
+    ),
+    "integer": ('("-"? integral-part) space', ("integral-part",)),
+    "value": ("object | array | string | number | boolean | null", ("object", "array", "string", "number", "boolean", "null")),
+    "object": ('"{" space ( string ":" space value ("," space string ":" space value)* )? "}" space', ("string", "value")),
+    "array": ('"[" space ( value ("," space value)* )? "]" space', ("value",)),
+    "char": (r'[^"\\\x7F\x00-\x1F] | [\\] (["\\bfnrt] | "u" [0-9a-fA-F]{4})', ()),
+    "string": (r'"\"" char* "\"" space', ("char",)),
+    "null": ('"null" space', ()),
+}
+COMMA = '"," space'
+_RESERVED_RULES = frozenset(PRIMITIVE_RULES) | {"space", "root"}
+
+# 出力を制約できないため変換を断るキーワード（数値の範囲やformatは制約せずに無視する）
+UNSUPPORTED_KEYWORDS = frozenset(["pattern", "patternProperties", "allOf", "not", "if", "dependentSchemas"])
+
+_INVALID_RULE_CHARS = re.compile(r"[^a-zA-Z0-9-]+")
+_LITERAL_ESCAPE = re.compile(r'[\r\n"\\]')
+_LITERAL_ESCAPES = {"\r": "\\r", "\n": "\\n", '"': '\\"', "\\": "\\\\"}
+
+
+def _format_literal(value: Any) -> str:
+    """JSONの値をそのまま出力するgrammarのリテラル"""
+    text = json.dumps(value, ensure_ascii=False)
+    return '"' + _LITERAL_ESCAPE.sub(lambda m: _LITERAL_ESCAPES[m.group()], text) + '"'
+
+
+def _build_repetition(item: str, min_items: int, max_items: Optional[int], separator: str = "") -> str:
+    if max_items == 0:
+        return ""
+    if min_items == 0 and max_items == 1:
+        return f"{item}?"
+    if not separator:
+        if min_items == 1 and max_items is None:
+            return f"{item}+"
+        if min_items == 0 and max_items is None:
+            return f"{item}*"
+        return f"{item}{{{min_items},{max_items if max_items is not None else ''}}}"
+    result = item + " " + _build_repetition(
+        f"({separator} {item})", max(min_items - 1, 0), max_items - 1 if max_items is not None else None
+    )
+    return f"({result})?" if min_items == 0 else result
+
+
+def _bound(schema: Dict[str, Any], key: str, default: Optional[int]) -> Optional[int]:
+    value = schema.get(key, default)
+    if value is None:
+        return None
+    if not isinstance(value, int) or isinstance(value, bool) or not 0 <= value <= MAX_REPETITIONS:
+        raise GrammarError(f"{key} must be an integer between 0 and {MAX_REPETITIONS}")
+    return value
+
+
+class _SchemaConverter:
+    """JSONスキーマを、スキーマに合うJSONだけを生成させるgrammarに変換する"""
+
+    def __init__(self, schema: Any):
+        self.schema = schema
+        self.rules: Dict[str, str] = {"space": SPACE_RULE}
+        self.refs: Dict[str, str] = {"#": "root"}
+
+    def convert(self) -> str:
+        self.rules["root"] = ""
+        self.rules["root"] = self.body(self.schema, "root")
+        return "".join(f"{name} ::= {rule}\n" for name, rule in sorted(self.rules.items()))
+
+    def unique_name(self, name: str) -> str:
+        base = _INVALID_RULE_CHARS.sub("-", name) or "rule"
+        key, i = base, 0
+        while key in self.rules or key in _RESERVED_RULES:
+            i += 1
+            key = f"{base}{i}"
+        return key
+
+    def add_rule(self, name: str, rule: str) -> str:
+        key = _INVALID_RULE_CHARS.sub("-", name)
+        if self.rules.get(key) == rule:
+            return key
+        key = self.unique_name(name)
+        self.rules[key] = rule
+        return key
+
+    def add_primitive(self, name: str) -> str:
+        rule, dependencies = PRIMITIVE_RULES[name]
+        if name not in self.rules:
+            self.rules[name] = rule
+            for dependency in dependencies:
+                self.add_primitive(dependency)
+        return name
+
+    def visit(self, schema: Any, name: str) -> str:
+        """スキーマのルールを追加してルール名を返す"""
+        rule = self.body(schema, name)
+        if rule in PRIMITIVE_RULES or rule in self.rules:
+            return rule
+        return self.add_rule(name, rule)
+
+    def resolve_ref(self, ref: Any) -> str:
+        if not isinstance(ref, str):
+            raise GrammarError("$ref must be a string")
+        if ref in self.refs:
+            return self.refs[ref]
+        if not ref.startswith("#/"):
+            raise GrammarError(f"unsupported $ref {ref!r} (only local references are supported)")
+        target = self.schema
+        parts = [part.replace("~1", "/").replace("~0", "~") for part in ref[2:].split("/")]
+        for part in parts:
+            if not isinstance(target, dict) or part not in target:
+                raise GrammarError(f"unresolvable $ref {ref!r}")
+            target = target[part]
+        # 再帰的な参照のために、変換する前にルール名を決めておく
+        name = self.unique_name(parts[-1])
+        self.refs[ref] = name
+        self.rules[name] = ""
+        self.rules[name] = self.body(target, name)
+        return name
+
+    def body(self, schema: Any, name: str) -> str:
+        if schema is True or schema == {}:
+            return self.add_primitive("value")
+        if not isinstance(schema, dict):
+            raise GrammarError("schema must be an object or true")
+        unsupported = UNSUPPORTED_KEYWORDS.intersection(schema)
+        if unsupported:
+            raise GrammarError(f"unsupported keyword {sorted(unsupported)[0]!r}")
+
+        if "$ref" in schema:
+            return self.resolve_ref(schema["$ref"])
+        for keyword in ("oneOf", "anyOf"):
+            if keyword in schema:
+                alternatives = schema[keyword]
+                if not isinstance(alternatives, list) or not alternatives:
+                    raise GrammarError(f"{keyword} must be a non-empty array")
+                return " | ".join(self.visit(s, f"{name}-{i}") for i, s in enumerate(alternatives))
+        if "const" in schema:
+            return f"{_format_literal(schema['const'])} space"
+        if "enum" in schema:
+            values = schema["enum"]
+            if not isinstance(values, list) or not values:
+                raise GrammarError("enum must be a non-empty array")
+            return "(" + " | ".join(_format_literal(value) for value in values) + ") space"
+
+        schema_type = schema.get("type")
+        if isinstance(schema_type, list):
+            if not schema_type:
+                raise GrammarError("type must not be empty")
+            return " | ".join(self.visit({**schema, "type": t}, f"{name}-{t}") for t in schema_type)
+        if schema_type is None:
+            if "properties" in schema or "additionalProperties" in schema or "required" in schema:
+                schema_type = "object"
+            elif "items" in schema or "prefixItems" in schema:
+                schema_type = "array"
+            else:
+                return self.add_primitive("value")
+
+        if schema_type == "object":
+            if any(key in schema for key in ("properties", "required")) or (
+                "additionalProperties" in schema and schema["additionalProperties"] is not True
+            ):
+                return self.build_object(schema, name)
+            return self.add_primitive("object")
+        if schema_type == "array":
+            return self.build_array(schema, name)
+        if schema_type == "string":
+            if "minLength" not in schema and "maxLength" not in schema:
+                return self.add_primitive("string")
+            char = self.add_primitive("char")
+            repetition = _build_repetition(char, _bound(schema, "minLength", 0), _bound(schema, "maxLength", None))
+            return f'"\\"" {repetition} "\\"" space'
+        if schema_type in ("number", "integer", "boolean", "null"):
+            return self.add_primitive(schema_type)
+        raise GrammarError(f"unsupported type {schema_type!r}")
+
+    def build_array(self, schema: Dict[str, Any], name: str) -> str:
+        prefix_items = schema.get("prefixItems")
+        if prefix_items is not None:
+            if not isinstance(prefix_items, list):
+                raise GrammarError("prefixItems must be an array")
+            items = ' "," space '.join(self.visit(s, f"{name}-{i}") for i, s in enumerate(prefix_items))
+            return f'"[" space {items} "]" space'
+        items = schema.get("items", True)
+        item = self.visit(items, f"{name}-item")
+        min_items = _bound(schema, "minItems", 0)
+        max_items = _bound(schema, "maxItems", None)
+        if max_items is not None and max_items < min_items:
+            raise GrammarError("maxItems must not be less than minItems")
+        return f'"[" space {_build_repetition(item, min_items, max_items, separator=COMMA)} "]" space'
+
+    def build_object(self, schema: Dict[str, Any], name: str) -> str:
+        properties = schema.get("properties", {})
+        required = schema.get("required", [])
+        if not isinstance(properties, dict) or not isinstance(required, list):
+            raise GrammarError("properties must be an object and required must be an array")
+        # propertiesにない必須のプロパティは任意の値を取る
+        properties = {**properties, **{key: True for key in required if key not in properties}}
+
+        kv_rules: Dict[str, str] = {}
+        for key, property_schema in properties.items():
+            value = self.visit(property_schema, f"{name}-{key}")
+            kv_rules[key] = self.add_rule(f"{name}-{key}-kv", f'{_format_literal(key)} space ":" space {value}')
+        required_keys = [key for key in properties if key in required]
+        optional_keys = [key for key in properties if key not in required]
+
+        additional = schema.get("additionalProperties")
+        if additional is not None and additional is not False:
+            value = self.visit(additional, f"{name}-additional-value")
+            self.add_primitive("string")
+            kv_rules["*"] = self.add_rule(f"{name}-additional-kv", f'string ":" space {value}')
+            optional_keys.append("*")
+
+        rule = '"{" space ' + f" {COMMA} ".join(kv_rules[key] for key in required_keys)
+        if optional_keys:
+            # 任意のプロパティは宣言順に、どの組み合わせでも出力できるようにする
+            def recursive_refs(keys: List[str], first_is_optional: bool) -> str:
+                key, rest = keys[0], keys[1:]
+                comma = f'( "," space {kv_rules[key]} )'
+                if first_is_optional:
+                    result = comma + ("*" if key == "*" else "?")
+                else:
+                    result = kv_rules[key] + (f" {comma}*" if key == "*" else "")
+                if rest:
+                    result += " " + self.add_rule(
+                        f"{name}-{'additional' if key == '*' else key}-rest", recursive_refs(rest, True)
+                    )
+                return result
+
+            alternatives = " | ".join(recursive_refs(optional_keys[i:], False) for i in range(len(optional_keys)))
+            if required_keys:
+                rule += f' ( "," space ( {alternatives} ) )?'
+            else:
+                rule += f"( {alternatives} )?"
+        return rule + ' "}" space'
+
+
+def schema_to_gbnf(schema: Any) -> str:
+    """JSONスキーマをgrammarに変換する（変換できなければGrammarError）"""
+    try:
+        return _SchemaConverter(schema).convert()
+    except RecursionError:
+        raise GrammarError("schema is nested too deeply") from None
+
+
+def _size(grammar: str) -> int:
+    return len(grammar.encode())
+
+
+def grammar_id(grammar: str) -> str:
+    return GRAMMAR_ID_PREFIX + hashlib.sha256(grammar.encode()).hexdigest()[:32]
+
+
+def grammar_error(message: str, param: str, code: str, status_code: int = 400) -> HTTPException:
+    return HTTPException(
+        status_code=status_code,
+        detail={
+            "error": {
+                "message": message,
+                "type": "invalid_request_error",
+                "param": param,
+                "code": code,
+            }
+        },
+    )
+
+
+class GrammarCache:
+    """検証済みのgrammarと、JSONスキーマから変換したgrammarのキャッシュ
+
+    grammarは内容のハッシュ、スキーマは正規化したJSONのハッシュをキーに、内容で引く。
+    /v1/grammarsで登録したgrammarは内容のハッシュをIDとして保持する。
+    どちらも件数と合計サイズの上限を超えると、最も古く使われたものから削除する。
+    offload_threshold以上の大きなgrammarは、イベントループを塞がないようスレッドプールで検証・変換する。
+    ワーカー間の共有状態があればそこにも書き込み、どのワーカーに届いたリクエストからも引けるようにする。
+    """
+
+    def __init__(self, settings: GrammarSettings, shared_state=None):
+        self.settings = settings
+        self.shared_state = shared_state
+        self._cache: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+        self._cache_bytes = 0
+        self._registered: "OrderedDict[str, str]" = OrderedDict()
+        self._registered_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._registered)
+
+    def _check_size(self, grammar: str) -> None:
+        size = _size(grammar)
+        if size > self.settings.max_bytes:
+            raise GrammarError(f"grammar is {size} bytes, larger than the limit of {self.settings.max_bytes} bytes")
+
+    async def _cached(self, key: Tuple[str, str], size: int, build: Callable[[], str]) -> str:
+        grammar = self._cache.get(key)
+        if grammar is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return grammar
+        self.misses += 1
+        threshold = self.settings.offload_threshold
+        if threshold > 0 and size >= threshold:
+            grammar = await run_in_threadpool(build)
+        else:
+            grammar = build()
+        # スレッドプールで待つ間に同じgrammarが追加されていれば置き換える
+        if key in self._cache:
+            self._cache_bytes -= _size(self._cache.pop(key))
+        self._cache[key] = grammar
+        self._cache_bytes += _size(grammar)
+        while len(self._cache) > self.settings.cache_size or self._cache_bytes > self.settings.cache_max_bytes:
+            _, evicted = self._cache.popitem(last=False)
+            self._cache_bytes -= _size(evicted)
+        return grammar
+
+    async def validated(self, grammar: str) -> str:
+        """検証したgrammarを返す（検証済みならキャッシュから）"""
+        def build() -> str:
+            self._check_size(grammar)
+            validate_gbnf(grammar)
+            return grammar
+
+        return await self._cached(("gbnf", grammar_id(grammar)), len(grammar), build)
+
+    async def from_schema(self, schema: Any) -> str:
+        """JSONスキーマを変換したgrammarを返す（変換済みならキャッシュから）"""
+        def build() -> str:
+            grammar = schema_to_gbnf(schema)
+            self._check_size(grammar)
+            return grammar
+
+        key = json.dumps(schema, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return await self._cached(("schema", hashlib.sha256(key.encode()).hexdigest()), len(key), build)
+
+    def _remember(self, id: str, grammar: str) -> None:
+        if id in self._registered:
+            self._registered_bytes -= _size(self._registered.pop(id))
+        self._registered[id] = grammar
+        self._registered_bytes += _size(grammar)
+        while (
+            len(self._registered) > self.settings.max_registered
+            or self._registered_bytes > self.settings.max_registered_bytes
+        ):
+            _, evicted = self._registered.popitem(last=False)
+            self._registered_bytes -= _size(evicted)
+
+    async def register(self, grammar: str) -> str:
+        """grammarを検証して登録し、IDを返す（同じ内容なら同じID）"""
+        grammar = await self.validated(grammar)
+        id = grammar_id(grammar)
+        self._remember(id, grammar)
+        if self.shared_state is not None:
+            try:
+                await run_in_threadpool(self.shared_state.put_grammar, id, grammar, self.settings.max_registered)
+            except sqlite3.Error as e:
+                logger.warning(f"Failed to share grammar {id}: {str(e)}")
+        return id
+
+    async def lookup(self, id: str) -> Optional[str]:
+        """登録されたgrammarを返す（なければNone）"""
+        grammar = self._registered.get(id)
+        if grammar is not None:
+            self._registered.move_to_end(id)
+            return grammar
+        if self.shared_state is None:
+            return None
+        try:
+            grammar = await run_in_threadpool(self.shared_state.get_grammar, id)
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to look up grammar {id}: {str(e)}")
+            return None
+        if grammar is not None:
+            self._remember(id, grammar)
+        return grammar
+
+    async def resolve(
+        self,
+        grammar: Optional[str],
+        grammar_id: Optional[str],
+        response_format: Optional[ResponseFormat],
+    ) -> Optional[str]:
+        """リクエストのgrammar・grammarのID・response_formatから、llama.cppへ渡すgrammarを決める
+
+        不正なgrammarやスキーマは上流へ送らずに400を返す。
+        """
+        if response_format is not None and response_format.type == "text":
+            response_format = None
+        given = [
+            param for param, value in (
+                ("llamacpp_proxy_grammar", grammar),
+                ("llamacpp_proxy_grammar_id", grammar_id),
+                ("response_format", response_format),
+            )
+            if value is not None
+        ]
+        if len(given) > 1:
+            raise grammar_error(f"Only one of {' and '.join(given)} can be specified", given[1], "invalid_value")
+
+        if grammar is not None:
+            try:
+                return await self.validated(grammar)
+            except GrammarError as e:
+                raise grammar_error(f"Invalid grammar: {e}", "llamacpp_proxy_grammar", "invalid_grammar")
+        if grammar_id is not None:
+            found = await self.lookup(grammar_id)
+            if found is None:
+                raise grammar_error(
+                    f"Grammar {grammar_id} not found", "llamacpp_proxy_grammar_id", "grammar_not_found"
+                )
+            return found
+        if response_format is None:
+            return None
+
+        if response_format.type == "json_schema":
+            if response_format.json_schema is None:
+                raise grammar_error(
+                    "response_format.json_schema is required for type json_schema", "response_format", "invalid_value"
+                )
+            schema = response_format.json_schema.schema_
+        else:
+            # json_objectは任意のオブジェクト（llama.cppと同じくschemaの指定も受け付ける）
+            schema = response_format.schema_ if response_format.schema_ is not None else {"type": "object"}
+        try:
+            return await self.from_schema(schema)
+        except GrammarError as e:
+            raise grammar_error(f"Invalid JSON schema: {e}", "response_format", "invalid_json_schema")
+
+
+def get_grammar_cache(request: Request) -> GrammarCache:
+    """lifespanで生成されたgrammarのキャッシュを返す"""
+    return request.app.state.grammar_cache
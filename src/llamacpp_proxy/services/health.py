@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Dict
+
+import httpx
+
+from llamacpp_proxy.config.health import HealthSettings
+from llamacpp_proxy.services.balancer import (
+    BACKEND_BUSY,
+    BACKEND_DOWN,
+    BACKEND_LOADING,
+    BACKEND_READY,
+    Backend,
+    LoadBalancer,
+)
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CircuitBreaker:
+    """バックエンドごとの回路遮断器
+
+    確認に連続してfailure_threshold回失敗するか、モデルの読み込み中と分かった時点で開く。
+    開いている間は割り当ての対象から外し、次の確認までの間隔を開くたびに倍にする（max_backoffまで）。
+    確認に成功すると閉じる。
+    """
+    failure_threshold: int
+    interval: float
+    max_backoff: float
+    failures: int = 0  # 連続した失敗の回数
+    trips: int = 0  # 閉じてから開いた回数
+    next_probe: float = 0.0
+
+    @property
+    def closed(self) -> bool:
+        return self.trips == 0
+
+    def record_success(self, now: float) -> None:
+        self.failures = 0
+        self.trips = 0
+        self.next_probe = now + self.interval
+
+    def record_failure(self, now: float, trip: bool = False) -> None:
+        self.failures += 1
+        if trip or self.failures >= self.failure_threshold:
+            self.trips += 1
+        if self.closed:
+            self.next_probe = now + self.interval
+        else:
+            self.next_probe = now + min(self.interval * 2 ** (self.trips - 1), self.max_backoff)
+
+
+def _is_loading(response: httpx.Response) -> bool:
+    # llama.cppはモデルの読み込み中に503と"Loading model"（古い版では"loading model"）を返す
+    return response.status_code == 503 and "loading" in response.text.lower()
+
+
+def _is_busy(response: httpx.Response) -> bool:
+    # fail_on_no_slotを指定した場合、空きスロットがなければ503と"no slot available"を返す
+    return response.status_code == 503 and "no slot" in response.text.lower()
+
+
+async def probe_backend(http_client: httpx.AsyncClient, backend: Backend, timeout: float) -> str:
+    """バックエンドの/healthと/slotsを確認して状態を返す
+
+    /slotsが無効（--no-slots）な場合は/healthだけで判定する。
+    """
+    try:
+        response = await http_client.get(f"{backend.url}/health", timeout=timeout)
+        if _is_loading(response):
+            return BACKEND_LOADING
+        if _is_busy(response):
+            return BACKEND_BUSY
+        response.raise_for_status()
+
+        response = await http_client.get(f"{backend.url}/slots", timeout=timeout)
+        if response.status_code != 200:
+            return BACKEND_READY
+        slots = response.json()
+    except (httpx.HTTPError, ValueError) as e:
+        logger.warning(f"Health check of {backend.url} failed: {str(e) or type(e).__name__}")
+        return BACKEND_DOWN
+    if not isinstance(slots, list) or not slots:
+        return BACKEND_READY
+    if not backend.slots_configured:
+        backend.slots = len(slots)
+    if all(_slot_processing(slot) for slot in slots):
+        return BACKEND_BUSY
+    return BACKEND_READY
+
+
+def _slot_processing(slot: Any) -> bool:
+    # 新しい版はis_processing、古い版はstate（0: 待機中、1: 処理中）
+    if not isinstance(slot, dict):
+        return False
+    if "is_processing" in slot:
+        return bool(slot["is_processing"])
+    return slot.get("state", 0) != 0
+
+
+class HealthMonitor:
+    """バックエンドの状態を定期的に確認し、回路遮断器に応じて割り当ての対象を切り替える"""
+
+    def __init__(self, load_balancer: LoadBalancer, http_client: httpx.AsyncClient, settings: HealthSettings):
+        self.load_balancer = load_balancer
+        self.http_client = http_client
+        self.settings = settings
+        self.breakers: Dict[str, CircuitBreaker] = {
+            backend.url: CircuitBreaker(settings.failure_threshold, settings.interval, settings.max_backoff)
+            for backend in load_balancer.backends
+        }
+
+    async def probe(self, backend: Backend) -> None:
+        state = await probe_backend(self.http_client, backend, self.settings.timeout)
+        self.update(backend, state, time.monotonic())
+
+    def update(self, backend: Backend, state: str, now: float) -> None:
+        """確認の結果をバックエンドと回路遮断器に反映する"""
+        breaker = self.breakers[backend.url]
+        if state in (BACKEND_READY, BACKEND_BUSY):
+            breaker.record_success(now)
+        else:
+            breaker.record_failure(now, trip=state == BACKEND_LOADING)
+
+        if backend.state != state:
+            logger.info(f"Backend {backend.url} is {state}")
+        backend.state = state
+        if backend.healthy != breaker.closed:
+            backend.healthy = breaker.closed
+            if backend.healthy:
+                logger.info(f"Backend {backend.url} is back in rotation")
+            else:
+                logger.warning(
+                    f"Backend {backend.url} is out of rotation, next check in "
+                    f"{breaker.next_probe - now:.1f} seconds"
+                )
+            self.load_balancer.wake()
+
+    async def probe_all(self, force: bool = False) -> None:
+        """確認の時刻になったバックエンド（forceの場合は全て）を並行に確認する"""
+        now = time.monotonic()
+        due = [
+            backend for backend in self.load_balancer.backends
+            if force or self.breakers[backend.url].next_probe <= now
+        ]
+        await asyncio.gather(*[self.probe(backend) for backend in due])
+
+    async def run(self) -> None:
+        """次の確認の時刻まで待って確認することを繰り返す"""
+        while True:
+            next_probe = min(breaker.next_probe for breaker in self.breakers.values())
+            await asyncio.sleep(max(next_probe - time.monotonic(), 0.0))
+            await self.probe_all()
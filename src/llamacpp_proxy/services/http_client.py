@@ -0,0 +1,46 @@
+import logging
+from typing import Dict
+import httpx
+from fastapi import Request
+
+from llamacpp_proxy.config.upstream import UpstreamSettings
+
+logger = logging.getLogger(__name__)
+
+def create_http_client(settings: UpstreamSettings) -> httpx.AsyncClient:
+    """llama.cppサーバーとの通信に使う共有HTTPクライアントを生成"""
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=settings.max_connections,
+            max_keepalive_connections=settings.max_keepalive_connections,
+            keepalive_expiry=settings.keepalive_expiry,
+        ),
+        timeout=httpx.Timeout(
+            connect=settings.connect_timeout,
+            read=settings.read_timeout,
+            write=settings.write_timeout,
+            pool=settings.pool_timeout,
+        ),
+        http2=settings.http2,
+    )
+
+def get_http_client(request: Request) -> httpx.AsyncClient:
+    """lifespanで生成された共有HTTPクライアントを返す"""
+    return request.app.state.http_client
+
+def get_pool_stats(client: httpx.AsyncClient) -> Dict[str, int]:
+    """コネクションプールの使用状況を返す
+
+    httpcoreの内部状態を参照するため、取得できない項目は0とする
+    """
+    pool = getattr(getattr(client, "_transport", None), "_pool", None)
+    connections = list(getattr(pool, "connections", []))
+    requests = list(getattr(pool, "_requests", []))
+    idle = sum(1 for connection in connections if connection.is_idle())
+    queued = sum(1 for pool_request in requests if pool_request.is_queued())
+    return {
+        "connections": len(connections),
+        "active": len(connections) - idle,
+        "idle": idle,
+        "queued": queued,
+    }
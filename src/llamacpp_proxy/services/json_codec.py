@@ -0,0 +1,76 @@
+import json
+from typing import Any, Callable, Coroutine
+
+from fastapi import Request, Response
+from fastapi.routing import APIRoute
+from pydantic import BaseModel
+
+from llamacpp_proxy.services.tracing import phase
+
+try:
+    import orjson
+except ImportError:  # orjsonがない場合は標準のjsonを使う
+    orjson = None
+
+
+def loads(data: bytes) -> Any:
+    """JSONをデコードする（orjsonがあれば使う）
+
+    orjson.JSONDecodeErrorはjson.JSONDecodeErrorのサブクラスのため、呼び出し側の例外処理は変わらない。
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(value: Any) -> bytes:
+    """JSONをUTF-8のバイト列にエンコードする（orjsonがあれば使う）"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(value)
+        except orjson.JSONEncodeError:
+            pass
+    else:
+        try:
+            return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode()
+        except UnicodeEncodeError:
+            pass
+    # 対になっていないサロゲートを含む文字列はUTF-8にできないため、\uXXXXにエスケープする
+    return json.dumps(value, separators=(",", ":")).encode()
+
+
+class FastJSONRequest(Request):
+    """ボディのJSONをorjsonでデコードするRequest"""
+
+    async def json(self) -> Any:
+        if not hasattr(self, "_json"):
+            self._json = loads(await self.body())
+        return self._json
+
+
+class FastJSONRoute(APIRoute):
+    """リクエストボディのデコードにFastJSONRequestを使うルート
+
+    長いmessagesや大きなgrammarを含むボディのデコードを速くする。
+    """
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        handler = super().get_route_handler()
+
+        async def fast_json_handler(request: Request) -> Response:
+            return await handler(FastJSONRequest(request.scope, request.receive))
+
+        return fast_json_handler
+
+
+def json_response(model: BaseModel, response: Response) -> Response:
+    """レスポンスのモデルをpydantic-coreのシリアライザで直接JSONにして返す
+
+    FastAPIにモデルを返すと、response_modelとしての再検証とjsonable_encoderによる変換を経てから
+    シリアライズされるため、プロキシ自身が組み立てたモデルはここで直接シリアライズする。
+    依存関係でResponseに設定されたヘッダーも引き継ぐ。
+    """
+    with phase("serialize"):
+        body = model.model_dump_json()
+    headers = {key: value for key, value in response.headers.items() if key != "content-length"}
+    return Response(body, media_type="application/json", headers=headers)
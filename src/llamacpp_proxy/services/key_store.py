@@ -0,0 +1,221 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+from dataclasses import dataclass
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from fastapi import Request
+
+from llamacpp_proxy.config.rate_limit import RateLimitSettings
+from llamacpp_proxy.services.admission import PRIORITY_HIGH, PRIORITY_NORMAL
+
+logger = logging.getLogger(__name__)
+
+# 組み込みの種別。unlimitedのキーにはレート制限をかけない（その他の種別名は自由に付けられる）
+TIER_UNLIMITED = "unlimited"
+TIER_LIMITED = "limited"
+
+# priorityを指定しないキーの待ち行列の優先度（無制限キーを優先する）
+DEFAULT_PRIORITIES = {TIER_UNLIMITED: PRIORITY_HIGH}
+
+# SQLiteのキーストアとして読み込む拡張子（その他はJSON）
+SQLITE_SUFFIXES = (".sqlite", ".sqlite3", ".db")
+
+_HASH_PATTERN = re.compile(r"(?:sha256:)?([0-9a-f]{64})")
+
+
+def hash_api_key(api_key: str) -> str:
+    """APIキーのハッシュ（キーストアにはこの値だけを保存する）"""
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+@dataclass(frozen=True)
+class ApiKey:
+    """認証済みのAPIキー
+
+    idはログでの識別とレート制限の単位に使う（同じidのキーは制限を共有する）。
+    制限の項目がNoneの場合はRateLimitSettingsの値を使う。
+    """
+    id: str
+    key_hash: str
+    tier: str = TIER_LIMITED
+    priority: int = PRIORITY_NORMAL
+    models: Optional[FrozenSet[str]] = None  # 使用できるモデル。Noneは全て
+    max_requests: Optional[int] = None
+    window: Optional[int] = None
+    max_tokens_per_minute: Optional[int] = None
+
+    @property
+    def limited(self) -> bool:
+        return self.tier != TIER_UNLIMITED
+
+    def allows_model(self, model: str) -> bool:
+        return self.models is None or model in self.models
+
+
+def parse_key_entry(entry: Dict[str, Any]) -> ApiKey:
+    """キーストアの1エントリ（JSONのオブジェクトまたはSQLiteの行）をApiKeyにする
+
+    key_hash（sha256の16進数、"sha256:"は省略可）か、平文のkeyのどちらかが必要。
+    """
+    if entry.get("key_hash"):
+        match = _HASH_PATTERN.fullmatch(str(entry["key_hash"]).lower())
+        if match is None:
+            raise ValueError("key_hash must be a hex encoded sha256 digest")
+        key_hash = match.group(1)
+    elif entry.get("key"):
+        key_hash = hash_api_key(str(entry["key"]))
+    else:
+        raise ValueError("key_hash or key is required")
+
+    tier = str(entry.get("tier") or TIER_LIMITED)
+    priority = entry.get("priority")
+    if priority is not None and (not isinstance(priority, int) or isinstance(priority, bool)):
+        raise ValueError("priority must be an integer")
+    models = entry.get("models")
+    if isinstance(models, str):
+        models = [model.strip() for model in models.split(",") if model.strip()]
+    if models is not None and not isinstance(models, list):
+        raise ValueError("models must be a list of model names")
+
+    limits = {}
+    for name in ("max_requests", "window", "max_tokens_per_minute"):
+        value = entry.get(name)
+        if value is not None:
+            if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+                raise ValueError(f"{name} must be a non-negative integer")
+            limits[name] = value
+    if limits.get("max_requests") == 0 or limits.get("window") == 0:
+        raise ValueError("max_requests and window must be positive")
+
+    return ApiKey(
+        id=str(entry.get("id") or key_hash[:12]),
+        key_hash=key_hash,
+        tier=tier,
+        priority=priority if priority is not None else DEFAULT_PRIORITIES.get(tier, PRIORITY_NORMAL),
+        models=frozenset(models) if models else None,
+        **limits,
+    )
+
+
+def load_key_file(path: str) -> List[ApiKey]:
+    """JSONまたはSQLiteのキーストアを読み込む
+
+    JSONは{"keys": [...]}またはエントリの配列。SQLiteはapi_keysテーブルの各行を
+    1エントリとし、modelsはカンマ区切りで記述する。
+    """
+    if path.endswith(SQLITE_SUFFIXES):
+        entries = _read_sqlite(path)
+    else:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        entries = data.get("keys") if isinstance(data, dict) else data
+        if not isinstance(entries, list):
+            raise ValueError('Key file must contain a list of keys or {"keys": [...]}')
+
+    keys = []
+    for i, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            raise ValueError(f"Key entry {i} must be an object")
+        try:
+            keys.append(parse_key_entry(entry))
+        except ValueError as e:
+            raise ValueError(f"Invalid key entry {i}: {str(e)}") from e
+    return keys
+
+
+def _read_sqlite(path: str) -> List[Dict[str, Any]]:
+    # 読み取り専用で開き、存在しないファイルを作らないようにする
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        connection.row_factory = sqlite3.Row
+        return [dict(row) for row in connection.execute("SELECT * FROM api_keys")]
+    finally:
+        connection.close()
+
+
+class KeyStore:
+    """ハッシュ化したAPIキーからApiKeyを引く辞書
+
+    環境変数で指定したキー（unlimited_api_key / limited_api_key）と、key_fileから読み込んだキーを持つ。
+    読み込み直す際は新しい辞書を作ってから参照を差し替えるため、処理中のリクエストには影響しない。
+    """
+
+    def __init__(self, settings: RateLimitSettings):
+        self.settings = settings
+        self._keys: Dict[str, ApiKey] = {}
+        self._file_state: Optional[Tuple[Tuple[int, int], ...]] = None
+        self.reload()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def lookup(self, api_key: str) -> Optional[ApiKey]:
+        return self._keys.get(hash_api_key(api_key))
+
+    def _configured_keys(self) -> Iterable[ApiKey]:
+        if self.settings.unlimited_api_key:
+            yield parse_key_entry({"id": TIER_UNLIMITED, "key": self.settings.unlimited_api_key, "tier": TIER_UNLIMITED})
+        if self.settings.limited_api_key:
+            yield parse_key_entry({"id": TIER_LIMITED, "key": self.settings.limited_api_key, "tier": TIER_LIMITED})
+
+    def reload(self) -> None:
+        """キーを読み込み直す。key_fileが不正な場合はValueError/OSError/sqlite3.Errorを送出し、前の状態を保つ"""
+        keys = {key.key_hash: key for key in self._configured_keys()}
+        path = self.settings.key_file
+        if path:
+            state = self._stat(path)
+            for key in load_key_file(path):
+                keys[key.key_hash] = key
+            self._file_state = state
+        self._keys = keys
+
+    def reload_if_changed(self) -> bool:
+        """key_fileが更新されていれば読み込み直し、読み込んだかを返す"""
+        path = self.settings.key_file
+        if not path:
+            return False
+        try:
+            state = self._stat(path)
+        except OSError as e:
+            logger.warning(f"Failed to stat key file: {str(e)}")
+            return False
+        if state == self._file_state:
+            return False
+        try:
+            self.reload()
+        except (ValueError, OSError, sqlite3.Error) as e:
+            # 書きかけのファイルなどで失敗した場合は次の確認で再び読み込む
+            logger.error(f"Keeping previous API keys, reload failed: {str(e)}")
+            return False
+        logger.info(f"Reloaded {len(self._keys)} API keys from {path}")
+        return True
+
+    @staticmethod
+    def _stat(path: str) -> Tuple[Tuple[int, int], ...]:
+        # SQLiteのWALモードでは書き込みが-walファイルに入るため、あればその状態も見る
+        stat = os.stat(path)
+        states = [(stat.st_mtime_ns, stat.st_size)]
+        if path.endswith(SQLITE_SUFFIXES):
+            try:
+                stat = os.stat(path + "-wal")
+                states.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                pass
+        return tuple(states)
+
+
+async def watch_key_store(key_store: KeyStore, interval: float) -> None:
+    """key_fileの更新を定期的に確認し、更新されていれば別スレッドで読み込み直す"""
+    while True:
+        await asyncio.sleep(interval)
+        await asyncio.to_thread(key_store.reload_if_changed)
+
+
+def get_key_store(request: Request) -> KeyStore:
+    """lifespanで生成されたキーストアを返す"""
+    return request.app.state.key_store
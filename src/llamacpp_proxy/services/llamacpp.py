@@ -1,57 +1,363 @@
+import asyncio
 import logging
-from typing import Any, AsyncIterator, Dict, List, Optional
+import time
+from contextlib import AsyncExitStack
+from functools import partial
+from typing import Any, AsyncIterator, Awaitable, Callable, Collection, Dict, List, Optional
 import httpx
 from fastapi import HTTPException, Depends
 
 from llamacpp_proxy.config.settings import Settings, settings
+from llamacpp_proxy.services.admission import PRIORITY_NORMAL
+from llamacpp_proxy.services.balancer import Backend, Lease, LoadBalancer, get_load_balancer
+from llamacpp_proxy.services.failover import FailoverPolicy, get_failover_policy, record_failover, should_fail_over
+from llamacpp_proxy.services.http_client import get_http_client
+from llamacpp_proxy.services.metrics import metrics
+from llamacpp_proxy.services.response_cache import cache_key, is_deterministic
+from llamacpp_proxy.services.singleflight import SingleFlight, get_singleflight
+from llamacpp_proxy.services.streaming import iter_sse_data
+from llamacpp_proxy.services.tracing import RequestTiming, current_timing, phase
 
 logger = logging.getLogger(__name__)
 
+def _streaming_error(e: httpx.HTTPError) -> HTTPException:
+    logger.error(f"Error in streaming completion: {str(e)}")
+    return HTTPException(
+        status_code=502,
+        detail=f"Error in streaming completion: {str(e)}",
+    )
+
+
+def _trace_options(timing: Optional[RequestTiming], span: Any) -> Dict[str, Any]:
+    """上流へのリクエストにトレースのヘッダーと接続時間の計測を付ける"""
+    if timing is None:
+        return {}
+    return {
+        "headers": timing.propagation_headers(span),
+        "extensions": {"trace": timing.connection_trace()},
+    }
+
+
+class UpstreamStream:
+    """llama.cppからのストリーミングレスポンスのSSEイベントのdataを返すイテレータ
+
+    読み終えるか閉じた時点で、上流の接続とバックエンドの割り当てを解放する。
+    通信エラーは502のHTTPExceptionとして送出し、元の例外をerrorに残す。
+    """
+
+    def __init__(
+        self,
+        payloads: AsyncIterator[bytes],
+        stack: AsyncExitStack,
+        backend: Optional[Backend] = None,
+        started: float = 0.0,
+    ):
+        self._payloads = payloads
+        self._stack = stack
+        self.backend = backend
+        self.started = started
+        self.error: Optional[httpx.HTTPError] = None
+        self._closed = False
+
+    def __aiter__(self) -> "UpstreamStream":
+        return self
+
+    async def __anext__(self) -> bytes:
+        try:
+            return await self._payloads.__anext__()
+        except httpx.HTTPError as e:
+            self.error = e
+            await self.aclose()
+            raise _streaming_error(e)
+        except BaseException:
+            await self.aclose()
+            raise
+
+    async def aclose(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            await self._payloads.aclose()
+        finally:
+            await self._stack.aclose()
+            if self.started and self.backend is not None:
+                metrics.upstream_duration.observe(time.perf_counter() - self.started, self.backend.url)
+
+
 class LlamaCppClient:
-    def __init__(self, settings: Settings = Depends(lambda: settings)):
+    def __init__(
+        self,
+        settings: Settings = Depends(lambda: settings),
+        http_client: httpx.AsyncClient = Depends(get_http_client),
+        load_balancer: LoadBalancer = Depends(get_load_balancer),
+        singleflight: Optional[SingleFlight] = Depends(get_singleflight),
+        failover: Optional[FailoverPolicy] = Depends(get_failover_policy),
+    ):
         self.settings = settings
-        self.base_url = settings.llamacpp_server_url
+        self.http_client = http_client
+        self.load_balancer = load_balancer
+        self.singleflight = singleflight
+        self.failover = failover
+
+    @staticmethod
+    def _build_payload(request: Dict[str, Any], lease: Lease) -> Dict[str, Any]:
+        """割り当てられたスロットを指定し、プロンプトのKVキャッシュを再利用させる"""
+        if lease.slot_id is None:
+            return request
+        return {**request, "id_slot": lease.slot_id, "cache_prompt": True}
 
-    async def create_completion(self, request: Dict[str, Any]) -> List[Dict[str, Any]]:
+    def _coalescable(self, request: Dict[str, Any]) -> bool:
+        """同時に届いた同一リクエストと上流の生成を共有してよいか"""
+        return self.singleflight is not None and is_deterministic(request)
+
+    @staticmethod
+    def _coalescing_key(request: Dict[str, Any], priority: int) -> str:
+        """上流の生成は最初のリクエストの優先度で待ち行列に入るため、優先度の異なるリクエストはまとめない"""
+        return f"{priority}:{cache_key(request)}"
+
+    def _should_fail_over(self, error: httpx.HTTPError, failed: List[Backend]) -> bool:
+        """失敗したリクエストを別のバックエンドで再試行するか"""
+        return should_fail_over(self.failover, error, failed, self.load_balancer.backends)
+
+    async def create_completion(
+        self,
+        request: Dict[str, Any],
+        affinity_key: Optional[str] = None,
+        priority: int = PRIORITY_NORMAL,
+        max_queue_wait: Optional[float] = None,
+    ) -> List[Dict[str, Any]]:
         """非ストリーミング補完リクエストを実行"""
-        try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.base_url}/completions",
-                    json=request,
-                    timeout=300.0,
+        create = partial(self._create_completion, request, affinity_key, priority, max_queue_wait)
+        if self._coalescable(request):
+            return await self.singleflight.do(self._coalescing_key(request, priority), create)
+        return await create()
+
+    async def _create_completion(
+        self,
+        request: Dict[str, Any],
+        affinity_key: Optional[str],
+        priority: int,
+        max_queue_wait: Optional[float],
+    ) -> List[Dict[str, Any]]:
+        # 接続エラーや5xxの場合は、失敗したバックエンドを除いて再試行する
+        failed: List[Backend] = []
+        while True:
+            try:
+                return await self._post_completion(request, affinity_key, priority, max_queue_wait, failed)
+            except httpx.HTTPError as e:
+                if self._should_fail_over(e, failed):
+                    record_failover(failed[-1], e)
+                    continue
+                logger.error(f"Error communicating with llama.cpp server: {str(e)}")
+                raise HTTPException(
+                    status_code=502,
+                    detail=f"Error communicating with llama.cpp server: {str(e)}",
                 )
-                response.raise_for_status()
-                result = response.json()
-                return result if isinstance(result, list) else [result]
 
-        except httpx.HTTPError as e:
-            logger.error(f"Error communicating with llama.cpp server: {str(e)}")
-            raise HTTPException(
-                status_code=502,
-                detail=f"Error communicating with llama.cpp server: {str(e)}",
-            )
+    async def _post_completion(
+        self,
+        request: Dict[str, Any],
+        affinity_key: Optional[str],
+        priority: int,
+        max_queue_wait: Optional[float],
+        failed: List[Backend],
+    ) -> List[Dict[str, Any]]:
+        """failedを除いたバックエンドへ送る。通信エラーの場合はバックエンドをfailedに加える"""
+        async with self.load_balancer.acquire(
+            affinity_key, failed, priority=priority, max_queue_wait=max_queue_wait
+        ) as lease:
+            timing = current_timing()
+            started = time.perf_counter()
+            try:
+                with phase("upstream") as span:
+                    response = await self.http_client.post(
+                        f"{lease.backend.url}/completions",
+                        json=self._build_payload(request, lease),
+                        **_trace_options(timing, span),
+                    )
+                metrics.upstream_duration.observe(time.perf_counter() - started, lease.backend.url)
+                response.raise_for_status()
+            except httpx.HTTPError:
+                failed.append(lease.backend)
+                raise
+        result = response.json()
+        results = result if isinstance(result, list) else [result]
+        if timing is not None:
+            for choice in results:
+                timing.record_llamacpp(choice)
+        return results
 
     async def create_streaming_completion(
-        self, request: Dict[str, Any]
-    ) -> AsyncIterator[str]:
-        """ストリーミング補完リクエストを実行"""
+        self,
+        request: Dict[str, Any],
+        affinity_key: Optional[str] = None,
+        priority: int = PRIORITY_NORMAL,
+        max_queue_wait: Optional[float] = None,
+    ) -> AsyncIterator[bytes]:
+        """ストリーミング補完リクエストを開始し、SSEイベントのdataをバイト列のまま返すイテレータを返す
+
+        待ち行列での待機と上流への接続はここで済ませるため、
+        503や502はレスポンスの送信を始める前に例外として送出される。
+        """
+        open_stream = partial(self._open_streaming_completion, request, affinity_key, priority, max_queue_wait)
+        if self._coalescable(request):
+            return await self.singleflight.stream(self._coalescing_key(request, priority), open_stream)
+        return await open_stream()
+
+    async def _open_streaming_completion(
+        self,
+        request: Dict[str, Any],
+        affinity_key: Optional[str],
+        priority: int,
+        max_queue_wait: Optional[float],
+    ) -> AsyncIterator[bytes]:
+        failed: List[Backend] = []
+        stream = await self._open_with_failover(
+            partial(self._open_upstream, request, affinity_key, priority, max_queue_wait), failed
+        )
+        if self.failover is None or not self.failover.guards_first_token:
+            return stream
+        return self._guard_first_token(
+            stream,
+            partial(self._open_upstream, request, affinity_key, priority, max_queue_wait),
+            # ヘッジは待ち行列で待たせず、負けた場合に備えてアフィニティも更新しない
+            partial(self._open_upstream, request, None, priority, 0),
+            failed,
+        )
+
+    async def _open_with_failover(
+        self,
+        open_upstream: Callable[[List[Backend]], Awaitable[UpstreamStream]],
+        failed: List[Backend],
+    ) -> UpstreamStream:
+        while True:
+            try:
+                return await open_upstream(failed)
+            except httpx.HTTPError as e:
+                if not self._should_fail_over(e, failed):
+                    raise _streaming_error(e)
+                record_failover(failed[-1], e)
+
+    async def _open_upstream(
+        self,
+        request: Dict[str, Any],
+        affinity_key: Optional[str],
+        priority: int,
+        max_queue_wait: Optional[float],
+        failed: List[Backend],
+        busy: Collection[Backend] = (),
+    ) -> UpstreamStream:
+        """failedとbusyを除いたバックエンドへの接続を開く。通信エラーの場合はバックエンドをfailedに加える"""
+        stack = AsyncExitStack()
+        lease = None
         try:
-            async with httpx.AsyncClient() as client:
-                async with client.stream(
+            lease = await stack.enter_async_context(
+                self.load_balancer.acquire(
+                    affinity_key, [*failed, *busy], priority=priority, max_queue_wait=max_queue_wait
+                )
+            )
+            # ストリームのスパンは接続を閉じるまでとする
+            span = stack.enter_context(phase("upstream"))
+            started = time.perf_counter()
+            response = await stack.enter_async_context(
+                self.http_client.stream(
                     "POST",
-                    f"{self.base_url}/completions",
-                    json=request,
-                    timeout=300.0,
-                ) as response:
-                    response.raise_for_status()
-                    async for line in response.aiter_lines():
-                        if line.startswith("data: "):
-                            yield f"{line}\n\n"
+                    f"{lease.backend.url}/completions",
+                    json=self._build_payload(request, lease),
+                    **_trace_options(current_timing(), span),
+                )
+            )
+            response.raise_for_status()
+        except BaseException as e:
+            await stack.aclose()
+            if isinstance(e, httpx.HTTPError) and lease is not None:
+                failed.append(lease.backend)
+            raise
+        return UpstreamStream(iter_sse_data(response.aiter_bytes()), stack, lease.backend, started)
 
-        except httpx.HTTPError as e:
-            logger.error(f"Error in streaming completion: {str(e)}")
-            raise HTTPException(
-                status_code=502,
-                detail=f"Error in streaming completion: {str(e)}",
-            )
\ No newline at end of file
+    async def _guard_first_token(
+        self,
+        stream: UpstreamStream,
+        reopen: Callable[[List[Backend]], Awaitable[UpstreamStream]],
+        open_hedge: Callable[[List[Backend], Collection[Backend]], Awaitable[UpstreamStream]],
+        failed: List[Backend],
+    ) -> AsyncIterator[bytes]:
+        """最初のトークンが届くまで上流を見張る
+
+        届く前に接続が切れた場合は、別のバックエンドで開き直す。最初のトークンまでの時間が
+        ヘッジの閾値を超えた場合は、空いている別のバックエンドへ同じリクエストを送り、
+        先にトークンが届いた方を使ってもう一方を閉じる（llama.cppはその生成を中止する）。
+        """
+        streams = [stream]
+        pending: Dict[asyncio.Future, UpstreamStream] = {asyncio.ensure_future(stream.__anext__()): stream}
+        delay = self.failover.hedge_delay()
+        hedge: Optional[UpstreamStream] = None
+        try:
+            winner = None
+            first: Optional[bytes] = None
+            while winner is None:
+                timeout = None
+                if delay is not None and hedge is None:
+                    timeout = max(delay - (time.perf_counter() - stream.started), 0.0)
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    delay = None  # ヘッジは1回だけ送る
+                    busy = [s.backend for s in pending.values()]
+                    if not self.load_balancer.has_idle_backend([*failed, *busy]):
+                        continue
+                    try:
+                        hedge = await open_hedge(list(failed), busy)
+                    except (httpx.HTTPError, HTTPException) as e:
+                        logger.warning(f"Failed to send a hedged request: {str(e)}")
+                        continue
+                    streams.append(hedge)
+                    pending[asyncio.ensure_future(hedge.__anext__())] = hedge
+                    continue
+
+                for task in done:
+                    candidate = pending.pop(task)
+                    try:
+                        first = task.result()
+                    except StopAsyncIteration:
+                        first = None
+                    except HTTPException:
+                        error = candidate.error
+                        if error is not None and candidate.backend is not None:
+                            failed.append(candidate.backend)
+                        if pending:
+                            continue  # もう一方の上流の結果を待つ
+                        if error is None or not self._should_fail_over(error, failed):
+                            raise
+                        record_failover(failed[-1], error)
+                        retry = await self._open_with_failover(reopen, failed)
+                        streams.append(retry)
+                        pending[asyncio.ensure_future(retry.__anext__())] = retry
+                        continue
+                    winner = candidate
+                    break
+
+            if hedge is not None:
+                metrics.hedged_requests.inc("hedge" if winner is hedge else "primary")
+            # 負けた方の上流はすぐに閉じてスロットを解放する
+            await self._close_pending(pending)
+            for s in streams:
+                if s is not winner:
+                    await s.aclose()
+            if first is None:
+                return
+            self.failover.observe_first_token(time.perf_counter() - winner.started)
+            yield first
+            async for payload in winner:
+                yield payload
+        finally:
+            await self._close_pending(pending)
+            for s in streams:
+                await s.aclose()
+
+    @staticmethod
+    async def _close_pending(pending: Dict[asyncio.Future, UpstreamStream]) -> None:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        pending.clear()
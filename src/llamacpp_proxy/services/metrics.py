@@ -0,0 +1,391 @@
+import logging
+import math
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from llamacpp_proxy.services.http_client import get_pool_stats
+from llamacpp_proxy.services.request_log import dropped_log_records
+
+logger = logging.getLogger(__name__)
+
+# レイテンシ（秒）のヒストグラムのバケット
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+# トークン間隔・テンプレートのレンダリング時間など短い処理のバケット
+FAST_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# 上流へまとめて送った入力数のバケット
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+Labels = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    """単調増加するカウンター。ラベルの値は位置引数で渡す"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0.0)
+
+    def samples(self) -> Iterable[Tuple[str, str, float]]:
+        for labels, value in self._values.items():
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+
+class Histogram:
+    """累積バケット形式のヒストグラム"""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Labels, List[float]] = {}  # バケットごとの件数 + [合計, 件数]
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0.0] * (len(self.buckets) + 2)
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def count(self, *labels: str) -> float:
+        series = self._series.get(labels)
+        return series[-1] if series else 0.0
+
+    def samples(self) -> Iterable[Tuple[str, str, float]]:
+        for labels, series in self._series.items():
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                yield (
+                    f"{self.name}_bucket",
+                    _format_labels(self.labelnames, labels, f'le="{_format_value(bound)}"'),
+                    cumulative,
+                )
+            yield f"{self.name}_bucket", _format_labels(self.labelnames, labels, 'le="+Inf"'), series[-1]
+            yield f"{self.name}_sum", _format_labels(self.labelnames, labels), series[-2]
+            yield f"{self.name}_count", _format_labels(self.labelnames, labels), series[-1]
+
+
+class GaugeCallback:
+    """出力時に値を取得するゲージ（リクエスト処理中には何もしない）"""
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        collect: Optional[Callable[[], Iterable[Tuple[Labels, float]]]] = None,
+        kind: str = "gauge",
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        self.kind = kind
+
+    def samples(self) -> Iterable[Tuple[str, str, float]]:
+        if self.collect is None:
+            return
+        for labels, value in self.collect():
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+
+class Registry:
+    """Prometheusのテキスト形式で出力するメトリクスの登録先"""
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                samples = list(metric.samples())
+            except Exception as e:
+                logger.warning(f"Failed to collect metric {metric.name}: {str(e)}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in samples:
+                lines.append(f"{name}{labels} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class ProxyMetrics:
+    """プロキシのメトリクス
+
+    リクエスト処理中に更新するのはカウンターとヒストグラムのみで、
+    バックエンドの負荷や待ち行列などの状態は/metricsの出力時に各コンポーネントから取得する。
+    """
+
+    def __init__(self):
+        self.registry = Registry()
+        register = self.registry.register
+        self.requests = register(Counter(
+            "llamacpp_proxy_requests_total",
+            "Requests by endpoint, API key tier and status code",
+            ("endpoint", "tier", "status"),
+        ))
+        self.request_duration = register(Histogram(
+            "llamacpp_proxy_request_duration_seconds",
+            "End-to-end request latency, until the last byte for streams",
+            ("endpoint",),
+        ))
+        self.upstream_duration = register(Histogram(
+            "llamacpp_proxy_upstream_duration_seconds",
+            "Latency of llama.cpp requests, until the end of the stream for streaming requests",
+            ("backend",),
+        ))
+        self.time_to_first_token = register(Histogram(
+            "llamacpp_proxy_time_to_first_token_seconds",
+            "Time from receiving a streaming request to sending its first token",
+            ("endpoint",),
+        ))
+        self.inter_token_latency = register(Histogram(
+            "llamacpp_proxy_inter_token_latency_seconds",
+            "Average interval between tokens of a stream",
+            ("endpoint",),
+            FAST_BUCKETS,
+        ))
+        self.generated_tokens = register(Counter(
+            "llamacpp_proxy_generated_tokens_total",
+            "Generated tokens, rate() gives tokens per second",
+            ("endpoint",),
+        ))
+        self.aborted_generations = register(Counter(
+            "llamacpp_proxy_aborted_generations_total",
+            "Upstream generations aborted because the client disconnected, "
+            "stage is waiting (before the response started) or streaming",
+            ("endpoint", "stage"),
+        ))
+        self.failovers = register(Counter(
+            "llamacpp_proxy_failovers_total",
+            "Requests retried on another backend after an error before the first token, by failed backend",
+            ("backend",),
+        ))
+        self.hedged_requests = register(Counter(
+            "llamacpp_proxy_hedged_requests_total",
+            "Streaming requests duplicated to a second backend because the first token was slow, "
+            "winner is the request that answered first (primary or hedge)",
+            ("winner",),
+        ))
+        self.embedding_batch_size = register(Histogram(
+            "llamacpp_proxy_embedding_batch_size",
+            "Inputs per upstream embedding request after micro-batching",
+            (),
+            BATCH_SIZE_BUCKETS,
+        ))
+        self.template_render_duration = register(Histogram(
+            "llamacpp_proxy_template_render_seconds",
+            "Chat template rendering time",
+            (),
+            FAST_BUCKETS,
+        ))
+        register(GaugeCallback(
+            "llamacpp_proxy_log_records_dropped_total",
+            "Log records dropped because the log queue was full",
+            collect=lambda: [((), dropped_log_records())],
+            kind="counter",
+        ))
+        self._state_gauges: List[GaugeCallback] = [
+            register(GaugeCallback(
+                "llamacpp_proxy_backend_in_flight", "In-flight requests per backend from this worker", ("backend",)
+            )),
+            register(GaugeCallback(
+                "llamacpp_proxy_backend_slots", "Parallel slots per backend", ("backend",)
+            )),
+            register(GaugeCallback(
+                "llamacpp_proxy_queue_depth", "Requests waiting in the admission queue"
+            )),
+            register(GaugeCallback(
+                "llamacpp_proxy_queue_wait_seconds_total", "Total time requests waited for admission", kind="counter"
+            )),
+            register(GaugeCallback(
+                "llamacpp_proxy_queue_rejected_total", "Requests shed by the admission queue", ("reason",), kind="counter"
+            )),
+            register(GaugeCallback(
+                "llamacpp_proxy_upstream_connections", "Upstream connection pool usage", ("state",)
+            )),
+            register(GaugeCallback(
+                "llamacpp_proxy_cache_requests_total", "Response cache lookups", ("result",), kind="counter"
+            )),
+            register(GaugeCallback(
+                "llamacpp_proxy_singleflight_coalesced_total",
+                "Requests that shared another request's upstream generation",
+                kind="counter",
+            )),
+            register(GaugeCallback(
+                "llamacpp_proxy_api_keys", "API keys loaded in the key store"
+            )),
+            register(GaugeCallback(
+                "llamacpp_proxy_backend_healthy",
+                "1 while a backend is in rotation, 0 while its circuit breaker is open",
+                ("backend",),
+            )),
+            register(GaugeCallback(
+                "llamacpp_proxy_backend_state",
+                "Backend state from the last health check (1 for the current state)",
+                ("backend", "state"),
+            )),
+            register(GaugeCallback(
+                "llamacpp_proxy_grammar_cache_requests_total",
+                "Grammar validation and JSON schema conversion cache lookups",
+                ("result",),
+                kind="counter",
+            )),
+            register(GaugeCallback(
+                "llamacpp_proxy_registered_grammars", "Grammars registered in this worker"
+            )),
+            register(GaugeCallback(
+                "llamacpp_proxy_embedding_cache_requests_total",
+                "Embedding cache lookups per input",
+                ("result",),
+                kind="counter",
+            )),
+            register(GaugeCallback(
+                "llamacpp_proxy_affinity_requests_total",
+                "Prefix affinity lookups (hit: same slot, miss: new key, fallback: another slot)",
+                ("result",),
+                kind="counter",
+            )),
+            register(GaugeCallback(
+                "llamacpp_proxy_affinity_entries", "Entries in the prefix affinity table"
+            )),
+            register(GaugeCallback(
+                "llamacpp_proxy_backend_queue_depth",
+                "Requests waiting for admission whose prefix affinity points at this backend",
+                ("backend",),
+            )),
+        ]
+
+    def bind(self, state) -> None:
+        """app.stateのコンポーネントから状態を取得するよう設定する"""
+        (in_flight, slots, queue_depth, queue_wait, queue_rejected,
+         connections, cache_requests, coalesced, api_keys, healthy, backend_state,
+         grammar_requests, grammars, embedding_requests, affinity_requests,
+         affinity_entries, backend_queue_depth) = self._state_gauges
+        balancer = state.load_balancer
+        cache = state.response_cache
+        singleflight = state.singleflight
+
+        def admission(*keys: str) -> List[Tuple[Labels, float]]:
+            if balancer.admission is None:
+                return []
+            stats = balancer.admission.stats()
+            return [((), stats[key]) for key in keys]
+
+        in_flight.collect = lambda: [((b.url,), b.in_flight) for b in balancer.backends]
+        slots.collect = lambda: [((b.url,), b.slots) for b in balancer.backends]
+        queue_depth.collect = lambda: admission("queue_depth")
+        queue_wait.collect = lambda: admission("wait_seconds_total")
+        queue_rejected.collect = lambda: [
+            ((reason,), value)
+            for reason, (_, value) in zip(("queue_full", "timeout"), admission("rejected", "timed_out"))
+        ]
+        connections.collect = lambda: [((key,), value) for key, value in get_pool_stats(state.http_client).items()]
+        cache_requests.collect = lambda: [(("hit",), cache.hits), (("miss",), cache.misses)]
+        coalesced.collect = lambda: [((), singleflight.coalesced)] if singleflight is not None else []
+        api_keys.collect = lambda: [((), len(state.key_store))]
+        healthy.collect = lambda: [((b.url,), int(b.healthy)) for b in balancer.backends]
+        backend_state.collect = lambda: [((b.url, b.state), 1) for b in balancer.backends]
+        grammar_requests.collect = lambda: [
+            (("hit",), state.grammar_cache.hits), (("miss",), state.grammar_cache.misses)
+        ]
+        grammars.collect = lambda: [((), len(state.grammar_cache))]
+        embedding_requests.collect = lambda: [
+            (("hit",), state.embedding_batcher.hits), (("miss",), state.embedding_batcher.misses)
+        ]
+
+        def affinity(*keys: str) -> List[Tuple[Labels, float]]:
+            if balancer.affinity is None:
+                return []
+            stats = balancer.affinity.stats()
+            return [((), stats[key]) for key in keys]
+
+        affinity_requests.collect = lambda: [
+            ((result,), value)
+            for result, (_, value) in zip(("hit", "miss", "fallback"), affinity("hits", "misses", "fallbacks"))
+        ]
+        affinity_entries.collect = lambda: affinity("entries")
+        backend_queue_depth.collect = lambda: (
+            [((b.url,), b.queued) for b in balancer.backends]
+            if balancer.admission is not None and balancer.affinity is not None else []
+        )
+
+    def render(self) -> str:
+        return self.registry.render()
+
+
+class StreamTimer:
+    """ストリームの最初のトークンまでの時間とトークン間隔を計測する"""
+
+    __slots__ = ("endpoint", "started", "first", "last", "tokens")
+
+    def __init__(self, endpoint: str, started: float):
+        self.endpoint = endpoint
+        self.started = started
+        self.first = 0.0
+        self.last = 0.0
+        self.tokens = 0
+
+    def token(self) -> None:
+        now = time.perf_counter()
+        if not self.tokens:
+            self.first = now
+        self.last = now
+        self.tokens += 1
+
+    def close(self) -> None:
+        if not self.tokens:
+            return
+        metrics.time_to_first_token.observe(self.first - self.started, self.endpoint)
+        if self.tokens > 1:
+            metrics.inter_token_latency.observe((self.last - self.first) / (self.tokens - 1), self.endpoint)
+
+
+metrics = ProxyMetrics()
@@ -0,0 +1,251 @@
+import atexit
+import json
+import logging
+import queue
+import random
+import re
+import sys
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from llamacpp_proxy.config.log import PROMPT_FIELDS, LogSettings
+
+# 受け取ったリクエストIDをそのまま使う条件（ログやヘッダーを壊す文字を含むものは作り直す）
+REQUEST_ID_PATTERN = re.compile(r"[A-Za-z0-9._:-]{1,128}")
+# ログのメッセージ本文の上限（例外のメッセージにプロンプトが含まれる場合などに備える）
+MAX_MESSAGE_CHARS = 4096
+
+_request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+_sampled: ContextVar[bool] = ContextVar("request_log_sampled", default=True)
+
+_handler: Optional["DroppingQueueHandler"] = None
+_listener: Optional[QueueListener] = None
+
+
+def request_id_from_header(value: Optional[str]) -> str:
+    """X-Request-Idヘッダーの値を使う。ない場合や不正な場合は生成する"""
+    if value and REQUEST_ID_PATTERN.fullmatch(value):
+        return value
+    return uuid.uuid4().hex
+
+
+def bind_request(request_id: str, sample_rate: float) -> Tuple[Any, Any]:
+    """リクエストIDとサンプリングの有無をcontextvarに設定し、戻すためのトークンを返す"""
+    sampled = sample_rate >= 1 or random.random() < sample_rate
+    return _request_id.set(request_id), _sampled.set(sampled)
+
+
+def unbind_request(tokens: Tuple[Any, Any]) -> None:
+    id_token, sampled_token = tokens
+    _sampled.reset(sampled_token)
+    _request_id.reset(id_token)
+
+
+def current_request_id() -> Optional[str]:
+    return _request_id.get()
+
+
+class RequestContextFilter(logging.Filter):
+    """ログにリクエストIDを付け、サンプリングされなかったリクエストのINFO以下のログを捨てる
+
+    contextvarを参照するため、ログを出力したスレッドで動くハンドラーに設定する。
+    WARNING以上はサンプリングに関係なく出力する。
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = _request_id.get()
+        return record.levelno >= logging.WARNING or _sampled.get()
+
+
+class DroppingQueueHandler(QueueHandler):
+    """ログをキューに入れるだけのハンドラー
+
+    文字列への変換や出力はQueueListenerのスレッドで行う。キューが一杯の場合は
+    待たずに捨て、捨てた件数を数える。
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 同じプロセス内のスレッドに渡すだけなので、メッセージの整形もリスナーに任せる
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def sanitize_fields(fields: Dict[str, Any], settings: LogSettings) -> Dict[str, Any]:
+    """ログの項目の値を伏せ字にし、長い文字列を切り詰める
+
+    redact_fieldsの項目は値の長さだけを残す。capture_promptsが有効な場合、
+    プロンプトなどの項目は伏せずに全文を残す（APIキーなどは常に伏せる）。
+    """
+    redacted = {name.lower() for name in settings.redact_fields}
+    captured = {name.lower() for name in PROMPT_FIELDS} if settings.capture_prompts else set()
+    return _sanitize_dict(fields, redacted, captured, settings.max_field_chars)
+
+
+def _sanitize_dict(fields: Dict[str, Any], redacted: set, captured: set, limit: int) -> Dict[str, Any]:
+    result = {}
+    for key, value in fields.items():
+        name = str(key).lower()
+        if name in captured:
+            result[key] = value
+        elif name in redacted:
+            result[key] = _redact(value)
+        else:
+            result[key] = _sanitize_value(value, redacted, captured, limit)
+    return result
+
+
+def _sanitize_value(value: Any, redacted: set, captured: set, limit: int) -> Any:
+    if isinstance(value, dict):
+        return _sanitize_dict(value, redacted, captured, limit)
+    if isinstance(value, (list, tuple)):
+        return [_sanitize_value(item, redacted, captured, limit) for item in value]
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return _truncate(str(value), limit)
+
+
+def _redact(value: Any) -> Any:
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return f"[REDACTED {len(value)} chars]"
+    if isinstance(value, (list, tuple)):
+        return f"[REDACTED {len(value)} items]"
+    return "[REDACTED]"
+
+
+def _truncate(text: str, limit: int) -> str:
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}...(+{len(text) - limit} chars)"
+
+
+class StructuredFormatter(logging.Formatter):
+    """extra={"fields": {...}}で渡された項目を伏せ字・切り詰めしてから出力するフォーマッター
+
+    formatはtext（key=value形式）またはjson（1行1オブジェクト）。
+    """
+
+    def __init__(self, settings: LogSettings):
+        super().__init__()
+        self.settings = settings
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = record.getMessage()
+        if not self.settings.capture_prompts:
+            message = _truncate(message, MAX_MESSAGE_CHARS)
+        fields = getattr(record, "fields", None)
+        fields = sanitize_fields(fields, self.settings) if isinstance(fields, dict) else {}
+        request_id = getattr(record, "request_id", None)
+        exception = self.formatException(record.exc_info) if record.exc_info else None
+
+        if self.settings.format == "json":
+            entry = {
+                "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+                "level": record.levelname,
+                "logger": record.name,
+                "message": message,
+            }
+            if request_id:
+                entry["request_id"] = request_id
+            entry.update(fields)
+            if exception:
+                entry["exception"] = exception
+            return json.dumps(entry, ensure_ascii=False, default=str)
+
+        text = f"{self.formatTime(record)} {record.levelname} {record.name}"
+        if request_id:
+            text += f" [{request_id}]"
+        text += f" {message}"
+        if fields:
+            text += " " + " ".join(f"{key}={_format_field(value)}" for key, value in fields.items())
+        if exception:
+            text += "\n" + exception
+        return text
+
+
+def _format_field(value: Any) -> str:
+    if isinstance(value, str) and value and " " not in value and '"' not in value:
+        return value
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+
+def configure_logging(settings: LogSettings, stream=None) -> None:
+    """ルートロガーの出力をキュー経由にし、別スレッドで整形・出力する
+
+    uvicornのロガーも同じハンドラーに流す。2回目以降の呼び出しでは前の設定を置き換える。
+    """
+    global _handler, _listener
+    shutdown_logging()
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(StructuredFormatter(settings))
+    _handler = DroppingQueueHandler(queue.Queue(settings.queue_size))
+    _handler.addFilter(RequestContextFilter())
+    _listener = QueueListener(_handler.queue, output)
+    _listener.start()
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_handler)
+    root.setLevel(settings.level.upper())
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers = []
+        uvicorn_logger.propagate = True
+    # 上流へのリクエストはエンドポイントが要約を出力するため、httpxのリクエストごとのINFOは出さない
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+def shutdown_logging() -> None:
+    """キューに残ったログを出力してリスナーを止める"""
+    global _handler, _listener
+    if _listener is not None:
+        _listener.stop()
+    if _handler is not None:
+        logging.getLogger().removeHandler(_handler)
+    _handler = _listener = None
+
+
+atexit.register(shutdown_logging)
+
+
+def dropped_log_records() -> int:
+    """キューが一杯で捨てたログの件数"""
+    return _handler.dropped if _handler is not None else 0
+
+
+def upstream_request_fields(requests: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """llama.cppへのリクエストをログの項目にまとめる
+
+    プロンプトとgrammarは文字列の参照を渡すだけで、伏せ字にするか残すかはフォーマッターが決める。
+    """
+    first = requests[0] if requests else {}
+    fields: Dict[str, Any] = {
+        "choices": len(requests),
+        "prompt_chars": sum(len(r.get("prompt", "")) for r in requests),
+        "n_predict": first.get("n_predict"),
+        "stream": first.get("stream"),
+        "prompt": _prompts(requests),
+    }
+    if first.get("grammar") is not None:
+        fields["grammar"] = first["grammar"]
+    return fields
+
+
+def _prompts(requests: Iterable[Dict[str, Any]]) -> Any:
+    prompts = [r.get("prompt", "") for r in requests]
+    return prompts[0] if len(prompts) == 1 else prompts
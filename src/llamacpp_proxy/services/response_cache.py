@@ -0,0 +1,267 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
+from fastapi import Request
+from starlette.concurrency import run_in_threadpool
+
+from llamacpp_proxy.config.cache import CacheSettings
+
+logger = logging.getLogger(__name__)
+
+# キャッシュの利用状況を返すレスポンスヘッダー
+CACHE_STATUS_HEADER = "X-Cache"
+CACHE_HIT = "HIT"
+CACHE_MISS = "MISS"
+CACHE_BYPASS = "BYPASS"
+
+# ディスクキャッシュのロックを待つ最大秒数（超えた場合はキャッシュを使わずに処理を続ける）
+DISK_LOCK_TIMEOUT = 0.05
+
+def is_deterministic(llamacpp_request: Dict[str, Any]) -> bool:
+    """同じリクエストに対して同じ結果が返るリクエストかどうか"""
+    if llamacpp_request.get("temperature") == 0:
+        return True
+    seed = llamacpp_request.get("seed")
+    return seed is not None and seed >= 0
+
+def is_cacheable(llamacpp_request: Dict[str, Any]) -> bool:
+    """レスポンスをキャッシュできるリクエストかどうか"""
+    return not llamacpp_request.get("stream") and is_deterministic(llamacpp_request)
+
+def merge_cache_statuses(statuses: List[Optional[str]]) -> Optional[str]:
+    """複数のchoiceのキャッシュ状態を1つのX-Cacheヘッダーの値にまとめる"""
+    if not statuses or statuses[0] is None:
+        return None
+    if all(status == CACHE_HIT for status in statuses):
+        return CACHE_HIT
+    if CACHE_MISS in statuses or CACHE_HIT in statuses:
+        return CACHE_MISS
+    return CACHE_BYPASS
+
+def cache_key(llamacpp_request: Dict[str, Any]) -> str:
+    """llama.cppへのリクエストを正規化してキャッシュキーを生成"""
+    normalized = {key: value for key, value in llamacpp_request.items() if value is not None}
+    serialized = json.dumps(normalized, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(serialized.encode()).hexdigest()
+
+
+class DiskCache:
+    """再起動後も残るSQLiteのキャッシュ
+
+    合計サイズはcache_sizeテーブルに保持し、同じファイルを使う全ワーカーで共有する。
+    ロックの待ち時間はDISK_LOCK_TIMEOUTまでに制限し、取れない場合はsqlite3.OperationalErrorを送出する。
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # 起動時は他のワーカーによるテーブルの作成を待てるよう、既定の5秒待つ
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, expires_at REAL NOT NULL, stored_at REAL NOT NULL, value BLOB NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache_size (id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER NOT NULL)"
+        )
+        # 以前のバージョンで作られたファイルは、既存のエントリから合計サイズを求める
+        self._connection.execute(
+            "INSERT OR IGNORE INTO cache_size (id, bytes) "
+            "SELECT 0, COALESCE(SUM(LENGTH(value)), 0) FROM responses"
+        )
+        self._connection.execute(f"PRAGMA busy_timeout = {int(DISK_LOCK_TIMEOUT * 1000)}")
+
+    @contextmanager
+    def _locked(self) -> Iterator[sqlite3.Connection]:
+        if not self._lock.acquire(timeout=DISK_LOCK_TIMEOUT):
+            raise sqlite3.OperationalError("disk cache is locked by another thread")
+        try:
+            yield self._connection
+        finally:
+            self._lock.release()
+
+    def get(self, key: str, now: float) -> Optional[Tuple[float, bytes]]:
+        with self._locked():
+            row = self._connection.execute(
+                "SELECT expires_at, value FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or row[0] <= now:
+            return None
+        return row[0], row[1]
+
+    def put(self, key: str, value: bytes, expires_at: float, now: float) -> None:
+        with self._locked() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                # 置き換える場合は古いエントリの分を差し引く
+                row = connection.execute("SELECT LENGTH(value) FROM responses WHERE key = ?", (key,)).fetchone()
+                connection.execute(
+                    "INSERT OR REPLACE INTO responses (key, expires_at, stored_at, value) VALUES (?, ?, ?, ?)",
+                    (key, expires_at, now, value),
+                )
+                connection.execute(
+                    "UPDATE cache_size SET bytes = bytes + ? WHERE id = 0",
+                    (len(value) - (row[0] if row is not None else 0),),
+                )
+                if self._total(connection) > self.max_bytes:
+                    self._prune(connection, now)
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def size(self) -> int:
+        """全ワーカーで共有している合計サイズ(バイト)"""
+        with self._locked() as connection:
+            return self._total(connection)
+
+    @staticmethod
+    def _total(connection: sqlite3.Connection) -> int:
+        return connection.execute("SELECT bytes FROM cache_size WHERE id = 0").fetchone()[0]
+
+    def _prune(self, connection: sqlite3.Connection, now: float) -> None:
+        """期限切れのエントリと、容量を超えた分の古いエントリを削除する"""
+        connection.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+        size = connection.execute("SELECT COALESCE(SUM(LENGTH(value)), 0) FROM responses").fetchone()[0]
+        rows = connection.execute("SELECT key, LENGTH(value) FROM responses ORDER BY stored_at")
+        evicted = []
+        for key, entry_size in rows:
+            if size <= self.max_bytes:
+                break
+            evicted.append((key,))
+            size -= entry_size
+        connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        connection.execute("UPDATE cache_size SET bytes = ? WHERE id = 0", (size,))
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+class ResponseCache:
+    """決定的なリクエストに対するllama.cppのレスポンスのキャッシュ
+
+    メモリ上のLRU(TTLと合計サイズの上限付き)を一次キャッシュとし、
+    パスが設定されていればSQLiteのディスクキャッシュを二次キャッシュとして使う。
+    ディスクキャッシュのエラー（ロック待ちのタイムアウトや容量不足など）は記録するだけで、
+    メモリのキャッシュやllama.cppへの問い合わせを続ける。
+    """
+
+    def __init__(self, settings: CacheSettings, clock: Callable[[], float] = time.time):
+        self.settings = settings
+        self.clock = clock
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._size = 0
+        self.disk = DiskCache(settings.disk_path, settings.disk_max_bytes) if settings.disk_path else None
+        self.hits = 0
+        self.misses = 0
+
+    def _get_memory(self, key: str, now: float) -> Optional[bytes]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= now:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _put_memory(self, key: str, value: bytes, expires_at: float) -> None:
+        if len(value) > self.settings.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (expires_at, value)
+        self._size += len(value)
+        while len(self._entries) > self.settings.max_entries or self._size > self.settings.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+
+    def _remove(self, key: str) -> None:
+        _, value = self._entries.pop(key)
+        self._size -= len(value)
+
+    async def get(self, key: str) -> Optional[List[Dict[str, Any]]]:
+        now = self.clock()
+        value = self._get_memory(key, now)
+        if value is None and self.disk is not None:
+            try:
+                entry = await run_in_threadpool(self.disk.get, key, now)
+            except sqlite3.Error as e:
+                logger.warning(f"Failed to read the disk cache: {str(e)}")
+                entry = None
+            if entry is not None:
+                expires_at, value = entry
+                self._put_memory(key, value, expires_at)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(value)
+
+    async def put(self, key: str, response: List[Dict[str, Any]]) -> None:
+        now = self.clock()
+        expires_at = now + self.settings.ttl
+        value = json.dumps(response, separators=(",", ":"), ensure_ascii=False).encode()
+        self._put_memory(key, value, expires_at)
+        if self.disk is not None:
+            try:
+                await run_in_threadpool(self.disk.put, key, value, expires_at, now)
+            except sqlite3.Error as e:
+                logger.warning(f"Failed to write the disk cache: {str(e)}")
+
+    async def fetch(
+        self,
+        llamacpp_request: Dict[str, Any],
+        create_completion: Callable[[], Awaitable[List[Dict[str, Any]]]],
+        cache_control: Optional[str] = None,
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """キャッシュを参照し、なければllama.cppへ問い合わせる
+
+        戻り値はレスポンスと、X-Cacheヘッダーに設定するキャッシュの状態。
+        リクエストのCache-Controlがno-cacheなら参照せずに保存のみ、
+        no-storeなら参照も保存もしない。
+        """
+        if not self.settings.enabled:
+            return await create_completion(), None
+        if not is_cacheable(llamacpp_request):
+            return await create_completion(), CACHE_BYPASS
+
+        directives = {d.strip().lower() for d in cache_control.split(",")} if cache_control else set()
+        if "no-store" in directives:
+            return await create_completion(), CACHE_BYPASS
+
+        key = cache_key(llamacpp_request)
+        if "no-cache" not in directives:
+            cached = await self.get(key)
+            if cached is not None:
+                return cached, CACHE_HIT
+
+        response = await create_completion()
+        await self.put(key, response)
+        return response, CACHE_MISS
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def close(self) -> None:
+        if self.disk is not None:
+            self.disk.close()
+
+
+def get_response_cache(request: Request) -> ResponseCache:
+    """lifespanで生成されたレスポンスキャッシュを返す"""
+    return request.app.state.response_cache
@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional
+from starlette.concurrency import run_in_threadpool
+
+from llamacpp_proxy.services.balancer import LoadBalancer
+
+logger = logging.getLogger(__name__)
+
+PRUNE_EVERY = 100  # この回数の同期ごとに期限切れのレート制限の状態を削除する
+LOCK_TIMEOUT = 0.05  # ロックを待つ最大秒数（超えた場合はsqlite3.OperationalError）
+
+
+class SharedState:
+    """ワーカープロセス間で共有する状態
+
+    同じホストの全ワーカーが1つのSQLiteファイル（WALモード）を開き、
+    レート制限のカウンターと、バックエンドごとの処理中リクエスト数と、登録されたgrammarを共有する。
+    各操作はロックを待つためブロックする。イベントループからはrun_in_threadpoolで呼び出す。
+    ロックの待ち時間はLOCK_TIMEOUTまでに制限し、取れない場合はsqlite3.OperationalErrorを送出する。
+    """
+
+    def __init__(self, path: str, worker_id: str = "", clock: Callable[[], float] = time.time):
+        self.path = path
+        self.worker_id = worker_id or str(os.getpid())
+        self.clock = clock
+        self._lock = threading.Lock()
+        # 起動時は他のワーカーによるテーブルの作成を待てるよう、長めに待つ
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5.0)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=OFF")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, tat REAL NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS backend_load ("
+            "worker TEXT NOT NULL, url TEXT NOT NULL, in_flight INTEGER NOT NULL, updated_at REAL NOT NULL, "
+            "PRIMARY KEY (worker, url))"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS grammars (id TEXT PRIMARY KEY, grammar TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._connection.execute(f"PRAGMA busy_timeout = {int(LOCK_TIMEOUT * 1000)}")
+
+    @contextmanager
+    def _locked(self) -> Iterator[sqlite3.Connection]:
+        """このプロセス内の他のスレッドとの排他（待ち時間はLOCK_TIMEOUTまで）"""
+        if not self._lock.acquire(timeout=LOCK_TIMEOUT):
+            raise sqlite3.OperationalError("shared state is locked by another thread")
+        try:
+            yield self._connection
+        finally:
+            self._lock.release()
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """書き込みロックを取ってトランザクションを実行する"""
+        with self._locked():
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._connection
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    def exchange_load(self, in_flight: Dict[str, int], stale_after: float) -> Dict[str, int]:
+        """このワーカーの処理中リクエスト数を書き込み、他のワーカーの合計を返す
+
+        stale_after秒以上更新されていないワーカー（終了したワーカーなど）は数えない。
+        """
+        now = self.clock()
+        with self.transaction() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO backend_load (worker, url, in_flight, updated_at) VALUES (?, ?, ?, ?)",
+                [(self.worker_id, url, count, now) for url, count in in_flight.items()],
+            )
+            rows = connection.execute(
+                "SELECT url, SUM(in_flight) FROM backend_load "
+                "WHERE worker != ? AND updated_at > ? GROUP BY url",
+                (self.worker_id, now - stale_after),
+            ).fetchall()
+        return {url: count for url, count in rows}
+
+    def put_grammar(self, grammar_id: str, grammar: str, max_grammars: int) -> None:
+        """登録されたgrammarを書き込み、max_grammars件を超えた分を古いものから削除する"""
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO grammars (id, grammar, created_at) VALUES (?, ?, ?)",
+                (grammar_id, grammar, self.clock()),
+            )
+            connection.execute(
+                "DELETE FROM grammars WHERE id IN "
+                "(SELECT id FROM grammars ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (max_grammars,),
+            )
+
+    def get_grammar(self, grammar_id: str) -> Optional[str]:
+        with self._locked() as connection:
+            row = connection.execute("SELECT grammar FROM grammars WHERE id = ?", (grammar_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def prune(self) -> None:
+        """期限切れのレート制限の状態と、終了したワーカーの行を削除する"""
+        now = self.clock()
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM rate_limits WHERE tat <= ?", (now,))
+            connection.execute("DELETE FROM backend_load WHERE updated_at <= ?", (now - 60,))
+
+    def close(self) -> None:
+        try:
+            with self.transaction() as connection:
+                connection.execute("DELETE FROM backend_load WHERE worker = ?", (self.worker_id,))
+        except sqlite3.Error as e:
+            # 残った行はstale_afterを過ぎると数えられなくなる
+            logger.warning(f"Failed to remove backend load of worker {self.worker_id}: {str(e)}")
+        with self._lock:
+            self._connection.close()
+
+
+def remove_database(path: str) -> None:
+    """SQLiteファイルと、WALモードの-wal/-shmファイルを削除する"""
+    for file in (path, f"{path}-wal", f"{path}-shm"):
+        try:
+            os.remove(file)
+        except FileNotFoundError:
+            pass
+
+
+async def sync_backend_load(load_balancer: LoadBalancer, shared_state: SharedState, interval: float) -> None:
+    """バックエンドごとの処理中リクエスト数を定期的に他のワーカーと同期する"""
+    count = 0
+    while True:
+        try:
+            remote = await run_in_threadpool(
+                shared_state.exchange_load,
+                {backend.url: backend.in_flight for backend in load_balancer.backends},
+                stale_after=max(interval * 10, 1.0),
+            )
+            load_balancer.set_remote_load(remote)
+            count += 1
+            if count % PRUNE_EVERY == 0:
+                await run_in_threadpool(shared_state.prune)
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to synchronize backend load: {str(e)}")
+        await asyncio.sleep(interval)
+
@@ -0,0 +1,158 @@
+import asyncio
+import logging
+from contextlib import nullcontext
+from typing import AsyncIterator, Awaitable, Callable, Dict, Generic, List, Optional, TypeVar
+from fastapi import Request
+
+from llamacpp_proxy.services.tracing import phase
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class SharedStream(Generic[T]):
+    """1本の上流ストリームを複数の購読者へ配信する
+
+    受信済みのチャンクは保持しておき、途中から参加した購読者にも先頭から配信する。
+    購読者が全員いなくなった時点で上流の読み込みを中止する。
+    """
+
+    def __init__(self, open_source: Callable[[], Awaitable[AsyncIterator[T]]], on_close: Callable[[], None]):
+        self.chunks: List[T] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.opened: "asyncio.Future" = asyncio.get_running_loop().create_future()
+        self._changed = asyncio.Event()
+        self._on_close = on_close
+        self._task = asyncio.ensure_future(self._pump(open_source))
+
+    async def _pump(self, open_source: Callable[[], Awaitable[AsyncIterator[T]]]) -> None:
+        try:
+            source = await open_source()
+            self.opened.set_result(None)
+            async for chunk in source:
+                self.chunks.append(chunk)
+                self._notify()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.error = e
+        finally:
+            if not self.opened.done():
+                if self.error is not None:
+                    self.opened.set_exception(self.error)
+                else:
+                    self.opened.cancel()
+            self.done = True
+            self._notify()
+            self._on_close()
+
+    def _notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def join(self) -> AsyncIterator[T]:
+        """上流への接続を待ってから購読を開始する（接続時のエラーはここで送出される）"""
+        self.subscribers += 1
+        try:
+            await asyncio.shield(self.opened)
+        except BaseException:
+            self._leave()
+            raise
+        return self._subscribe()
+
+    async def _subscribe(self) -> AsyncIterator[T]:
+        index = 0
+        try:
+            while True:
+                if index < len(self.chunks):
+                    yield self.chunks[index]
+                    index += 1
+                    continue
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self._changed.wait()
+        finally:
+            self._leave()
+
+    def _leave(self) -> None:
+        self.subscribers -= 1
+        if self.subscribers == 0 and not self.done:
+            self._task.cancel()
+
+
+class SingleFlight:
+    """同時に処理中の同一リクエストを1回の上流リクエストにまとめる
+
+    上流の処理は最初のリクエストのコンテキスト（計測やスパン）で実行される。
+    相乗りしたリクエストは、結果や接続を待った時間を自身のcoalescedフェーズとして記録する。
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, "asyncio.Future"] = {}
+        self._waiters: Dict[str, int] = {}
+        self._streams: Dict[str, SharedStream] = {}
+        self.coalesced = 0  # 他のリクエストの結果を共有したリクエスト数
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        """同じキーの処理が実行中ならその結果を待ち、なければ実行する"""
+        task = self._calls.get(key)
+        follower = task is not None
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            self._waiters[key] = 0
+            task.add_done_callback(lambda _: self._forget_call(key, task))
+        else:
+            self.coalesced += 1
+
+        self._waiters[key] += 1
+        try:
+            with phase("coalesced") if follower else nullcontext():
+                return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # 待っているリクエストが全員キャンセルされたら上流も中止する
+            if self._calls.get(key) is task and self._waiters[key] == 1:
+                task.cancel()
+            raise
+        finally:
+            if self._calls.get(key) is task:
+                self._waiters[key] -= 1
+
+    def _forget_call(self, key: str, task: "asyncio.Future") -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+            del self._waiters[key]
+
+    async def stream(
+        self, key: str, open_stream: Callable[[], Awaitable[AsyncIterator[T]]]
+    ) -> AsyncIterator[T]:
+        """同じキーのストリームが配信中なら相乗りし、なければ開始する"""
+        shared = self._streams.get(key)
+        if shared is None:
+            def forget():
+                if self._streams.get(key) is shared:
+                    del self._streams[key]
+
+            shared = SharedStream(open_stream, forget)
+            self._streams[key] = shared
+            return await shared.join()
+        self.coalesced += 1
+        with phase("coalesced"):
+            return await shared.join()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": len(self._calls),
+            "streams": len(self._streams),
+            "coalesced": self.coalesced,
+        }
+
+
+def get_singleflight(request: Request) -> Optional[SingleFlight]:
+    """lifespanで生成されたSingleFlightを返す（無効の場合はNone）"""
+    return request.app.state.singleflight
@@ -0,0 +1,278 @@
+import asyncio
+import json
+import logging
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+from fastapi import Response
+from fastapi.responses import StreamingResponse
+
+from llamacpp_proxy.config.streaming import StreamingSettings
+from llamacpp_proxy.services.batch import merge_streams
+from llamacpp_proxy.services.json_codec import dumps
+from llamacpp_proxy.services.metrics import StreamTimer, metrics
+
+logger = logging.getLogger(__name__)
+
+DONE = b"data: [DONE]\n\n"
+# 送るものがない間に接続を保つためのSSEのコメント（クライアントは読み捨てる）
+HEARTBEAT = b": keep-alive\n\n"
+SLOW_CONSUMER_ERROR = (
+    b'data: {"error":{"message":"Client is reading the stream too slowly",'
+    b'"type":"server_error","code":"slow_consumer"}}\n\n'
+)
+
+def get_finish_reason(choice: dict) -> Optional[str]:
+    """
+    llama.cppのstop_typeとtruncatedフラグからOpenAI APIのfinish_reasonを決定する
+
+    finish_reason:
+    - "stop": APIリクエストで指定されたstop sequenceに到達
+    - "length": max_tokensに到達
+    - "content_filter": コンテンツフィルターによる停止（llama.cppでは未サポート）
+    - null: 生成が進行中（ストリーミング時のみ）
+    """
+    if choice.get("truncated", False):
+        return "length"
+
+    stop_type = choice.get("stop_type")
+    if stop_type == "word":
+        return "stop"  # stop wordによる停止
+    elif stop_type == "eos":
+        return "stop"  # EOSトークンによる停止
+    elif stop_type == "limit":
+        return "length"  # n_predict（max_tokens）制限による停止
+    else:
+        return "stop"  # デフォルト値（通常は発生しない）
+
+async def iter_sse_data(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """生のバイト列からSSEイベントのdataフィールドを取り出す
+
+    行単位で文字列に変換せず、イベント区切りの空行をバイト列のまま探す。
+    """
+    buffer = b""
+    async for chunk in chunks:
+        buffer = buffer + chunk if buffer else chunk
+        if b"\r" in buffer:
+            buffer = buffer.replace(b"\r\n", b"\n")
+        start = 0
+        while True:
+            end = buffer.find(b"\n\n", start)
+            if end < 0:
+                break
+            frame = buffer[start:end]
+            start = end + 2
+            if frame.startswith(b"data: ") and b"\n" not in frame:
+                yield frame[6:]
+                continue
+            for line in frame.split(b"\n"):
+                if line.startswith(b"data:"):
+                    yield line[5:].lstrip(b" ")
+        buffer = buffer[start:]
+    if buffer.startswith(b"data:"):
+        yield buffer[5:].strip()
+
+
+class ChunkEncoder:
+    """OpenAI形式のストリーミングチャンクを組み立てる
+
+    id・created・modelなどトークンごとに変わらない部分は事前にシリアライズしておき、
+    トークンごとにはテキストのJSONエンコードと連結だけを行う。
+    """
+
+    def __init__(self, object_type: str, completion_id: str, created: int, model: str, chat: bool):
+        head = json.dumps(
+            {"id": completion_id, "object": object_type, "created": created, "model": model},
+            separators=(",", ":"),
+            ensure_ascii=False,
+        )
+        self.chat = chat
+        self._head = b"data: " + head[:-1].encode() + b',"choices":[{"index":'
+        self._prefixes: Dict[int, bytes] = {}
+        if chat:
+            self._content = b',"delta":{"content":'
+            self._content_tail = b'},"finish_reason":null}]}\n\n'
+            self._finish = b',"delta":{},"finish_reason":'
+        else:
+            self._content = b',"text":'
+            self._content_tail = b',"logprobs":null,"finish_reason":null}]}\n\n'
+            self._finish = b',"text":"","logprobs":null,"finish_reason":'
+
+    @classmethod
+    def for_chat(cls, completion_id: str, created: int, model: str) -> "ChunkEncoder":
+        return cls("chat.completion.chunk", completion_id, created, model, chat=True)
+
+    @classmethod
+    def for_completion(cls, completion_id: str, created: int, model: str) -> "ChunkEncoder":
+        return cls("text_completion", completion_id, created, model, chat=False)
+
+    def _prefix(self, index: int) -> bytes:
+        prefix = self._prefixes.get(index)
+        if prefix is None:
+            prefix = self._prefixes[index] = self._head + str(index).encode()
+        return prefix
+
+    def role(self, index: int) -> bytes:
+        """チャットの最初のチャンク（roleのみ）"""
+        return self._prefix(index) + b',"delta":{"role":"assistant","content":""},"finish_reason":null}]}\n\n'
+
+    def content(self, index: int, text: str) -> bytes:
+        return (
+            self._prefix(index)
+            + self._content
+            + dumps(text)
+            + self._content_tail
+        )
+
+    def finish(self, index: int, finish_reason: Optional[str]) -> bytes:
+        return self._prefix(index) + self._finish + json.dumps(finish_reason).encode() + b"}]}\n\n"
+
+
+async def translate_stream(
+    payloads: AsyncIterator[bytes],
+    encoder: ChunkEncoder,
+    index: int = 0,
+    on_finish: Optional[Callable[[Dict[str, Any]], None]] = None,
+    timer: Optional[StreamTimer] = None,
+) -> AsyncIterator[bytes]:
+    """llama.cppのストリーミングイベントをOpenAI形式のチャンクに変換する
+
+    on_finishが指定されている場合は、生成が終わった時点の最後のイベントを渡して呼び出す。
+    timerが指定されている場合は、トークンを送るたびに時刻を記録する。
+    """
+    try:
+        if encoder.chat:
+            yield encoder.role(index)
+        async for payload in payloads:
+            if payload == b"[DONE]":
+                return
+            event = json.loads(payload)
+            if "error" in event:
+                yield b"data: " + payload + b"\n\n"
+                return
+            content = event.get("content")
+            if content:
+                if timer is not None:
+                    timer.token()
+                yield encoder.content(index, content)
+            if event.get("stop"):
+                if on_finish is not None:
+                    on_finish(event)
+                yield encoder.finish(index, get_finish_reason(event))
+                return
+    finally:
+        if timer is not None:
+            timer.close()
+        await payloads.aclose()
+
+async def openai_stream(streams: List[AsyncIterator[bytes]]) -> AsyncIterator[bytes]:
+    """choiceごとのチャンクを1本のSSEストリームにまとめ、最後に[DONE]を送る
+
+    各ストリームは上流への接続を済ませているため、すべて同時に読む。
+    途中で閉じられた場合は上流の接続を閉じる。
+    """
+    merged = streams[0] if len(streams) == 1 else merge_streams(streams, len(streams))
+    try:
+        async for chunk in merged:
+            yield chunk
+    finally:
+        await merged.aclose()
+    yield DONE
+
+async def buffered_stream(
+    source: AsyncIterator[bytes],
+    settings: StreamingSettings,
+    endpoint: Optional[str] = None,
+) -> AsyncIterator[bytes]:
+    """上流の読み込みとクライアントへの送信を切り離し、送信の回数を減らす
+
+    上流のチャンクは別タスクでバッファに溜め、送信のたびに溜まっている分を1回の書き込みにまとめる。
+    flush_intervalが指定されている場合は、最初のチャンクからその秒数だけ待って次のチャンクもまとめる。
+    heartbeat_intervalの間送るものがない場合（プロンプトの評価中など）はSSEのコメントを送る。
+
+    クライアントの読み込みが遅く、送っていないチャンクがmax_buffer_bytesを超えた場合、
+    abortでは上流を閉じてスロットを解放し、溜まっている分とエラーのイベントを送って終える。
+    blockでは上流の読み込みを止めてクライアントを待つ。
+
+    クライアントが切断するとStarletteがこのイテレータをキャンセル（または破棄）し、
+    上流の接続を閉じる。endpointを指定した場合は中止した生成として数える。
+    """
+    buffer: List[bytes] = []
+    buffered = 0
+    finished = False
+    overflowed = False
+    error: Optional[BaseException] = None
+    data_ready = asyncio.Event()
+    space_ready = asyncio.Event()
+    block = settings.slow_consumer_policy == "block"
+
+    async def pump() -> None:
+        nonlocal buffered, finished, overflowed, error
+        try:
+            async for chunk in source:
+                while block and buffered >= settings.max_buffer_bytes:
+                    space_ready.clear()
+                    await space_ready.wait()
+                buffer.append(chunk)
+                buffered += len(chunk)
+                data_ready.set()
+                if buffered > settings.max_buffer_bytes and not block:
+                    overflowed = True
+                    break
+        except Exception as e:
+            error = e
+        finally:
+            # 打ち切った場合もここで上流の接続を閉じ、スロットを解放する
+            await source.aclose()
+            finished = True
+            data_ready.set()
+
+    task = asyncio.ensure_future(pump())
+    # 上流を読み終えた（または打ち切った）後の切断は中止した生成として数えない
+    settled = False
+    try:
+        while True:
+            if not buffer:
+                if finished:
+                    break
+                data_ready.clear()
+                if settings.heartbeat_interval:
+                    try:
+                        async with asyncio.timeout(settings.heartbeat_interval):
+                            await data_ready.wait()
+                    except TimeoutError:
+                        yield HEARTBEAT
+                else:
+                    await data_ready.wait()
+                continue
+
+            if settings.flush_interval and not finished and buffered < settings.max_buffer_bytes:
+                await asyncio.sleep(settings.flush_interval)
+            frame = buffer[0] if len(buffer) == 1 else b"".join(buffer)
+            buffer.clear()
+            buffered = 0
+            space_ready.set()
+            yield frame
+
+        settled = True
+        if overflowed:
+            if endpoint is not None:
+                metrics.aborted_generations.inc(endpoint, "slow_consumer")
+            logger.warning("Client is reading the stream too slowly, aborted the upstream request")
+            yield SLOW_CONSUMER_ERROR + DONE
+        elif error is not None:
+            raise error
+    except (asyncio.CancelledError, GeneratorExit):
+        if endpoint is not None and not settled:
+            metrics.aborted_generations.inc(endpoint, "streaming")
+            logger.info("Client disconnected during the stream, aborted the upstream request")
+        raise
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+def streaming_response(stream: AsyncIterator[bytes], response: Response) -> StreamingResponse:
+    """依存関係でResponseに設定されたヘッダーを引き継いでSSEのレスポンスを返す
+
+    エンドポイントがResponseを直接返す場合、FastAPIは依存関係のヘッダーをマージしないため。
+    """
+    headers = {key: value for key, value in response.headers.items() if key != "content-length"}
+    return StreamingResponse(stream, media_type="text/event-stream", headers=headers)
@@ -1,25 +1,144 @@
+import hashlib
 import logging
-from typing import List
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
 import jinja2
 from fastapi import HTTPException, Depends
+from starlette.concurrency import run_in_threadpool
 
 from llamacpp_proxy.config.settings import Settings, settings
 from llamacpp_proxy.models.chat import Message
+from llamacpp_proxy.services.metrics import metrics
+from llamacpp_proxy.services.tracing import phase
 
 logger = logging.getLogger(__name__)
 
+class _SourceLoader(jinja2.BaseLoader):
+    """ソースのハッシュ値をテンプレート名として扱うローダー"""
+
+    def __init__(self):
+        self.sources: Dict[str, str] = {}
+
+    def get_source(self, environment, template):
+        source = self.sources.get(template)
+        if source is None:
+            raise jinja2.TemplateNotFound(template)
+        return source, None, lambda: True
+
+
+class TemplateCache:
+    """コンパイル済みのチャットテンプレートを共有するキャッシュ
+
+    テンプレートはソース文字列ごとに一度だけコンパイルし、以降は同じオブジェクトを返す。
+    テンプレートファイルが指定されている場合は更新を検知して再読み込みする。
+    """
+
+    max_templates = 8
+
+    def __init__(self):
+        self.loader = _SourceLoader()
+        self.environment = jinja2.Environment(loader=self.loader, auto_reload=False)
+        self._templates: "OrderedDict[str, jinja2.Template]" = OrderedDict()
+        self._file_states: Dict[str, Tuple[int, int]] = {}
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+
+    def configure(self, bytecode_cache_dir: Optional[str] = None) -> None:
+        """バイトコードキャッシュを設定する"""
+        with self._lock:
+            if bytecode_cache_dir:
+                os.makedirs(bytecode_cache_dir, exist_ok=True)
+                self.environment.bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_cache_dir)
+            else:
+                self.environment.bytecode_cache = None
+            self._templates.clear()
+            self.loader.sources.clear()
+            if self.environment.cache is not None:
+                self.environment.cache.clear()
+
+    def get_template(self, source: str) -> jinja2.Template:
+        """ソースに対応するコンパイル済みテンプレートを返す"""
+        template = self._templates.get(source)
+        if template is not None:
+            return template
+
+        with self._lock:
+            template = self._templates.get(source)
+            if template is not None:
+                return template
+            name = hashlib.sha256(source.encode()).hexdigest()
+            self.loader.sources[name] = source
+            try:
+                template = self.environment.get_template(name)
+            finally:
+                del self.loader.sources[name]
+            self._templates[source] = template
+            while len(self._templates) > self.max_templates:
+                self._templates.popitem(last=False)
+            return template
+
+    def maybe_reload(self, settings: Settings) -> None:
+        """テンプレートファイルが更新されていれば読み込み直す"""
+        path = settings.chat_template_path
+        if not path or settings.template_reload_interval <= 0:
+            return
+        now = time.monotonic()
+        if now - self._last_check < settings.template_reload_interval:
+            return
+        self._last_check = now
+
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            logger.warning(f"Failed to stat chat template: {str(e)}")
+            return
+        state = (stat.st_mtime_ns, stat.st_size)
+        if self._file_states.get(path) == state:
+            return
+        self._file_states[path] = state
+
+        try:
+            source = Settings.load_chat_template(path)
+            self.get_template(source)
+        except (ValueError, jinja2.TemplateError) as e:
+            logger.error(f"Keeping previous chat template, reload failed: {str(e)}")
+            return
+        if source != settings.chat_template:
+            settings.chat_template = source
+            logger.info(f"Reloaded chat template from {path}")
+
+
+template_cache = TemplateCache()
+
+
 class TemplateService:
     def __init__(self, settings: Settings = Depends(lambda: settings)):
         self.settings = settings
-        
+        self.template_cache = template_cache
+
     def render(self, messages: List[Message]) -> str:
         """メッセージリストからプロンプトを生成"""
         try:
-            template = jinja2.Template(self.settings.chat_template)
-            return template.render(messages=messages)
+            self.template_cache.maybe_reload(self.settings)
+            template = self.template_cache.get_template(self.settings.chat_template)
+            started = time.perf_counter()
+            prompt = template.render(messages=messages)
+            metrics.template_render_duration.observe(time.perf_counter() - started)
+            return prompt
         except jinja2.TemplateError as e:
             logger.error(f"Template rendering error: {str(e)}")
             raise HTTPException(
                 status_code=400,
                 detail=f"Template rendering error: {str(e)}",
-            )
\ No newline at end of file
+            )
+
+    async def render_async(self, messages: List[Message]) -> str:
+        """長い会話履歴はイベントループを塞がないようスレッドプールでレンダリングする"""
+        threshold = self.settings.template_offload_threshold
+        with phase("template"):
+            if threshold > 0 and len(messages) >= threshold:
+                return await run_in_threadpool(self.render, messages)
+            return self.render(messages)
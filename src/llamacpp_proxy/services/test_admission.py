@@ -0,0 +1,101 @@
+import asyncio
+import pytest
+from fastapi import HTTPException
+from llamacpp_proxy.services.admission import (
+    PRIORITY_HIGH,
+    PRIORITY_NORMAL,
+    AdmissionController,
+    parse_max_queue_wait,
+)
+
+def test_parse_max_queue_wait():
+    assert parse_max_queue_wait(None) is None
+    assert parse_max_queue_wait("2.5") == 2.5
+    assert parse_max_queue_wait("abc") is None
+    assert parse_max_queue_wait("-1") is None
+
+@pytest.mark.asyncio
+async def test_admit_within_capacity():
+    admission = AdmissionController(queue_size=10, max_wait=1.0)
+    await admission.admit(capacity=2)
+    await admission.admit(capacity=2)
+    assert admission.admitted == 2
+    assert admission.queue_depth() == 0
+
+@pytest.mark.asyncio
+async def test_release_hands_off_by_priority():
+    admission = AdmissionController(queue_size=10, max_wait=1.0)
+    await admission.admit(capacity=1)
+    order = []
+
+    async def wait(name, priority):
+        await admission.admit(1, priority)
+        order.append(name)
+        admission.release()
+
+    normal = asyncio.ensure_future(wait("normal", PRIORITY_NORMAL))
+    await asyncio.sleep(0)
+    high = asyncio.ensure_future(wait("high", PRIORITY_HIGH))
+    await asyncio.sleep(0)
+    assert admission.queue_depth() == 2
+
+    admission.release()
+    await asyncio.gather(normal, high)
+    assert order == ["high", "normal"]
+    assert admission.admitted == 0
+
+@pytest.mark.asyncio
+async def test_full_queue_rejects_with_retry_after():
+    admission = AdmissionController(queue_size=1, max_wait=1.0)
+    await admission.admit(capacity=1)
+    waiter = asyncio.ensure_future(admission.admit(1))
+    await asyncio.sleep(0)
+
+    with pytest.raises(HTTPException) as exc_info:
+        await admission.admit(1)
+    assert exc_info.value.status_code == 503
+    assert int(exc_info.value.headers["Retry-After"]) >= 1
+    assert admission.rejected == 1
+
+    waiter.cancel()
+
+@pytest.mark.asyncio
+async def test_wait_deadline():
+    admission = AdmissionController(queue_size=10, max_wait=1.0)
+    await admission.admit(capacity=1)
+
+    with pytest.raises(HTTPException) as exc_info:
+        await admission.admit(1, max_wait=0.01)
+    assert exc_info.value.status_code == 503
+    assert admission.timed_out == 1
+    assert admission.queue_depth() == 0
+
+    # タイムアウトした待ち手には枠を渡さない
+    admission.release()
+    assert admission.admitted == 0
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_is_skipped():
+    admission = AdmissionController(queue_size=10, max_wait=1.0)
+    await admission.admit(capacity=1)
+    cancelled = asyncio.ensure_future(admission.admit(1))
+    waiting = asyncio.ensure_future(admission.admit(1))
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    await asyncio.sleep(0)
+
+    admission.release()
+    await asyncio.wait_for(waiting, 1)
+    assert admission.admitted == 1
+    assert admission.queue_depth() == 0
+
+@pytest.mark.asyncio
+async def test_wake_admits_up_to_new_capacity():
+    admission = AdmissionController(queue_size=10, max_wait=1.0)
+    await admission.admit(capacity=1)
+    waiters = [asyncio.ensure_future(admission.admit(1)) for _ in range(2)]
+    await asyncio.sleep(0)
+
+    admission.wake(capacity=3)
+    await asyncio.wait_for(asyncio.gather(*waiters), 1)
+    assert admission.admitted == 3
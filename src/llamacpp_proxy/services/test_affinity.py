@@ -0,0 +1,44 @@
+from llamacpp_proxy.models.chat import Message
+from llamacpp_proxy.services.affinity import AffinityTable, chat_affinity_key, prompt_affinity_key
+
+def test_chat_affinity_key_stable_across_turns():
+    first_turn = [
+        Message(role="system", content="You are helpful."),
+        Message(role="user", content="Hello"),
+    ]
+    second_turn = first_turn + [
+        Message(role="assistant", content="Hi"),
+        Message(role="user", content="How are you?"),
+    ]
+    assert chat_affinity_key(first_turn) == chat_affinity_key(second_turn)
+
+def test_chat_affinity_key_differs_by_conversation():
+    a = [Message(role="user", content="Hello")]
+    b = [Message(role="user", content="Goodbye")]
+    assert chat_affinity_key(a) != chat_affinity_key(b)
+
+def test_chat_affinity_key_conversation_id():
+    a = [Message(role="user", content="Hello")]
+    b = [Message(role="user", content="Goodbye")]
+    assert chat_affinity_key(a, "conversation-1") == chat_affinity_key(b, "conversation-1")
+
+def test_prompt_affinity_key_uses_prefix():
+    assert prompt_affinity_key("abcdef", 3) == prompt_affinity_key("abcxyz", 3)
+    assert prompt_affinity_key("abcdef", 4) != prompt_affinity_key("abcxyz", 4)
+
+def test_affinity_table_evicts_least_recently_used():
+    table = AffinityTable(max_size=2)
+    table.put("a", "http://a", 0)
+    table.put("b", "http://a", 1)
+    table.get("a")
+    table.put("c", "http://a", 2)
+
+    assert table.get("a") == ("http://a", 0)
+    assert table.get("b") is None
+    assert len(table) == 2
+
+def test_affinity_table_stats():
+    table = AffinityTable()
+    assert table.stats()["hit_rate"] == 0.0
+    table.hits, table.misses, table.fallbacks = 3, 1, 0
+    assert table.stats()["hit_rate"] == 0.75
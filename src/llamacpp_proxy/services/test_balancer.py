@@ -0,0 +1,251 @@
+import asyncio
+import pytest
+import httpx
+from fastapi import HTTPException
+from llamacpp_proxy.config.settings import BackendConfig, Settings
+from llamacpp_proxy.config.routing import RoutingSettings
+from llamacpp_proxy.services.admission import AdmissionController
+from llamacpp_proxy.services.affinity import AffinityTable
+from llamacpp_proxy.services.balancer import Backend, LoadBalancer
+
+def test_from_settings_single_server():
+    balancer = LoadBalancer.from_settings(Settings(llamacpp_server_url="http://a:8080/"))
+    assert [backend.url for backend in balancer.backends] == ["http://a:8080"]
+
+def test_from_settings_backends():
+    balancer = LoadBalancer.from_settings(Settings(backends=[
+        BackendConfig(url="http://a:8080"),
+        BackendConfig(url="http://b:8080", slots=4),
+    ]))
+    assert [(b.url, b.slots, b.slots_configured) for b in balancer.backends] == [
+        ("http://a:8080", 1, False),
+        ("http://b:8080", 4, True),
+    ]
+
+def test_choose_least_outstanding():
+    a = Backend(url="http://a", in_flight=2)
+    b = Backend(url="http://b", in_flight=1)
+    balancer = LoadBalancer([a, b])
+    for _ in range(4):
+        assert balancer.choose() is b
+
+def test_choose_weighted_by_slots():
+    a = Backend(url="http://a", slots=1, in_flight=0)
+    b = Backend(url="http://b", slots=4, in_flight=2)
+    balancer = LoadBalancer([a, b])
+    assert balancer.choose() is b
+
+def test_choose_rotates_on_tie():
+    a = Backend(url="http://a")
+    b = Backend(url="http://b")
+    balancer = LoadBalancer([a, b])
+    assert {balancer.choose().url for _ in range(2)} == {"http://a", "http://b"}
+
+def test_choose_no_backend():
+    balancer = LoadBalancer([Backend(url="http://a")])
+    with pytest.raises(HTTPException) as exc_info:
+        balancer.choose(exclude=balancer.backends)
+    assert exc_info.value.status_code == 503
+
+@pytest.mark.asyncio
+async def test_acquire_counts_in_flight():
+    balancer = LoadBalancer([Backend(url="http://a")])
+    async with balancer.acquire() as lease:
+        assert lease.backend.in_flight == 1
+        assert lease.slot_id is None
+    assert lease.backend.in_flight == 0
+
+@pytest.mark.asyncio
+async def test_refresh_props():
+    def handler(request):
+        if request.url.host == "a":
+            return httpx.Response(200, json={"total_slots": 8, "default_generation_settings": {"n_ctx": 4096}})
+        if request.url.host == "c":
+            return httpx.Response(200, json={"total_slots": 8, "default_generation_settings": {"n_ctx": 2048}})
+        return httpx.Response(500)
+
+    balancer = LoadBalancer([
+        Backend(url="http://a"),
+        Backend(url="http://b"),
+        Backend(url="http://c", slots=2, slots_configured=True),
+    ])
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as http_client:
+        await balancer.refresh_props(http_client)
+
+    assert [backend.slots for backend in balancer.backends] == [8, 1, 2]
+    assert [backend.n_ctx for backend in balancer.backends] == [4096, 0, 2048]
+    assert balancer.context_size() == 2048
+
+def test_from_settings_prefix_affinity():
+    settings = Settings(llamacpp_server_url="http://a:8080")
+    assert LoadBalancer.from_settings(settings, RoutingSettings()).affinity is not None
+    assert LoadBalancer.from_settings(settings, RoutingSettings(prefix_affinity=False)).affinity is None
+
+@pytest.mark.asyncio
+async def test_acquire_pins_affinity_key_to_slot():
+    a = Backend(url="http://a", slots=2)
+    b = Backend(url="http://b", slots=2)
+    balancer = LoadBalancer([a, b], AffinityTable())
+
+    async with balancer.acquire("conversation") as first:
+        assert first.slot_id is not None
+        assert first.slot_id in first.backend.busy_slots
+    assert first.backend.busy_slots == set()
+
+    for _ in range(3):
+        async with balancer.acquire("conversation") as lease:
+            assert (lease.backend, lease.slot_id) == (first.backend, first.slot_id)
+
+    assert balancer.affinity.stats()["hits"] == 3
+    assert balancer.affinity.stats()["misses"] == 1
+
+@pytest.mark.asyncio
+async def test_acquire_falls_back_when_slot_busy():
+    balancer = LoadBalancer([Backend(url="http://a", slots=2)], AffinityTable())
+
+    async with balancer.acquire("conversation") as first:
+        async with balancer.acquire("conversation") as second:
+            assert second.backend is first.backend
+            assert second.slot_id is not None
+            assert second.slot_id != first.slot_id
+
+    assert balancer.affinity.fallbacks == 1
+
+@pytest.mark.asyncio
+async def test_acquire_without_free_slot():
+    balancer = LoadBalancer([Backend(url="http://a", slots=1)], AffinityTable())
+
+    async with balancer.acquire("first"):
+        async with balancer.acquire("second") as lease:
+            assert lease.slot_id is None
+
+    assert len(balancer.affinity) == 1
+
+@pytest.mark.asyncio
+async def test_acquire_without_slot_pinning_keeps_backend_affinity():
+    a = Backend(url="http://a", slots=2)
+    b = Backend(url="http://b", slots=2)
+    balancer = LoadBalancer([a, b], AffinityTable(), pin_slots=False)
+
+    async with balancer.acquire("conversation") as first:
+        assert first.slot_id is None
+        async with balancer.acquire("conversation") as second:
+            # 他のワーカーが同じスロットを指定しないよう、スロットはllama.cppに選ばせる
+            assert (second.backend, second.slot_id) == (first.backend, None)
+        assert first.backend.busy_slots == set()
+
+    assert balancer.affinity.stats()["hits"] == 1
+    assert balancer.affinity.stats()["misses"] == 1
+
+def test_free_slot_prefers_least_recently_used():
+    backend = Backend(url="http://a", slots=3, busy_slots={0}, slot_last_used={1: 20.0, 2: 10.0})
+    assert backend.free_slot() == 2
+
+@pytest.mark.asyncio
+async def test_acquire_waits_for_capacity():
+    backend = Backend(url="http://a", slots=2, max_in_flight=1)
+    balancer = LoadBalancer([backend], admission=AdmissionController(10, 1.0))
+    assert balancer.capacity() == 1
+
+    queued = balancer.acquire()
+    async with balancer.acquire():
+        waiter = asyncio.ensure_future(queued.__aenter__())
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        assert balancer.admission.queue_depth() == 1
+    lease = await asyncio.wait_for(waiter, 1)
+    assert lease.backend is backend
+    assert backend.in_flight == 1
+    await queued.__aexit__(None, None, None)
+    assert balancer.admission.admitted == 0
+
+@pytest.mark.asyncio
+async def test_acquire_counts_queued_requests_per_affinity_backend():
+    a = Backend(url="http://a", max_in_flight=1)
+    b = Backend(url="http://b", max_in_flight=1)
+    balancer = LoadBalancer([a, b], AffinityTable(), AdmissionController(10, 1.0))
+    balancer.affinity.put("pinned", "http://b", 0)
+
+    queued = [balancer.acquire("pinned"), balancer.acquire("new")]
+    async with balancer.acquire(exclude=[b]), balancer.acquire(exclude=[a]):
+        waiters = [asyncio.ensure_future(q.__aenter__()) for q in queued]
+        await asyncio.sleep(0)
+        assert balancer.admission.queue_depth() == 2
+        # アフィニティの割り当て先がないリクエストはバックエンドごとの待ち数に数えない
+        assert (a.queued, b.queued) == (0, 1)
+    await asyncio.wait_for(asyncio.gather(*waiters), 1)
+    assert (a.queued, b.queued) == (0, 0)
+    for q in queued:
+        await q.__aexit__(None, None, None)
+
+@pytest.mark.asyncio
+async def test_acquire_with_affinity_respects_limit():
+    a = Backend(url="http://a", slots=4, max_in_flight=1)
+    b = Backend(url="http://b", slots=4, max_in_flight=1)
+    balancer = LoadBalancer([a, b], AffinityTable(), AdmissionController(10, 1.0))
+    balancer.affinity.put("pinned", "http://a", 0)
+    peak = {}
+
+    async def request(key):
+        async with balancer.acquire(key) as lease:
+            for backend in (a, b):
+                peak[backend.url] = max(peak.get(backend.url, 0), backend.in_flight)
+            await asyncio.sleep(0.01)
+        return lease
+
+    # aのスロット0が空いていても、aが上限に達している間はアフィニティより上限を優先する
+    async with balancer.acquire("other", exclude=[b]):
+        lease = await request("pinned")
+    assert lease.backend is b
+    assert balancer.affinity.fallbacks == 1
+
+    await asyncio.gather(*[request(f"key-{i}") for i in range(6)], request("pinned"))
+    assert peak == {"http://a": 1, "http://b": 1}
+
+@pytest.mark.asyncio
+async def test_acquire_parks_instead_of_overshooting_limit():
+    a = Backend(url="http://a", max_in_flight=1)
+    b = Backend(url="http://b", max_in_flight=1)
+    balancer = LoadBalancer([a, b], admission=AdmissionController(10, 0.5))
+
+    parked = balancer.acquire(exclude=[a])
+    async with balancer.acquire(exclude=[a]):
+        # aを除外した再試行は、aの分の枠で通ってもbが空くまで待つ
+        waiter = asyncio.ensure_future(parked.__aenter__())
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        assert b.in_flight == 1
+    lease = await asyncio.wait_for(waiter, 1)
+    assert lease.backend is b
+
+    with pytest.raises(HTTPException) as exc_info:
+        async with balancer.acquire(exclude=[a], max_queue_wait=0.01):
+            pass
+    assert exc_info.value.status_code == 503
+    assert balancer.admission.timed_out == 1
+    assert balancer.admission.admitted == 1
+    await parked.__aexit__(None, None, None)
+
+def test_from_settings_admission():
+    balancer = LoadBalancer.from_settings(
+        Settings(llamacpp_server_url="http://a:8080"),
+        RoutingSettings(admission_control=True, max_in_flight_per_backend=3),
+    )
+    assert balancer.admission is not None
+    assert balancer.capacity() == 3
+
+def test_choose_prefers_backend_under_limit():
+    a = Backend(url="http://a", slots=4, in_flight=1, max_in_flight=1)
+    b = Backend(url="http://b", slots=1, in_flight=0)
+    balancer = LoadBalancer([a, b], admission=AdmissionController(10, 1.0))
+    assert balancer.choose() is b
+
+def test_choose_skips_unhealthy_backends():
+    a = Backend(url="http://a", healthy=False)
+    b = Backend(url="http://b", in_flight=3)
+    balancer = LoadBalancer([a, b])
+    assert balancer.choose() is b
+    b.healthy = False
+    with pytest.raises(HTTPException) as exc_info:
+        balancer.choose()
+    assert exc_info.value.status_code == 503
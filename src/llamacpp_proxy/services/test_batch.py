@@ -0,0 +1,79 @@
+import asyncio
+import pytest
+from fastapi import HTTPException
+from llamacpp_proxy.services.batch import expand_requests, gather_bounded, merge_streams
+
+@pytest.mark.asyncio
+async def test_gather_bounded_keeps_order_and_limit():
+    running = 0
+    max_running = 0
+
+    def factory(value):
+        async def run():
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.01 * (5 - value))
+            running -= 1
+            return value
+        return run
+
+    assert await gather_bounded([factory(i) for i in range(5)], limit=2) == [0, 1, 2, 3, 4]
+    assert max_running == 2
+
+@pytest.mark.asyncio
+async def test_gather_bounded_cancels_remaining_on_error():
+    cancelled = asyncio.Event()
+
+    async def failing():
+        raise HTTPException(status_code=502)
+
+    async def slow():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    with pytest.raises(HTTPException):
+        await gather_bounded([slow, failing], limit=2)
+    assert cancelled.is_set()
+
+async def stream(items, delay=0):
+    for item in items:
+        await asyncio.sleep(delay)
+        yield item
+
+@pytest.mark.asyncio
+async def test_merge_streams_interleaves():
+    merged = [item async for item in merge_streams([stream(["a1", "a2"], 0.01), stream(["b1", "b2"], 0.015)], 2)]
+    assert sorted(merged) == ["a1", "a2", "b1", "b2"]
+    assert merged.index("a1") < merged.index("a2")
+    assert merged.index("b1") < merged.index("b2")
+
+@pytest.mark.asyncio
+async def test_merge_streams_propagates_error():
+    async def failing():
+        yield "a"
+        raise HTTPException(status_code=502)
+
+    with pytest.raises(HTTPException):
+        [item async for item in merge_streams([failing(), stream(["b"])], 2)]
+
+def test_expand_requests_prompts_times_n():
+    requests = expand_requests({"temperature": 0.7}, ["p1", "p2"], 2, 64)
+    assert [r["prompt"] for r in requests] == ["p1", "p1", "p2", "p2"]
+
+def test_expand_requests_varies_seed():
+    requests = expand_requests({"seed": 10}, ["p1", "p2"], 2, 64)
+    assert [r["seed"] for r in requests] == [10, 11, 10, 11]
+
+def test_expand_requests_too_many_choices():
+    with pytest.raises(HTTPException) as exc_info:
+        expand_requests({}, ["p1", "p2"], 3, 5)
+    assert exc_info.value.status_code == 400
+
+def test_expand_requests_invalid_n():
+    with pytest.raises(HTTPException) as exc_info:
+        expand_requests({}, ["p1"], 0, 5)
+    assert exc_info.value.status_code == 400
@@ -0,0 +1,49 @@
+import asyncio
+import pytest
+from llamacpp_proxy.services.disconnect import CLIENT_CLOSED_REQUEST, ClientDisconnected, cancel_on_disconnect
+from llamacpp_proxy.services.metrics import metrics
+
+class FakeRequest:
+    """receiveでhttp.disconnectを返すまで待つリクエスト"""
+
+    def __init__(self):
+        self.disconnected = asyncio.Event()
+
+    async def receive(self):
+        await self.disconnected.wait()
+        return {"type": "http.disconnect"}
+
+@pytest.mark.asyncio
+async def test_returns_result_when_client_stays():
+    async def work():
+        return "done"
+
+    assert await cancel_on_disconnect(FakeRequest(), work(), "test") == "done"
+
+@pytest.mark.asyncio
+async def test_propagates_errors():
+    async def work():
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError, match="boom"):
+        await cancel_on_disconnect(FakeRequest(), work(), "test")
+
+@pytest.mark.asyncio
+async def test_cancels_work_when_client_disconnects():
+    request = FakeRequest()
+    cleaned_up = asyncio.Event()
+
+    async def work():
+        try:
+            await asyncio.sleep(3600)
+        finally:
+            cleaned_up.set()
+
+    before = metrics.aborted_generations.value("test", "waiting")
+    asyncio.get_running_loop().call_later(0.01, request.disconnected.set)
+    with pytest.raises(ClientDisconnected) as exc_info:
+        await cancel_on_disconnect(request, work(), "test")
+
+    assert exc_info.value.status_code == CLIENT_CLOSED_REQUEST
+    assert cleaned_up.is_set()
+    assert metrics.aborted_generations.value("test", "waiting") == before + 1
@@ -0,0 +1,158 @@
+import asyncio
+import base64
+import json
+import struct
+import pytest
+import httpx
+from fastapi import HTTPException
+from llamacpp_proxy.config.embedding import EmbeddingSettings
+from llamacpp_proxy.services.admission import AdmissionController
+from llamacpp_proxy.services.balancer import Backend, LoadBalancer
+from llamacpp_proxy.services.embedding import EmbeddingBatcher, encode_embedding, normalize_inputs
+from llamacpp_proxy.services.failover import FailoverPolicy
+
+def embeddings_handler(calls, reject=None, fail=()):
+    """入力の長さを値とする埋め込みを返す（rejectを含むバッチは400、failのバックエンドは500）"""
+    def handler(request: httpx.Request) -> httpx.Response:
+        inputs = json.loads(request.content)["input"]
+        calls.append((request.url.host, inputs))
+        if request.url.host in fail:
+            return httpx.Response(500)
+        if reject is not None and reject in inputs:
+            return httpx.Response(400, json={"error": {"message": "input is too large"}})
+        data = [{"index": i, "embedding": [float(len(value)), 0.5]} for i, value in enumerate(inputs)]
+        # 上流と同じく、dataの順序はindex順とは限らない
+        tokens = sum(len(value.split()) for value in inputs)
+        return httpx.Response(200, json={"data": data[::-1], "usage": {"prompt_tokens": tokens}})
+    return handler
+
+@pytest.fixture
+async def batcher_factory():
+    clients = []
+
+    def create(settings=None, calls=None, backends=("a",), failover=None, **handler_options):
+        handler = embeddings_handler(calls if calls is not None else [], **handler_options)
+        http_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        clients.append(http_client)
+        balancer = LoadBalancer([Backend(url=f"http://{name}") for name in backends])
+        return EmbeddingBatcher(http_client, balancer, settings or EmbeddingSettings(), failover)
+
+    yield create
+    for http_client in clients:
+        await http_client.aclose()
+
+def test_normalize_inputs():
+    assert normalize_inputs("a") == ["a"]
+    assert normalize_inputs(["a", "b"]) == ["a", "b"]
+    assert normalize_inputs([1, 2]) == [[1, 2]]
+    assert normalize_inputs([[1], [2, 3]]) == [[1], [2, 3]]
+
+def test_encode_embedding_base64():
+    from array import array
+    embedding = array("f", [1.0, -0.5])
+    assert encode_embedding(embedding, "float") == [1.0, -0.5]
+    assert struct.unpack("<2f", base64.b64decode(encode_embedding(embedding, "base64"))) == (1.0, -0.5)
+
+@pytest.mark.asyncio
+async def test_concurrent_requests_are_batched(batcher_factory):
+    calls = []
+    batcher = batcher_factory(EmbeddingSettings(batch_window=0.01), calls=calls)
+
+    first, second = await asyncio.gather(batcher.embed(["a", "bb cc"]), batcher.embed(["ddd"]))
+
+    assert calls == [("a", ["a", "bb cc", "ddd"])]
+    assert [list(embedding) for embedding, _ in first] == [[1.0, 0.5], [5.0, 0.5]]
+    assert [list(embedding) for embedding, _ in second] == [[3.0, 0.5]]
+    assert first[0][0].typecode == "f"  # float32で保持する
+    # バッチ全体の4トークンを入力の長さで按分する
+    assert sum(tokens for _, tokens in first + second) == 4
+
+@pytest.mark.asyncio
+async def test_full_batch_is_sent_without_waiting(batcher_factory):
+    calls = []
+    batcher = batcher_factory(EmbeddingSettings(batch_window=10, max_batch_size=2), calls=calls)
+
+    results = await asyncio.wait_for(batcher.embed(["a", "b", "c", "d"]), timeout=1)
+
+    assert [inputs for _, inputs in calls] == [["a", "b"], ["c", "d"]]
+    assert len(results) == 4
+
+@pytest.mark.asyncio
+async def test_repeated_inputs_are_cached(batcher_factory):
+    calls = []
+    batcher = batcher_factory(EmbeddingSettings(batch_window=0), calls=calls)
+
+    await asyncio.gather(batcher.embed(["a", "a"]), batcher.embed(["a"]))
+    results = await batcher.embed(["a", "b"])
+
+    # 計算中の同じ入力は共有し、計算済みの入力はキャッシュから返す
+    assert [inputs for _, inputs in calls] == [["a"], ["b"]]
+    assert [list(embedding) for embedding, _ in results] == [[1.0, 0.5], [1.0, 0.5]]
+    assert batcher.hits == 1
+
+@pytest.mark.asyncio
+async def test_cache_is_bounded(batcher_factory):
+    calls = []
+    batcher = batcher_factory(EmbeddingSettings(batch_window=0, cache_size=1), calls=calls)
+
+    await batcher.embed(["a"])
+    await batcher.embed(["b"])
+    await batcher.embed(["a"])
+    assert [inputs for _, inputs in calls] == [["a"], ["b"], ["a"]]
+
+    disabled = batcher_factory(EmbeddingSettings(batch_window=0, cache_size=0))
+    await disabled.embed(["a"])
+    await disabled.embed(["a"])
+    assert disabled.hits == 0
+
+@pytest.mark.asyncio
+async def test_rejected_input_fails_only_its_caller(batcher_factory):
+    calls = []
+    batcher = batcher_factory(EmbeddingSettings(batch_window=0.01), calls=calls, reject="bad")
+
+    good, bad = await asyncio.gather(batcher.embed(["ok"]), batcher.embed(["bad"]), return_exceptions=True)
+
+    assert [list(embedding) for embedding, _ in good] == [[2.0, 0.5]]
+    assert isinstance(bad, HTTPException)
+    assert bad.status_code == 400
+    assert bad.detail["error"]["code"] == "invalid_input"
+    # バッチで拒否されたら1件ずつ送り直す
+    assert [inputs for _, inputs in calls] == [["ok", "bad"], ["ok"], ["bad"]]
+
+@pytest.mark.asyncio
+async def test_batch_fails_over_to_another_backend(batcher_factory):
+    calls = []
+    batcher = batcher_factory(
+        EmbeddingSettings(batch_window=0), calls=calls, backends=("a", "b"), failover=FailoverPolicy(1), fail=("a",)
+    )
+    batcher.load_balancer._rotation = 0
+
+    results = await batcher.embed(["x"])
+
+    assert [host for host, _ in calls] == ["a", "b"]
+    assert len(results) == 1
+
+@pytest.mark.asyncio
+async def test_batch_honours_max_queue_wait(batcher_factory):
+    batcher = batcher_factory(EmbeddingSettings(batch_window=0.01))
+    batcher.load_balancer = LoadBalancer(
+        [Backend(url="http://a", max_in_flight=1)], admission=AdmissionController(10, 5.0)
+    )
+
+    async with batcher.load_balancer.acquire():
+        # バッチは含まれる入力のうち最も短い待ち時間の上限で待つ
+        results = await asyncio.wait_for(
+            asyncio.gather(batcher.embed(["x"], max_queue_wait=0.05), batcher.embed(["y"]), return_exceptions=True),
+            timeout=1,
+        )
+    assert [e.status_code for e in results] == [503, 503]
+    assert batcher.load_balancer.admission.timed_out == 1
+
+@pytest.mark.asyncio
+async def test_upstream_error_is_502(batcher_factory):
+    batcher = batcher_factory(EmbeddingSettings(batch_window=0), fail=("a",))
+    with pytest.raises(HTTPException) as exc_info:
+        await batcher.embed(["x"])
+    assert exc_info.value.status_code == 502
+    # 失敗した入力はキャッシュしない
+    assert batcher._inflight == {}
@@ -0,0 +1,45 @@
+import httpx
+from llamacpp_proxy.services.balancer import Backend
+from llamacpp_proxy.services.failover import HEDGE_MIN_SAMPLES, FailoverPolicy, is_retryable, should_fail_over
+
+def status_error(status_code):
+    request = httpx.Request("POST", "http://a:8080/completions")
+    return httpx.HTTPStatusError("error", request=request, response=httpx.Response(status_code, request=request))
+
+def test_is_retryable():
+    assert is_retryable(httpx.ConnectError("refused"))
+    assert is_retryable(httpx.ReadTimeout("timeout"))
+    assert is_retryable(status_error(503))
+    assert not is_retryable(status_error(400))
+    assert not is_retryable(httpx.HTTPError("unknown"))
+
+def test_should_fail_over():
+    a, b = Backend(url="http://a"), Backend(url="http://b")
+    error = status_error(503)
+    assert should_fail_over(FailoverPolicy(1), error, [a], [a, b])
+    assert not should_fail_over(None, error, [a], [a, b])
+    assert not should_fail_over(FailoverPolicy(0), error, [a], [a, b])
+    assert not should_fail_over(FailoverPolicy(1), status_error(400), [a], [a, b])
+    # 残りのバックエンドがなければ再試行しない
+    assert not should_fail_over(FailoverPolicy(2), error, [a, b], [a, b])
+
+def test_hedge_delay_uses_percentile():
+    policy = FailoverPolicy(1, hedge_percentile=90)
+    for i in range(1, 101):
+        policy.observe_first_token(i / 100)
+    assert policy.hedge_delay() == 0.9
+
+def test_hedge_delay_requires_samples():
+    policy = FailoverPolicy(1, hedge_percentile=95)
+    for _ in range(HEDGE_MIN_SAMPLES - 1):
+        policy.observe_first_token(0.1)
+    assert policy.hedge_delay() is None
+    policy.observe_first_token(0.1)
+    assert policy.hedge_delay() == 0.1
+
+def test_hedging_disabled():
+    policy = FailoverPolicy(0)
+    for _ in range(HEDGE_MIN_SAMPLES):
+        policy.observe_first_token(0.1)
+    assert policy.hedge_delay() is None
+    assert not policy.guards_first_token
@@ -0,0 +1,257 @@
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+
+from llamacpp_proxy.api.grammar import register_grammar, retrieve_grammar
+from llamacpp_proxy.config.grammar import GrammarSettings
+from llamacpp_proxy.models.grammar import JsonSchemaFormat, ResponseFormat
+from llamacpp_proxy.services.grammar import (
+    GrammarCache,
+    GrammarError,
+    grammar_id,
+    schema_to_gbnf,
+    validate_gbnf,
+)
+from llamacpp_proxy.services.shared_state import SharedState
+
+# llama.cppのgrammars/json.gbnfと同じ形
+JSON_GBNF = r'''
+root   ::= object
+value  ::= object | array | string | number | ("true" | "false" | "null") ws
+
+object ::=
+  "{" ws (
+            string ":" ws value
+    ("," ws string ":" ws value)*
+  )? "}" ws
+
+array  ::=
+  "[" ws (
+            value
+    ("," ws value)*
+  )? "]" ws
+
+string ::=
+  "\"" (
+    [^"\\\x7F\x00-\x1F] |
+    "\\" (["\\/bfnrt] | "u" [0-9a-fA-F]{4}) # escapes
+  )* "\"" ws
+
+number ::= ("-"? ([0-9] | [1-9] [0-9]{0,15})) ("." [0-9]+)? ([eE] [-+]? [0-9] [1-9]{0,15})? ws
+
+# Optional space: by convention, applied in this grammar after literal chars when allowed
+ws ::= | " " | "\n" [ \t]{0,20}
+'''
+
+def test_validate_accepts_llamacpp_grammar():
+    validate_gbnf(JSON_GBNF)  # should not raise
+    validate_gbnf('root ::= "yes" | "no"')  # should not raise
+    validate_gbnf('root ::= . [^\\]]* "\\u00e9"?')  # should not raise
+    validate_gbnf('root ::= <think> "x"')  # should not raise
+    validate_gbnf('root ::= <[1234]>+ !<|im_end|>* (<think> | "a"){1,2}')  # should not raise
+
+@pytest.mark.parametrize("grammar, message", [
+    ("", "does not define root"),
+    ('answer ::= "a"', "does not define root"),
+    ('root ::= answer', "undefined rule 'answer' at line 1, column 10"),
+    ('root ::= "a', "unexpected end of input"),
+    ('root ::= [a-z', "unexpected end of input"),
+    ('root = "a"', "expecting ::="),
+    ('root ::= ("a"', "expecting \\)"),
+    ('root ::= * "a"', "expecting preceding item to \\*"),
+    ('root ::= "a"{2,1}', "maximum repetitions is less than minimum"),
+    ('root ::= "a"{9999}', "number of repetitions exceeds 2000"),
+    ('root ::= "\\q"', "unknown escape"),
+    ('root ::= "\\x4"', "expecting hex digits"),
+    ('root ::= "a"\n| "b"', "expecting name at line 2, column 1"),
+    ('root ::= "a" ) "b"', "expecting newline or end"),
+    ('root ::= <think "a"', "expecting token"),
+    ('root ::= <[12a]>', "expecting token"),
+    ('root ::= ! "a"', "expecting token"),
+    ("root ::= " + "(" * 100 + '"a"' + ")" * 100, "nested too deeply"),
+])
+def test_validate_rejects_invalid_grammar(grammar, message):
+    with pytest.raises(GrammarError, match=message):
+        validate_gbnf(grammar)
+
+@pytest.mark.parametrize("schema", [
+    {},
+    {"type": "object"},
+    {
+        "type": "object",
+        "properties": {
+            "name": {"type": "string", "maxLength": 20},
+            "age": {"type": "integer"},
+            "tags": {"type": "array", "items": {"type": "string"}, "minItems": 1, "maxItems": 3},
+            "kind": {"enum": ["a", "b", None]},
+        },
+        "required": ["name"],
+    },
+    {"type": "object", "properties": {"a": {"type": "number"}, "b": {"type": "boolean"}}},
+    {"type": "object", "additionalProperties": {"type": "number"}},
+    {"type": ["string", "null"]},
+    {"type": "array", "prefixItems": [{"const": 'quote " and \\'}, {"type": "integer"}]},
+    {
+        "$defs": {
+            "node": {
+                "type": "object",
+                "properties": {"value": {"type": "integer"}, "next": {"anyOf": [{"$ref": "#/$defs/node"}, {"type": "null"}]}},
+                "required": ["value", "next"],
+            }
+        },
+        "$ref": "#/$defs/node",
+    },
+])
+def test_schema_converts_to_valid_grammar(schema):
+    validate_gbnf(schema_to_gbnf(schema))  # should not raise
+
+def test_schema_keeps_property_order():
+    grammar = schema_to_gbnf({
+        "type": "object",
+        "properties": {"b": {"type": "string"}, "a": {"type": "integer"}},
+        "required": ["b", "a"],
+    })
+    assert 'root ::= "{" space root-b-kv "," space root-a-kv "}" space' in grammar
+    assert 'root-b-kv ::= "\\"b\\"" space ":" space string' in grammar
+
+@pytest.mark.parametrize("schema, message", [
+    ({"type": "string", "pattern": "^a+$"}, "unsupported keyword 'pattern'"),
+    ({"type": "date"}, "unsupported type 'date'"),
+    ({"$ref": "https://example.com/schema.json"}, "only local references"),
+    ({"$ref": "#/$defs/missing"}, "unresolvable"),
+    ({"type": "array", "minItems": 3, "maxItems": 1}, "maxItems must not be less than minItems"),
+    ({"enum": []}, "enum must be a non-empty array"),
+])
+def test_schema_rejects_unsupported(schema, message):
+    with pytest.raises(GrammarError, match=message):
+        schema_to_gbnf(schema)
+
+@pytest.mark.asyncio
+async def test_cache_validates_once():
+    cache = GrammarCache(GrammarSettings())
+    assert await cache.validated('root ::= "a"') == 'root ::= "a"'
+    assert await cache.validated('root ::= "a"') == 'root ::= "a"'
+    assert await cache.from_schema({"type": "object", "required": ["a"]})
+    # キーの順序が違っても同じスキーマ
+    assert await cache.from_schema({"required": ["a"], "type": "object"})
+    assert (cache.hits, cache.misses) == (2, 2)
+
+@pytest.mark.asyncio
+async def test_cache_evicts_least_recently_used():
+    cache = GrammarCache(GrammarSettings(cache_size=2))
+    for grammar in ('root ::= "a"', 'root ::= "b"', 'root ::= "a"', 'root ::= "c"', 'root ::= "b"'):
+        await cache.validated(grammar)
+    assert (cache.hits, cache.misses) == (1, 4)
+
+@pytest.mark.asyncio
+async def test_cache_byte_budget():
+    grammar_size = len('root ::= "a"')
+    cache = GrammarCache(GrammarSettings(cache_max_bytes=grammar_size * 2, max_registered_bytes=grammar_size * 2))
+    for grammar in ('root ::= "a"', 'root ::= "b"', 'root ::= "c"', 'root ::= "a"'):
+        await cache.register(grammar)
+    assert (cache.hits, cache.misses) == (0, 4)
+    assert len(cache) == 2
+    assert await cache.lookup(grammar_id('root ::= "b"')) is None
+    assert await cache.lookup(grammar_id('root ::= "c"')) == 'root ::= "c"'
+
+@pytest.mark.asyncio
+async def test_cache_offloads_large_grammar(monkeypatch):
+    calls = []
+    async def run_in_threadpool(func, *args):
+        calls.append(func)
+        return func(*args)
+    monkeypatch.setattr("llamacpp_proxy.services.grammar.run_in_threadpool", run_in_threadpool)
+    cache = GrammarCache(GrammarSettings(offload_threshold=20))
+
+    await cache.validated('root ::= "a"')
+    assert calls == []
+    assert await cache.validated('root ::= "' + "a" * 20 + '"') == 'root ::= "' + "a" * 20 + '"'
+    assert len(calls) == 1
+    with pytest.raises(GrammarError):
+        await cache.validated('root ::= "' + "a" * 20)
+    assert len(calls) == 2
+
+@pytest.mark.asyncio
+async def test_cache_rejects_large_grammar():
+    cache = GrammarCache(GrammarSettings(max_bytes=10))
+    with pytest.raises(GrammarError, match="larger than the limit"):
+        await cache.validated('root ::= "abcdefgh"')
+    with pytest.raises(GrammarError, match="larger than the limit"):
+        await cache.from_schema({"type": "object"})
+
+@pytest.mark.asyncio
+async def test_register_returns_content_id():
+    cache = GrammarCache(GrammarSettings(max_registered=1))
+    grammar_id = await cache.register('root ::= "a"')
+    assert grammar_id.startswith("grammar-")
+    assert await cache.register('root ::= "a"') == grammar_id
+    assert await cache.lookup(grammar_id) == 'root ::= "a"'
+
+    # 上限を超えると古いものから削除する
+    await cache.register('root ::= "b"')
+    assert await cache.lookup(grammar_id) is None
+    assert len(cache) == 1
+
+@pytest.mark.asyncio
+async def test_registered_grammar_is_shared_between_workers(tmp_path):
+    path = str(tmp_path / "state.sqlite")
+    first = GrammarCache(GrammarSettings(), SharedState(path, worker_id="1"))
+    second = GrammarCache(GrammarSettings(), SharedState(path, worker_id="2"))
+
+    grammar_id = await first.register('root ::= "a"')
+    assert await second.lookup(grammar_id) == 'root ::= "a"'
+    assert await second.lookup("grammar-unknown") is None
+
+@pytest.mark.asyncio
+async def test_resolve():
+    cache = GrammarCache(GrammarSettings())
+    grammar_id = await cache.register('root ::= "a"')
+
+    assert await cache.resolve(None, None, None) is None
+    assert await cache.resolve(None, None, ResponseFormat(type="text")) is None
+    assert await cache.resolve('root ::= "b"', None, None) == 'root ::= "b"'
+    assert await cache.resolve(None, grammar_id, None) == 'root ::= "a"'
+    assert "root ::= object" in await cache.resolve(None, None, ResponseFormat(type="json_object"))
+    response_format = ResponseFormat(
+        type="json_schema", json_schema=JsonSchemaFormat(name="answer", schema={"type": "boolean"})
+    )
+    assert "root ::= boolean" in await cache.resolve(None, None, response_format)
+
+@pytest.mark.parametrize("args, param, code", [
+    (('root ::= "a', None, None), "llamacpp_proxy_grammar", "invalid_grammar"),
+    ((None, "grammar-unknown", None), "llamacpp_proxy_grammar_id", "grammar_not_found"),
+    ((None, None, ResponseFormat(type="json_object", schema={"type": "date"})), "response_format", "invalid_json_schema"),
+    ((None, None, ResponseFormat(type="json_schema")), "response_format", "invalid_value"),
+    (('root ::= "a"', "grammar-unknown", None), "llamacpp_proxy_grammar_id", "invalid_value"),
+])
+@pytest.mark.asyncio
+async def test_resolve_rejects_invalid_request(args, param, code):
+    cache = GrammarCache(GrammarSettings())
+    with pytest.raises(HTTPException) as e:
+        await cache.resolve(*args)
+    assert e.value.status_code == 400
+    assert e.value.detail["error"]["param"] == param
+    assert e.value.detail["error"]["code"] == code
+
+def test_grammar_endpoints():
+    app = FastAPI()
+    app.state.grammar_cache = GrammarCache(GrammarSettings())
+    app.add_api_route("/v1/grammars", register_grammar, methods=["POST"])
+    app.add_api_route("/v1/grammars/{grammar_id}", retrieve_grammar, methods=["GET"])
+    client = TestClient(app)
+
+    response = client.post("/v1/grammars", json={"json_schema": {"type": "integer"}})
+    assert response.status_code == 200
+    registered = response.json()
+    assert registered["object"] == "grammar"
+    assert "root ::= integer" in registered["grammar"]
+
+    response = client.get(f"/v1/grammars/{registered['id']}")
+    assert response.json() == registered
+
+    response = client.post("/v1/grammars", json={"grammar": "root ::= missing"})
+    assert response.status_code == 400
+    assert response.json()["detail"]["error"]["code"] == "invalid_grammar"
+
+    assert client.post("/v1/grammars", json={}).status_code == 400
+    assert client.get("/v1/grammars/grammar-unknown").status_code == 404
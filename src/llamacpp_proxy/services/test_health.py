@@ -0,0 +1,106 @@
+import pytest
+import httpx
+from llamacpp_proxy.config.health import HealthSettings
+from llamacpp_proxy.services.admission import AdmissionController
+from llamacpp_proxy.services.balancer import (
+    BACKEND_BUSY,
+    BACKEND_DOWN,
+    BACKEND_LOADING,
+    BACKEND_READY,
+    Backend,
+    LoadBalancer,
+)
+from llamacpp_proxy.services.health import CircuitBreaker, HealthMonitor, probe_backend
+
+def client_for(routes):
+    def handler(request):
+        response = routes.get(request.url.path)
+        if isinstance(response, Exception):
+            raise response
+        return response or httpx.Response(404)
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+def test_circuit_breaker_opens_after_threshold_and_backs_off():
+    breaker = CircuitBreaker(failure_threshold=2, interval=5.0, max_backoff=30.0)
+    breaker.record_failure(0.0)
+    assert breaker.closed
+    assert breaker.next_probe == 5.0
+    breaker.record_failure(5.0)
+    assert not breaker.closed
+    assert breaker.next_probe == 10.0
+    breaker.record_failure(10.0)
+    assert breaker.next_probe == 20.0
+    for now in (20.0, 40.0, 70.0):
+        breaker.record_failure(now)
+    assert breaker.next_probe == 100.0  # max_backoffで頭打ち
+    breaker.record_success(100.0)
+    assert breaker.closed
+    assert breaker.failures == 0
+
+def test_circuit_breaker_trips_immediately():
+    breaker = CircuitBreaker(failure_threshold=3, interval=5.0, max_backoff=30.0)
+    breaker.record_failure(0.0, trip=True)
+    assert not breaker.closed
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("routes, expected", [
+    ({"/health": httpx.Response(200, json={"status": "ok"})}, BACKEND_READY),
+    ({
+        "/health": httpx.Response(200, json={"status": "ok"}),
+        "/slots": httpx.Response(200, json=[{"id": 0, "is_processing": True}, {"id": 1, "is_processing": False}]),
+    }, BACKEND_READY),
+    ({
+        "/health": httpx.Response(200, json={"status": "ok"}),
+        "/slots": httpx.Response(200, json=[{"id": 0, "state": 1}]),
+    }, BACKEND_BUSY),
+    ({"/health": httpx.Response(503, json={"error": {"code": 503, "message": "Loading model"}})}, BACKEND_LOADING),
+    ({"/health": httpx.Response(503, json={"status": "no slot available"})}, BACKEND_BUSY),
+    ({"/health": httpx.Response(500)}, BACKEND_DOWN),
+    ({"/health": httpx.ConnectError("refused")}, BACKEND_DOWN),
+])
+async def test_probe_backend(routes, expected):
+    async with client_for(routes) as http_client:
+        assert await probe_backend(http_client, Backend(url="http://a:8080"), 1.0) == expected
+
+@pytest.mark.asyncio
+async def test_probe_backend_updates_slots():
+    routes = {
+        "/health": httpx.Response(200, json={"status": "ok"}),
+        "/slots": httpx.Response(200, json=[{"id": i, "is_processing": False} for i in range(4)]),
+    }
+    backend = Backend(url="http://a:8080")
+    configured = Backend(url="http://b:8080", slots=2, slots_configured=True)
+    async with client_for(routes) as http_client:
+        await probe_backend(http_client, backend, 1.0)
+        await probe_backend(http_client, configured, 1.0)
+    assert backend.slots == 4
+    assert configured.slots == 2
+
+@pytest.mark.asyncio
+async def test_loading_backend_is_taken_out_of_rotation():
+    routes = {"/health": httpx.Response(503, json={"error": {"code": 503, "message": "Loading model"}})}
+    loading = Backend(url="http://a:8080")
+    ready = Backend(url="http://b:8080", in_flight=3)
+    balancer = LoadBalancer([loading, ready])
+    async with client_for(routes) as http_client:
+        monitor = HealthMonitor(balancer, http_client, HealthSettings())
+        await monitor.probe(loading)
+
+    assert loading.state == BACKEND_LOADING
+    assert not loading.healthy
+    assert balancer.choose() is ready
+
+    monitor.update(loading, BACKEND_READY, 0.0)
+    assert loading.healthy
+    assert balancer.choose() is loading
+
+def test_backend_back_in_rotation_wakes_admission_queue():
+    backend = Backend(url="http://a:8080", healthy=False)
+    balancer = LoadBalancer([backend], admission=AdmissionController(10, 5.0))
+    monitor = HealthMonitor(balancer, httpx.AsyncClient(), HealthSettings())
+    assert balancer.capacity() == 0
+    woken = []
+    balancer.admission.wake = woken.append
+    monitor.update(backend, BACKEND_READY, 0.0)
+    assert woken == [1]
@@ -0,0 +1,25 @@
+import pytest
+import httpx
+from llamacpp_proxy.config.upstream import UpstreamSettings
+from llamacpp_proxy.services.http_client import create_http_client, get_pool_stats
+
+@pytest.mark.asyncio
+async def test_create_http_client_applies_settings():
+    settings = UpstreamSettings(connect_timeout=1.5, read_timeout=60.0, write_timeout=2.0, pool_timeout=3.0)
+    client = create_http_client(settings)
+    try:
+        assert client.timeout == httpx.Timeout(connect=1.5, read=60.0, write=2.0, pool=3.0)
+    finally:
+        await client.aclose()
+
+@pytest.mark.asyncio
+async def test_get_pool_stats_empty_pool():
+    client = create_http_client(UpstreamSettings())
+    try:
+        assert get_pool_stats(client) == {"connections": 0, "active": 0, "idle": 0, "queued": 0}
+    finally:
+        await client.aclose()
+
+def test_get_pool_stats_unknown_transport():
+    client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200)))
+    assert get_pool_stats(client) == {"connections": 0, "active": 0, "idle": 0, "queued": 0}
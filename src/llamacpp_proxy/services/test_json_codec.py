@@ -0,0 +1,48 @@
+import json
+import pytest
+from fastapi import APIRouter, FastAPI, Response
+from fastapi.testclient import TestClient
+from llamacpp_proxy.models.chat import Message
+from llamacpp_proxy.services import json_codec
+from llamacpp_proxy.services.json_codec import FastJSONRoute, dumps, json_response, loads
+
+def test_dumps_matches_json():
+    value = {"text": "héllo\n", "n": [1, 2.5, None]}
+    assert json.loads(dumps(value)) == value
+    assert "é".encode() in dumps(value)
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_dumps_escapes_lone_surrogates(monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(json_codec, "orjson", None)
+    assert dumps("\ud83d") == b'"\\ud83d"'
+    assert dumps("é") == '"é"'.encode()
+
+def test_loads_without_orjson(monkeypatch):
+    monkeypatch.setattr(json_codec, "orjson", None)
+    assert loads(b'{"a": [1]}') == {"a": [1]}
+    with pytest.raises(json.JSONDecodeError):
+        loads(b'{"a":')
+
+def test_json_response_keeps_dependency_headers():
+    response = Response()
+    response.headers["X-Cache"] = "MISS"
+    result = json_response(Message.model_construct(role="assistant", content="hi"), response)
+    assert result.headers["x-cache"] == "MISS"
+    assert result.headers["content-type"] == "application/json"
+    assert json.loads(result.body) == {"role": "assistant", "content": "hi", "name": None}
+
+def test_fast_json_route_decodes_body():
+    router = APIRouter(route_class=FastJSONRoute)
+
+    @router.post("/echo")
+    async def echo(message: Message) -> Message:
+        return message
+
+    app = FastAPI()
+    app.include_router(router)
+    client = TestClient(app)
+    assert client.post("/echo", json={"role": "user", "content": "hi"}).json()["content"] == "hi"
+    response = client.post("/echo", content=b'{"role":', headers={"content-type": "application/json"})
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["type"] == "json_invalid"
@@ -0,0 +1,119 @@
+import json
+import os
+import sqlite3
+
+import pytest
+
+from llamacpp_proxy.config.rate_limit import RateLimitSettings
+from llamacpp_proxy.services.admission import PRIORITY_HIGH, PRIORITY_NORMAL
+from llamacpp_proxy.services.key_store import KeyStore, hash_api_key, load_key_file, parse_key_entry
+
+
+def write_keys(path, keys):
+    with open(path, "w") as f:
+        json.dump({"keys": keys}, f)
+    # 同じ秒内の書き換えでも更新を検知できるよう、更新時刻を進める
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+
+def test_parse_key_entry_with_hash():
+    key = parse_key_entry({
+        "id": "team-a",
+        "key_hash": "sha256:" + hash_api_key("secret"),
+        "tier": "gold",
+        "priority": 0,
+        "models": ["llama", "mixtral"],
+        "max_requests": 100,
+        "max_tokens_per_minute": 0,
+    })
+    assert key.id == "team-a"
+    assert key.key_hash == hash_api_key("secret")
+    assert key.tier == "gold" and key.limited
+    assert key.priority == 0
+    assert key.allows_model("llama") and not key.allows_model("other")
+    assert key.max_requests == 100
+    assert key.window is None
+    assert key.max_tokens_per_minute == 0
+
+
+def test_parse_key_entry_defaults():
+    key = parse_key_entry({"key": "secret"})
+    assert key.id == hash_api_key("secret")[:12]
+    assert key.priority == PRIORITY_NORMAL
+    assert key.models is None
+    assert parse_key_entry({"key": "secret", "tier": "unlimited"}).priority == PRIORITY_HIGH
+
+
+@pytest.mark.parametrize("entry, message", [
+    ({}, "key_hash or key is required"),
+    ({"key_hash": "abc"}, "key_hash must be"),
+    ({"key": "k", "max_requests": -1}, "max_requests must be a non-negative integer"),
+    ({"key": "k", "window": 0}, "must be positive"),
+    ({"key": "k", "priority": "high"}, "priority must be an integer"),
+    ({"key": "k", "models": {"a": 1}}, "models must be a list"),
+])
+def test_parse_key_entry_invalid(entry, message):
+    with pytest.raises(ValueError, match=message):
+        parse_key_entry(entry)
+
+
+def test_load_key_file_sqlite(tmp_path):
+    path = str(tmp_path / "keys.sqlite")
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "CREATE TABLE api_keys (key_hash TEXT PRIMARY KEY, id TEXT, tier TEXT, priority INTEGER, models TEXT, "
+        "max_requests INTEGER, window INTEGER, max_tokens_per_minute INTEGER)"
+    )
+    connection.execute(
+        "INSERT INTO api_keys VALUES (?, 'team-a', 'limited', NULL, 'llama, mixtral', 30, 60, NULL)",
+        (hash_api_key("secret"),),
+    )
+    connection.commit()
+    connection.close()
+
+    [key] = load_key_file(path)
+    assert key.id == "team-a"
+    assert key.models == frozenset({"llama", "mixtral"})
+    assert key.max_requests == 30
+
+
+def test_load_key_file_reports_entry(tmp_path):
+    path = tmp_path / "keys.json"
+    path.write_text(json.dumps([{"key": "a"}, {"id": "broken"}]))
+    with pytest.raises(ValueError, match="Invalid key entry 1"):
+        load_key_file(str(path))
+
+
+def test_key_store_combines_configured_and_file_keys(tmp_path):
+    path = str(tmp_path / "keys.json")
+    write_keys(path, [{"id": "team-a", "key_hash": hash_api_key("team-a-key")}])
+    store = KeyStore(RateLimitSettings(unlimited_api_key="admin", key_file=path))
+
+    assert len(store) == 2
+    assert store.lookup("admin").tier == "unlimited"
+    assert store.lookup("team-a-key").id == "team-a"
+    assert store.lookup("unknown") is None
+
+
+def test_key_store_reloads_changed_file(tmp_path):
+    path = str(tmp_path / "keys.json")
+    write_keys(path, [{"id": "team-a", "key": "a"}])
+    store = KeyStore(RateLimitSettings(key_file=path))
+    assert not store.reload_if_changed()
+
+    write_keys(path, [{"id": "team-b", "key": "b"}])
+    assert store.reload_if_changed()
+    assert store.lookup("a") is None
+    assert store.lookup("b").id == "team-b"
+
+
+def test_key_store_keeps_keys_when_reload_fails(tmp_path):
+    path = str(tmp_path / "keys.json")
+    write_keys(path, [{"id": "team-a", "key": "a"}])
+    store = KeyStore(RateLimitSettings(key_file=path))
+
+    with open(path, "w") as f:
+        f.write('{"keys": [')  # 書きかけのファイル
+    assert not store.reload_if_changed()
+    assert store.lookup("a").id == "team-a"
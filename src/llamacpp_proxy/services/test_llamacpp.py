@@ -1,8 +1,16 @@
+import asyncio
+import json
 import pytest
 from unittest.mock import AsyncMock, patch
 import httpx
 from fastapi import HTTPException
+from llamacpp_proxy.services.admission import PRIORITY_HIGH, PRIORITY_NORMAL, AdmissionController
+from llamacpp_proxy.services.affinity import AffinityTable
+from llamacpp_proxy.services.balancer import Backend, LoadBalancer
+from llamacpp_proxy.services.failover import FailoverPolicy
 from llamacpp_proxy.services.llamacpp import LlamaCppClient
+from llamacpp_proxy.services.metrics import metrics
+from llamacpp_proxy.services.singleflight import SingleFlight
 from llamacpp_proxy.config.settings import Settings
 
 @pytest.fixture
@@ -10,8 +18,10 @@ def settings():
     return Settings(llamacpp_server_url="http://test-server:8080")
 
 @pytest.fixture
-def client(settings):
-    return LlamaCppClient(settings)
+async def client(settings):
+    http_client = httpx.AsyncClient()
+    yield LlamaCppClient(settings, http_client, LoadBalancer.from_settings(settings), None, None)
+    await http_client.aclose()
 
 @pytest.mark.asyncio
 async def test_create_completion_success(client):
@@ -41,22 +51,22 @@ async def test_create_completion_http_error(client):
 @pytest.mark.asyncio
 async def test_create_streaming_completion_success(client):
     async def mock_aiter():
-        for line in ["data: line1", "data: line2"]:
-            yield line
+        for chunk in [b'data: {"content":"a"}\n\nda', b'ta: {"content":"b"}\n\n']:
+            yield chunk
 
     mock_response = AsyncMock()
     mock_response.status_code = 200
-    mock_response.raise_for_status = AsyncMock()
-    mock_response.aiter_lines = mock_aiter
+    mock_response.raise_for_status = lambda: None
+    mock_response.aiter_bytes = mock_aiter
 
     with patch("httpx.AsyncClient.stream") as mock_stream:
         mock_stream.return_value.__aenter__.return_value = mock_response
         
         result = []
-        async for line in client.create_streaming_completion({"prompt": "test"}):
-            result.append(line)
+        async for payload in await client.create_streaming_completion({"prompt": "test"}):
+            result.append(payload)
         
-        assert result == ["data: line1\n\n", "data: line2\n\n"]
+        assert result == [b'{"content":"a"}', b'{"content":"b"}']
 
 @pytest.mark.asyncio
 async def test_create_streaming_completion_http_error(client):
@@ -64,8 +74,205 @@ async def test_create_streaming_completion_http_error(client):
         mock_stream.side_effect = httpx.HTTPError("Test error")
         
         with pytest.raises(HTTPException) as exc_info:
-            async for _ in client.create_streaming_completion({"prompt": "test"}):
-                pass
+            await client.create_streaming_completion({"prompt": "test"})
         
         assert exc_info.value.status_code == 502
-        assert "Error in streaming completion" in str(exc_info.value.detail)
\ No newline at end of file
+        assert "Error in streaming completion" in str(exc_info.value.detail)
+
+@pytest.mark.asyncio
+async def test_create_completion_uses_shared_client(settings):
+    seen = []
+
+    def handler(request):
+        seen.append(str(request.url))
+        return httpx.Response(200, json={"content": "ok"})
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as http_client:
+        client = LlamaCppClient(settings, http_client, LoadBalancer.from_settings(settings), None, None)
+        await client.create_completion({"prompt": "a"})
+        await client.create_completion({"prompt": "b"})
+
+    assert seen == ["http://test-server:8080/completions"] * 2
+
+@pytest.mark.asyncio
+async def test_create_completion_balances_backends(settings):
+    seen = []
+
+    def handler(request):
+        seen.append(request.url.host)
+        return httpx.Response(200, json={"content": "ok"})
+
+    busy = Backend(url="http://busy:8080", in_flight=3)
+    idle = Backend(url="http://idle:8080")
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as http_client:
+        client = LlamaCppClient(settings, http_client, LoadBalancer([busy, idle]), None, None)
+        await client.create_completion({"prompt": "a"})
+
+    assert seen == ["idle"]
+    assert idle.in_flight == 0
+
+@pytest.mark.asyncio
+async def test_create_completion_pins_slot_for_affinity_key(settings):
+    payloads = []
+
+    def handler(request):
+        payloads.append(json.loads(request.content))
+        return httpx.Response(200, json={"content": "ok"})
+
+    balancer = LoadBalancer([Backend(url="http://a:8080", slots=2)], AffinityTable())
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as http_client:
+        client = LlamaCppClient(settings, http_client, balancer, None, None)
+        request = {"prompt": "a"}
+        await client.create_completion(request, affinity_key="conversation")
+        await client.create_completion(request, affinity_key="conversation")
+
+    assert payloads[0]["cache_prompt"] is True
+    assert payloads[0]["id_slot"] == payloads[1]["id_slot"]
+    assert request == {"prompt": "a"}
+
+@pytest.mark.asyncio
+async def test_create_completion_coalesces_identical_requests(settings):
+    calls = []
+
+    async def handler(request):
+        calls.append(request)
+        await asyncio.sleep(0.01)
+        return httpx.Response(200, json={"content": "ok"})
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as http_client:
+        client = LlamaCppClient(settings, http_client, LoadBalancer.from_settings(settings), SingleFlight(), None)
+        deterministic = {"prompt": "a", "temperature": 0}
+        results = await asyncio.gather(*[client.create_completion(deterministic) for _ in range(5)])
+        assert results == [[{"content": "ok"}]] * 5
+        assert len(calls) == 1
+
+        sampled = {"prompt": "a", "temperature": 0.7}
+        await asyncio.gather(*[client.create_completion(sampled) for _ in range(2)])
+        assert len(calls) == 3
+
+        # 優先度の高いリクエストは優先度の低いリクエストの生成に相乗りしない
+        await asyncio.gather(
+            client.create_completion(deterministic),
+            client.create_completion(deterministic, priority=PRIORITY_HIGH),
+        )
+        assert len(calls) == 5
+
+@pytest.mark.asyncio
+async def test_create_streaming_completion_releases_backend_on_close(settings):
+    def handler(request):
+        return httpx.Response(200, content=b'data: {"content":"a"}\n\ndata: {"content":"b"}\n\n')
+
+    backend = Backend(url="http://a:8080")
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as http_client:
+        client = LlamaCppClient(settings, http_client, LoadBalancer([backend]), None, None)
+        stream = await client.create_streaming_completion({"prompt": "a"})
+        assert backend.in_flight == 1
+        await stream.aclose()
+
+    assert backend.in_flight == 0
+
+@pytest.mark.asyncio
+async def test_create_completion_queues_by_priority(settings):
+    order = []
+
+    async def handler(request):
+        await asyncio.sleep(0.01)
+        order.append(json.loads(request.content)["prompt"])
+        return httpx.Response(200, json={"content": "ok"})
+
+    balancer = LoadBalancer([Backend(url="http://a:8080")], admission=AdmissionController(10, 5.0))
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as http_client:
+        client = LlamaCppClient(settings, http_client, balancer, None, None)
+        first = asyncio.ensure_future(client.create_completion({"prompt": "first"}))
+        await asyncio.sleep(0)
+        normal = asyncio.ensure_future(client.create_completion({"prompt": "normal"}, priority=PRIORITY_NORMAL))
+        await asyncio.sleep(0)
+        high = asyncio.ensure_future(client.create_completion({"prompt": "high"}, priority=PRIORITY_HIGH))
+        await asyncio.gather(first, normal, high)
+
+    assert order == ["first", "high", "normal"]
+
+@pytest.mark.asyncio
+async def test_create_completion_fails_over_to_another_backend(settings):
+    seen = []
+
+    def handler(request):
+        seen.append(request.url.host)
+        if request.url.host == "broken":
+            return httpx.Response(500, json={"error": "boom"})
+        return httpx.Response(200, json={"content": "ok"})
+
+    broken = Backend(url="http://broken:8080")
+    healthy = Backend(url="http://healthy:8080", in_flight=1)
+    before = metrics.failovers.value("http://broken:8080")
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as http_client:
+        client = LlamaCppClient(settings, http_client, LoadBalancer([broken, healthy]), None, FailoverPolicy(1))
+        assert await client.create_completion({"prompt": "a"}) == [{"content": "ok"}]
+
+    assert seen == ["broken", "healthy"]
+    assert metrics.failovers.value("http://broken:8080") == before + 1
+
+@pytest.mark.asyncio
+async def test_create_completion_does_not_retry_client_errors(settings):
+    seen = []
+
+    def handler(request):
+        seen.append(request.url.host)
+        return httpx.Response(400, json={"error": "bad request"})
+
+    balancer = LoadBalancer([Backend(url="http://a:8080"), Backend(url="http://b:8080")])
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as http_client:
+        client = LlamaCppClient(settings, http_client, balancer, None, FailoverPolicy(1))
+        with pytest.raises(HTTPException) as exc_info:
+            await client.create_completion({"prompt": "a"})
+
+    assert exc_info.value.status_code == 502
+    assert len(seen) == 1
+
+@pytest.mark.asyncio
+async def test_create_streaming_completion_fails_over_before_first_token(settings):
+    async def broken_body():
+        raise httpx.ReadError("connection reset")
+        yield b""
+
+    def handler(request):
+        if request.url.host == "broken":
+            return httpx.Response(200, content=broken_body())
+        return httpx.Response(200, content=b'data: {"content":"a"}\n\n')
+
+    broken = Backend(url="http://broken:8080")
+    healthy = Backend(url="http://healthy:8080", in_flight=1)
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as http_client:
+        client = LlamaCppClient(settings, http_client, LoadBalancer([broken, healthy]), None, FailoverPolicy(1))
+        stream = await client.create_streaming_completion({"prompt": "a"})
+        assert [payload async for payload in stream] == [b'{"content":"a"}']
+
+    assert broken.in_flight == 0
+    assert healthy.in_flight == 1
+
+@pytest.mark.asyncio
+async def test_create_streaming_completion_hedges_slow_first_token(settings):
+    async def body(delay):
+        await asyncio.sleep(delay)
+        yield b'data: {"content":"a"}\n\n'
+
+    def handler(request):
+        return httpx.Response(200, content=body(5 if request.url.host == "slow" else 0))
+
+    slow = Backend(url="http://slow:8080")
+    fast = Backend(url="http://fast:8080", in_flight=1, slots=2)
+    policy = FailoverPolicy(0, hedge_percentile=90)
+    for _ in range(20):
+        policy.observe_first_token(0.01)
+    before = metrics.hedged_requests.value("hedge")
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as http_client:
+        client = LlamaCppClient(settings, http_client, LoadBalancer([slow, fast]), None, policy)
+        stream = await client.create_streaming_completion({"prompt": "a"})
+        assert await asyncio.wait_for(stream.__anext__(), 1) == b'{"content":"a"}'
+        # 負けた方の上流はすぐに閉じる
+        assert slow.in_flight == 0
+        assert fast.in_flight == 2
+        await stream.aclose()
+
+    assert fast.in_flight == 1
+    assert metrics.hedged_requests.value("hedge") == before + 1
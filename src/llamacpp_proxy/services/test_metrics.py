@@ -0,0 +1,98 @@
+from types import SimpleNamespace
+import httpx
+from llamacpp_proxy.config.grammar import GrammarSettings
+from llamacpp_proxy.services.admission import AdmissionController
+from llamacpp_proxy.services.affinity import AffinityTable
+from llamacpp_proxy.services.grammar import GrammarCache
+from llamacpp_proxy.services.metrics import Counter, Histogram, ProxyMetrics, Registry, StreamTimer, metrics
+
+def test_counter_renders_labels():
+    registry = Registry()
+    counter = registry.register(Counter("requests_total", "Requests", ("endpoint", "status")))
+    counter.inc("/v1/completions", "200")
+    counter.inc("/v1/completions", "200", amount=2)
+    counter.inc("/v1/completions", "429")
+
+    assert counter.value("/v1/completions", "200") == 3
+    text = registry.render()
+    assert "# TYPE requests_total counter" in text
+    assert 'requests_total{endpoint="/v1/completions",status="200"} 3' in text
+    assert 'requests_total{endpoint="/v1/completions",status="429"} 1' in text
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    histogram = registry.register(Histogram("latency_seconds", "Latency", (), buckets=(0.1, 1.0)))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value)
+
+    text = registry.render()
+    assert 'latency_seconds_bucket{le="0.1"} 2' in text
+    assert 'latency_seconds_bucket{le="1"} 3' in text
+    assert 'latency_seconds_bucket{le="+Inf"} 4' in text
+    assert "latency_seconds_sum 2.65" in text
+    assert "latency_seconds_count 4" in text
+
+def test_label_values_are_escaped():
+    registry = Registry()
+    counter = registry.register(Counter("c", "C", ("v",)))
+    counter.inc('a"b\\c')
+    assert 'c{v="a\\"b\\\\c"} 1' in registry.render()
+
+def test_stream_timer_observes_ttft_and_inter_token_latency(monkeypatch):
+    now = [10.0]
+    monkeypatch.setattr("llamacpp_proxy.services.metrics.time.perf_counter", lambda: now[0])
+    ttft_before = metrics.time_to_first_token.count("test")
+    itl_before = metrics.inter_token_latency.count("test")
+
+    timer = StreamTimer("test", started=9.5)
+    for t in (10.0, 10.2, 10.4):
+        now[0] = t
+        timer.token()
+    timer.close()
+
+    assert metrics.time_to_first_token.count("test") == ttft_before + 1
+    assert metrics.inter_token_latency.count("test") == itl_before + 1
+
+def test_stream_timer_without_tokens_records_nothing():
+    before = metrics.time_to_first_token.count("empty")
+    StreamTimer("empty", started=0.0).close()
+    assert metrics.time_to_first_token.count("empty") == before
+
+def test_bind_collects_state():
+    backend = SimpleNamespace(url="http://a", in_flight=2, slots=4)
+    affinity = AffinityTable()
+    affinity.put("key", "http://a", 0)
+    affinity.hits, affinity.misses, affinity.fallbacks = 8, 1, 2
+    state = SimpleNamespace(
+        load_balancer=SimpleNamespace(backends=[backend], admission=None, affinity=affinity),
+        response_cache=SimpleNamespace(hits=3, misses=1),
+        singleflight=SimpleNamespace(coalesced=5),
+        http_client=httpx.AsyncClient(),
+        key_store=[object()] * 7,
+        grammar_cache=GrammarCache(GrammarSettings()),
+        embedding_batcher=SimpleNamespace(hits=6, misses=2),
+    )
+    proxy_metrics = ProxyMetrics()
+    proxy_metrics.bind(state)
+
+    text = proxy_metrics.render()
+    assert 'llamacpp_proxy_backend_in_flight{backend="http://a"} 2' in text
+    assert 'llamacpp_proxy_backend_slots{backend="http://a"} 4' in text
+    assert 'llamacpp_proxy_cache_requests_total{result="hit"} 3' in text
+    assert "llamacpp_proxy_singleflight_coalesced_total 5" in text
+    assert 'llamacpp_proxy_upstream_connections{state="active"} 0' in text
+    assert "llamacpp_proxy_api_keys 7" in text
+    assert 'llamacpp_proxy_grammar_cache_requests_total{result="miss"} 0' in text
+    assert "llamacpp_proxy_registered_grammars 0" in text
+    assert 'llamacpp_proxy_embedding_cache_requests_total{result="hit"} 6' in text
+    assert 'llamacpp_proxy_affinity_requests_total{result="hit"} 8' in text
+    assert 'llamacpp_proxy_affinity_requests_total{result="fallback"} 2' in text
+    assert "llamacpp_proxy_affinity_entries 1" in text
+    assert "\nllamacpp_proxy_queue_depth " not in text
+    assert "\nllamacpp_proxy_backend_queue_depth{" not in text
+
+    backend.queued = 3
+    state.load_balancer.admission = AdmissionController(10, 1.0)
+    text = proxy_metrics.render()
+    assert "llamacpp_proxy_queue_depth 0" in text
+    assert 'llamacpp_proxy_backend_queue_depth{backend="http://a"} 3' in text
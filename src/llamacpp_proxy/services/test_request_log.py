@@ -0,0 +1,186 @@
+import io
+import json
+import logging
+import queue
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from llamacpp_proxy.config.log import LogSettings
+from llamacpp_proxy.middleware.request_log import RequestLogMiddleware
+from llamacpp_proxy.services.request_log import (
+    DroppingQueueHandler,
+    RequestContextFilter,
+    StructuredFormatter,
+    bind_request,
+    configure_logging,
+    current_request_id,
+    request_id_from_header,
+    sanitize_fields,
+    shutdown_logging,
+    unbind_request,
+    upstream_request_fields,
+)
+
+
+def make_record(level=logging.INFO, msg="message", fields=None):
+    record = logging.LogRecord("test", level, __file__, 1, msg, None, None)
+    if fields is not None:
+        record.fields = fields
+    return record
+
+
+def test_sanitize_fields_redacts_prompts_and_keys():
+    fields = sanitize_fields(
+        {"prompt": "secret prompt", "api_key": "sk-123", "messages": [{"content": "hi"}], "n_predict": 16},
+        LogSettings(),
+    )
+    assert fields == {
+        "prompt": "[REDACTED 13 chars]",
+        "api_key": "[REDACTED 6 chars]",
+        "messages": "[REDACTED 1 items]",
+        "n_predict": 16,
+    }
+
+
+def test_sanitize_fields_redacts_nested_fields():
+    fields = sanitize_fields({"choices": [{"content": "generated", "stop": True}]}, LogSettings())
+    assert fields == {"choices": [{"content": "[REDACTED 9 chars]", "stop": True}]}
+
+
+def test_sanitize_fields_truncates_long_values():
+    fields = sanitize_fields({"path": "x" * 100}, LogSettings(max_field_chars=16))
+    assert fields["path"] == "x" * 16 + "...(+84 chars)"
+
+
+def test_sanitize_fields_capture_prompts_keeps_prompts_but_not_keys():
+    prompt = "p" * 1000
+    fields = sanitize_fields(
+        {"prompt": prompt, "api_key": "sk-123"}, LogSettings(max_field_chars=16, capture_prompts=True)
+    )
+    assert fields == {"prompt": prompt, "api_key": "[REDACTED 6 chars]"}
+
+
+def test_upstream_request_fields():
+    requests = [{"prompt": "abc", "n_predict": 8, "stream": False}, {"prompt": "de", "n_predict": 8, "stream": False}]
+    fields = upstream_request_fields(requests)
+    assert fields == {"choices": 2, "prompt_chars": 5, "n_predict": 8, "stream": False, "prompt": ["abc", "de"]}
+    assert upstream_request_fields([{"prompt": "abc", "grammar": "root ::= x"}])["grammar"] == "root ::= x"
+
+
+def test_structured_formatter_text():
+    formatter = StructuredFormatter(LogSettings())
+    record = make_record(fields={"status": 200, "prompt": "hello"})
+    record.request_id = "req-1"
+    text = formatter.format(record)
+    assert " INFO test [req-1] message status=200 " in text
+    assert "hello" not in text
+    assert "[REDACTED 5 chars]" in text
+
+
+def test_structured_formatter_json():
+    formatter = StructuredFormatter(LogSettings(format="json"))
+    record = make_record(fields={"status": 200, "grammar": "root ::= x"})
+    record.request_id = "req-1"
+    entry = json.loads(formatter.format(record))
+    assert entry["level"] == "INFO"
+    assert entry["request_id"] == "req-1"
+    assert entry["status"] == 200
+    assert entry["grammar"] == "[REDACTED 10 chars]"
+
+
+def test_request_id_from_header():
+    assert request_id_from_header("abc-123") == "abc-123"
+    generated = request_id_from_header("bad id\n")
+    assert len(generated) == 32 and generated != "bad id\n"
+    assert request_id_from_header(None) != request_id_from_header(None)
+
+
+def test_filter_adds_request_id_and_applies_sampling():
+    log_filter = RequestContextFilter()
+    tokens = bind_request("req-1", 0.0)
+    try:
+        assert current_request_id() == "req-1"
+        info, warning = make_record(), make_record(logging.WARNING)
+        assert not log_filter.filter(info)
+        assert log_filter.filter(warning)
+        assert warning.request_id == "req-1"
+    finally:
+        unbind_request(tokens)
+    assert current_request_id() is None
+    assert log_filter.filter(make_record())
+
+
+def test_dropping_queue_handler_never_blocks():
+    handler = DroppingQueueHandler(queue.Queue(1))
+    record = make_record(msg="value %s", fields={"prompt": "x"})
+    record.args = ("arg",)
+    handler.emit(record)
+    handler.emit(make_record())
+    assert handler.dropped == 1
+    # 整形はリスナーのスレッドで行うため、キューにはそのままのレコードが入る
+    assert handler.queue.get_nowait() is record
+    assert record.args == ("arg",)
+
+
+@pytest.fixture
+def log_stream():
+    stream = io.StringIO()
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    yield stream
+    shutdown_logging()
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+
+
+def test_configure_logging_writes_from_listener(log_stream):
+    configure_logging(LogSettings(format="json"), stream=log_stream)
+    logging.getLogger("llamacpp_proxy.test").info("hello", extra={"fields": {"prompt": "secret"}})
+    shutdown_logging()
+    entry = json.loads(log_stream.getvalue().strip())
+    assert entry["message"] == "hello"
+    assert entry["prompt"] == "[REDACTED 6 chars]"
+
+
+def test_request_log_middleware_sets_request_id(log_stream):
+    configure_logging(LogSettings(format="json"), stream=log_stream)
+    app = FastAPI()
+    seen = []
+
+    @app.get("/ping")
+    async def ping():
+        seen.append(current_request_id())
+        return {"ok": True}
+
+    app.add_middleware(RequestLogMiddleware, settings=LogSettings())
+    client = TestClient(app)
+    response = client.get("/ping", headers={"X-Request-Id": "client-id"})
+    assert response.headers["x-request-id"] == "client-id"
+    generated = client.get("/ping").headers["x-request-id"]
+    assert seen == ["client-id", generated]
+
+    shutdown_logging()
+    entries = [json.loads(line) for line in log_stream.getvalue().splitlines()]
+    access = [entry for entry in entries if entry["logger"] == "llamacpp_proxy.access"]
+    assert [entry["request_id"] for entry in access] == ["client-id", generated]
+    assert access[0]["message"] == "GET /ping 200"
+    assert access[0]["status"] == 200
+
+
+def test_request_log_middleware_sampling(log_stream):
+    configure_logging(LogSettings(format="json"), stream=log_stream)
+    app = FastAPI()
+
+    @app.get("/fail")
+    async def fail():
+        logging.getLogger("llamacpp_proxy.test").warning("always logged")
+        return {"ok": False}
+
+    app.add_middleware(RequestLogMiddleware, settings=LogSettings(sample_rate=0.0))
+    TestClient(app).get("/fail")
+    shutdown_logging()
+    messages = [json.loads(line)["message"] for line in log_stream.getvalue().splitlines()]
+    assert messages == ["always logged"]
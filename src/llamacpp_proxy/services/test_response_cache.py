@@ -0,0 +1,168 @@
+import sqlite3
+import time
+import pytest
+from llamacpp_proxy.config.cache import CacheSettings
+from llamacpp_proxy.services.response_cache import ResponseCache, cache_key, is_cacheable
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def make_completion(calls, content="ok"):
+    async def create_completion():
+        calls.append(content)
+        return [{"content": content}]
+    return create_completion
+
+def test_is_cacheable():
+    assert is_cacheable({"prompt": "a", "temperature": 0})
+    assert is_cacheable({"prompt": "a", "temperature": 0.7, "seed": 42})
+    assert not is_cacheable({"prompt": "a", "temperature": 0.7})
+    assert not is_cacheable({"prompt": "a", "temperature": 0.7, "seed": -1})
+    assert not is_cacheable({"prompt": "a", "temperature": 0, "stream": True})
+
+def test_cache_key_normalizes_request():
+    assert cache_key({"prompt": "a", "temperature": 0, "stop": None}) == cache_key({"temperature": 0, "prompt": "a"})
+    assert cache_key({"prompt": "a", "temperature": 0}) != cache_key({"prompt": "b", "temperature": 0})
+
+@pytest.mark.asyncio
+async def test_fetch_hit_and_miss():
+    cache = ResponseCache(CacheSettings(enabled=True))
+    calls = []
+    request = {"prompt": "a", "temperature": 0}
+
+    assert await cache.fetch(request, make_completion(calls)) == ([{"content": "ok"}], "MISS")
+    assert await cache.fetch(request, make_completion(calls)) == ([{"content": "ok"}], "HIT")
+    assert calls == ["ok"]
+
+@pytest.mark.asyncio
+async def test_fetch_disabled():
+    cache = ResponseCache(CacheSettings(enabled=False))
+    calls = []
+    request = {"prompt": "a", "temperature": 0}
+
+    await cache.fetch(request, make_completion(calls))
+    assert await cache.fetch(request, make_completion(calls)) == ([{"content": "ok"}], None)
+    assert len(calls) == 2
+
+@pytest.mark.asyncio
+async def test_fetch_non_deterministic_bypass():
+    cache = ResponseCache(CacheSettings(enabled=True))
+    calls = []
+    request = {"prompt": "a", "temperature": 0.7}
+
+    await cache.fetch(request, make_completion(calls))
+    assert (await cache.fetch(request, make_completion(calls)))[1] == "BYPASS"
+    assert len(calls) == 2
+
+@pytest.mark.asyncio
+async def test_fetch_cache_control():
+    cache = ResponseCache(CacheSettings(enabled=True))
+    calls = []
+    request = {"prompt": "a", "temperature": 0}
+
+    assert (await cache.fetch(request, make_completion(calls, "first"), "no-store"))[1] == "BYPASS"
+    assert (await cache.fetch(request, make_completion(calls, "second"), "no-cache"))[1] == "MISS"
+    assert await cache.fetch(request, make_completion(calls, "third")) == ([{"content": "second"}], "HIT")
+    assert calls == ["first", "second"]
+
+@pytest.mark.asyncio
+async def test_ttl_expiry():
+    clock = FakeClock()
+    cache = ResponseCache(CacheSettings(enabled=True, ttl=10), clock=clock)
+    await cache.put("key", [{"content": "ok"}])
+
+    clock.now += 9
+    assert await cache.get("key") == [{"content": "ok"}]
+    clock.now += 2
+    assert await cache.get("key") is None
+
+@pytest.mark.asyncio
+async def test_byte_budget_evicts_least_recently_used():
+    entry_size = len(b'[{"content":"xxxxxxxxxx"}]')
+    cache = ResponseCache(CacheSettings(enabled=True, max_bytes=entry_size * 2))
+    await cache.put("a", [{"content": "x" * 10}])
+    await cache.put("b", [{"content": "x" * 10}])
+    await cache.get("a")
+    await cache.put("c", [{"content": "x" * 10}])
+
+    assert await cache.get("a") is not None
+    assert await cache.get("b") is None
+    assert cache.stats()["bytes"] == entry_size * 2
+
+@pytest.mark.asyncio
+async def test_disk_cache_survives_restart(tmp_path):
+    settings = CacheSettings(enabled=True, disk_path=str(tmp_path / "cache.sqlite3"))
+    cache = ResponseCache(settings)
+    await cache.put("key", [{"content": "persisted"}])
+    cache.close()
+
+    restarted = ResponseCache(settings)
+    try:
+        assert await restarted.get("key") == [{"content": "persisted"}]
+        assert restarted.stats()["entries"] == 1
+    finally:
+        restarted.close()
+
+@pytest.mark.asyncio
+async def test_disk_cache_budget(tmp_path):
+    settings = CacheSettings(enabled=True, disk_path=str(tmp_path / "cache.sqlite3"), disk_max_bytes=100)
+    clock = FakeClock()
+    cache = ResponseCache(settings, clock=clock)
+    try:
+        for i in range(5):
+            clock.now += 1
+            await cache.put(f"key{i}", [{"content": "x" * 30}])
+        assert cache.disk.get("key0", clock.now) is None
+        assert cache.disk.get("key4", clock.now) is not None
+    finally:
+        cache.close()
+
+@pytest.mark.asyncio
+async def test_disk_cache_size_is_shared(tmp_path):
+    settings = CacheSettings(enabled=True, disk_path=str(tmp_path / "cache.sqlite3"), disk_max_bytes=100)
+    clock = FakeClock()
+    first = ResponseCache(settings, clock=clock)
+    second = ResponseCache(settings, clock=clock)
+    try:
+        # 同じキーの上書きでは合計サイズは増えない
+        for _ in range(10):
+            await first.put("key", [{"content": "x" * 30}])
+        entry_size = first.disk.size()
+        assert entry_size == len(b'[{"content":"' + b"x" * 30 + b'"}]')
+
+        # 別のワーカーが書き込んだ分も上限に数える
+        clock.now += 1
+        await second.put("other", [{"content": "x" * 30}])
+        clock.now += 1
+        await first.put("third", [{"content": "x" * 30}])
+        assert first.disk.size() == second.disk.size() <= 100
+        assert first.disk.get("key", clock.now) is None
+    finally:
+        first.close()
+        second.close()
+
+@pytest.mark.asyncio
+async def test_disk_cache_errors_fall_through(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = ResponseCache(CacheSettings(enabled=True, disk_path=path))
+    writer = sqlite3.connect(path, isolation_level=None)
+    calls = []
+    try:
+        # 他のプロセスが書き込み中でも、上流のレスポンスを返してメモリにはキャッシュする
+        writer.execute("BEGIN IMMEDIATE")
+        started = time.monotonic()
+        response, status = await cache.fetch({"prompt": "a", "temperature": 0}, make_completion(calls))
+        assert (response, status) == ([{"content": "ok"}], "MISS")
+        assert time.monotonic() - started < 1.0
+        writer.execute("ROLLBACK")
+
+        # ディスクを読めない場合はミスとして扱う
+        with cache.disk._locked():
+            assert await cache.get("unknown") is None
+    finally:
+        writer.close()
+        cache.close()
@@ -0,0 +1,121 @@
+import os
+import sqlite3
+import time
+from types import SimpleNamespace
+import pytest
+from fastapi import Response
+from llamacpp_proxy.config.rate_limit import RateLimitSettings
+from llamacpp_proxy.middleware.rate_limit import RateLimiter, check_rate_limit
+from llamacpp_proxy.services.key_store import ApiKey
+from llamacpp_proxy.services.balancer import Backend, LoadBalancer
+from llamacpp_proxy.services.shared_state import SharedState, remove_database
+
+def test_exchange_load_sums_other_workers(tmp_path):
+    path = str(tmp_path / "state.sqlite")
+    first = SharedState(path, worker_id="1")
+    second = SharedState(path, worker_id="2")
+    third = SharedState(path, worker_id="3")
+
+    first.exchange_load({"http://a": 2, "http://b": 0}, stale_after=10)
+    second.exchange_load({"http://a": 1}, stale_after=10)
+    assert third.exchange_load({"http://a": 5}, stale_after=10) == {"http://a": 3, "http://b": 0}
+    assert first.exchange_load({"http://a": 2}, stale_after=10) == {"http://a": 6}
+
+    # 終了したワーカーの分は数えない
+    second.close()
+    assert first.exchange_load({"http://a": 2}, stale_after=10) == {"http://a": 5}
+
+def test_stale_workers_are_ignored(tmp_path):
+    now = [1000.0]
+    path = str(tmp_path / "state.sqlite")
+    first = SharedState(path, worker_id="1", clock=lambda: now[0])
+    second = SharedState(path, worker_id="2", clock=lambda: now[0])
+
+    second.exchange_load({"http://a": 4}, stale_after=1)
+    now[0] += 2
+    assert first.exchange_load({"http://a": 0}, stale_after=1) == {}
+
+def test_rate_limit_is_shared_between_workers(tmp_path):
+    path = str(tmp_path / "state.sqlite")
+    settings = RateLimitSettings(window=60, max_requests=2, limited_api_key="limited")
+    first = RateLimiter(settings, shared_state=SharedState(path, worker_id="1"))
+    second = RateLimiter(settings, shared_state=SharedState(path, worker_id="2"))
+
+    key = ApiKey(id="limited", key_hash="0" * 64)
+    first.check(key)
+    second.check(key)
+    status = first.requests.acquire("limited", 2, 60)
+    assert status.retry_after > 0
+
+def test_remote_load_reduces_capacity():
+    a = Backend(url="http://a", slots=2)
+    b = Backend(url="http://b", slots=2)
+    balancer = LoadBalancer([a, b])
+    balancer.set_remote_load({"http://a": 2})
+
+    assert balancer.capacity() == 2
+    assert balancer.choose() is b
+    assert not a.has_free_slot()
+
+def test_registered_grammars_are_shared_and_bounded(tmp_path):
+    now = [1000.0]
+    path = str(tmp_path / "state.sqlite")
+    first = SharedState(path, worker_id="1", clock=lambda: now[0])
+    second = SharedState(path, worker_id="2", clock=lambda: now[0])
+
+    first.put_grammar("grammar-a", 'root ::= "a"', max_grammars=2)
+    now[0] += 1
+    first.put_grammar("grammar-b", 'root ::= "b"', max_grammars=2)
+    assert second.get_grammar("grammar-a") == 'root ::= "a"'
+
+    # 上限を超えると古いものから削除する
+    now[0] += 1
+    second.put_grammar("grammar-c", 'root ::= "c"', max_grammars=2)
+    assert first.get_grammar("grammar-a") is None
+    assert first.get_grammar("grammar-c") == 'root ::= "c"'
+
+def test_lock_wait_is_bounded(tmp_path):
+    path = str(tmp_path / "state.sqlite")
+    first = SharedState(path, worker_id="1")
+    second = SharedState(path, worker_id="2")
+
+    # 他のワーカーが書き込み中
+    with first.transaction():
+        started = time.monotonic()
+        with pytest.raises(sqlite3.OperationalError):
+            second.exchange_load({"http://a": 1}, stale_after=10)
+        assert time.monotonic() - started < 1.0
+
+    # 同じワーカーの他のスレッドが使用中
+    with second._locked():
+        with pytest.raises(sqlite3.OperationalError):
+            second.get_grammar("grammar-a")
+    assert second.exchange_load({"http://a": 1}, stale_after=10) == {}
+
+@pytest.mark.asyncio
+async def test_check_rate_limit_allows_request_when_shared_state_is_locked(tmp_path):
+    path = str(tmp_path / "state.sqlite")
+    settings = RateLimitSettings(window=60, max_requests=2, limited_api_key="limited")
+    limiter = RateLimiter(settings, shared_state=SharedState(path, worker_id="1"))
+    other = SharedState(path, worker_id="2")
+    key = ApiKey(id="limited", key_hash="0" * 64)
+    request = SimpleNamespace(state=SimpleNamespace())
+
+    response = Response()
+    await check_rate_limit(request, response, key, limiter)
+    assert response.headers["X-RateLimit-Remaining"] == "1"
+
+    with other.transaction():
+        response = Response()
+        await check_rate_limit(request, response, key, limiter)
+        assert "X-RateLimit-Remaining" not in response.headers
+
+def test_remove_database(tmp_path):
+    path = str(tmp_path / "state.sqlite")
+    state = SharedState(path)
+    state.exchange_load({"http://a": 1}, stale_after=10)
+    state.close()
+
+    remove_database(path)
+    remove_database(path)  # 既にない場合も失敗しない
+    assert not any(name.startswith("state.sqlite") for name in os.listdir(tmp_path))
@@ -0,0 +1,205 @@
+import asyncio
+import pytest
+from llamacpp_proxy.services.singleflight import SingleFlight
+from llamacpp_proxy.services.tracing import end_request, start_request
+
+@pytest.mark.asyncio
+async def test_do_shares_result():
+    singleflight = SingleFlight()
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "result"
+
+    results = await asyncio.gather(*[singleflight.do("key", fn) for _ in range(3)])
+    assert results == ["result"] * 3
+    assert calls == [1]
+    assert singleflight.coalesced == 2
+    assert singleflight.stats()["in_flight"] == 0
+
+@pytest.mark.asyncio
+async def test_do_records_follower_phase_in_own_request():
+    singleflight = SingleFlight()
+
+    async def fn():
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def request():
+        timing, token = start_request("test", {})
+        try:
+            await singleflight.do("key", fn)
+        finally:
+            end_request(token)
+        return [name for name, _, _ in timing.phases]
+
+    leader, follower = await asyncio.gather(request(), request())
+    assert leader == []
+    assert follower == ["coalesced"]
+
+@pytest.mark.asyncio
+async def test_do_runs_again_after_completion():
+    singleflight = SingleFlight()
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        return len(calls)
+
+    assert await singleflight.do("key", fn) == 1
+    assert await singleflight.do("key", fn) == 2
+
+@pytest.mark.asyncio
+async def test_do_shares_exception():
+    singleflight = SingleFlight()
+
+    async def fn():
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream error")
+
+    results = await asyncio.gather(*[singleflight.do("key", fn) for _ in range(2)], return_exceptions=True)
+    assert all(isinstance(result, ValueError) for result in results)
+
+@pytest.mark.asyncio
+async def test_do_cancel_one_waiter_keeps_others():
+    singleflight = SingleFlight()
+    started = asyncio.Event()
+
+    async def fn():
+        started.set()
+        await asyncio.sleep(0.02)
+        return "result"
+
+    first = asyncio.ensure_future(singleflight.do("key", fn))
+    second = asyncio.ensure_future(singleflight.do("key", fn))
+    await started.wait()
+    first.cancel()
+
+    assert await second == "result"
+    with pytest.raises(asyncio.CancelledError):
+        await first
+
+@pytest.mark.asyncio
+async def test_do_cancel_all_waiters_cancels_upstream():
+    singleflight = SingleFlight()
+    cancelled = asyncio.Event()
+
+    async def fn():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    waiter = asyncio.ensure_future(singleflight.do("key", fn))
+    await asyncio.sleep(0)
+    waiter.cancel()
+    await asyncio.wait_for(cancelled.wait(), 1)
+
+async def opener(chunks, gate=None, closed=None):
+    return source(chunks, gate, closed)
+
+async def source(chunks, gate=None, closed=None):
+    try:
+        for chunk in chunks:
+            if gate is not None:
+                await gate.wait()
+            yield chunk
+            await asyncio.sleep(0)
+    finally:
+        if closed is not None:
+            closed.set()
+
+async def collect(stream):
+    return [chunk async for chunk in stream]
+
+@pytest.mark.asyncio
+async def test_stream_fans_out_to_subscribers():
+    singleflight = SingleFlight()
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        return source(["a", "b", "c"])
+
+    async def consume():
+        return await collect(await singleflight.stream("key", fn))
+
+    results = await asyncio.gather(*[consume() for _ in range(3)])
+    assert results == [["a", "b", "c"]] * 3
+    assert calls == [1]
+
+@pytest.mark.asyncio
+async def test_stream_late_joiner_receives_all_chunks():
+    singleflight = SingleFlight()
+    gate = asyncio.Event()
+
+    first = await singleflight.stream("key", lambda: opener(["a", "b"], gate))
+    gate.set()
+    assert await first.__anext__() == "a"
+    gate.clear()
+
+    late = asyncio.ensure_future(collect(await singleflight.stream("key", lambda: opener(["unused"]))))
+    await asyncio.sleep(0)
+    gate.set()
+
+    assert await collect(first) == ["b"]
+    assert await late == ["a", "b"]
+
+@pytest.mark.asyncio
+async def test_stream_subscriber_leaving_keeps_others():
+    singleflight = SingleFlight()
+    gate = asyncio.Event()
+    gate.set()
+
+    leaving = await singleflight.stream("key", lambda: opener(["a", "b", "c"], gate))
+    staying = asyncio.ensure_future(collect(await singleflight.stream("key", lambda: opener([]))))
+    assert await leaving.__anext__() == "a"
+    await leaving.aclose()
+
+    assert await staying == ["a", "b", "c"]
+
+@pytest.mark.asyncio
+async def test_stream_last_subscriber_leaving_cancels_upstream():
+    singleflight = SingleFlight()
+    gate = asyncio.Event()
+    closed = asyncio.Event()
+
+    stream = await singleflight.stream("key", lambda: opener(["a", "b"], gate, closed))
+    gate.set()
+    assert await stream.__anext__() == "a"
+    gate.clear()
+    await stream.aclose()
+
+    await asyncio.wait_for(closed.wait(), 1)
+    assert singleflight.stats()["streams"] == 0
+
+@pytest.mark.asyncio
+async def test_stream_propagates_error():
+    singleflight = SingleFlight()
+
+    async def failing():
+        yield "a"
+        raise ValueError("upstream error")
+
+    async def open_failing():
+        return failing()
+
+    with pytest.raises(ValueError):
+        await collect(await singleflight.stream("key", open_failing))
+
+@pytest.mark.asyncio
+async def test_stream_open_error_reaches_all_subscribers():
+    singleflight = SingleFlight()
+
+    async def open_failing():
+        await asyncio.sleep(0.01)
+        raise ValueError("connect error")
+
+    results = await asyncio.gather(
+        *[singleflight.stream("key", open_failing) for _ in range(2)], return_exceptions=True
+    )
+    assert all(isinstance(result, ValueError) for result in results)
+    assert singleflight.stats()["streams"] == 0
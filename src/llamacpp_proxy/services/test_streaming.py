@@ -0,0 +1,207 @@
+import asyncio
+import json
+import pytest
+from fastapi import HTTPException
+from llamacpp_proxy.config.streaming import StreamingSettings
+from llamacpp_proxy.services.metrics import metrics
+from llamacpp_proxy.services.streaming import (
+    DONE,
+    HEARTBEAT,
+    SLOW_CONSUMER_ERROR,
+    ChunkEncoder,
+    buffered_stream,
+    get_finish_reason,
+    iter_sse_data,
+    openai_stream,
+    translate_stream,
+)
+
+async def aiter(items):
+    for item in items:
+        yield item
+
+async def collect(stream):
+    return [item async for item in stream]
+
+def parse_chunks(chunks):
+    assert chunks[-1] == DONE
+    events = []
+    for chunk in chunks[:-1]:
+        assert chunk.startswith(b"data: ") and chunk.endswith(b"\n\n")
+        events.append(json.loads(chunk[6:]))
+    return events
+
+def test_get_finish_reason():
+    assert get_finish_reason({"stop_type": "eos"}) == "stop"
+    assert get_finish_reason({"stop_type": "word"}) == "stop"
+    assert get_finish_reason({"stop_type": "limit"}) == "length"
+    assert get_finish_reason({"stop_type": "eos", "truncated": True}) == "length"
+
+@pytest.mark.asyncio
+async def test_iter_sse_data_splits_frames_across_chunks():
+    chunks = [b'data: {"a":1}\n\ndata: {"b"', b':2}\n', b'\ndata: {"c":3}\r\n\r\n']
+    assert await collect(iter_sse_data(aiter(chunks))) == [b'{"a":1}', b'{"b":2}', b'{"c":3}']
+
+@pytest.mark.asyncio
+async def test_iter_sse_data_ignores_other_fields():
+    chunks = [b': comment\n\nevent: message\ndata: {"a":1}\n\n']
+    assert await collect(iter_sse_data(aiter(chunks))) == [b'{"a":1}']
+
+@pytest.mark.asyncio
+async def test_translate_chat_stream():
+    encoder = ChunkEncoder.for_chat("chatcmpl-1", 123, "test-model")
+    payloads = [
+        b'{"content":"Hel","stop":false}',
+        b'{"content":"lo \\"x\\"","stop":false}',
+        b'{"content":"","stop":true,"stop_type":"limit"}',
+    ]
+    events = parse_chunks(await collect(openai_stream([translate_stream(aiter(payloads), encoder)])))
+
+    assert all(event["id"] == "chatcmpl-1" and event["object"] == "chat.completion.chunk" for event in events)
+    assert all(event["model"] == "test-model" and event["created"] == 123 for event in events)
+    assert [event["choices"][0]["delta"] for event in events] == [
+        {"role": "assistant", "content": ""},
+        {"content": "Hel"},
+        {"content": 'lo "x"'},
+        {},
+    ]
+    assert [event["choices"][0]["finish_reason"] for event in events] == [None, None, None, "length"]
+
+@pytest.mark.asyncio
+async def test_translate_completion_stream():
+    encoder = ChunkEncoder.for_completion("cmpl-1", 123, "test-model")
+    payloads = [b'{"content":"a","stop":false}', b'{"content":"b","stop":true,"stop_type":"eos"}']
+    events = parse_chunks(await collect(openai_stream([translate_stream(aiter(payloads), encoder)])))
+
+    assert all(event["object"] == "text_completion" for event in events)
+    assert [event["choices"][0]["text"] for event in events] == ["a", "b", ""]
+    assert [event["choices"][0]["finish_reason"] for event in events] == [None, None, "stop"]
+
+@pytest.mark.asyncio
+async def test_openai_stream_multiplexes_choices():
+    encoder = ChunkEncoder.for_completion("cmpl-1", 123, "test-model")
+    streams = [
+        translate_stream(aiter([b'{"content":"a","stop":true,"stop_type":"eos"}']), encoder, 0),
+        translate_stream(aiter([b'{"content":"b","stop":true,"stop_type":"eos"}']), encoder, 1),
+    ]
+    events = parse_chunks(await collect(openai_stream(streams)))
+
+    texts = {(event["choices"][0]["index"], event["choices"][0]["text"]) for event in events}
+    assert texts == {(0, "a"), (0, ""), (1, "b"), (1, "")}
+
+@pytest.mark.asyncio
+async def test_translate_stream_forwards_error():
+    encoder = ChunkEncoder.for_completion("cmpl-1", 123, "test-model")
+    payloads = [b'{"error":{"message":"boom"}}']
+    assert await collect(translate_stream(aiter(payloads), encoder)) == [b'data: {"error":{"message":"boom"}}\n\n']
+
+@pytest.mark.asyncio
+async def test_buffered_stream_coalesces_pending_chunks():
+    chunks = [b"data: 1\n\n", b"data: 2\n\n", b"data: 3\n\n"]
+    frames = await collect(buffered_stream(aiter(chunks), StreamingSettings()))
+    # 送信側が待っている間に届いたチャンクは1回の書き込みにまとめる
+    assert b"".join(frames) == b"".join(chunks)
+    assert len(frames) < len(chunks)
+
+@pytest.mark.asyncio
+async def test_buffered_stream_waits_for_flush_interval():
+    async def tokens():
+        for i in range(3):
+            yield f"data: {i}\n\n".encode()
+            await asyncio.sleep(0.01)
+
+    frames = await collect(buffered_stream(tokens(), StreamingSettings(flush_interval=0.2)))
+    assert frames == [b"data: 0\n\ndata: 1\n\ndata: 2\n\n"]
+
+@pytest.mark.asyncio
+async def test_buffered_stream_sends_heartbeat_while_idle():
+    async def slow():
+        await asyncio.sleep(0.15)
+        yield b"data: 1\n\n"
+
+    frames = await collect(buffered_stream(slow(), StreamingSettings(heartbeat_interval=0.05)))
+    assert frames[0] == HEARTBEAT
+    assert frames[-1] == b"data: 1\n\n"
+    assert set(frames[:-1]) == {HEARTBEAT}
+
+@pytest.mark.asyncio
+async def test_buffered_stream_aborts_upstream_for_slow_consumer():
+    closed = asyncio.Event()
+    read = 0
+
+    async def endless():
+        nonlocal read
+        try:
+            while True:
+                read += 1
+                yield b"x" * 10
+                await asyncio.sleep(0)
+        finally:
+            closed.set()
+
+    before = metrics.aborted_generations.value("test", "slow_consumer")
+    stream = buffered_stream(endless(), StreamingSettings(max_buffer_bytes=100), "test")
+    await stream.__anext__()
+    # クライアントが読まない間に上流が上限を超えて溜まる
+    await asyncio.wait_for(closed.wait(), 1)
+    frames = await collect(stream)
+
+    assert read <= 20
+    assert frames[-1] == SLOW_CONSUMER_ERROR + DONE
+    assert metrics.aborted_generations.value("test", "slow_consumer") == before + 1
+
+@pytest.mark.asyncio
+async def test_buffered_stream_blocks_upstream_for_slow_consumer():
+    read = 0
+
+    async def counted():
+        nonlocal read
+        for _ in range(50):
+            read += 1
+            yield b"x" * 10
+
+    stream = buffered_stream(counted(), StreamingSettings(max_buffer_bytes=100, slow_consumer_policy="block"))
+    first = await stream.__anext__()
+    for _ in range(10):
+        await asyncio.sleep(0)
+    # バッファが一杯の間は上流を読まない
+    assert read <= len(first) // 10 + 11
+    rest = await collect(stream)
+    assert len(first) + sum(len(frame) for frame in rest) == 500
+    assert read == 50
+
+@pytest.mark.asyncio
+async def test_buffered_stream_raises_upstream_error_after_pending_chunks():
+    async def failing():
+        yield b"data: 1\n\n"
+        raise HTTPException(status_code=502, detail="boom")
+
+    stream = buffered_stream(failing(), StreamingSettings())
+    assert await stream.__anext__() == b"data: 1\n\n"
+    with pytest.raises(HTTPException):
+        await stream.__anext__()
+
+@pytest.mark.asyncio
+async def test_buffered_stream_counts_client_disconnect():
+    closed = asyncio.Event()
+
+    async def endless():
+        try:
+            yield b'{"content":"a","stop":false}'
+            await asyncio.sleep(3600)
+        finally:
+            closed.set()
+
+    before = metrics.aborted_generations.value("test", "streaming")
+    encoder = ChunkEncoder.for_completion("cmpl-1", 123, "test-model")
+    stream = buffered_stream(openai_stream([translate_stream(endless(), encoder)]), StreamingSettings(), "test")
+    await stream.__anext__()
+    # Starletteはクライアントの切断時にレスポンスのタスクをキャンセルする
+    task = asyncio.ensure_future(stream.__anext__())
+    await asyncio.sleep(0)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    assert closed.is_set()
+    assert metrics.aborted_generations.value("test", "streaming") == before + 1
@@ -1,6 +1,9 @@
+import time
 import pytest
+from unittest.mock import patch
 from fastapi import HTTPException
-from llamacpp_proxy.services.template import TemplateService
+from starlette.concurrency import run_in_threadpool
+from llamacpp_proxy.services.template import TemplateCache, TemplateService
 from llamacpp_proxy.config.settings import Settings
 from llamacpp_proxy.models.chat import Message
 
@@ -48,4 +51,64 @@ def test_render_template_error(settings):
         template_service.render([Message(role="user", content="test")])
     
     assert exc_info.value.status_code == 400
-    assert "Template rendering error" in str(exc_info.value.detail)
\ No newline at end of file
+    assert "Template rendering error" in str(exc_info.value.detail)
+
+def test_template_compiled_once():
+    cache = TemplateCache()
+    source = "{{ messages[0].content }}"
+    assert cache.get_template(source) is cache.get_template(source)
+
+def test_bytecode_cache(tmp_path):
+    cache = TemplateCache()
+    cache.configure(bytecode_cache_dir=str(tmp_path / "bytecode"))
+    template = cache.get_template("{{ messages[0].content }}")
+
+    assert template.render(messages=[Message(role="user", content="hi")]) == "hi"
+    assert list((tmp_path / "bytecode").iterdir())
+
+def test_hot_reload(tmp_path):
+    template_file = tmp_path / "template.jinja"
+    template_file.write_text("A:{{ messages[0].content }}")
+    settings = Settings(
+        chat_template=template_file.read_text(),
+        chat_template_path=str(template_file),
+        template_reload_interval=0.001,
+    )
+    template_service = TemplateService(settings)
+    template_service.template_cache = TemplateCache()
+    messages = [Message(role="user", content="hi")]
+    assert template_service.render(messages) == "A:hi"
+
+    time.sleep(0.01)
+    template_file.write_text("B:{{ messages[0].content }}!")
+    assert template_service.render(messages) == "B:hi!"
+
+def test_hot_reload_keeps_previous_template_on_error(tmp_path):
+    template_file = tmp_path / "template.jinja"
+    template_file.write_text("A:{{ messages[0].content }}")
+    settings = Settings(
+        chat_template=template_file.read_text(),
+        chat_template_path=str(template_file),
+        template_reload_interval=0.001,
+    )
+    template_service = TemplateService(settings)
+    template_service.template_cache = TemplateCache()
+    messages = [Message(role="user", content="hi")]
+    template_service.render(messages)
+
+    time.sleep(0.01)
+    template_file.write_text("{{ invalid syntax }")
+    assert template_service.render(messages) == "A:hi"
+
+@pytest.mark.asyncio
+async def test_render_async_offloads_long_history(settings):
+    settings.template_offload_threshold = 2
+    template_service = TemplateService(settings)
+    template_service.template_cache = TemplateCache()
+    messages = [Message(role="user", content=str(i)) for i in range(3)]
+
+    with patch("llamacpp_proxy.services.template.run_in_threadpool", wraps=run_in_threadpool) as mock_offload:
+        result = await template_service.render_async(messages)
+
+    mock_offload.assert_called_once()
+    assert result == template_service.render(messages)
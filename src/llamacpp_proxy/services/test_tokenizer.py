@@ -0,0 +1,120 @@
+import asyncio
+import json
+import pytest
+import httpx
+from fastapi import HTTPException
+from llamacpp_proxy.config.tokenizer import TokenizerSettings
+from llamacpp_proxy.models.chat import Message
+from llamacpp_proxy.services.balancer import Backend, LoadBalancer
+from llamacpp_proxy.services.tokenizer import TokenCounter, usage_from_choices
+
+def tokenize_handler(calls):
+    def handler(request):
+        content = json.loads(request.content)["content"]
+        calls.append(content)
+        return httpx.Response(200, json={"tokens": list(range(len(content.split())))})
+    return handler
+
+@pytest.fixture
+async def counter_factory():
+    clients = []
+
+    def create(settings=None, n_ctx=20, calls=None):
+        http_client = httpx.AsyncClient(transport=httpx.MockTransport(tokenize_handler(calls if calls is not None else [])))
+        clients.append(http_client)
+        balancer = LoadBalancer([Backend(url="http://a", n_ctx=n_ctx)])
+        return TokenCounter(http_client, balancer, settings or TokenizerSettings(message_overhead=0))
+
+    yield create
+    for http_client in clients:
+        await http_client.aclose()
+
+@pytest.mark.asyncio
+async def test_count_is_cached_by_content(counter_factory):
+    calls = []
+    counter = counter_factory(calls=calls)
+    assert await counter.count("one two three") == 3
+    assert await counter.count("one two three") == 3
+    assert calls == ["one two three"]
+    assert counter.stats() == {"entries": 1, "hits": 1, "misses": 1}
+
+@pytest.mark.asyncio
+async def test_count_returns_none_on_error():
+    async with httpx.AsyncClient(transport=httpx.MockTransport(lambda r: httpx.Response(404))) as http_client:
+        counter = TokenCounter(http_client, LoadBalancer([Backend(url="http://a")]), TokenizerSettings())
+        assert await counter.count("text") is None
+
+@pytest.mark.asyncio
+async def test_check_prompt_rejects_too_long(counter_factory):
+    counter = counter_factory(n_ctx=10)
+    await counter.check_prompt("a b c d e", max_tokens=5)
+    with pytest.raises(HTTPException) as exc_info:
+        await counter.check_prompt("a b c d e", max_tokens=6)
+    assert exc_info.value.status_code == 400
+    assert exc_info.value.detail["error"]["code"] == "context_length_exceeded"
+
+@pytest.mark.asyncio
+async def test_check_skipped_without_n_ctx(counter_factory):
+    calls = []
+    counter = counter_factory(n_ctx=0, calls=calls)
+    await counter.check_prompt("a " * 100, max_tokens=None)
+    assert calls == []
+
+@pytest.mark.asyncio
+async def test_fit_messages_rejects_without_trimming(counter_factory):
+    counter = counter_factory(n_ctx=10)
+    messages = [Message(role="user", content="a b c d e f"), Message(role="user", content="g h i j k")]
+    with pytest.raises(HTTPException):
+        await counter.fit_messages(messages, max_tokens=None)
+
+@pytest.mark.asyncio
+async def test_fit_messages_trims_oldest_turns(counter_factory):
+    counter = counter_factory(TokenizerSettings(message_overhead=1, trim_chat_history=True), n_ctx=12)
+    messages = [
+        Message(role="system", content="s"),
+        Message(role="user", content="a b c"),
+        Message(role="assistant", content="d e f"),
+        Message(role="user", content="g h"),
+    ]
+    trimmed = await counter.fit_messages(messages, max_tokens=2)
+    assert [message.content for message in trimmed] == ["s", "d e f", "g h"]
+
+@pytest.mark.asyncio
+async def test_fit_messages_keeps_last_message(counter_factory):
+    counter = counter_factory(TokenizerSettings(message_overhead=0, trim_chat_history=True), n_ctx=3)
+    with pytest.raises(HTTPException):
+        await counter.fit_messages([Message(role="user", content="a b c d")], max_tokens=None)
+
+@pytest.mark.asyncio
+async def test_count_many_bounds_upstream_calls():
+    calls = []
+    active = [0, 0]  # 現在の並行数, 最大の並行数
+
+    async def handler(request):
+        calls.append(json.loads(request.content)["content"])
+        active[0] += 1
+        active[1] = max(active)
+        await asyncio.sleep(0.01)
+        active[0] -= 1
+        return httpx.Response(200, json={"tokens": [0]})
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as http_client:
+        counter = TokenCounter(
+            http_client, LoadBalancer([Backend(url="http://a")]), TokenizerSettings(max_concurrency=2)
+        )
+        texts = [f"message {i}" for i in range(8)] + ["message 0"] * 4
+        assert await counter.count_many(texts) == [1] * 12
+        assert sorted(calls) == sorted(set(texts))  # 同じテキストは1回だけ
+        assert active[1] == 2
+
+        assert await counter.count_many(texts) == [1] * 12
+        assert len(calls) == 8  # 2回目は全てキャッシュから
+
+def test_usage_from_choices():
+    choices = [
+        {"tokens_evaluated": 5, "tokens_predicted": 2},
+        {"tokens_evaluated": 5, "tokens_predicted": 3},
+        {"tokens_evaluated": 7, "tokens_predicted": 1},
+        {"tokens_evaluated": 7, "tokens_predicted": 1},
+    ]
+    assert usage_from_choices(choices, n=2) == {"prompt_tokens": 12, "completion_tokens": 7, "total_tokens": 19}
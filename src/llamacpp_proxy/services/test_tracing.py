@@ -0,0 +1,62 @@
+import pytest
+from llamacpp_proxy.services.tracing import (
+    RequestTiming,
+    current_timing,
+    end_request,
+    phase,
+    start_request,
+)
+
+def test_phase_without_request_is_noop():
+    assert current_timing() is None
+    with phase("template") as span:
+        assert span is None
+
+def test_phases_are_recorded_in_server_timing():
+    timing, token = start_request("POST /v1/completions", {})
+    try:
+        with phase("auth"):
+            pass
+        with pytest.raises(ValueError):
+            with phase("upstream"):
+                raise ValueError("failed")
+    finally:
+        end_request(token)
+
+    assert current_timing() is None
+    assert [name for name, _, _ in timing.phases] == ["auth", "upstream"]
+    entries = [entry.split(";")[0] for entry in timing.server_timing().split(", ")]
+    assert entries == ["auth", "upstream", "total"]
+
+def test_record_llamacpp_timings():
+    timing = RequestTiming()
+    timing.record_llamacpp({"timings": {"prompt_ms": 12.5, "predicted_ms": 40, "prompt_n": 3}})
+    timing.record_llamacpp({"content": "no timings"})
+
+    assert timing.phases == [
+        ("llamacpp_prompt", 12.5, "llama.cpp prompt processing"),
+        ("llamacpp_predict", 40.0, "llama.cpp generation"),
+    ]
+    assert 'llamacpp_prompt;dur=12.500;desc="llama.cpp prompt processing"' in timing.server_timing()
+
+def test_trace_headers_are_forwarded_without_tracer():
+    headers = {
+        "traceparent": "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01",
+        "tracestate": "vendor=value",
+        "authorization": "Bearer secret",
+    }
+    timing, token = start_request("POST /v1/completions", headers)
+    end_request(token)
+    assert timing.span is None
+    assert timing.propagation_headers() == {
+        "traceparent": headers["traceparent"],
+        "tracestate": headers["tracestate"],
+    }
+
+@pytest.mark.asyncio
+async def test_connection_trace_records_connect_phase():
+    timing = RequestTiming()
+    trace = timing.connection_trace()
+    await trace("connection.connect_tcp.started", {})
+    await trace("http11.send_request_headers.started", {})
+    assert [name for name, _, _ in timing.phases] == ["connect"]
@@ -0,0 +1,158 @@
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+import httpx
+from fastapi import HTTPException, Request
+
+from llamacpp_proxy.config.tokenizer import TokenizerSettings
+from llamacpp_proxy.models.chat import Message
+from llamacpp_proxy.services.balancer import LoadBalancer
+
+logger = logging.getLogger(__name__)
+
+def context_length_error(prompt_tokens: int, max_tokens: Optional[int], n_ctx: int) -> HTTPException:
+    requested = prompt_tokens + (max_tokens or 0)
+    return HTTPException(
+        status_code=400,
+        detail={
+            "error": {
+                "message": (
+                    f"This model's maximum context length is {n_ctx} tokens. "
+                    f"However, you requested {requested} tokens "
+                    f"({prompt_tokens} in the prompt, {max_tokens or 0} for the completion)."
+                ),
+                "type": "invalid_request_error",
+                "code": "context_length_exceeded",
+            }
+        },
+    )
+
+def usage_from_choices(choices: List[Dict[str, Any]], n: int) -> Dict[str, int]:
+    """llama.cppのtokens_evaluated/tokens_predictedからusageを計算する
+
+    choicesはプロンプトごとにn個ずつ並んでいるため、プロンプトのトークン数は各プロンプトの先頭のchoiceから数える。
+    """
+    prompt_tokens = sum(choice.get("tokens_evaluated", 0) for choice in choices[::max(n, 1)])
+    completion_tokens = sum(choice.get("tokens_predicted", 0) for choice in choices)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+class TokenCounter:
+    """llama.cppの/tokenizeでテキストのトークン数を数える
+
+    結果はテキストのハッシュ値をキーとするLRUに保持するため、
+    繰り返し送られるシステムプロンプトや会話履歴は一度しかトークナイズしない。
+    """
+
+    def __init__(self, http_client: httpx.AsyncClient, load_balancer: LoadBalancer, settings: TokenizerSettings):
+        self.http_client = http_client
+        self.load_balancer = load_balancer
+        self.settings = settings
+        self._counts: "OrderedDict[bytes, int]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def context_size(self) -> int:
+        """確認に使うコンテキスト長（確認しない場合は0）"""
+        if not self.settings.context_check:
+            return 0
+        return self.load_balancer.context_size()
+
+    async def count(self, text: str) -> Optional[int]:
+        """トークン数を返す。トークナイズできなかった場合はNone"""
+        key = hashlib.blake2b(text.encode(), digest_size=16).digest()
+        count = self._counts.get(key)
+        if count is not None:
+            self._counts.move_to_end(key)
+            self.hits += 1
+            return count
+
+        self.misses += 1
+        backend = self.load_balancer.choose()
+        try:
+            response = await self.http_client.post(f"{backend.url}/tokenize", json={"content": text})
+            response.raise_for_status()
+            count = len(response.json()["tokens"])
+        except (httpx.HTTPError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Failed to tokenize with {backend.url}: {str(e)}")
+            return None
+
+        self._counts[key] = count
+        while len(self._counts) > self.settings.cache_size:
+            self._counts.popitem(last=False)
+        return count
+
+    async def count_many(self, texts: List[str]) -> Optional[List[int]]:
+        """テキストごとのトークン数を返す
+
+        同じテキストは1回だけ数え、上流への/tokenizeはmax_concurrency件ずつ並行に送る。
+        """
+        semaphore = asyncio.Semaphore(self.settings.max_concurrency)
+
+        async def count(text: str) -> Optional[int]:
+            async with semaphore:
+                return await self.count(text)
+
+        unique = list(dict.fromkeys(texts))
+        counts = dict(zip(unique, await asyncio.gather(*[count(text) for text in unique])))
+        if any(count is None for count in counts.values()):
+            return None
+        return [counts[text] for text in texts]
+
+    async def check_prompt(self, prompt: str, max_tokens: Optional[int]) -> None:
+        """プロンプトとmax_tokensがコンテキスト長に収まらなければ400を送出する"""
+        n_ctx = self.context_size()
+        if not n_ctx:
+            return
+        prompt_tokens = await self.count(prompt)
+        if prompt_tokens is not None and prompt_tokens + (max_tokens or 0) > n_ctx:
+            raise context_length_error(prompt_tokens, max_tokens, n_ctx)
+
+    async def fit_messages(self, messages: List[Message], max_tokens: Optional[int]) -> List[Message]:
+        """会話がコンテキスト長に収まるか確認する
+
+        メッセージごとにトークン数を数え、テンプレートによる増加分はメッセージあたりの見積もりで加算する。
+        trim_chat_historyが有効な場合は、システムメッセージと最後のメッセージを残して古い順に削除する。
+        """
+        n_ctx = self.context_size()
+        if not n_ctx:
+            return messages
+        counts = await self.count_many([message.content for message in messages])
+        if counts is None:
+            return messages
+
+        overhead = self.settings.message_overhead
+        budget = n_ctx - (max_tokens or 0)
+        total = sum(counts) + overhead * len(messages)
+        if total <= budget:
+            return messages
+        if not self.settings.trim_chat_history:
+            raise context_length_error(total, max_tokens, n_ctx)
+
+        keep = [True] * len(messages)
+        for i, message in enumerate(messages[:-1]):
+            if total <= budget:
+                break
+            if message.role == "system":
+                continue
+            keep[i] = False
+            total -= counts[i] + overhead
+        if total > budget:
+            raise context_length_error(total, max_tokens, n_ctx)
+        trimmed = [message for message, kept in zip(messages, keep) if kept]
+        logger.info(f"Trimmed {len(messages) - len(trimmed)} messages to fit the context window")
+        return trimmed
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self._counts), "hits": self.hits, "misses": self.misses}
+
+
+def get_token_counter(request: Request) -> TokenCounter:
+    """lifespanで生成されたTokenCounterを返す"""
+    return request.app.state.token_counter
@@ -0,0 +1,180 @@
+import logging
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import Any, Callable, ContextManager, Dict, Iterator, List, Optional, Tuple
+
+from llamacpp_proxy.config.tracing import TracingSettings
+
+logger = logging.getLogger(__name__)
+
+# バックエンドへ引き継ぐW3C Trace Contextのヘッダー
+TRACE_HEADERS = ("traceparent", "tracestate")
+
+# Server-Timingに含めるllama.cppのtimingsの項目（キー, 名前, 説明）
+LLAMACPP_TIMINGS = (
+    ("prompt_ms", "llamacpp_prompt", "llama.cpp prompt processing"),
+    ("predicted_ms", "llamacpp_predict", "llama.cpp generation"),
+)
+
+Phase = Tuple[str, float, Optional[str]]  # 名前, 時間（ミリ秒）, 説明
+
+_tracer = None
+_provider = None
+_exporter_file = None
+
+
+def configure_tracing(settings: TracingSettings) -> None:
+    """OpenTelemetryのスパンの出力を設定する（otel_exporterが空の場合は何もしない）"""
+    global _tracer, _provider, _exporter_file
+    if not settings.otel_exporter:
+        return
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+
+    if settings.otel_exporter == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        exporter = OTLPSpanExporter(endpoint=settings.otel_endpoint)
+    elif settings.otel_exporter == "file":
+        _exporter_file = open(settings.otel_file_path, "a", encoding="utf-8")
+        exporter = ConsoleSpanExporter(out=_exporter_file, formatter=lambda span: span.to_json(indent=None) + "\n")
+    else:
+        exporter = ConsoleSpanExporter()
+
+    _provider = TracerProvider(resource=Resource.create({"service.name": settings.service_name}))
+    _provider.add_span_processor(BatchSpanProcessor(exporter))
+    _tracer = _provider.get_tracer("llamacpp_proxy")
+    logger.info(f"Exporting OpenTelemetry spans to {settings.otel_exporter}")
+
+
+def shutdown_tracing() -> None:
+    """未送信のスパンを出力して終了する"""
+    global _tracer, _provider, _exporter_file
+    if _provider is not None:
+        _provider.shutdown()
+    if _exporter_file is not None:
+        _exporter_file.close()
+    _tracer = _provider = _exporter_file = None
+
+
+class RequestTiming:
+    """1リクエストの処理をフェーズごとに計測する
+
+    計測結果はServer-Timingヘッダーとして返し、OpenTelemetryが有効な場合は
+    リクエストのスパンの子スパンとしても出力する。
+    """
+
+    __slots__ = ("started", "phases", "span", "trace_headers")
+
+    def __init__(self, trace_headers: Optional[Dict[str, str]] = None, span: Any = None):
+        self.started = time.perf_counter()
+        self.phases: List[Phase] = []
+        self.span = span
+        self.trace_headers = trace_headers or {}
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[Any]:
+        """with内の処理時間をnameのフェーズとして記録する。OpenTelemetryが有効な場合は子スパンを返す"""
+        span = None
+        if self.span is not None:
+            from opentelemetry import trace
+            span = _tracer.start_span(name, context=trace.set_span_in_context(self.span))
+        started = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            if span is not None:
+                span.record_exception(e)
+            raise
+        finally:
+            self.phases.append((name, (time.perf_counter() - started) * 1000, None))
+            if span is not None:
+                span.end()
+
+    def add(self, name: str, duration_ms: float, description: Optional[str] = None) -> None:
+        """別の場所で計測された時間を記録する"""
+        self.phases.append((name, duration_ms, description))
+        if self.span is not None:
+            self.span.set_attribute(f"llamacpp_proxy.{name}_ms", duration_ms)
+
+    def record_llamacpp(self, result: Dict[str, Any]) -> None:
+        """llama.cppのレスポンス（またはストリームの最後のイベント）のtimingsを記録する"""
+        timings = result.get("timings")
+        if not isinstance(timings, dict):
+            return
+        for key, name, description in LLAMACPP_TIMINGS:
+            value = timings.get(key)
+            if isinstance(value, (int, float)):
+                self.add(name, float(value), description)
+
+    def connection_trace(self) -> Callable[[str, Dict[str, Any]], Any]:
+        """上流へのリクエストを送り始めるまで（接続の取得を含む）の時間を記録するhttpxのtrace拡張"""
+        started = time.perf_counter()
+
+        async def trace(event: str, info: Dict[str, Any]) -> None:
+            if event.endswith("send_request_headers.started"):
+                self.add("connect", (time.perf_counter() - started) * 1000)
+
+        return trace
+
+    def propagation_headers(self, span: Any = None) -> Dict[str, str]:
+        """上流へのリクエストに付けるtraceparent/tracestateヘッダー
+
+        スパンがある場合はそのスパンを親とし、ない場合は受け取ったヘッダーをそのまま引き継ぐ。
+        """
+        if span is None:
+            return self.trace_headers
+        from opentelemetry import propagate, trace
+        carrier: Dict[str, str] = {}
+        propagate.inject(carrier, context=trace.set_span_in_context(span))
+        return carrier
+
+    def server_timing(self) -> str:
+        now = time.perf_counter()
+        entries = [_server_timing_entry(*phase) for phase in self.phases]
+        entries.append(_server_timing_entry("total", (now - self.started) * 1000))
+        return ", ".join(entries)
+
+    def finish(self, status: int) -> None:
+        if self.span is not None:
+            self.span.set_attribute("http.response.status_code", status)
+            if status >= 500:
+                from opentelemetry.trace import Status, StatusCode
+                self.span.set_status(Status(StatusCode.ERROR))
+            self.span.end()
+
+
+def _server_timing_entry(name: str, duration_ms: float, description: Optional[str] = None) -> str:
+    entry = f"{name};dur={duration_ms:.3f}"
+    if description:
+        entry += f';desc="{description}"'
+    return entry
+
+
+_current: ContextVar[Optional[RequestTiming]] = ContextVar("request_timing", default=None)
+
+
+def start_request(name: str, headers: Dict[str, str]) -> Tuple[RequestTiming, Any]:
+    """リクエストの計測を開始し、(計測, contextvarのトークン)を返す"""
+    trace_headers = {key: headers[key] for key in TRACE_HEADERS if key in headers}
+    span = None
+    if _tracer is not None:
+        from opentelemetry import propagate
+        span = _tracer.start_span(name, context=propagate.extract(trace_headers))
+    timing = RequestTiming(trace_headers, span)
+    return timing, _current.set(timing)
+
+
+def end_request(token: Any) -> None:
+    _current.reset(token)
+
+
+def current_timing() -> Optional[RequestTiming]:
+    return _current.get()
+
+
+def phase(name: str) -> ContextManager[Any]:
+    """計測中のリクエストがあればフェーズとして記録する"""
+    timing = _current.get()
+    return timing.phase(name) if timing is not None else nullcontext()